@@ -1,61 +1,362 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
+import argparse
+import bisect
+import collections
+import mmap
+import os
 import socket
 import struct
 import sys
 
-def readRecord(fp, withTimestamp):
-
-    if withTimestamp:
-        data = fp.read(12)
-        if not data:
-            return False
-        tv_sec, tv_nsec = struct.unpack("QI", data)
-
-    data = fp.read(2)
-    if not data:
-        return False
-
-    queryID = struct.unpack("!H", data)[0]
-    qname = ''
-    while True:
-        labelLen = struct.unpack("B", fp.read(1))[0]
-        if labelLen == 0:
-            break
-        label = fp.read(labelLen)
-        if qname != '':
-            qname = qname + '.'
-        qname = qname + label.decode()
-
-    qtype = struct.unpack("H", fp.read(2))[0]
-    addrType = struct.unpack("H", fp.read(2))[0]
-    addr = None
-    if addrType == socket.AF_INET:
-        addr = socket.inet_ntop(socket.AF_INET, fp.read(4))
-    elif addrType == socket.AF_INET6:
-        addr = socket.inet_ntop(socket.AF_INET6, fp.read(16))
-    else:
-        print('Unsupported address type %d, skipping this record' % (int(addrType)))
-        return False
-    port = struct.unpack("!H", fp.read(2))[0]
-
-    if withTimestamp:
-        print('[%u.%u] Packet from %s:%d for %s %s with id %d' % (tv_sec, tv_nsec, addr, port, qname, qtype, queryID))
-    else:
-        print('Packet from %s:%d for %s %s with id %d' % (addr, port, qname, qtype, queryID))
-
-    return True
+LogRecord = collections.namedtuple('LogRecord', ['offset', 'tv_sec', 'tv_nsec', 'queryID', 'qname', 'qtype', 'addr', 'port'])
 
-def readLogFile(filename, withTimestamps):
-    with open(filename, mode='rb') as fp:
-        while True:
-            if not readRecord(fp, withTimestamps):
+class LogActionReader(object):
+    """
+    Reads the records written by LogAction(binary=true) from a memory-mapped file.
+
+    Record layout, as written by dnsdist:
+    - if timestamps are included: tv_sec (uint64), tv_nsec (uint32), native byte order
+    - query ID (uint16), as found in the DNS header (network byte order)
+    - qname, in wire format
+    - qtype (uint16), address family (uint16), native byte order
+    - address (4 or 16 bytes), port (uint16, network byte order)
+    """
+
+    _timestamp = struct.Struct('=QI')
+    _queryID = struct.Struct('!H')
+    _qtypeFamily = struct.Struct('=HH')
+    _port = struct.Struct('!H')
+    _indexHeader = struct.Struct('=8sQ')
+    _indexEntry = struct.Struct('=QQ')
+    _indexMagic = b'DDLAIDX1'
+
+    def __init__(self, filename, withTimestamps):
+        self._filename = filename
+        self._withTimestamps = withTimestamps
+        self._fp = open(filename, mode='rb')
+        self._size = os.fstat(self._fp.fileno()).st_size
+        self._mm = None
+        if self._size > 0:
+            self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(self._mm, 'madvise'):
+                self._mm.madvise(mmap.MADV_SEQUENTIAL)
+        self._index = None
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def readRecord(self, pos):
+        """
+        Parses the record starting at `pos`, returning a (LogRecord, next position)
+        tuple, or (None, pos) if there is no complete record at that position.
+        """
+        buf = self._mm
+        start = pos
+        try:
+            tv_sec = tv_nsec = None
+            if self._withTimestamps:
+                tv_sec, tv_nsec = self._timestamp.unpack_from(buf, pos)
+                pos += 12
+
+            (queryID,) = self._queryID.unpack_from(buf, pos)
+            pos += 2
+
+            labels = []
+            labelLen = buf[pos]
+            pos += 1
+            while labelLen != 0:
+                labels.append(buf[pos:pos + labelLen])
+                pos += labelLen
+                labelLen = buf[pos]
+                pos += 1
+            qname = b'.'.join(labels).decode('utf-8', 'backslashreplace')
+
+            qtype, addrType = self._qtypeFamily.unpack_from(buf, pos)
+            pos += 4
+            if addrType == socket.AF_INET:
+                addrLen = 4
+            elif addrType == socket.AF_INET6:
+                addrLen = 16
+            else:
+                sys.stderr.write('Unsupported address type %d at offset %d, stopping\n' % (int(addrType), start))
+                return None, start
+            if pos + addrLen > self._size:
+                return None, start
+            addr = socket.inet_ntop(addrType, buf[pos:pos + addrLen])
+            pos += addrLen
+            (port,) = self._port.unpack_from(buf, pos)
+            pos += 2
+        except (IndexError, struct.error):
+            # truncated record, most likely still being written
+            return None, start
+
+        return LogRecord(start, tv_sec, tv_nsec, queryID, qname, qtype, addr, port), pos
+
+    def records(self, offset=0):
+        """
+        Generator yielding every record starting at `offset`.
+        """
+        if self._mm is None:
+            return
+        pos = offset
+        while pos < self._size:
+            record, pos = self.readRecord(pos)
+            if record is None:
+                break
+            yield record
+
+    def buildIndex(self, every=10000):
+        """
+        Scans the whole file and records, every `every` records, the offset of the
+        next record and the highest timestamp seen so far. Since dnsdist might log
+        queries slightly out of order, using the running maximum guarantees that
+        no record with a timestamp at or after a given time is located before the
+        corresponding offset.
+        """
+        if not self._withTimestamps:
+            raise ValueError('An index can only be built for logs including timestamps')
+        index = [(0, 0)]
+        maxSec = 0
+        count = 0
+        pos = 0
+        while pos < self._size:
+            record, pos = self.readRecord(pos)
+            if record is None:
                 break
+            if record.tv_sec > maxSec:
+                maxSec = record.tv_sec
+            count += 1
+            if count % every == 0:
+                index.append((maxSec, pos))
+        self._index = index
+        return index
+
+    def saveIndex(self, filename):
+        with open(filename, 'wb') as fp:
+            fp.write(self._indexHeader.pack(self._indexMagic, len(self._index)))
+            fp.write(b''.join([self._indexEntry.pack(maxSec, offset) for maxSec, offset in self._index]))
+
+    def loadIndex(self, filename):
+        with open(filename, 'rb') as fp:
+            data = fp.read()
+        magic, count = self._indexHeader.unpack_from(data, 0)
+        if magic != self._indexMagic:
+            raise ValueError('%s is not a valid index file' % (filename))
+        self._index = list(self._indexEntry.iter_unpack(data[self._indexHeader.size:self._indexHeader.size + count * self._indexEntry.size]))
+        return self._index
+
+    def findOffset(self, startTime):
+        """
+        Returns an offset before which no record has a timestamp >= `startTime`.
+        Without an index, this is the beginning of the file.
+        """
+        if not self._index:
+            return 0
+        maxSecs = [entry[0] for entry in self._index]
+        pos = bisect.bisect_left(maxSecs, startTime) - 1
+        if pos < 0:
+            return 0
+        return self._index[pos][1]
+
+    def recordsInRange(self, startTime=None, endTime=None, every=10000):
+        """
+        Generator yielding the records whose tv_sec is in [startTime, endTime].
+        Uses the index, if any, to skip to the first relevant part of the file.
+        Since records might be slightly out of order, a single record after
+        endTime does not mean that the following ones are too: the file is read
+        by blocks of `every` records, and the scan stops once every record of a
+        block is after endTime.
+        """
+        if not self._withTimestamps:
+            raise ValueError('Filtering on time requires a log including timestamps')
+        offset = self.findOffset(startTime) if startTime is not None else 0
+        blockMin = None
+        count = 0
+        for record in self.records(offset):
+            if blockMin is None or record.tv_sec < blockMin:
+                blockMin = record.tv_sec
+            count += 1
+            if (startTime is None or record.tv_sec >= startTime) and (endTime is None or record.tv_sec <= endTime):
+                yield record
+            if endTime is not None and count % every == 0:
+                if blockMin > endTime:
+                    break
+                blockMin = None
+
+class SpaceSaving(object):
+    """
+    Bounded-memory approximate counter of the most frequent keys. Up to
+    2 * `capacity` keys are tracked; when that limit is reached only the
+    `capacity` most frequent ones are kept, and keys seen afterwards start
+    at the highest evicted count, so counts are never under-estimated.
+    The possible over-estimation of each key is reported as its error.
+    """
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._counts = {}
+        self._errors = {}
+        self._floor = 0
+        self.total = 0
+
+    def add(self, key):
+        self.total += 1
+        counts = self._counts
+        if key in counts:
+            counts[key] += 1
+            return
+        if self._floor:
+            self._errors[key] = self._floor
+        counts[key] = self._floor + 1
+        if len(counts) >= 2 * self._capacity:
+            self._prune()
+
+    def _prune(self):
+        ranked = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)
+        kept = ranked[:self._capacity]
+        self._floor = max(self._floor, ranked[self._capacity][1])
+        self._counts = dict(kept)
+        self._errors = {key: self._errors[key] for key, _ in kept if key in self._errors}
+
+    def top(self, count):
+        """
+        Returns the `count` most frequent keys as a list of (key, count, error) tuples.
+        """
+        ranked = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)[:count]
+        return [(key, value, self._errors.get(key, 0)) for key, value in ranked]
+
+class LogAggregator(object):
+    """
+    Computes, in one streaming pass, the top qnames and clients (approximate,
+    bounded memory, see SpaceSaving), the exact qtype distribution and, for logs
+    including timestamps, the number of queries per second.
+    """
+
+    def __init__(self, capacity=10000, labels=None):
+        self._labels = labels
+        self.qnames = SpaceSaving(capacity)
+        self.clients = SpaceSaving(capacity)
+        self.qtypes = collections.Counter()
+        self.perSecond = collections.Counter()
+        self.total = 0
+
+    def add(self, record):
+        self.total += 1
+        qname = record.qname
+        if self._labels is not None:
+            qname = '.'.join(qname.split('.')[-self._labels:]) if self._labels > 0 else ''
+        self.qnames.add(qname)
+        self.clients.add(record.addr)
+        self.qtypes[record.qtype] += 1
+        if record.tv_sec is not None:
+            self.perSecond[record.tv_sec] += 1
+
+    def consume(self, records):
+        for record in records:
+            self.add(record)
+        return self
+
+    def report(self, top, out=sys.stdout):
+        total = self.total
+        fmt = '%4d  %-40s %4d %4.1f%%%s\n'
+
+        def printTop(title, counter):
+            out.write('%s:\n' % (title))
+            entries = counter.top(top)
+            shown = 0
+            for idx, (key, value, error) in enumerate(entries):
+                out.write(fmt % (idx + 1, key if key else '.', value, 100.0 * value / total, ' (+/- %d)' % (error) if error else ''))
+                shown += value
+            rest = max(total - shown, 0)
+            out.write(fmt % (len(entries) + 1, 'Rest', rest, 100.0 * rest / total, ''))
+
+        out.write('%d queries\n' % (total))
+        if total == 0:
+            return
+        printTop('Top qnames', self.qnames)
+        printTop('Top clients', self.clients)
+
+        out.write('QTypes:\n')
+        for qtype, value in self.qtypes.most_common():
+            out.write('%6d  %10d %5.1f%%\n' % (qtype, value, 100.0 * value / total))
+
+        if self.perSecond:
+            first = min(self.perSecond)
+            last = max(self.perSecond)
+            duration = last - first + 1
+            out.write('Queries per second: average %.1f, max %d over %d seconds\n' % (float(total) / duration,
+                                                                                       max(self.perSecond.values()),
+                                                                                       duration))
+            out.write('Busiest seconds:\n')
+            for second, value in self.perSecond.most_common(top):
+                out.write('%12d  %10d\n' % (second, value))
+
+def printRecords(records, withTimestamps):
+    out = sys.stdout
+    for record in records:
+        if withTimestamps:
+            out.write('[%u.%u] Packet from %s:%d for %s %s with id %d\n' % (record.tv_sec, record.tv_nsec, record.addr, record.port, record.qname, record.qtype, record.queryID))
+        else:
+            out.write('Packet from %s:%d for %s %s with id %d\n' % (record.addr, record.port, record.qname, record.qtype, record.queryID))
+
+def readLogFile(filename, withTimestamps):
+    with LogActionReader(filename, withTimestamps) as reader:
+        printRecords(reader.records(), withTimestamps)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2 and (len(sys.argv) != 3 or sys.argv[2] != 'with-timestamps'):
-        sys.exit('Usage: %s <path to log file> [with-timestamps]' % (sys.argv[0]))
+    parser = argparse.ArgumentParser(description='Read the binary files written by dnsdist\'s LogAction.')
+    parser.add_argument('filename', help='path to the log file')
+    parser.add_argument('timestamps', nargs='?', choices=['with-timestamps'],
+                        help='the log has been written with includeTimestamp=true')
+    parser.add_argument('--from', dest='start', type=int, default=None,
+                        help='only display records received at or after this time (seconds since epoch, requires with-timestamps)')
+    parser.add_argument('--to', dest='end', type=int, default=None,
+                        help='only display records received at or before this time (seconds since epoch, requires with-timestamps)')
+    parser.add_argument('--index', default=None,
+                        help='offset index file used to skip directly to --from. Built when it does not exist yet')
+    parser.add_argument('--index-every', type=int, default=10000,
+                        help='number of records between two index entries (default 10000)')
+    parser.add_argument('--top', type=int, default=None,
+                        help='instead of displaying every record, display the N most frequent qnames and clients, the qtype distribution and the per-second query rates')
+    parser.add_argument('--labels', type=int, default=None,
+                        help='with --top, only consider the last N labels of the qnames, like topQueries(top, labels) does')
+    parser.add_argument('--capacity', type=int, default=10000,
+                        help='with --top, number of distinct qnames and clients tracked (default 10000). Higher values mean more accurate counts and more memory')
+    args = parser.parse_args()
+
+    withTimestamps = args.timestamps is not None
+    if (args.start is not None or args.end is not None or args.index) and not withTimestamps:
+        sys.exit('--from, --to and --index require with-timestamps')
+
+    with LogActionReader(args.filename, withTimestamps) as reader:
+        if args.index:
+            if os.path.exists(args.index):
+                reader.loadIndex(args.index)
+            else:
+                reader.buildIndex(args.index_every)
+                reader.saveIndex(args.index)
+
+        if args.start is not None or args.end is not None:
+            records = reader.recordsInRange(args.start, args.end)
+        else:
+            records = reader.records()
 
-    readLogFile(sys.argv[1], len(sys.argv) == 3)
+        if args.top is not None:
+            LogAggregator(max(args.capacity, args.top), args.labels).consume(records).report(args.top)
+        else:
+            printRecords(records, withTimestamps)
 
     sys.exit(0)
@@ -1,31 +1,31 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
+import argparse
+import asyncio
 import binascii
 import datetime
+import json
 import socket
 import struct
 import sys
-import threading
+import time
 
 # run: protoc -I=../pdns/ --python_out=. ../pdns/dnsmessage.proto
 # to generate dnsmessage_pb2
 import dnsmessage_pb2
 
-class PDNSPBConnHandler(object):
+class PDNSPBTextOutput(object):
+    """
+    Human-readable output, one summary line per message followed by
+    the question and, for responses, the records.
+    """
+    needsDecoding = True
 
-    def __init__(self, conn):
-        self._conn = conn
+    def __init__(self, out):
+        self._out = out
 
-    def run(self):
-        while True:
-            data = self._conn.recv(2)
-            if not data:
-                break
-            (datalen,) = struct.unpack("!H", data)
-            data = self._conn.recv(datalen)
-
-            msg = dnsmessage_pb2.PBDNSMessage()
-            msg.ParseFromString(data)
+    def write(self, messages):
+        for msg in messages:
             if msg.type == dnsmessage_pb2.PBDNSMessage.DNSQueryType:
                 self.printQueryMessage(msg)
             elif msg.type == dnsmessage_pb2.PBDNSMessage.DNSResponseType:
@@ -35,9 +35,14 @@ class PDNSPBConnHandler(object):
             elif msg.type == dnsmessage_pb2.PBDNSMessage.DNSIncomingResponseType:
                 self.printIncomingResponseMessage(msg)
             else:
-                print('Discarding unsupported message type %d' % (msg.type))
+                self.print('Discarding unsupported message type %d' % (msg.type))
+        self._out.flush()
+
+    def close(self):
+        self._out.flush()
 
-        self._conn.close()
+    def print(self, line):
+        self._out.write(line + '\n')
 
     def printQueryMessage(self, message):
         self.printSummary(message, 'Query')
@@ -62,9 +67,9 @@ class PDNSPBConnHandler(object):
             qclass = 1
             if message.question.HasField('qClass'):
                 qclass = message.question.qClass
-            print("- Question: %d, %d, %s" % (qclass,
-                                              message.question.qType,
-                                              message.question.qName))
+            self.print("- Question: %d, %d, %s" % (qclass,
+                                                   message.question.qType,
+                                                   message.question.qName))
 
     @staticmethod
     def getAppliedPolicyTypeAsString(polType):
@@ -89,7 +94,7 @@ class PDNSPBConnHandler(object):
                 datestr = datetime.datetime.fromtimestamp(response.queryTimeSec).strftime('%Y-%m-%d %H:%M:%S')
                 if response.HasField('queryTimeUsec'):
                     datestr = datestr + '.' + str(response.queryTimeUsec)
-                print("- Query time: %s" % (datestr))
+                self.print("- Query time: %s" % (datestr))
 
             policystr = ''
             if response.HasField('appliedPolicy') and response.appliedPolicy:
@@ -103,54 +108,35 @@ class PDNSPBConnHandler(object):
 
             rrscount = len(response.rrs)
 
-            print("- Response Code: %d, RRs: %d%s%s" % (response.rcode,
-                                                      rrscount,
-                                                      policystr,
-                                                      tagsstr))
+            self.print("- Response Code: %d, RRs: %d%s%s" % (response.rcode,
+                                                           rrscount,
+                                                           policystr,
+                                                           tagsstr))
 
             for rr in response.rrs:
-                rrclass = 1
-                rdatastr = ''
-                rrudr = 0
-                if rr.HasField('class'):
-                    rrclass = getattr(rr, 'class')
-                rrtype = rr.type
-                if rr.HasField('udr'):
-                    rrudr = rr.udr
-                if (rrclass == 1 or rrclass == 255) and rr.HasField('rdata'):
-                    if rrtype == 1:
-                        rdatastr = socket.inet_ntop(socket.AF_INET, rr.rdata)
-                    elif rrtype == 5:
-                        rdatastr = rr.rdata
-                    elif rrtype == 28:
-                        rdatastr = socket.inet_ntop(socket.AF_INET6, rr.rdata)
-
-                print("\t - %d, %d, %s, %d, %s, %d" % (rrclass,
-                                                   rrtype,
-                                                   rr.name,
-                                                   rr.ttl,
-                                                   rdatastr,
-                                                   rrudr))
+                rrclass, rrtype, rdatastr, rrudr = getRRDetails(rr)
+                self.print("\t - %d, %d, %s, %d, %s, %d" % (rrclass,
+                                                        rrtype,
+                                                        rr.name,
+                                                        rr.ttl,
+                                                        rdatastr,
+                                                        rrudr))
 
     def printSummary(self, msg, typestr):
         datestr = datetime.datetime.fromtimestamp(msg.timeSec).strftime('%Y-%m-%d %H:%M:%S')
         if msg.HasField('timeUsec'):
             datestr = datestr + '.' + str(msg.timeUsec)
-        ipfromstr = 'N/A'
-        iptostr = 'N/A'
+        ipfromstr, iptostr = getAddresses(msg)
+        if ipfromstr is None:
+            ipfromstr = 'N/A'
+        elif msg.socketFamily != dnsmessage_pb2.PBDNSMessage.INET:
+            ipfromstr = '[' + ipfromstr + ']'
+        if iptostr is None:
+            iptostr = 'N/A'
+        elif msg.socketFamily != dnsmessage_pb2.PBDNSMessage.INET:
+            iptostr = '[' + iptostr + ']'
         toportstr = ''
         fromportstr = ''
-        fromvalue = getattr(msg, 'from')
-        if msg.socketFamily == dnsmessage_pb2.PBDNSMessage.INET:
-            if msg.HasField('from'):
-                ipfromstr = socket.inet_ntop(socket.AF_INET, fromvalue)
-            if msg.HasField('to'):
-                iptostr = socket.inet_ntop(socket.AF_INET, msg.to)
-        else:
-            if msg.HasField('from'):
-                ipfromstr = '[' + socket.inet_ntop(socket.AF_INET6, fromvalue) + ']'
-            if msg.HasField('to'):
-                iptostr = '[' + socket.inet_ntop(socket.AF_INET6, msg.to) + ']'
 
         if msg.socketProtocol == dnsmessage_pb2.PBDNSMessage.UDP:
             protostr = 'UDP'
@@ -163,59 +149,439 @@ class PDNSPBConnHandler(object):
         if msg.HasField('toPort'):
             toportstr = ':' + str(msg.toPort) + ' '
 
-        messageidstr = binascii.hexlify(bytearray(msg.messageId))
+        messageidstr = binascii.hexlify(bytearray(msg.messageId)).decode()
 
         serveridstr = 'N/A'
         if msg.HasField('serverIdentity'):
-            serveridstr = msg.serverIdentity
+            serveridstr = msg.serverIdentity.decode(errors='replace')
 
         initialrequestidstr = ''
         if msg.HasField('initialRequestId'):
-            initialrequestidstr = ', initial uuid: %s ' % (binascii.hexlify(bytearray(msg.initialRequestId)))
+            initialrequestidstr = ', initial uuid: %s ' % (binascii.hexlify(bytearray(msg.initialRequestId)).decode())
 
         requestorstr = ''
-        requestor = self.getRequestorSubnet(msg)
+        requestor = getRequestorSubnet(msg)
         if requestor:
             requestorstr = ' (' + requestor + ')'
 
-        deviceId = binascii.hexlify(bytearray(msg.deviceId))
+        deviceId = binascii.hexlify(bytearray(msg.deviceId)).decode()
         requestorId = msg.requestorId
         nod = 0
         if (msg.HasField('newlyObservedDomain')):
             nod = msg.newlyObservedDomain
 
-        print('[%s] %s of size %d: %s%s%s -> %s%s (%s), id: %d, uuid: %s%s '
-                  'requestorid: %s deviceid: %s serverid: %s nod: %d' % (datestr,
-                                                    typestr,
-                                                    msg.inBytes,
-                                                    ipfromstr,
-                                                    fromportstr,
-                                                    requestorstr,
-                                                    iptostr,
-                                                    toportstr,
-                                                    protostr,
-                                                    msg.id,
-                                                    messageidstr,
-                                                    initialrequestidstr,
-                                                    requestorId,
-                                                    deviceId,
-                                                    serveridstr,
-                                                    nod))
-
-    def getRequestorSubnet(self, msg):
-        requestorstr = None
-        if msg.HasField('originalRequestorSubnet'):
-            if len(msg.originalRequestorSubnet) == 4:
-                requestorstr = socket.inet_ntop(socket.AF_INET,
-                                                msg.originalRequestorSubnet)
-            elif len(msg.originalRequestorSubnet) == 16:
-                requestorstr = socket.inet_ntop(socket.AF_INET6,
-                                                msg.originalRequestorSubnet)
-        return requestorstr
+        self.print('[%s] %s of size %d: %s%s%s -> %s%s (%s), id: %d, uuid: %s%s '
+                   'requestorid: %s deviceid: %s serverid: %s nod: %d' % (datestr,
+                                                     typestr,
+                                                     msg.inBytes,
+                                                     ipfromstr,
+                                                     fromportstr,
+                                                     requestorstr,
+                                                     iptostr,
+                                                     toportstr,
+                                                     protostr,
+                                                     msg.id,
+                                                     messageidstr,
+                                                     initialrequestidstr,
+                                                     requestorId,
+                                                     deviceId,
+                                                     serveridstr,
+                                                     nod))
+
+class PDNSPBJSONOutput(object):
+    """
+    Newline-delimited JSON output, one object per message. Each batch
+    is serialized into a single write.
+    """
+    needsDecoding = True
+
+    _typeNames = {
+        dnsmessage_pb2.PBDNSMessage.DNSQueryType: 'query',
+        dnsmessage_pb2.PBDNSMessage.DNSResponseType: 'response',
+        dnsmessage_pb2.PBDNSMessage.DNSOutgoingQueryType: 'outgoing-query',
+        dnsmessage_pb2.PBDNSMessage.DNSIncomingResponseType: 'incoming-response',
+    }
+
+    def __init__(self, out):
+        self._out = out
+        self._encoder = json.JSONEncoder(separators=(',', ':'))
+
+    def write(self, messages):
+        encode = self._encoder.encode
+        self._out.write(''.join([encode(self.messageToDict(msg)) + '\n' for msg in messages]))
+        self._out.flush()
+
+    def close(self):
+        self._out.flush()
+
+    def messageToDict(self, msg):
+        ipfrom, ipto = getAddresses(msg)
+        entry = {
+            'type': self._typeNames.get(msg.type, msg.type),
+            'time': msg.timeSec + msg.timeUsec / 1000000.0,
+            'id': msg.id,
+            'uuid': binascii.hexlify(msg.messageId).decode(),
+            'protocol': 'UDP' if msg.socketProtocol == dnsmessage_pb2.PBDNSMessage.UDP else 'TCP',
+            'from': ipfrom,
+            'to': ipto,
+            'inBytes': msg.inBytes,
+        }
+        if msg.HasField('fromPort'):
+            entry['fromPort'] = msg.fromPort
+        if msg.HasField('toPort'):
+            entry['toPort'] = msg.toPort
+        if msg.HasField('serverIdentity'):
+            entry['serverIdentity'] = msg.serverIdentity.decode(errors='replace')
+        if msg.HasField('initialRequestId'):
+            entry['initialUuid'] = binascii.hexlify(msg.initialRequestId).decode()
+        requestor = getRequestorSubnet(msg)
+        if requestor:
+            entry['requestorSubnet'] = requestor
+        if msg.HasField('requestorId'):
+            entry['requestorId'] = msg.requestorId
+        if msg.HasField('deviceId'):
+            entry['deviceId'] = binascii.hexlify(msg.deviceId).decode()
+        if msg.HasField('deviceName'):
+            entry['deviceName'] = msg.deviceName
+        if msg.HasField('newlyObservedDomain'):
+            entry['nod'] = msg.newlyObservedDomain
+
+        if msg.HasField('question'):
+            entry['qname'] = msg.question.qName
+            entry['qtype'] = msg.question.qType
+            entry['qclass'] = msg.question.qClass if msg.question.HasField('qClass') else 1
+
+        if msg.HasField('response'):
+            response = msg.response
+            entry['rcode'] = response.rcode
+            if response.HasField('queryTimeSec'):
+                entry['queryTime'] = response.queryTimeSec + response.queryTimeUsec / 1000000.0
+            if response.HasField('appliedPolicy') and response.appliedPolicy:
+                entry['appliedPolicy'] = response.appliedPolicy
+                if response.HasField('appliedPolicyType'):
+                    entry['appliedPolicyType'] = PDNSPBTextOutput.getAppliedPolicyTypeAsString(response.appliedPolicyType)
+            if response.tags:
+                entry['tags'] = list(response.tags)
+            rrs = []
+            for rr in response.rrs:
+                rrclass, rrtype, rdatastr, rrudr = getRRDetails(rr)
+                rrs.append({'name': rr.name, 'type': rrtype, 'class': rrclass, 'ttl': rr.ttl, 'rdata': rdatastr, 'udr': rrudr})
+            entry['rrs'] = rrs
+
+        return entry
+
+class PDNSPBBinaryOutput(object):
+    """
+    Compact binary output: the received frames (16-bit length in network
+    byte order followed by the PBDNSMessage) are written as-is, without
+    being decoded. The resulting file can be read back with the same
+    framing used on the wire.
+    """
+    needsDecoding = False
+
+    def __init__(self, out):
+        self._out = out
+
+    def write(self, frames):
+        self._out.write(b''.join([struct.pack('!H', len(frame)) + frame for frame in frames]))
+
+    def close(self):
+        self._out.flush()
+
+class PDNSPBColumnarOutput(object):
+    """
+    Columnar output: the main fields of each message are accumulated
+    column by column, and every `batchSize` messages, or at least every
+    `flushSeconds` seconds, the batch is appended to the current Parquet
+    (or Arrow IPC) file as one record batch. A new file is started every
+    `rotateRows` messages or `rotateSeconds` seconds, whichever comes first.
+    tick() should be called periodically so that batches are written and
+    files rotated even when no messages are received.
+    Requires pyarrow.
+    """
+    needsDecoding = True
+
+    _columns = ['type', 'time', 'id', 'protocol', 'from', 'fromPort', 'to', 'toPort',
+                'inBytes', 'qname', 'qtype', 'qclass', 'rcode', 'latencyUsec',
+                'appliedPolicy', 'appliedPolicyType', 'tags', 'serverIdentity']
+
+    def __init__(self, prefix, outputFormat='parquet', batchSize=65536, rotateRows=0, rotateSeconds=3600, flushSeconds=10):
+        try:
+            import pyarrow
+            if outputFormat == 'parquet':
+                import pyarrow.parquet
+        except ImportError:
+            sys.stderr.write("The %s output format requires pyarrow\n" % (outputFormat))
+            sys.exit(1)
+
+        self._pa = pyarrow
+        self._schema = pyarrow.schema([
+            ('type', pyarrow.uint8()),
+            ('time', pyarrow.timestamp('us', tz='UTC')),
+            ('id', pyarrow.uint16()),
+            ('protocol', pyarrow.string()),
+            ('from', pyarrow.string()),
+            ('fromPort', pyarrow.uint16()),
+            ('to', pyarrow.string()),
+            ('toPort', pyarrow.uint16()),
+            ('inBytes', pyarrow.uint32()),
+            ('qname', pyarrow.string()),
+            ('qtype', pyarrow.uint16()),
+            ('qclass', pyarrow.uint16()),
+            ('rcode', pyarrow.uint32()),
+            ('latencyUsec', pyarrow.int64()),
+            ('appliedPolicy', pyarrow.string()),
+            ('appliedPolicyType', pyarrow.uint8()),
+            ('tags', pyarrow.list_(pyarrow.string())),
+            ('serverIdentity', pyarrow.string()),
+        ])
+        self._prefix = prefix if prefix and prefix != '-' else 'pdns-protobuf'
+        self._format = outputFormat
+        self._batchSize = batchSize
+        self._rotateRows = rotateRows
+        self._rotateSeconds = rotateSeconds
+        self._flushSeconds = flushSeconds
+        self._writer = None
+        self._sink = None
+        self._fileRows = 0
+        self._fileOpened = 0
+        self._fileSeq = 0
+        self._resetBatch()
+
+    def _resetBatch(self):
+        self._batch = {name: [] for name in self._columns}
+        self._batchRows = 0
+        self._batchStarted = time.time()
+
+    def write(self, messages):
+        cols = self._batch
+        for msg in messages:
+            ipfrom, ipto = getAddresses(msg)
+            cols['type'].append(msg.type)
+            cols['time'].append(msg.timeSec * 1000000 + msg.timeUsec)
+            cols['id'].append(msg.id)
+            cols['protocol'].append('UDP' if msg.socketProtocol == dnsmessage_pb2.PBDNSMessage.UDP else 'TCP')
+            cols['from'].append(ipfrom)
+            cols['fromPort'].append(msg.fromPort if msg.HasField('fromPort') else None)
+            cols['to'].append(ipto)
+            cols['toPort'].append(msg.toPort if msg.HasField('toPort') else None)
+            cols['inBytes'].append(msg.inBytes)
+            cols['serverIdentity'].append(msg.serverIdentity.decode(errors='replace') if msg.HasField('serverIdentity') else None)
+
+            if msg.HasField('question'):
+                cols['qname'].append(msg.question.qName)
+                cols['qtype'].append(msg.question.qType)
+                cols['qclass'].append(msg.question.qClass if msg.question.HasField('qClass') else 1)
+            else:
+                cols['qname'].append(None)
+                cols['qtype'].append(None)
+                cols['qclass'].append(None)
+
+            if msg.HasField('response'):
+                response = msg.response
+                cols['rcode'].append(response.rcode)
+                if response.HasField('queryTimeSec'):
+                    cols['latencyUsec'].append((msg.timeSec - response.queryTimeSec) * 1000000 + msg.timeUsec - response.queryTimeUsec)
+                else:
+                    cols['latencyUsec'].append(None)
+                if response.HasField('appliedPolicy') and response.appliedPolicy:
+                    cols['appliedPolicy'].append(response.appliedPolicy)
+                    cols['appliedPolicyType'].append(response.appliedPolicyType if response.HasField('appliedPolicyType') else None)
+                else:
+                    cols['appliedPolicy'].append(None)
+                    cols['appliedPolicyType'].append(None)
+                cols['tags'].append(list(response.tags))
+            else:
+                cols['rcode'].append(None)
+                cols['latencyUsec'].append(None)
+                cols['appliedPolicy'].append(None)
+                cols['appliedPolicyType'].append(None)
+                cols['tags'].append(None)
+
+        self._batchRows += len(messages)
+        if self._batchRows >= self._batchSize:
+            self.flush()
+        else:
+            self.tick()
+
+    def tick(self):
+        now = time.time()
+        if self._batchRows > 0 and self._flushSeconds and now - self._batchStarted >= self._flushSeconds:
+            self.flush()
+        elif self._writer and self._rotateSeconds and now - self._fileOpened >= self._rotateSeconds:
+            # nothing to write, but the current file is complete
+            self._closeFile()
+
+    def flush(self):
+        if self._batchRows == 0:
+            return
+
+        now = time.time()
+        if self._writer and ((self._rotateRows and self._fileRows >= self._rotateRows) or
+                             (self._rotateSeconds and now - self._fileOpened >= self._rotateSeconds)):
+            self._closeFile()
+        if not self._writer:
+            self._openFile(now)
+
+        batch = self._pa.RecordBatch.from_arrays([self._pa.array(self._batch[name], type=self._schema.field(name).type) for name in self._columns],
+                                                 schema=self._schema)
+        if self._format == 'parquet':
+            self._writer.write_table(self._pa.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+        self._fileRows += self._batchRows
+        self._resetBatch()
+
+    def _openFile(self, now):
+        self._fileSeq += 1
+        extension = 'parquet' if self._format == 'parquet' else 'arrow'
+        filename = '%s-%s-%d.%s' % (self._prefix,
+                                    datetime.datetime.fromtimestamp(now).strftime('%Y%m%d-%H%M%S'),
+                                    self._fileSeq,
+                                    extension)
+        if self._format == 'parquet':
+            import pyarrow.parquet
+            self._writer = pyarrow.parquet.ParquetWriter(filename, self._schema)
+        else:
+            self._sink = self._pa.OSFile(filename, 'wb')
+            self._writer = self._pa.ipc.new_file(self._sink, self._schema)
+        self._fileRows = 0
+        self._fileOpened = now
+
+    def _closeFile(self):
+        self._writer.close()
+        self._writer = None
+        if self._sink:
+            self._sink.close()
+            self._sink = None
+
+    def close(self):
+        self.flush()
+        if self._writer:
+            self._closeFile()
+
+def getAddresses(msg):
+    ipfromstr = None
+    iptostr = None
+    family = socket.AF_INET if msg.socketFamily == dnsmessage_pb2.PBDNSMessage.INET else socket.AF_INET6
+    if msg.HasField('from'):
+        ipfromstr = socket.inet_ntop(family, getattr(msg, 'from'))
+    if msg.HasField('to'):
+        iptostr = socket.inet_ntop(family, msg.to)
+    return ipfromstr, iptostr
+
+def getRequestorSubnet(msg):
+    requestorstr = None
+    if msg.HasField('originalRequestorSubnet'):
+        if len(msg.originalRequestorSubnet) == 4:
+            requestorstr = socket.inet_ntop(socket.AF_INET,
+                                            msg.originalRequestorSubnet)
+        elif len(msg.originalRequestorSubnet) == 16:
+            requestorstr = socket.inet_ntop(socket.AF_INET6,
+                                            msg.originalRequestorSubnet)
+    return requestorstr
+
+def getRRDetails(rr):
+    rrclass = 1
+    rdatastr = ''
+    rrudr = 0
+    if rr.HasField('class'):
+        rrclass = getattr(rr, 'class')
+    rrtype = rr.type
+    if rr.HasField('udr'):
+        rrudr = rr.udr
+    if (rrclass == 1 or rrclass == 255) and rr.HasField('rdata'):
+        if rrtype == 1:
+            rdatastr = socket.inet_ntop(socket.AF_INET, rr.rdata)
+        elif rrtype == 5:
+            rdatastr = rr.rdata.decode(errors='replace')
+        elif rrtype == 28:
+            rdatastr = socket.inet_ntop(socket.AF_INET6, rr.rdata)
+    return rrclass, rrtype, rdatastr, rrudr
+
+class PDNSPBStats(object):
+    """
+    Throughput counters, reported on stderr every `interval` seconds.
+    """
+
+    def __init__(self, interval):
+        self._interval = interval
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0
+
+    async def report(self):
+        lastMessages = 0
+        lastBytes = 0
+        lastTime = time.monotonic()
+        while True:
+            await asyncio.sleep(self._interval)
+            now = time.monotonic()
+            elapsed = now - lastTime
+            sys.stderr.write('%d connections, %.1f messages/s, %.1f bytes/s (%d messages, %d bytes total)\n' % (self.connections,
+                                                                                                                 (self.messages - lastMessages) / elapsed,
+                                                                                                                 (self.bytes - lastBytes) / elapsed,
+                                                                                                                 self.messages,
+                                                                                                                 self.bytes))
+            lastMessages = self.messages
+            lastBytes = self.bytes
+            lastTime = now
+
+class PDNSPBConnProtocol(asyncio.Protocol):
+    """
+    Reads length-prefixed PBDNSMessage frames from a single connection.
+    Incoming data is accumulated in a buffer and every complete frame
+    available after a read is decoded and handed to the output as one batch.
+    """
+
+    def __init__(self, output, stats):
+        self._output = output
+        self._stats = stats
+        self._buffer = bytearray()
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._stats.connections += 1
+
+    def connection_lost(self, exc):
+        self._stats.connections -= 1
+
+    def data_received(self, data):
+        self._buffer += data
+        buf = self._buffer
+        buflen = len(buf)
+        pos = 0
+        frames = []
+        while buflen - pos >= 2:
+            (datalen,) = struct.unpack_from('!H', buf, pos)
+            if buflen - pos - 2 < datalen:
+                break
+            frames.append(bytes(buf[pos + 2:pos + 2 + datalen]))
+            pos = pos + 2 + datalen
+
+        if pos:
+            del buf[:pos]
+
+        if not frames:
+            return
+
+        self._stats.messages += len(frames)
+        self._stats.bytes += pos
+
+        if self._output.needsDecoding:
+            messages = []
+            for frame in frames:
+                msg = dnsmessage_pb2.PBDNSMessage()
+                msg.ParseFromString(frame)
+                messages.append(msg)
+            self._output.write(messages)
+        else:
+            self._output.write(frames)
 
 class PDNSPBListener(object):
 
-    def __init__(self, addr, port):
+    def __init__(self, addr, port, output, stats=None):
         res = socket.getaddrinfo(addr, port, socket.AF_UNSPEC,
                                  socket.SOCK_STREAM, 0,
                                  socket.AI_PASSIVE)
@@ -232,24 +598,79 @@ class PDNSPBListener(object):
             sys.exit(1)
 
         self._sock.listen(100)
-
-    def run(self):
+        self._output = output
+        self._stats = stats
+
+    async def serve(self):
+        stats = self._stats if self._stats else PDNSPBStats(0)
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: PDNSPBConnProtocol(self._output, stats),
+                                          sock=self._sock)
+        reporter = None
+        if self._stats:
+            reporter = asyncio.ensure_future(self._stats.report())
+        ticker = None
+        if hasattr(self._output, 'tick'):
+            ticker = asyncio.ensure_future(self.tick())
+        try:
+            await server.serve_forever()
+        finally:
+            if reporter:
+                reporter.cancel()
+            if ticker:
+                ticker.cancel()
+            server.close()
+            self._output.close()
+
+    async def tick(self):
         while True:
-            (conn, _) = self._sock.accept()
-
-            handler = PDNSPBConnHandler(conn)
-            thread = threading.Thread(name='Connection Handler',
-                                      target=PDNSPBConnHandler.run,
-                                      args=[handler])
-            thread.setDaemon(True)
-            thread.start()
-
-        self._sock.close()
+            await asyncio.sleep(1)
+            self._output.tick()
 
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+def getOutput(args):
+    outputFormat = args.format
+    filename = args.output
+    if outputFormat in ('parquet', 'arrow'):
+        return PDNSPBColumnarOutput(filename, outputFormat, args.batch_size, args.rotate_rows, args.rotate_seconds, args.flush_seconds)
+
+    binary = outputFormat == 'binary'
+    if filename and filename != '-':
+        out = open(filename, 'ab' if binary else 'a')
+    else:
+        out = sys.stdout.buffer if binary else sys.stdout
+
+    if outputFormat == 'json':
+        return PDNSPBJSONOutput(out)
+    if binary:
+        return PDNSPBBinaryOutput(out)
+    return PDNSPBTextOutput(out)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        sys.exit('Usage: %s <address> <port>' % (sys.argv[0]))
-
-    PDNSPBListener(sys.argv[1], sys.argv[2]).run()
+    parser = argparse.ArgumentParser(description='Receive protobuf-encoded DNS messages from PowerDNS products and dnsdist.')
+    parser.add_argument('address', help='address to listen on')
+    parser.add_argument('port', help='port to listen on')
+    parser.add_argument('--format', choices=['text', 'json', 'binary', 'parquet', 'arrow'], default='text',
+                        help='output format: human-readable text (default), newline-delimited JSON, the raw length-prefixed protobuf frames, or columnar Parquet / Arrow IPC files (requires pyarrow)')
+    parser.add_argument('--output', default=None,
+                        help='write to this file instead of the standard output. For the parquet and arrow formats, this is the prefix of the rotated files')
+    parser.add_argument('--batch-size', type=int, default=65536,
+                        help='number of messages accumulated before a columnar batch is written (parquet and arrow formats)')
+    parser.add_argument('--rotate-rows', type=int, default=0,
+                        help='start a new file after that many messages (parquet and arrow formats, 0 to disable)')
+    parser.add_argument('--rotate-seconds', type=int, default=3600,
+                        help='start a new file after that many seconds (parquet and arrow formats, 0 to disable)')
+    parser.add_argument('--flush-seconds', type=int, default=10,
+                        help='write the pending messages at least every that many seconds (parquet and arrow formats, 0 to disable)')
+    parser.add_argument('--stats-interval', type=float, default=0,
+                        help='report messages/s and bytes/s on stderr every that many seconds (0 to disable)')
+    args = parser.parse_args()
+
+    stats = PDNSPBStats(args.stats_interval) if args.stats_interval > 0 else None
+    PDNSPBListener(args.address, args.port, getOutput(args), stats).run()
     sys.exit(0)
@@ -0,0 +1,560 @@
+/*
+ * This file is part of PowerDNS or dnsdist.
+ * Copyright -- PowerDNS.COM B.V. and its contributors
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of version 2 of the GNU General Public License as
+ * published by the Free Software Foundation.
+ *
+ * In addition, for the avoidance of any doubt, permission is granted to
+ * link this program with OpenSSL and to (re)distribute the binaries
+ * produced as the result of such linking.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+ */
+
+/* Benchmark of the DNSDistPacketCache, in the spirit of speedtest.cc: a
+   given workload is run for a fixed amount of time from N threads, against
+   caches with different numbers of shards, and the number of operations per
+   second is reported along with the contention counters of the cache
+   (deferred lookups and inserts) and the memory used per entry.
+
+   The queried names follow a Zipf distribution, so that a few names are
+   much more popular than the others, as is the case with real traffic. */
+
+#include <cmath>
+#include <cstring>
+#include <fstream>
+#include <getopt.h>
+#include <numeric>
+#include <random>
+#include <set>
+#include <sys/wait.h>
+#include <thread>
+
+#include <boost/format.hpp>
+
+#include "dnsdist.hh"
+#include "dnsdist-cache.hh"
+#include "dnswriter.hh"
+#include "gettime.hh"
+
+struct BenchEntry
+{
+  DNSName qname;
+  std::vector<uint8_t> query;
+  std::vector<uint8_t> response;
+  uint32_t key{0};
+  uint16_t qtype{0};
+  uint16_t queryFlags{0};
+};
+
+struct BenchConfig
+{
+  std::vector<unsigned int> threads{1, 2, 4, 8};
+  std::vector<uint32_t> shards{1, 4, 16, 64};
+  std::set<std::string> workloads{"hit", "insert", "mixed", "expunge"};
+  size_t names{100000};
+  size_t maxEntries{50000};
+  double zipfExponent{1.0};
+  unsigned int durationMS{1000};
+  /* percentage of the responses with a TTL of one second, to give
+     purgeExpired() something to do */
+  unsigned int shortTTLPercentage{10};
+  bool deferrableInsertLock{true};
+  bool lockFreeLookups{false};
+  DNSDistPacketCache::EvictionPolicy evictionPolicy{DNSDistPacketCache::EvictionPolicy::None};
+  std::string sharedMemoryFile;
+};
+
+struct BenchResult
+{
+  uint64_t ops{0};
+  uint64_t hits{0};
+  uint64_t misses{0};
+  uint64_t deferredLookups{0};
+  uint64_t deferredInserts{0};
+  uint64_t collisions{0};
+  uint64_t removed{0};
+  uint64_t evictions{0};
+  double elapsed{0};
+};
+
+static const std::vector<std::string> s_tlds{"com", "net", "org", "nl", "de", "io"};
+static const size_t s_zones{5000};
+
+static DNSName getZoneName(size_t idx)
+{
+  return DNSName("zone" + std::to_string(idx % s_zones) + "." + s_tlds.at(idx % s_tlds.size()));
+}
+
+static DNSName getName(size_t idx)
+{
+  /* a mix of names directly under a zone and deeper ones */
+  std::string prefix = "host" + std::to_string(idx);
+  if (idx % 3 == 0) {
+    prefix = "www." + prefix;
+  }
+  else if (idx % 7 == 0) {
+    prefix = "a.b.c." + prefix;
+  }
+  return DNSName(prefix) + getZoneName(idx);
+}
+
+static std::vector<BenchEntry> generateEntries(const BenchConfig& config)
+{
+  std::vector<BenchEntry> entries;
+  entries.reserve(config.names);
+  /* only used to compute the keys */
+  DNSDistPacketCache keyCache(1);
+  const unsigned int shortTTLEvery = config.shortTTLPercentage > 0 ? 100 / config.shortTTLPercentage : 0;
+
+  for (size_t idx = 0; idx < config.names; idx++) {
+    BenchEntry entry;
+    entry.qname = getName(idx);
+    entry.qtype = (idx % 4 == 0) ? QType::AAAA : QType::A;
+    const uint16_t qtype = entry.qtype;
+
+    DNSPacketWriter pwQ(entry.query, entry.qname, qtype, QClass::IN, 0);
+    pwQ.getHeader()->rd = 1;
+    pwQ.getHeader()->id = htons(idx % 65536);
+    entry.queryFlags = *getFlagsFromDNSHeader(pwQ.getHeader());
+
+    DNSPacketWriter pwR(entry.response, entry.qname, qtype, QClass::IN, 0);
+    pwR.getHeader()->rd = 1;
+    pwR.getHeader()->ra = 1;
+    pwR.getHeader()->qr = 1;
+    pwR.getHeader()->id = pwQ.getHeader()->id;
+    const uint32_t ttl = (shortTTLEvery > 0 && idx % shortTTLEvery == 0) ? 1 : 3600;
+    pwR.startRecord(entry.qname, qtype, ttl, QClass::IN, DNSResourceRecord::ANSWER);
+    if (qtype == QType::A) {
+      pwR.xfr32BitInt(0xC0000200 + (idx % 256));
+    }
+    else {
+      pwR.xfrBlob(std::string(16, static_cast<char>(idx % 256)));
+    }
+    pwR.commit();
+
+    entry.key = keyCache.getKey(entry.qname.getStorage(), entry.qname.wirelength(), entry.query.data(), entry.query.size(), false);
+    entries.push_back(std::move(entry));
+  }
+
+  return entries;
+}
+
+/* indexes of the names, from the most popular to the least popular one,
+   so that the most popular names do not all end up in the same shard */
+static std::vector<uint32_t> generatePopularityOrder(size_t names)
+{
+  std::vector<uint32_t> order(names);
+  std::iota(order.begin(), order.end(), 0);
+  std::shuffle(order.begin(), order.end(), std::mt19937(42));
+  return order;
+}
+
+/* pre-computed sequence of indexes following a Zipf distribution, so that
+   drawing random numbers does not happen during the measurements */
+static std::vector<uint32_t> generateZipfSequence(const std::vector<uint32_t>& popularityOrder, double exponent, size_t count, unsigned int seed)
+{
+  const size_t names = popularityOrder.size();
+  std::vector<double> cdf(names);
+  double sum = 0;
+  for (size_t idx = 0; idx < names; idx++) {
+    sum += 1.0 / std::pow(static_cast<double>(idx + 1), exponent);
+    cdf[idx] = sum;
+  }
+
+  std::mt19937 gen(seed);
+  std::uniform_real_distribution<double> dist(0, sum);
+
+  std::vector<uint32_t> sequence;
+  sequence.reserve(count);
+  for (size_t idx = 0; idx < count; idx++) {
+    auto it = std::lower_bound(cdf.begin(), cdf.end(), dist(gen));
+    size_t rank = std::min(static_cast<size_t>(std::distance(cdf.begin(), it)), names - 1);
+    sequence.push_back(popularityOrder.at(rank));
+  }
+
+  return sequence;
+}
+
+static uint64_t getResidentMemory()
+{
+  std::ifstream statm("/proc/self/statm");
+  uint64_t size = 0, resident = 0;
+  if (!(statm >> size >> resident)) {
+    return 0;
+  }
+  return resident * getpagesize();
+}
+
+static bool doGet(DNSDistPacketCache& cache, BenchEntry& entry, const ComboAddress& remote, const struct timespec& queryTime)
+{
+  char responseBuf[4096];
+  uint16_t responseBufSize = sizeof(responseBuf);
+  uint32_t key = 0;
+  boost::optional<Netmask> subnet;
+  auto dh = reinterpret_cast<dnsheader*>(entry.query.data());
+  DNSQuestion dq(&entry.qname, entry.qtype, QClass::IN, entry.qname.wirelength(), &remote, &remote, dh, entry.query.size(), entry.query.size(), false, &queryTime);
+  return cache.get(dq, entry.qname.wirelength(), dh->id, responseBuf, &responseBufSize, &key, subnet, false);
+}
+
+static void doInsert(DNSDistPacketCache& cache, const BenchEntry& entry)
+{
+  cache.insert(entry.key, boost::none, entry.queryFlags, false, entry.qname, entry.qtype, QClass::IN, reinterpret_cast<const char*>(entry.response.data()), entry.response.size(), false, 0, boost::none);
+}
+
+/* a warm cache holds the most popular names */
+static void fillCache(DNSDistPacketCache& cache, const std::vector<BenchEntry>& entries, const std::vector<uint32_t>& popularityOrder)
+{
+  for (const auto idx : popularityOrder) {
+    if (cache.isFull()) {
+      break;
+    }
+    doInsert(cache, entries.at(idx));
+  }
+}
+
+/* The memory is measured in a child process, since the memory released by
+   a previous cache would otherwise be reused without increasing the
+   resident size. Returns the increase of the resident size per entry, and
+   the estimation reported by the cache itself, or 0 if the measurement failed. */
+static void setupCache(DNSDistPacketCache& cache, const BenchConfig& config)
+{
+  cache.setEvictionPolicy(config.evictionPolicy);
+  if (!config.sharedMemoryFile.empty()) {
+    /* start from scratch, the file might have been created for a different number of entries */
+    unlink(config.sharedMemoryFile.c_str());
+    cache.setSharedMemory(config.sharedMemoryFile, 1232);
+  }
+}
+
+static std::pair<uint64_t, uint64_t> getMemoryPerEntry(const BenchConfig& config, uint32_t shards, const std::vector<BenchEntry>& entries, const std::vector<uint32_t>& popularityOrder)
+{
+  int fds[2];
+  if (pipe(fds) != 0) {
+    return {0, 0};
+  }
+
+  pid_t pid = fork();
+  if (pid < 0) {
+    close(fds[0]);
+    close(fds[1]);
+    return {0, 0};
+  }
+
+  if (pid == 0) {
+    close(fds[0]);
+    uint64_t perEntry[2] = {0, 0};
+    const uint64_t before = getResidentMemory();
+    DNSDistPacketCache cache(config.maxEntries, 86400, 0, 60, 3600, 60, false, shards, config.deferrableInsertLock, false, config.lockFreeLookups);
+    setupCache(cache, config);
+    fillCache(cache, entries, popularityOrder);
+    const uint64_t after = getResidentMemory();
+    const uint64_t count = cache.getEntriesCount();
+    if (count > 0 && after > before) {
+      perEntry[0] = (after - before) / count;
+    }
+    if (count > 0) {
+      for (const auto& usage : cache.getMemoryUsage()) {
+        perEntry[1] += usage.bytes;
+      }
+      perEntry[1] /= count;
+    }
+    ssize_t written = write(fds[1], &perEntry, sizeof(perEntry));
+    _exit(written == sizeof(perEntry) ? EXIT_SUCCESS : EXIT_FAILURE);
+  }
+
+  close(fds[1]);
+  uint64_t perEntry[2] = {0, 0};
+  if (read(fds[0], &perEntry, sizeof(perEntry)) != sizeof(perEntry)) {
+    perEntry[0] = perEntry[1] = 0;
+  }
+  close(fds[0]);
+  waitpid(pid, nullptr, 0);
+  return {perEntry[0], perEntry[1]};
+}
+
+static BenchResult runWorkload(const std::string& workload, DNSDistPacketCache& cache, std::vector<BenchEntry>& entries, const std::vector<std::vector<uint32_t>>& sequences, const BenchConfig& config, unsigned int threadsCount)
+{
+  std::atomic<bool> start{false};
+  std::atomic<bool> stop{false};
+  std::atomic<uint64_t> totalOps{0};
+  std::atomic<uint64_t> totalRemoved{0};
+  std::atomic<unsigned int> running{threadsCount};
+  std::vector<std::thread> threads;
+  ComboAddress remote("192.0.2.1");
+  struct timespec queryTime;
+  gettime(&queryTime);
+
+  const uint64_t hitsBefore = cache.getHits();
+  const uint64_t missesBefore = cache.getMisses();
+  const uint64_t deferredLookupsBefore = cache.getDeferredLookups();
+  const uint64_t deferredInsertsBefore = cache.getDeferredInserts();
+  const uint64_t collisionsBefore = cache.getLookupCollisions() + cache.getInsertCollisions();
+  const uint64_t evictionsBefore = cache.getEvictions();
+
+  for (unsigned int threadIdx = 0; threadIdx < threadsCount; threadIdx++) {
+    threads.push_back(std::thread([&,threadIdx]() {
+      const auto& sequence = sequences.at(threadIdx);
+      uint64_t ops = 0;
+      size_t pos = 0;
+      /* the insert workload inserts every name once, each thread taking
+         care of a different part of the names */
+      size_t insertPos = (entries.size() / threadsCount) * threadIdx;
+      const size_t insertEnd = threadIdx == (threadsCount - 1) ? entries.size() : (entries.size() / threadsCount) * (threadIdx + 1);
+
+      while (!start) {
+        std::this_thread::yield();
+      }
+
+      while (!stop) {
+        if (workload == "insert") {
+          if (insertPos >= insertEnd) {
+            break;
+          }
+          doInsert(cache, entries.at(insertPos++));
+        }
+        else {
+          auto& entry = entries.at(sequence.at(pos++ % sequence.size()));
+          if (!doGet(cache, entry, remote, queryTime) && workload != "hit") {
+            /* a miss, insert the response as dnsdist would after getting it
+               from the backend */
+            doInsert(cache, entry);
+          }
+        }
+        ops++;
+      }
+      totalOps += ops;
+      running--;
+    }));
+  }
+
+  /* maintenance thread, doing what the dnsdist maintenance thread does
+     (mixed workload) or removing all the names of a zone (expunge workload) */
+  std::thread maintenance([&]() {
+    size_t zone = 0;
+    while (!start) {
+      std::this_thread::yield();
+    }
+    while (!stop) {
+      if (workload == "mixed") {
+        totalRemoved += cache.purgeExpired(0);
+        std::this_thread::sleep_for(std::chrono::milliseconds(100));
+      }
+      else if (workload == "expunge") {
+        totalRemoved += cache.expungeByName(getZoneName(zone++), QType::ANY, true);
+        std::this_thread::sleep_for(std::chrono::milliseconds(10));
+      }
+      else {
+        std::this_thread::sleep_for(std::chrono::milliseconds(10));
+      }
+    }
+  });
+
+  DTime dt;
+  dt.set();
+  start = true;
+  while (running > 0 && static_cast<unsigned int>(dt.udiffNoReset()) < config.durationMS * 1000) {
+    std::this_thread::sleep_for(std::chrono::milliseconds(1));
+  }
+  stop = true;
+  for (auto& thread : threads) {
+    thread.join();
+  }
+  BenchResult result;
+  result.elapsed = dt.udiff() / 1000000.0;
+  maintenance.join();
+
+  result.ops = totalOps;
+  result.removed = totalRemoved;
+  result.hits = cache.getHits() - hitsBefore;
+  result.misses = cache.getMisses() - missesBefore;
+  result.deferredLookups = cache.getDeferredLookups() - deferredLookupsBefore;
+  result.deferredInserts = cache.getDeferredInserts() - deferredInsertsBefore;
+  result.evictions = cache.getEvictions() - evictionsBefore;
+  result.collisions = cache.getLookupCollisions() + cache.getInsertCollisions() - collisionsBefore;
+  return result;
+}
+
+template<typename T> static std::vector<T> parseList(const std::string& str)
+{
+  std::vector<T> result;
+  std::vector<std::string> parts;
+  stringtok(parts, str, ",");
+  for (const auto& part : parts) {
+    result.push_back(pdns_stou(part));
+  }
+  return result;
+}
+
+static void usage()
+{
+  cerr<<"Usage: dnsdist-cache-bench [OPTION]..."<<endl;
+  cerr<<"  -t, --threads LIST       comma-separated numbers of threads to use (default 1,2,4,8)"<<endl;
+  cerr<<"  -s, --shards LIST        comma-separated numbers of shards to use (default 1,4,16,64)"<<endl;
+  cerr<<"  -w, --workloads LIST     comma-separated workloads among hit, insert, mixed and expunge (default all)"<<endl;
+  cerr<<"  -n, --names NUM          number of distinct names (default 100000)"<<endl;
+  cerr<<"  -m, --max-entries NUM    maximum number of entries in the cache (default 50000)"<<endl;
+  cerr<<"  -z, --zipf EXPONENT      exponent of the Zipf distribution of the names (default 1.0)"<<endl;
+  cerr<<"  -d, --duration MS        duration of each run, in milliseconds (default 1000)"<<endl;
+  cerr<<"  -N, --no-deferrable      do not defer inserts when the lock is already held"<<endl;
+  cerr<<"  -L, --lock-free          use the lock-free lookups engine"<<endl;
+  cerr<<"  -E, --eviction POLICY    eviction policy among none, lru and tinylfu (default none)"<<endl;
+  cerr<<"  -S, --shared-memory FILE store the entries in shared memory, in this file which is overwritten"<<endl;
+  cerr<<"  -h, --help               display this help"<<endl;
+}
+
+int main(int argc, char** argv)
+try
+{
+  BenchConfig config;
+
+  struct option longopts[]={
+    {"threads", required_argument, 0, 't'},
+    {"shards", required_argument, 0, 's'},
+    {"workloads", required_argument, 0, 'w'},
+    {"names", required_argument, 0, 'n'},
+    {"max-entries", required_argument, 0, 'm'},
+    {"zipf", required_argument, 0, 'z'},
+    {"duration", required_argument, 0, 'd'},
+    {"no-deferrable", no_argument, 0, 'N'},
+    {"lock-free", no_argument, 0, 'L'},
+    {"eviction", required_argument, 0, 'E'},
+    {"shared-memory", required_argument, 0, 'S'},
+    {"help", no_argument, 0, 'h'},
+    {0,0,0,0}
+  };
+  int longindex=0;
+  for (;;) {
+    int c = getopt_long(argc, argv, "t:s:w:n:m:z:d:NLE:S:h", longopts, &longindex);
+    if (c == -1) {
+      break;
+    }
+    switch (c) {
+    case 't':
+      config.threads = parseList<unsigned int>(optarg);
+      break;
+    case 's':
+      config.shards = parseList<uint32_t>(optarg);
+      break;
+    case 'w': {
+      std::vector<std::string> parts;
+      stringtok(parts, optarg, ",");
+      config.workloads = std::set<std::string>(parts.begin(), parts.end());
+      break;
+    }
+    case 'n':
+      config.names = pdns_stou(optarg);
+      break;
+    case 'm':
+      config.maxEntries = pdns_stou(optarg);
+      break;
+    case 'z':
+      config.zipfExponent = std::stod(optarg);
+      break;
+    case 'd':
+      config.durationMS = pdns_stou(optarg);
+      break;
+    case 'N':
+      config.deferrableInsertLock = false;
+      break;
+    case 'L':
+      config.lockFreeLookups = true;
+      break;
+    case 'E':
+      if (strcmp(optarg, "none") == 0) {
+        config.evictionPolicy = DNSDistPacketCache::EvictionPolicy::None;
+      }
+      else if (strcmp(optarg, "lru") == 0) {
+        config.evictionPolicy = DNSDistPacketCache::EvictionPolicy::LRU;
+      }
+      else if (strcmp(optarg, "tinylfu") == 0) {
+        config.evictionPolicy = DNSDistPacketCache::EvictionPolicy::TinyLFU;
+      }
+      else {
+        cerr<<"Unknown eviction policy '"<<optarg<<"'"<<endl;
+        return EXIT_FAILURE;
+      }
+      break;
+    case 'S':
+      config.sharedMemoryFile = optarg;
+      break;
+    case 'h':
+      usage();
+      return EXIT_SUCCESS;
+    default:
+      usage();
+      return EXIT_FAILURE;
+    }
+  }
+
+  for (const auto& workload : config.workloads) {
+    if (workload != "hit" && workload != "insert" && workload != "mixed" && workload != "expunge") {
+      cerr<<"Unknown workload '"<<workload<<"'"<<endl;
+      return EXIT_FAILURE;
+    }
+  }
+
+  if (config.names == 0 || config.maxEntries == 0 || config.threads.empty() || config.shards.empty()) {
+    usage();
+    return EXIT_FAILURE;
+  }
+
+  cerr<<"Generating "<<config.names<<" names..."<<endl;
+  auto entries = generateEntries(config);
+  const auto popularityOrder = generatePopularityOrder(config.names);
+  const unsigned int maxThreads = *std::max_element(config.threads.begin(), config.threads.end());
+  std::vector<std::vector<uint32_t>> sequences;
+  for (unsigned int idx = 0; idx < maxThreads; idx++) {
+    sequences.push_back(generateZipfSequence(popularityOrder, config.zipfExponent, 1000000, idx));
+  }
+
+  boost::format fmt("%-8s %6d shards %3d threads: %12.0f ops/s, %10.0f ops/s/thread, hit ratio %5.1f%%, deferred lookups %8d, deferred inserts %8d, collisions %6d, removed %8d, evictions %8d");
+
+  /* before running the workloads, which would leave freed memory behind */
+  for (const auto shards : config.shards) {
+    const auto perEntry = getMemoryPerEntry(config, shards, entries, popularityOrder);
+    if (perEntry.first > 0) {
+      cout<<(boost::format("%6d shards: about %d bytes of memory per entry, %d reported by the cache") % shards % perEntry.first % perEntry.second)<<endl;
+    }
+  }
+
+  for (const auto shards : config.shards) {
+    for (const auto& workload : config.workloads) {
+      for (const auto threadsCount : config.threads) {
+        /* the insert workload inserts every name once, so the cache has to be large enough */
+        const size_t maxEntries = workload == "insert" ? std::max(config.maxEntries, config.names) : config.maxEntries;
+        DNSDistPacketCache cache(maxEntries, 86400, 0, 60, 3600, 60, false, shards, config.deferrableInsertLock, false, config.lockFreeLookups);
+        setupCache(cache, config);
+        if (workload != "insert") {
+          fillCache(cache, entries, popularityOrder);
+        }
+
+        auto result = runWorkload(workload, cache, entries, sequences, config, threadsCount);
+        const double opsPerSecond = result.ops / result.elapsed;
+        const double hitRatio = (result.hits + result.misses) > 0 ? (100.0 * result.hits / (result.hits + result.misses)) : 0.0;
+        cout<<(fmt % workload % shards % threadsCount % opsPerSecond % (opsPerSecond / threadsCount) % hitRatio % result.deferredLookups % result.deferredInserts % result.collisions % result.removed % result.evictions)<<endl;
+      }
+    }
+  }
+
+  return EXIT_SUCCESS;
+}
+catch(const PDNSException& e)
+{
+  cerr<<"Fatal error: "<<e.reason<<endl;
+  return EXIT_FAILURE;
+}
+catch(const std::exception& e)
+{
+  cerr<<"Fatal error: "<<e.what()<<endl;
+  return EXIT_FAILURE;
+}
@@ -0,0 +1,416 @@
+/*
+ * This file is part of PowerDNS or dnsdist.
+ * Copyright -- PowerDNS.COM B.V. and its contributors
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of version 2 of the GNU General Public License as
+ * published by the Free Software Foundation.
+ *
+ * In addition, for the avoidance of any doubt, permission is granted to
+ * link this program with OpenSSL and to (re)distribute the binaries
+ * produced as the result of such linking.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+ */
+#pragma once
+
+#include <atomic>
+#include <deque>
+#include <functional>
+#include <limits>
+#include <memory>
+#include <stdexcept>
+#include <thread>
+#include <utility>
+
+#include <boost/noncopyable.hpp>
+
+/* An open-addressing hash table, indexed by the 32-bit key of a packet cache
+   entry, where lookups never block and never wait for writers.
+
+   Readers enter a read-side critical section by creating a ReadGuard, then
+   call find() or forEach(). The pointers they get are valid until the guard
+   is destroyed.
+   Writers (insert(), replace(), eraseIf(), clear()) have to be serialized by
+   the caller, for example using a mutex. They never modify an entry that has
+   been published: a replaced or removed entry is unlinked from the table then
+   retired, and only freed once every reader that might still be looking at it
+   has left its critical section. Slots are never emptied, only marked as
+   deleted, and the slots array is rebuilt from scratch once there are too many
+   deleted ones, the old array being retired the same way.
+
+   Reclamation uses two generations of reader counters, selected by the parity
+   of the current epoch. The epoch is only advanced by writers, when no reader
+   is left on the counters of the previous epoch, so everything retired during
+   epoch E can be freed once the epoch reaches E + 2. The counters are striped
+   over several cache lines to limit the contention between reader threads.
+*/
+template <typename T>
+class LockFreeCacheTable : boost::noncopyable
+{
+  struct Entry
+  {
+    Entry(uint32_t key_, T&& value_): value(std::move(value_)), key(key_)
+    {
+    }
+
+    T value;
+    uint32_t key;
+  };
+
+  struct Slots
+  {
+    Slots(size_t capacity, uint8_t bits): d_slots(new std::atomic<Entry*>[capacity]), d_capacity(capacity), d_bits(bits)
+    {
+      for (size_t idx = 0; idx < d_capacity; idx++) {
+        d_slots[idx].store(nullptr, std::memory_order_relaxed);
+      }
+    }
+
+    size_t getIndex(uint32_t key) const
+    {
+      /* the lowest bits of the key are used to select the shard, so use
+         Fibonacci hashing to spread the keys over the whole table */
+      return (static_cast<uint64_t>(key) * 0x9E3779B97F4A7C15ULL) >> (64 - d_bits);
+    }
+
+    std::unique_ptr<std::atomic<Entry*>[]> d_slots;
+    const size_t d_capacity;
+    const uint8_t d_bits;
+  };
+
+  static const size_t s_stripes = 8;
+
+  /* padded rather than aligned, since over-aligned types are not supported
+     by operator new before C++17. Counters are still 64 bytes apart, so no
+     two of them share a cache line */
+  struct ReadersCounter
+  {
+    std::atomic<uint64_t> d_count{0};
+    char d_padding[64 - sizeof(std::atomic<uint64_t>)];
+  };
+
+public:
+  class ReadGuard : boost::noncopyable
+  {
+  public:
+    ReadGuard(const LockFreeCacheTable& table)
+    {
+      static thread_local const size_t stripe = std::hash<std::thread::id>()(std::this_thread::get_id()) % s_stripes;
+      d_counter = &table.d_readers[table.d_epoch.load() & 1][stripe].d_count;
+      d_counter->fetch_add(1);
+    }
+
+    ~ReadGuard()
+    {
+      d_counter->fetch_sub(1);
+    }
+
+  private:
+    std::atomic<uint64_t>* d_counter;
+  };
+
+  /* maxEntries is the maximum number of live entries, the table holds twice
+     as many slots, rounded up to the next power of two, to keep the probe
+     sequences short */
+  explicit LockFreeCacheTable(size_t maxEntries)
+  {
+    uint8_t bits = 4;
+    while ((static_cast<size_t>(1) << bits) < maxEntries * 2) {
+      bits++;
+    }
+    d_slots.store(new Slots(static_cast<size_t>(1) << bits, bits));
+  }
+
+  ~LockFreeCacheTable()
+  {
+    clear();
+    delete d_slots.load();
+    freeRetired(std::numeric_limits<uint64_t>::max());
+  }
+
+  /* readers, need to hold a ReadGuard, or to be serialized with writers */
+  const T* find(uint32_t key) const
+  {
+    const Slots* slots = d_slots.load();
+    const size_t mask = slots->d_capacity - 1;
+    size_t idx = slots->getIndex(key);
+
+    for (size_t probes = 0; probes < slots->d_capacity; probes++, idx = (idx + 1) & mask) {
+      const Entry* entry = slots->d_slots[idx].load();
+      if (entry == nullptr) {
+        return nullptr;
+      }
+      if (entry != deleted() && entry->key == key) {
+        return &entry->value;
+      }
+    }
+
+    return nullptr;
+  }
+
+  void forEach(const std::function<void(uint32_t key, const T& value)>& visitor) const
+  {
+    const Slots* slots = d_slots.load();
+    for (size_t idx = 0; idx < slots->d_capacity; idx++) {
+      const Entry* entry = slots->d_slots[idx].load();
+      if (entry != nullptr && entry != deleted()) {
+        visitor(entry->key, entry->value);
+      }
+    }
+  }
+
+  /* writers, have to be serialized by the caller */
+
+  /* returns the existing value if there is already an entry for this key,
+     leaving the new value untouched, nullptr if the new value has been inserted */
+  const T* insert(uint32_t key, T&& value)
+  {
+    if ((d_used + 1) > (d_slots.load()->d_capacity / 4) * 3) {
+      rebuild();
+    }
+
+    Slots* slots = d_slots.load();
+    const size_t mask = slots->d_capacity - 1;
+    size_t idx = slots->getIndex(key);
+    std::atomic<Entry*>* target = nullptr;
+
+    for (size_t probes = 0; probes < slots->d_capacity; probes++, idx = (idx + 1) & mask) {
+      Entry* entry = slots->d_slots[idx].load();
+      if (entry == nullptr) {
+        if (target == nullptr) {
+          target = &slots->d_slots[idx];
+          d_used++;
+        }
+        break;
+      }
+      if (entry == deleted()) {
+        if (target == nullptr) {
+          target = &slots->d_slots[idx];
+        }
+        continue;
+      }
+      if (entry->key == key) {
+        return &entry->value;
+      }
+    }
+
+    if (target == nullptr) {
+      /* can't happen since we never have more than 3/4 of the slots used */
+      throw std::runtime_error("No free slot left in the lock-free packet cache table");
+    }
+
+    target->store(new Entry(key, std::move(value)));
+    d_size++;
+    return nullptr;
+  }
+
+  /* replace the value of an existing entry */
+  void replace(uint32_t key, T&& value)
+  {
+    std::atomic<Entry*>* slot = findSlot(key);
+    if (slot == nullptr) {
+      return;
+    }
+
+    Entry* old = slot->exchange(new Entry(key, std::move(value)));
+    retire(old);
+    reclaim();
+  }
+
+  /* remove the entry for this key, if any */
+  bool erase(uint32_t key)
+  {
+    std::atomic<Entry*>* slot = findSlot(key);
+    if (slot == nullptr) {
+      return false;
+    }
+
+    Entry* entry = slot->load();
+    slot->store(deleted());
+    retire(entry);
+    d_size--;
+    reclaim();
+    return true;
+  }
+
+  /* return the first entry found starting at the slot selected by position,
+     used to pick random entries. O(1) on average once the table is full,
+     since at least a quarter of the slots then hold a live entry */
+  const T* sample(size_t position, uint32_t& key) const
+  {
+    const Slots* slots = d_slots.load();
+    const size_t mask = slots->d_capacity - 1;
+    size_t idx = position & mask;
+
+    for (size_t probes = 0; probes < slots->d_capacity; probes++, idx = (idx + 1) & mask) {
+      const Entry* entry = slots->d_slots[idx].load();
+      if (entry != nullptr && entry != deleted()) {
+        key = entry->key;
+        return &entry->value;
+      }
+    }
+
+    return nullptr;
+  }
+
+  /* remove the entries for which the predicate returns true, until upTo
+     entries have been removed, and return the number of removed entries */
+  size_t eraseIf(const std::function<bool(uint32_t key, const T& value)>& predicate, size_t upTo=std::numeric_limits<size_t>::max())
+  {
+    size_t removed = 0;
+    Slots* slots = d_slots.load();
+
+    for (size_t idx = 0; removed < upTo && idx < slots->d_capacity; idx++) {
+      Entry* entry = slots->d_slots[idx].load();
+      if (entry == nullptr || entry == deleted() || !predicate(entry->key, entry->value)) {
+        continue;
+      }
+
+      slots->d_slots[idx].store(deleted());
+      retire(entry);
+      d_size--;
+      removed++;
+    }
+
+    reclaim();
+    return removed;
+  }
+
+  void clear()
+  {
+    eraseIf([](uint32_t, const T&) { return true; });
+  }
+
+  size_t size() const
+  {
+    return d_size;
+  }
+
+  /* free the retired entries and slots that can no longer be seen by any
+     reader. Called by the writers, and periodically from the cleaning thread
+     via eraseIf() so that memory is reclaimed even without writes */
+  void reclaim()
+  {
+    uint64_t epoch = d_epoch.load();
+    if (getReadersCount((epoch + 1) & 1) == 0) {
+      epoch++;
+      d_epoch.store(epoch);
+    }
+
+    if (epoch >= 2) {
+      freeRetired(epoch - 2);
+    }
+  }
+
+  /* the memory used by the slots and the entries, not counting what the
+     values might have allocated themselves */
+  size_t getMemoryUsage() const
+  {
+    return sizeof(*this) + d_slots.load()->d_capacity * sizeof(std::atomic<Entry*>) + d_size * sizeof(Entry);
+  }
+
+  size_t getRetiredCount() const
+  {
+    return d_retiredEntries.size() + d_retiredSlots.size();
+  }
+
+private:
+  static Entry* deleted()
+  {
+    static char marker;
+    return reinterpret_cast<Entry*>(&marker);
+  }
+
+  std::atomic<Entry*>* findSlot(uint32_t key)
+  {
+    Slots* slots = d_slots.load();
+    const size_t mask = slots->d_capacity - 1;
+    size_t idx = slots->getIndex(key);
+
+    for (size_t probes = 0; probes < slots->d_capacity; probes++, idx = (idx + 1) & mask) {
+      Entry* entry = slots->d_slots[idx].load();
+      if (entry == nullptr) {
+        return nullptr;
+      }
+      if (entry != deleted() && entry->key == key) {
+        return &slots->d_slots[idx];
+      }
+    }
+
+    return nullptr;
+  }
+
+  /* build a new slots array without the deleted entries, publish it then
+     retire the old one. The entries themselves are moved to the new array,
+     not copied, so readers still using the old array see the same values */
+  void rebuild()
+  {
+    Slots* old = d_slots.load();
+    auto slots = std::unique_ptr<Slots>(new Slots(old->d_capacity, old->d_bits));
+    const size_t mask = slots->d_capacity - 1;
+    size_t used = 0;
+
+    for (size_t idx = 0; idx < old->d_capacity; idx++) {
+      Entry* entry = old->d_slots[idx].load();
+      if (entry == nullptr || entry == deleted()) {
+        continue;
+      }
+
+      size_t target = slots->getIndex(entry->key);
+      while (slots->d_slots[target].load(std::memory_order_relaxed) != nullptr) {
+        target = (target + 1) & mask;
+      }
+      slots->d_slots[target].store(entry, std::memory_order_relaxed);
+      used++;
+    }
+
+    d_slots.store(slots.release());
+    d_used = used;
+    d_retiredSlots.push_back({d_epoch.load(), old});
+    reclaim();
+  }
+
+  void retire(Entry* entry)
+  {
+    d_retiredEntries.push_back({d_epoch.load(), entry});
+  }
+
+  void freeRetired(uint64_t upToEpoch)
+  {
+    while (!d_retiredEntries.empty() && d_retiredEntries.front().first <= upToEpoch) {
+      delete d_retiredEntries.front().second;
+      d_retiredEntries.pop_front();
+    }
+    while (!d_retiredSlots.empty() && d_retiredSlots.front().first <= upToEpoch) {
+      delete d_retiredSlots.front().second;
+      d_retiredSlots.pop_front();
+    }
+  }
+
+  uint64_t getReadersCount(size_t generation) const
+  {
+    uint64_t count = 0;
+    for (const auto& counter : d_readers[generation]) {
+      count += counter.d_count.load();
+    }
+    return count;
+  }
+
+  mutable ReadersCounter d_readers[2][s_stripes];
+  std::atomic<uint64_t> d_epoch{0};
+  std::atomic<Slots*> d_slots{nullptr};
+  /* only accessed by writers */
+  std::deque<std::pair<uint64_t, Entry*>> d_retiredEntries;
+  std::deque<std::pair<uint64_t, Slots*>> d_retiredSlots;
+  size_t d_size{0};
+  /* live and deleted entries */
+  size_t d_used{0};
+};
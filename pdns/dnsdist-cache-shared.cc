@@ -0,0 +1,491 @@
+/*
+ * This file is part of PowerDNS or dnsdist.
+ * Copyright -- PowerDNS.COM B.V. and its contributors
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of version 2 of the GNU General Public License as
+ * published by the Free Software Foundation.
+ *
+ * In addition, for the avoidance of any doubt, permission is granted to
+ * link this program with OpenSSL and to (re)distribute the binaries
+ * produced as the result of such linking.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+ */
+#include <cstring>
+#include <fcntl.h>
+#include <signal.h>
+#include <stdexcept>
+#include <sys/file.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <thread>
+#include <unistd.h>
+
+#include "dnsdist-cache-shared.hh"
+#include "misc.hh"
+
+/* the atomics stored in the file are used by several processes, which only
+   works if they do not rely on a lock private to one process */
+static_assert(ATOMIC_CHAR_LOCK_FREE == 2 && ATOMIC_SHORT_LOCK_FREE == 2 && ATOMIC_INT_LOCK_FREE == 2 && ATOMIC_LLONG_LOCK_FREE == 2, "The shared packet cache requires lock-free atomics");
+
+static const char s_sharedCacheMagic[8] = {'D', 'D', 'P', 'C', 'S', 'H', 'M', '1'};
+static const uint32_t s_sharedCacheVersion{1};
+/* how many times a lookup tries to copy a slot that is being written to */
+static const size_t s_maxReadAttempts{4};
+
+struct SharedCacheTable::FileHeader
+{
+  char magic[sizeof(s_sharedCacheMagic)];
+  uint32_t version;
+  uint32_t compatibilityFlags;
+  uint64_t slotsCount;
+  uint64_t maxPayloadSize;
+  std::atomic<uint64_t> entries;
+};
+
+struct SharedCacheTable::SlotHeader
+{
+  /* odd while the slot is being written to */
+  std::atomic<uint32_t> sequence;
+  std::atomic<uint32_t> key;
+  std::atomic<int64_t> validity;
+  /* in seconds, updated by lookups */
+  std::atomic<uint32_t> lastUsed;
+  std::atomic<uint32_t> hits;
+  /* 0 if the slot is empty */
+  std::atomic<uint16_t> payloadSize;
+  std::atomic<uint8_t> prefetchRequested;
+};
+
+static size_t roundToCacheLine(size_t size)
+{
+  return ((size + 63) / 64) * 64;
+}
+
+SharedCacheTable::SharedCacheTable(const std::string& path, size_t maxEntries, size_t maxPayloadSize, uint32_t compatibilityFlags)
+{
+  if (maxEntries == 0) {
+    throw std::runtime_error("The shared packet cache needs to hold at least one entry");
+  }
+  if (maxPayloadSize == 0 || maxPayloadSize > std::numeric_limits<uint16_t>::max()) {
+    throw std::runtime_error("Invalid entry size " + std::to_string(maxPayloadSize) + " for the shared packet cache");
+  }
+
+  d_bucketsCount = (maxEntries + s_bucketSize - 1) / s_bucketSize;
+  d_slotsCount = d_bucketsCount * s_bucketSize;
+  d_maxPayloadSize = maxPayloadSize;
+  d_slotSize = roundToCacheLine(sizeof(SlotHeader) + maxPayloadSize);
+  const size_t headerSize = roundToCacheLine(sizeof(FileHeader));
+  const size_t locksSize = roundToCacheLine(d_bucketsCount * sizeof(std::atomic<int32_t>));
+  d_mappedSize = headerSize + locksSize + d_slotsCount * d_slotSize;
+
+  int fd = open(path.c_str(), O_RDWR | O_CREAT | O_CLOEXEC, 0600);
+  if (fd < 0) {
+    throw std::runtime_error("Error opening the shared packet cache file '" + path + "': " + stringerror());
+  }
+
+  void* mapped = MAP_FAILED;
+  try {
+    /* serialize the initialization of the file between processes */
+    if (flock(fd, LOCK_EX) != 0) {
+      throw std::runtime_error("Error locking the shared packet cache file '" + path + "': " + stringerror());
+    }
+
+    struct stat st;
+    if (fstat(fd, &st) != 0) {
+      throw std::runtime_error("Error getting the size of the shared packet cache file '" + path + "': " + stringerror());
+    }
+
+    if (st.st_size == 0) {
+      /* a file full of zeros is a valid initial state for the locks and the slots */
+      if (ftruncate(fd, d_mappedSize) != 0) {
+        throw std::runtime_error("Error setting the size of the shared packet cache file '" + path + "': " + stringerror());
+      }
+    }
+    else if (static_cast<size_t>(st.st_size) != d_mappedSize) {
+      throw std::runtime_error("The shared packet cache file '" + path + "' has a size of " + std::to_string(st.st_size) + " bytes instead of the expected " + std::to_string(d_mappedSize) + ", it has been created with a different number of entries or entry size");
+    }
+
+    mapped = mmap(nullptr, d_mappedSize, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    if (mapped == MAP_FAILED) {
+      throw std::runtime_error("Error mapping the shared packet cache file '" + path + "': " + stringerror());
+    }
+
+    d_header = static_cast<FileHeader*>(mapped);
+    static const char s_uninitialized[sizeof(s_sharedCacheMagic)] = {0};
+    if (memcmp(d_header->magic, s_uninitialized, sizeof(s_uninitialized)) == 0) {
+      /* new file, or one whose initialization did not complete. The magic is
+         written last, and we hold the lock */
+      d_header->version = s_sharedCacheVersion;
+      d_header->compatibilityFlags = compatibilityFlags;
+      d_header->slotsCount = d_slotsCount;
+      d_header->maxPayloadSize = d_maxPayloadSize;
+      d_header->entries.store(0);
+      memcpy(d_header->magic, s_sharedCacheMagic, sizeof(s_sharedCacheMagic));
+    }
+    else if (memcmp(d_header->magic, s_sharedCacheMagic, sizeof(s_sharedCacheMagic)) != 0) {
+      throw std::runtime_error("Invalid shared packet cache file '" + path + "'");
+    }
+    else if (d_header->version != s_sharedCacheVersion) {
+      throw std::runtime_error("Unsupported version " + std::to_string(d_header->version) + " of the shared packet cache file '" + path + "'");
+    }
+    else if (d_header->slotsCount != d_slotsCount || d_header->maxPayloadSize != d_maxPayloadSize) {
+      throw std::runtime_error("The shared packet cache file '" + path + "' has been created with a different number of entries or entry size");
+    }
+    else if (d_header->compatibilityFlags != compatibilityFlags) {
+      throw std::runtime_error("The shared packet cache file '" + path + "' is used by a cache with different settings");
+    }
+
+    flock(fd, LOCK_UN);
+  }
+  catch (...) {
+    if (mapped != MAP_FAILED) {
+      munmap(mapped, d_mappedSize);
+    }
+    close(fd);
+    throw;
+  }
+
+  /* the mapping stays valid after the descriptor has been closed */
+  close(fd);
+
+  d_locks = reinterpret_cast<std::atomic<int32_t>*>(static_cast<char*>(mapped) + headerSize);
+  d_slots = static_cast<char*>(mapped) + headerSize + locksSize;
+}
+
+SharedCacheTable::~SharedCacheTable()
+{
+  if (d_header != nullptr) {
+    munmap(d_header, d_mappedSize);
+  }
+}
+
+SharedCacheTable::BucketLock::BucketLock(SharedCacheTable& table, size_t bucket, bool wait): d_lock(table.d_locks[bucket]), d_pid(getpid())
+{
+  int32_t holder = 0;
+  if (d_lock.compare_exchange_strong(holder, d_pid)) {
+    d_locked = true;
+    return;
+  }
+
+  if (!wait) {
+    return;
+  }
+
+  for (size_t attempts = 1; ; attempts++) {
+    holder = 0;
+    if (d_lock.compare_exchange_weak(holder, d_pid)) {
+      d_locked = true;
+      return;
+    }
+
+    /* check from time to time whether the process holding the lock is still there */
+    if ((attempts % 1024) == 0 && holder != 0 && holder != d_pid && kill(holder, 0) != 0 && errno == ESRCH) {
+      if (d_lock.compare_exchange_strong(holder, d_pid)) {
+        table.recoverBucket(bucket);
+        d_locked = true;
+        return;
+      }
+    }
+
+    std::this_thread::yield();
+  }
+}
+
+SharedCacheTable::BucketLock::~BucketLock()
+{
+  if (d_locked) {
+    d_lock.store(0);
+  }
+}
+
+SharedCacheTable::SlotHeader& SharedCacheTable::getSlot(size_t slot) const
+{
+  return *reinterpret_cast<SlotHeader*>(d_slots + slot * d_slotSize);
+}
+
+char* SharedCacheTable::getPayload(size_t slot) const
+{
+  return d_slots + slot * d_slotSize + sizeof(SlotHeader);
+}
+
+size_t SharedCacheTable::getBucket(uint32_t key) const
+{
+  /* the lowest bits of the key are used to select the shard, so mix them with the others */
+  return ((static_cast<uint64_t>(key) * 0x9E3779B97F4A7C15ULL) >> 32) % d_bucketsCount;
+}
+
+/* a sequence lock: the slot is copied, then we check that no writer modified it in the meantime */
+bool SharedCacheTable::snapshot(size_t slot, uint32_t& key, time_t& validity, char* buffer, size_t& payloadSize, uint32_t& sequence) const
+{
+  const auto& header = getSlot(slot);
+  const uint32_t before = header.sequence.load(std::memory_order_acquire);
+  if ((before & 1) != 0) {
+    return false;
+  }
+
+  key = header.key.load(std::memory_order_relaxed);
+  validity = static_cast<time_t>(header.validity.load(std::memory_order_relaxed));
+  payloadSize = header.payloadSize.load(std::memory_order_relaxed);
+  if (payloadSize == 0 || payloadSize > d_maxPayloadSize) {
+    return false;
+  }
+  memcpy(buffer, getPayload(slot), payloadSize);
+
+  std::atomic_thread_fence(std::memory_order_acquire);
+  if (header.sequence.load(std::memory_order_relaxed) != before) {
+    return false;
+  }
+
+  sequence = before;
+  return true;
+}
+
+size_t SharedCacheTable::find(uint32_t key, char* buffer, uint32_t now, Location& location, Usage& usage) const
+{
+  const size_t first = getBucket(key) * s_bucketSize;
+
+  for (size_t slot = first; slot < (first + s_bucketSize); slot++) {
+    auto& header = getSlot(slot);
+    if (header.payloadSize.load(std::memory_order_relaxed) == 0 || header.key.load(std::memory_order_relaxed) != key) {
+      continue;
+    }
+
+    for (size_t attempt = 0; attempt < s_maxReadAttempts; attempt++) {
+      uint32_t foundKey;
+      time_t validity;
+      size_t payloadSize;
+      uint32_t sequence;
+      if (!snapshot(slot, foundKey, validity, buffer, payloadSize, sequence)) {
+        continue;
+      }
+      if (foundKey != key) {
+        /* replaced in the meantime */
+        break;
+      }
+
+      location.slot = slot;
+      location.sequence = sequence;
+      /* these might be applied to an entry that has just replaced this one, which is fine */
+      if (now != 0) {
+        if (header.lastUsed.load(std::memory_order_relaxed) != now) {
+          header.lastUsed.store(now, std::memory_order_relaxed);
+        }
+        usage.hits = header.hits.fetch_add(1, std::memory_order_relaxed) + 1;
+      }
+      else {
+        usage.hits = header.hits.load(std::memory_order_relaxed);
+      }
+      usage.prefetchRequested = header.prefetchRequested.load(std::memory_order_relaxed) != 0;
+      return payloadSize;
+    }
+  }
+
+  return 0;
+}
+
+bool SharedCacheTable::requestPrefetch(const Location& location) const
+{
+  auto& header = getSlot(location.slot);
+  if (header.sequence.load() != location.sequence) {
+    return false;
+  }
+  return header.prefetchRequested.exchange(1) == 0;
+}
+
+/* has to be called with the lock of the bucket held */
+void SharedCacheTable::writeSlot(size_t slot, uint32_t key, time_t validity, const char* payload, size_t payloadSize)
+{
+  auto& header = getSlot(slot);
+  const uint32_t sequence = header.sequence.load(std::memory_order_relaxed);
+  header.sequence.store(sequence + 1, std::memory_order_relaxed);
+  std::atomic_thread_fence(std::memory_order_release);
+
+  header.key.store(key, std::memory_order_relaxed);
+  header.validity.store(static_cast<int64_t>(validity), std::memory_order_relaxed);
+  header.lastUsed.store(static_cast<uint32_t>(time(nullptr)), std::memory_order_relaxed);
+  header.hits.store(0, std::memory_order_relaxed);
+  header.prefetchRequested.store(0, std::memory_order_relaxed);
+  header.payloadSize.store(static_cast<uint16_t>(payloadSize), std::memory_order_relaxed);
+  memcpy(getPayload(slot), payload, payloadSize);
+
+  header.sequence.store(sequence + 2, std::memory_order_release);
+}
+
+/* has to be called with the lock of the bucket held */
+void SharedCacheTable::releaseSlot(size_t slot)
+{
+  auto& header = getSlot(slot);
+  const uint32_t sequence = header.sequence.load(std::memory_order_relaxed);
+  header.sequence.store(sequence + 1, std::memory_order_relaxed);
+  std::atomic_thread_fence(std::memory_order_release);
+  header.payloadSize.store(0, std::memory_order_relaxed);
+  header.sequence.store(sequence + 2, std::memory_order_release);
+  /* decremented after the slot has been emptied, see recoverBucket() */
+  d_header->entries--;
+}
+
+/* called after taking over the lock of a process that died while holding it.
+   The count of entries is incremented before writing into an empty slot, and
+   decremented after emptying one, so emptying the slot that was being written
+   to and decrementing the count keeps it right in every case */
+void SharedCacheTable::recoverBucket(size_t bucket)
+{
+  const size_t first = bucket * s_bucketSize;
+  for (size_t slot = first; slot < (first + s_bucketSize); slot++) {
+    auto& header = getSlot(slot);
+    const uint32_t sequence = header.sequence.load();
+    if ((sequence & 1) == 0) {
+      continue;
+    }
+    header.payloadSize.store(0);
+    header.sequence.store(sequence + 1);
+    d_header->entries--;
+  }
+}
+
+SharedCacheTable::InsertResult SharedCacheTable::insert(uint32_t key, time_t validity, const char* payload, size_t payloadSize, bool wait, const std::function<bool(const char* payload, size_t payloadSize, time_t validity)>& canReplace, const std::function<bool(uint32_t victimKey)>& canEvict)
+{
+  if (payloadSize == 0 || payloadSize > d_maxPayloadSize) {
+    return InsertResult::Refused;
+  }
+
+  const size_t bucket = getBucket(key);
+  BucketLock lock(*this, bucket, wait);
+  if (!lock.gotIt()) {
+    return InsertResult::Deferred;
+  }
+
+  const time_t now = time(nullptr);
+  const size_t first = bucket * s_bucketSize;
+  const size_t none = d_slotsCount;
+  size_t emptySlot = none;
+  size_t expiredSlot = none;
+  size_t lruSlot = none;
+  uint32_t lruLastUsed = std::numeric_limits<uint32_t>::max();
+
+  for (size_t slot = first; slot < (first + s_bucketSize); slot++) {
+    /* we hold the lock, so nobody else can modify the slots of this bucket */
+    auto& header = getSlot(slot);
+    const size_t existingSize = header.payloadSize.load(std::memory_order_relaxed);
+    if (existingSize == 0) {
+      if (emptySlot == none) {
+        emptySlot = slot;
+      }
+      continue;
+    }
+
+    const time_t existingValidity = static_cast<time_t>(header.validity.load(std::memory_order_relaxed));
+    if (header.key.load(std::memory_order_relaxed) == key) {
+      if (!canReplace(getPayload(slot), existingSize, existingValidity)) {
+        return InsertResult::Refused;
+      }
+      writeSlot(slot, key, validity, payload, payloadSize);
+      return InsertResult::Inserted;
+    }
+
+    if (existingValidity <= now) {
+      if (expiredSlot == none) {
+        expiredSlot = slot;
+      }
+      continue;
+    }
+
+    const uint32_t lastUsed = header.lastUsed.load(std::memory_order_relaxed);
+    if (lastUsed < lruLastUsed) {
+      lruLastUsed = lastUsed;
+      lruSlot = slot;
+    }
+  }
+
+  if (emptySlot != none) {
+    /* incremented before writing, see recoverBucket() */
+    d_header->entries++;
+    writeSlot(emptySlot, key, validity, payload, payloadSize);
+    return InsertResult::Inserted;
+  }
+
+  if (expiredSlot != none) {
+    writeSlot(expiredSlot, key, validity, payload, payloadSize);
+    return InsertResult::Inserted;
+  }
+
+  if (!canEvict || lruSlot == none || !canEvict(getSlot(lruSlot).key.load(std::memory_order_relaxed))) {
+    return InsertResult::Refused;
+  }
+
+  writeSlot(lruSlot, key, validity, payload, payloadSize);
+  return InsertResult::Evicted;
+}
+
+size_t SharedCacheTable::eraseIf(const std::function<bool(uint32_t key, time_t validity, const char* payload, size_t payloadSize)>& predicate, size_t upTo)
+{
+  size_t removed = 0;
+
+  for (size_t bucket = 0; bucket < d_bucketsCount && removed < upTo; bucket++) {
+    const size_t first = bucket * s_bucketSize;
+
+    /* don't bother taking the lock of empty buckets */
+    bool empty = true;
+    for (size_t slot = first; slot < (first + s_bucketSize); slot++) {
+      if (getSlot(slot).payloadSize.load(std::memory_order_relaxed) != 0) {
+        empty = false;
+        break;
+      }
+    }
+    if (empty) {
+      continue;
+    }
+
+    BucketLock lock(*this, bucket, true);
+    for (size_t slot = first; slot < (first + s_bucketSize) && removed < upTo; slot++) {
+      auto& header = getSlot(slot);
+      const size_t payloadSize = header.payloadSize.load(std::memory_order_relaxed);
+      if (payloadSize == 0) {
+        continue;
+      }
+
+      if (predicate(header.key.load(std::memory_order_relaxed), static_cast<time_t>(header.validity.load(std::memory_order_relaxed)), getPayload(slot), payloadSize)) {
+        releaseSlot(slot);
+        removed++;
+      }
+    }
+  }
+
+  return removed;
+}
+
+void SharedCacheTable::forEach(const std::function<void(uint32_t key, time_t validity, const char* payload, size_t payloadSize)>& visitor) const
+{
+  std::string buffer(d_maxPayloadSize, '\0');
+
+  for (size_t slot = 0; slot < d_slotsCount; slot++) {
+    if (getSlot(slot).payloadSize.load(std::memory_order_relaxed) == 0) {
+      continue;
+    }
+
+    for (size_t attempt = 0; attempt < s_maxReadAttempts; attempt++) {
+      uint32_t key;
+      time_t validity;
+      size_t payloadSize;
+      uint32_t sequence;
+      if (snapshot(slot, key, validity, &buffer.at(0), payloadSize, sequence)) {
+        visitor(key, validity, buffer.data(), payloadSize);
+        break;
+      }
+    }
+  }
+}
+
+uint64_t SharedCacheTable::size() const
+{
+  return d_header->entries.load();
+}
@@ -0,0 +1,155 @@
+/*
+ * This file is part of PowerDNS or dnsdist.
+ * Copyright -- PowerDNS.COM B.V. and its contributors
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of version 2 of the GNU General Public License as
+ * published by the Free Software Foundation.
+ *
+ * In addition, for the avoidance of any doubt, permission is granted to
+ * link this program with OpenSSL and to (re)distribute the binaries
+ * produced as the result of such linking.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+ */
+#pragma once
+
+#include <atomic>
+#include <ctime>
+#include <functional>
+#include <limits>
+#include <string>
+
+#include <boost/noncopyable.hpp>
+
+/* A fixed-size table of packet cache entries living in a memory-mapped file,
+   so that several processes on the same host can share the same entries.
+
+   The table does not know what an entry contains: the packet cache stores an
+   opaque payload along with the key and the validity of the entry. The file
+   starts with a header, followed by one lock per bucket then by the buckets
+   themselves, each holding s_bucketSize slots of the same size. A key always
+   goes to the same bucket, so a full bucket means that an entry has to be
+   evicted, or the new one refused, even if other buckets still have room.
+
+   Lookups never block: every slot has a sequence number, odd while the slot
+   is being written to, and a reader copies the slot then checks that the
+   sequence number did not change in the meantime.
+   Writers take the lock of the bucket, storing their PID into it so that the
+   lock held by a process that died can be taken over, the slot it was writing
+   to being emptied. All processes attached to the same file have to run in
+   the same PID namespace.
+*/
+class SharedCacheTable : boost::noncopyable
+{
+public:
+  static const size_t s_bucketSize = 8;
+
+  /* attach to the table stored in path, creating the file if it does not
+     exist. An existing file has to have been created with the same number
+     of entries, payload size and compatibility flags, otherwise an exception
+     is raised. maxEntries is rounded up to a multiple of s_bucketSize */
+  SharedCacheTable(const std::string& path, size_t maxEntries, size_t maxPayloadSize, uint32_t compatibilityFlags);
+  ~SharedCacheTable();
+
+  /* where an entry was found, to be able to update its usage state afterwards */
+  struct Location
+  {
+    size_t slot{0};
+    uint32_t sequence{0};
+  };
+
+  /* lock-free state of an entry, updated by lookups from all processes */
+  struct Usage
+  {
+    uint32_t hits{0};
+    bool prefetchRequested{false};
+  };
+
+  /* copy the payload of the entry for this key, if any, into buffer, which
+     has to be at least getMaxPayloadSize() long, and return its size, 0 if
+     there is no such entry. If now is not 0, the entry is marked as used at
+     that time and its hits count incremented. Never blocks */
+  size_t find(uint32_t key, char* buffer, uint32_t now, Location& location, Usage& usage) const;
+  /* mark the entry found at this location as being prefetched, returns false if
+     it already was, or if the entry has been replaced since */
+  bool requestPrefetch(const Location& location) const;
+
+  enum class InsertResult : uint8_t { Inserted, Evicted, Refused, Deferred };
+  /* insert the payload for this key. If there is already an entry for this
+     key, it is only replaced if canReplace returns true, and is given the
+     payload of the existing entry and its validity. If the bucket is full,
+     an expired entry is replaced, otherwise canEvict, if set, is given the key
+     of the least recently used entry and decides whether it should be evicted.
+     If wait is false and the lock of the bucket is held, the insertion is
+     deferred */
+  InsertResult insert(uint32_t key, time_t validity, const char* payload, size_t payloadSize, bool wait, const std::function<bool(const char* payload, size_t payloadSize, time_t validity)>& canReplace, const std::function<bool(uint32_t victimKey)>& canEvict);
+
+  /* remove, up to upTo, the entries for which the predicate returns true. The
+     lock of the bucket is held while the predicate is called, so the payload it
+     is given does not change */
+  size_t eraseIf(const std::function<bool(uint32_t key, time_t validity, const char* payload, size_t payloadSize)>& predicate, size_t upTo=std::numeric_limits<size_t>::max());
+  /* call the visitor on a copy of every entry. Never blocks, but an entry
+     inserted or removed during the walk might or might not be visited */
+  void forEach(const std::function<void(uint32_t key, time_t validity, const char* payload, size_t payloadSize)>& visitor) const;
+
+  /* the number of entries, shared by all the processes */
+  uint64_t size() const;
+  size_t getMaxEntries() const
+  {
+    return d_slotsCount;
+  }
+  size_t getMaxPayloadSize() const
+  {
+    return d_maxPayloadSize;
+  }
+  /* the size of the mapped file */
+  size_t getMappedSize() const
+  {
+    return d_mappedSize;
+  }
+
+private:
+  struct FileHeader;
+  struct SlotHeader;
+
+  class BucketLock : boost::noncopyable
+  {
+  public:
+    BucketLock(SharedCacheTable& table, size_t bucket, bool wait);
+    ~BucketLock();
+    bool gotIt() const
+    {
+      return d_locked;
+    }
+
+  private:
+    std::atomic<int32_t>& d_lock;
+    int32_t d_pid;
+    bool d_locked{false};
+  };
+
+  SlotHeader& getSlot(size_t slot) const;
+  char* getPayload(size_t slot) const;
+  size_t getBucket(uint32_t key) const;
+  bool snapshot(size_t slot, uint32_t& key, time_t& validity, char* buffer, size_t& payloadSize, uint32_t& sequence) const;
+  void writeSlot(size_t slot, uint32_t key, time_t validity, const char* payload, size_t payloadSize);
+  void releaseSlot(size_t slot);
+  void recoverBucket(size_t bucket);
+
+  FileHeader* d_header{nullptr};
+  std::atomic<int32_t>* d_locks{nullptr};
+  char* d_slots{nullptr};
+  size_t d_mappedSize{0};
+  size_t d_slotsCount{0};
+  size_t d_bucketsCount{0};
+  size_t d_maxPayloadSize{0};
+  size_t d_slotSize{0};
+};
@@ -30,14 +30,14 @@
 #include "ednssubnet.hh"
 #include "packetcache.hh"
 
-DNSDistPacketCache::DNSDistPacketCache(size_t maxEntries, uint32_t maxTTL, uint32_t minTTL, uint32_t tempFailureTTL, uint32_t maxNegativeTTL, uint32_t staleTTL, bool dontAge, uint32_t shards, bool deferrableInsertLock, bool parseECS): d_maxEntries(maxEntries), d_shardCount(shards), d_maxTTL(maxTTL), d_tempFailureTTL(tempFailureTTL), d_maxNegativeTTL(maxNegativeTTL), d_minTTL(minTTL), d_staleTTL(staleTTL), d_dontAge(dontAge), d_deferrableInsertLock(deferrableInsertLock), d_parseECS(parseECS)
+DNSDistPacketCache::DNSDistPacketCache(size_t maxEntries, uint32_t maxTTL, uint32_t minTTL, uint32_t tempFailureTTL, uint32_t maxNegativeTTL, uint32_t staleTTL, bool dontAge, uint32_t shards, bool deferrableInsertLock, bool parseECS, bool lockFreeLookups): d_maxEntries(maxEntries), d_shardCount(shards), d_maxTTL(maxTTL), d_tempFailureTTL(tempFailureTTL), d_maxNegativeTTL(maxNegativeTTL), d_minTTL(minTTL), d_staleTTL(staleTTL), d_dontAge(dontAge), d_deferrableInsertLock(deferrableInsertLock), d_parseECS(parseECS), d_lockFreeLookups(lockFreeLookups)
 {
   d_shards.resize(d_shardCount);
 
   /* we reserve maxEntries + 1 to avoid rehashing from occurring
      when we get to maxEntries, as it means a load factor of 1 */
   for (auto& shard : d_shards) {
-    shard.setSize((maxEntries / d_shardCount) + 1);
+    shard.setSize((maxEntries / d_shardCount) + 1, d_lockFreeLookups);
   }
 }
 
@@ -53,6 +53,366 @@ DNSDistPacketCache::~DNSDistPacketCache()
   }
 }
 
+static const char* getSubnetAddress(const ComboAddress& network)
+{
+  if (network.isIPv4()) {
+    return reinterpret_cast<const char*>(&network.sin4.sin_addr.s_addr);
+  }
+  return reinterpret_cast<const char*>(&network.sin6.sin6_addr.s6_addr);
+}
+
+/* DNS-native comparison (case insensitive) of two names in wire format */
+static bool wireNamesEqual(const char* first, const char* second, size_t len)
+{
+  for (size_t idx = 0; idx < len; idx++) {
+    if (dns_tolower(first[idx]) != dns_tolower(second[idx])) {
+      return false;
+    }
+  }
+  return true;
+}
+
+DNSDistPacketCache::CacheValue::CacheValue(const char* response, uint16_t responseLen, const DNSName& qname, const boost::optional<Netmask>& subnet): len(responseLen)
+{
+  const auto& storage = qname.getStorage();
+  /* a name in wire format can't be longer than 255 bytes */
+  d_qnameLen = static_cast<uint8_t>(storage.size());
+  /* responses start with the question, so most of the time we don't need to store the qname twice */
+  d_qnameInResponse = responseLen >= (sizeof(dnsheader) + d_qnameLen) && reinterpret_cast<const dnsheader*>(response)->qdcount != htons(0) && wireNamesEqual(response + sizeof(dnsheader), storage.data(), d_qnameLen);
+
+  if (subnet) {
+    d_subnetFamily = subnet->getNetwork().isIPv4() ? 4 : 6;
+    d_subnetBits = subnet->getBits();
+  }
+
+  d_data = std::unique_ptr<char[]>(new char[getDataSize()]);
+  memcpy(d_data.get(), response, responseLen);
+  if (!d_qnameInResponse) {
+    memcpy(d_data.get() + responseLen, storage.data(), d_qnameLen);
+  }
+  if (subnet) {
+    memcpy(const_cast<char*>(getSubnetData()), getSubnetAddress(subnet->getNetwork()), d_subnetFamily == 4 ? 4 : 16);
+  }
+}
+
+size_t DNSDistPacketCache::CacheValue::getDataSize() const
+{
+  size_t size = len;
+  if (!d_qnameInResponse) {
+    size += d_qnameLen;
+  }
+  if (d_subnetFamily == 4) {
+    size += 4;
+  }
+  else if (d_subnetFamily == 6) {
+    size += 16;
+  }
+  return size;
+}
+
+DNSName DNSDistPacketCache::CacheValue::getQName() const
+{
+  if (d_qnameLen == 0) {
+    return DNSName();
+  }
+  return DNSName(getQNameWire(), d_qnameLen, 0, false);
+}
+
+bool DNSDistPacketCache::CacheValue::qnameMatches(const DNSName& qname) const
+{
+  const auto& storage = qname.getStorage();
+  return storage.size() == d_qnameLen && wireNamesEqual(getQNameWire(), storage.data(), d_qnameLen);
+}
+
+bool DNSDistPacketCache::CacheValue::qnameIsPartOf(const DNSName& zone) const
+{
+  const auto& storage = zone.getStorage();
+  const char* qname = getQNameWire();
+  /* walk the labels of the qname until what remains has the length of the zone */
+  size_t pos = 0;
+  while (pos < d_qnameLen && (d_qnameLen - pos) > storage.size()) {
+    pos += static_cast<uint8_t>(qname[pos]) + 1;
+  }
+  return (d_qnameLen - pos) == storage.size() && wireNamesEqual(qname + pos, storage.data(), storage.size());
+}
+
+boost::optional<Netmask> DNSDistPacketCache::CacheValue::getSubnet() const
+{
+  if (d_subnetFamily == 0) {
+    return boost::none;
+  }
+
+  ComboAddress network;
+  if (d_subnetFamily == 4) {
+    network.sin4.sin_family = AF_INET;
+    memcpy(&network.sin4.sin_addr.s_addr, getSubnetData(), 4);
+  }
+  else {
+    network.sin6.sin6_family = AF_INET6;
+    memcpy(&network.sin6.sin6_addr.s6_addr, getSubnetData(), 16);
+  }
+  return Netmask(network, d_subnetBits);
+}
+
+bool DNSDistPacketCache::CacheValue::subnetMatches(const boost::optional<Netmask>& subnet) const
+{
+  if (!subnet) {
+    return d_subnetFamily == 0;
+  }
+
+  const auto& network = subnet->getNetwork();
+  const uint8_t family = network.isIPv4() ? 4 : 6;
+  return d_subnetFamily == family && d_subnetBits == subnet->getBits() && memcmp(getSubnetData(), getSubnetAddress(network), family == 4 ? 4 : 16) == 0;
+}
+
+/* the fixed-size part of a serialized value, followed by the data */
+struct SerializedCacheValue
+{
+  int64_t added;
+  int64_t validity;
+  uint16_t qtype;
+  uint16_t qclass;
+  uint16_t queryFlags;
+  uint16_t len;
+  uint8_t qnameLen;
+  uint8_t subnetFamily;
+  uint8_t subnetBits;
+  uint8_t flags;
+};
+
+static const uint8_t s_serializedTCP{1};
+static const uint8_t s_serializedDNSSECOK{2};
+static const uint8_t s_serializedQNameInResponse{4};
+
+size_t DNSDistPacketCache::CacheValue::getSerializedSize() const
+{
+  return sizeof(SerializedCacheValue) + getDataSize();
+}
+
+void DNSDistPacketCache::CacheValue::serialize(char* buffer) const
+{
+  SerializedCacheValue header;
+  header.added = static_cast<int64_t>(added);
+  header.validity = static_cast<int64_t>(validity);
+  header.qtype = qtype;
+  header.qclass = qclass;
+  header.queryFlags = queryFlags;
+  header.len = len;
+  header.qnameLen = d_qnameLen;
+  header.subnetFamily = d_subnetFamily;
+  header.subnetBits = d_subnetBits;
+  header.flags = (tcp ? s_serializedTCP : 0) | (dnssecOK ? s_serializedDNSSECOK : 0) | (d_qnameInResponse ? s_serializedQNameInResponse : 0);
+  memcpy(buffer, &header, sizeof(header));
+  memcpy(buffer + sizeof(header), d_data.get(), getDataSize());
+}
+
+bool DNSDistPacketCache::CacheValue::unserialize(const char* buffer, size_t size, CacheValue& value)
+{
+  SerializedCacheValue header;
+  if (size < sizeof(header)) {
+    return false;
+  }
+  memcpy(&header, buffer, sizeof(header));
+
+  value.added = static_cast<time_t>(header.added);
+  value.validity = static_cast<time_t>(header.validity);
+  value.qtype = header.qtype;
+  value.qclass = header.qclass;
+  value.queryFlags = header.queryFlags;
+  value.len = header.len;
+  value.tcp = header.flags & s_serializedTCP;
+  value.dnssecOK = header.flags & s_serializedDNSSECOK;
+  value.d_qnameLen = header.qnameLen;
+  value.d_qnameInResponse = header.flags & s_serializedQNameInResponse;
+  value.d_subnetFamily = header.subnetFamily;
+  value.d_subnetBits = header.subnetBits;
+
+  const size_t dataSize = value.getDataSize();
+  if (value.len < sizeof(dnsheader) || (value.d_subnetFamily != 0 && value.d_subnetFamily != 4 && value.d_subnetFamily != 6) || (size - sizeof(header)) != dataSize) {
+    return false;
+  }
+
+  value.d_data = std::unique_ptr<char[]>(new char[dataSize]);
+  memcpy(value.d_data.get(), buffer + sizeof(header), dataSize);
+  return true;
+}
+
+size_t DNSDistPacketCache::CacheShard::eraseIf(const std::function<bool(uint32_t key, const CacheValue& value)>& predicate, size_t upTo)
+{
+  size_t removed = 0;
+
+  if (d_table) {
+    removed = d_table->eraseIf(predicate, upTo);
+  }
+  else {
+    for (auto it = d_map.begin(); removed < upTo && it != d_map.end(); ) {
+      if (predicate(it->first, it->second)) {
+        it = d_map.erase(it);
+        ++removed;
+      }
+      else {
+        ++it;
+      }
+    }
+  }
+
+  d_entriesCount -= removed;
+  return removed;
+}
+
+void DNSDistPacketCache::CacheShard::forEach(const std::function<void(uint32_t key, const CacheValue& value)>& visitor) const
+{
+  if (d_table) {
+    d_table->forEach(visitor);
+    return;
+  }
+
+  for (const auto& entry : d_map) {
+    visitor(entry.first, entry.second);
+  }
+}
+
+const DNSDistPacketCache::CacheValue* DNSDistPacketCache::CacheShard::sample(uint32_t& key)
+{
+  /* xorshift32, we only need something cheap and reasonably spread */
+  d_sampleState ^= d_sampleState << 13;
+  d_sampleState ^= d_sampleState >> 17;
+  d_sampleState ^= d_sampleState << 5;
+
+  if (d_table) {
+    return d_table->sample(d_sampleState, key);
+  }
+
+  if (d_map.empty()) {
+    return nullptr;
+  }
+
+  /* the map has about as many buckets as entries once the shard is full,
+     so we should find a non-empty bucket right away */
+  const size_t buckets = d_map.bucket_count();
+  size_t bucket = d_sampleState % buckets;
+  for (size_t tried = 0; tried < buckets; tried++, bucket = (bucket + 1) % buckets) {
+    auto it = d_map.begin(bucket);
+    if (it != d_map.end(bucket)) {
+      key = it->first;
+      return &it->second;
+    }
+  }
+
+  return nullptr;
+}
+
+size_t DNSDistPacketCache::CacheShard::getMemoryUsage() const
+{
+  size_t usage = 0;
+  if (d_table) {
+    usage = d_table->getMemoryUsage();
+  }
+  else {
+    /* the buckets, then one node per entry holding a pointer to the next one */
+    usage = d_map.bucket_count() * sizeof(void*) + d_map.size() * (sizeof(void*) + sizeof(decltype(d_map)::value_type));
+  }
+
+  forEach([&usage](uint32_t, const CacheValue& value) {
+    usage += value.getDataSize();
+  });
+
+  return usage;
+}
+
+void DNSDistPacketCache::FrequencySketch::setSize(size_t maxEntries)
+{
+  d_width = 16;
+  while (d_width < maxEntries) {
+    d_width <<= 1;
+  }
+
+  d_counters = std::unique_ptr<std::atomic<uint8_t>[]>(new std::atomic<uint8_t>[d_width * s_depth]);
+  for (size_t idx = 0; idx < d_width * s_depth; idx++) {
+    d_counters[idx].store(0, std::memory_order_relaxed);
+  }
+  d_additions.store(0);
+}
+
+/* the position of the counter of that key in a given row, using double hashing */
+static size_t getSketchIndex(uint32_t key, size_t row, size_t width)
+{
+  const uint64_t hash = static_cast<uint64_t>(key) * 0x9E3779B97F4A7C15ULL;
+  const uint32_t first = static_cast<uint32_t>(hash >> 32);
+  const uint32_t second = static_cast<uint32_t>(hash) | 1;
+  return row * width + ((first + row * second) & (width - 1));
+}
+
+void DNSDistPacketCache::FrequencySketch::add(uint32_t key)
+{
+  if (!d_counters) {
+    return;
+  }
+
+  for (size_t row = 0; row < s_depth; row++) {
+    auto& counter = d_counters[getSketchIndex(key, row, d_width)];
+    /* a concurrent increment might be lost, which is fine */
+    const uint8_t count = counter.load(std::memory_order_relaxed);
+    if (count < s_maxCount) {
+      counter.store(count + 1, std::memory_order_relaxed);
+    }
+  }
+
+  if ((d_additions.fetch_add(1, std::memory_order_relaxed) + 1) == (d_width * 10)) {
+    for (size_t idx = 0; idx < d_width * s_depth; idx++) {
+      d_counters[idx].store(d_counters[idx].load(std::memory_order_relaxed) >> 1, std::memory_order_relaxed);
+    }
+    d_additions.store(0, std::memory_order_relaxed);
+  }
+}
+
+uint8_t DNSDistPacketCache::FrequencySketch::estimate(uint32_t key) const
+{
+  if (!d_counters) {
+    return 0;
+  }
+
+  uint8_t result = s_maxCount;
+  for (size_t row = 0; row < s_depth; row++) {
+    result = std::min(result, d_counters[getSketchIndex(key, row, d_width)].load(std::memory_order_relaxed));
+  }
+  return result;
+}
+
+void DNSDistPacketCache::setEvictionPolicy(EvictionPolicy policy)
+{
+  if (policy == EvictionPolicy::TinyLFU) {
+    for (auto& shard : d_shards) {
+      shard.d_sketch.setSize((d_maxEntries / d_shardCount) + 1);
+    }
+  }
+  d_evictionPolicy = policy;
+}
+
+/* the largest response that can be stored in shared memory, so that lookups can copy an entry to the stack */
+static const uint16_t s_sharedMaxResponseSize{4096};
+/* the serialized value, the response, and a subnet. The qname is usually part of the response */
+static const size_t s_sharedMaxPayloadSize{sizeof(SerializedCacheValue) + s_sharedMaxResponseSize + 16};
+
+void DNSDistPacketCache::setSharedMemory(const std::string& path, uint16_t maxResponseSize)
+{
+  if (maxResponseSize < sizeof(dnsheader) || maxResponseSize > s_sharedMaxResponseSize) {
+    throw std::runtime_error("The maximum size of a response stored in shared memory should be between " + std::to_string(sizeof(dnsheader)) + " and " + std::to_string(s_sharedMaxResponseSize));
+  }
+
+  /* processes computing the keys differently can't share entries */
+  const uint32_t compatibilityFlags = d_cookieHashing ? 1 : 0;
+  d_sharedTable = std::unique_ptr<SharedCacheTable>(new SharedCacheTable(path, d_maxEntries, sizeof(SerializedCacheValue) + maxResponseSize + 16, compatibilityFlags));
+
+  /* release the memory reserved by the shards, which are now empty */
+  for (auto& shard : d_shards) {
+    WriteLock w(&shard.d_lock);
+    std::unordered_map<uint32_t,CacheValue>().swap(shard.d_map);
+    shard.d_table.reset();
+    shard.d_entriesCount = 0;
+  }
+}
+
 bool DNSDistPacketCache::getClientSubnet(const char* packet, unsigned int consumed, uint16_t len, boost::optional<Netmask>& subnet)
 {
   uint16_t optRDPosition;
@@ -81,50 +441,139 @@ bool DNSDistPacketCache::getClientSubnet(const char* packet, unsigned int consum
 
 bool DNSDistPacketCache::cachedValueMatches(const CacheValue& cachedValue, uint16_t queryFlags, const DNSName& qname, uint16_t qtype, uint16_t qclass, bool tcp, bool dnssecOK, const boost::optional<Netmask>& subnet) const
 {
-  if (cachedValue.queryFlags != queryFlags || cachedValue.dnssecOK != dnssecOK || cachedValue.tcp != tcp || cachedValue.qtype != qtype || cachedValue.qclass != qclass || cachedValue.qname != qname) {
+  if (cachedValue.queryFlags != queryFlags || cachedValue.dnssecOK != dnssecOK || cachedValue.tcp != tcp || cachedValue.qtype != qtype || cachedValue.qclass != qclass || !cachedValue.qnameMatches(qname)) {
     return false;
   }
 
-  if (d_parseECS && cachedValue.subnet != subnet) {
+  if (d_parseECS && !cachedValue.subnetMatches(subnet)) {
     return false;
   }
 
   return true;
 }
 
-void DNSDistPacketCache::insertLocked(CacheShard& shard, uint32_t key, CacheValue& newValue)
+/* Make room in a full shard for the entry of that key, by evicting an expired
+   entry or the least recently used one out of a few randomly selected ones.
+   Returns false if the new entry should not be inserted. */
+bool DNSDistPacketCache::evictLocked(CacheShard& shard, uint32_t key, time_t now)
 {
-  auto& map = shard.d_map;
-  /* check again now that we hold the lock to prevent a race */
-  if (map.size() >= (d_maxEntries / d_shardCount)) {
-    return;
+  static const size_t samples = 5;
+  const CacheValue* victim = nullptr;
+  uint32_t victimKey = 0;
+
+  for (size_t idx = 0; idx < samples; idx++) {
+    uint32_t sampledKey = 0;
+    const CacheValue* sampled = shard.sample(sampledKey);
+    if (sampled == nullptr) {
+      break;
+    }
+
+    if (sampled->validity <= now) {
+      /* no need to look any further */
+      victim = sampled;
+      victimKey = sampledKey;
+      break;
+    }
+
+    if (victim == nullptr || sampled->getLastUsed() < victim->getLastUsed() || (sampled->getLastUsed() == victim->getLastUsed() && sampled->validity < victim->validity)) {
+      victim = sampled;
+      victimKey = sampledKey;
+    }
   }
 
-  std::unordered_map<uint32_t,CacheValue>::iterator it;
-  bool result;
-  tie(it, result) = map.insert({key, newValue});
+  if (victim == nullptr) {
+    return false;
+  }
+
+  if (d_evictionPolicy == EvictionPolicy::TinyLFU && victim->validity > now && shard.d_sketch.estimate(key) <= shard.d_sketch.estimate(victimKey)) {
+    d_rejectedAdmissions++;
+    return false;
+  }
 
-  if (result) {
+  shard.erase(victimKey);
+  shard.d_entriesCount--;
+  d_evictions++;
+  return true;
+}
+
+void DNSDistPacketCache::insertLocked(CacheShard& shard, uint32_t key, CacheValue&& newValue, const DNSName& qname, const boost::optional<Netmask>& subnet)
+{
+  const CacheValue* existing = shard.find(key);
+
+  if (existing == nullptr) {
+    /* check again now that we hold the lock to prevent a race */
+    if (shard.size() >= (d_maxEntries / d_shardCount) && (d_evictionPolicy == EvictionPolicy::None || !evictLocked(shard, key, newValue.added))) {
+      return;
+    }
+
+    shard.insert(key, std::move(newValue));
     shard.d_entriesCount++;
     return;
   }
 
+  if (shouldReplace(*existing, newValue, qname, subnet)) {
+    shard.replace(key, std::move(newValue));
+  }
+}
+
+bool DNSDistPacketCache::shouldReplace(const CacheValue& existing, const CacheValue& newValue, const DNSName& qname, const boost::optional<Netmask>& subnet)
+{
   /* in case of collision, don't override the existing entry
      except if it has expired */
-  CacheValue& value = it->second;
-  bool wasExpired = value.validity <= newValue.added;
+  bool wasExpired = existing.validity <= newValue.added;
 
-  if (!wasExpired && !cachedValueMatches(value, newValue.queryFlags, newValue.qname, newValue.qtype, newValue.qclass, newValue.tcp, newValue.dnssecOK, newValue.subnet)) {
+  if (!wasExpired && !cachedValueMatches(existing, newValue.queryFlags, qname, newValue.qtype, newValue.qclass, newValue.tcp, newValue.dnssecOK, subnet)) {
     d_insertCollisions++;
-    return;
+    return false;
   }
 
   /* if the existing entry had a longer TTD, keep it */
-  if (newValue.validity <= value.validity) {
-    return;
+  return newValue.validity > existing.validity;
+}
+
+bool DNSDistPacketCache::insertShared(uint32_t key, const CacheValue& newValue, const DNSName& qname, const boost::optional<Netmask>& subnet, bool wait)
+{
+  const size_t size = newValue.getSerializedSize();
+  if (size > d_sharedTable->getMaxPayloadSize()) {
+    return false;
   }
 
-  value = newValue;
+  char buffer[s_sharedMaxPayloadSize];
+  newValue.serialize(buffer);
+
+  auto canReplace = [this, &newValue, &qname, &subnet](const char* payload, size_t payloadSize, time_t) {
+    CacheValue existing;
+    if (!CacheValue::unserialize(payload, payloadSize, existing)) {
+      return true;
+    }
+    return shouldReplace(existing, newValue, qname, subnet);
+  };
+
+  std::function<bool(uint32_t)> canEvict;
+  if (d_evictionPolicy != EvictionPolicy::None) {
+    canEvict = [this, key](uint32_t victimKey) {
+      /* the lookups of a key are counted in the sketch of the shard it belongs to */
+      if (d_evictionPolicy == EvictionPolicy::TinyLFU && d_shards.at(getShardIndex(key)).d_sketch.estimate(key) <= d_shards.at(getShardIndex(victimKey)).d_sketch.estimate(victimKey)) {
+        d_rejectedAdmissions++;
+        return false;
+      }
+      return true;
+    };
+  }
+
+  switch (d_sharedTable->insert(key, newValue.validity, buffer, size, wait, canReplace, canEvict)) {
+  case SharedCacheTable::InsertResult::Inserted:
+    return true;
+  case SharedCacheTable::InsertResult::Evicted:
+    d_evictions++;
+    return true;
+  case SharedCacheTable::InsertResult::Deferred:
+    d_deferredInserts++;
+    return false;
+  case SharedCacheTable::InsertResult::Refused:
+    break;
+  }
+  return false;
 }
 
 void DNSDistPacketCache::insert(uint32_t key, const boost::optional<Netmask>& subnet, uint16_t queryFlags, bool dnssecOK, const DNSName& qname, uint16_t qtype, uint16_t qclass, const char* response, uint16_t responseLen, bool tcp, uint8_t rcode, boost::optional<uint32_t> tempFailureTTL)
@@ -165,24 +614,26 @@ void DNSDistPacketCache::insert(uint32_t key, const boost::optional<Netmask>& su
 
   uint32_t shardIndex = getShardIndex(key);
 
-  if (d_shards.at(shardIndex).d_entriesCount >= (d_maxEntries / d_shardCount)) {
+  /* no need to go any further, unless we might evict an entry or replace an existing one */
+  if (d_evictionPolicy == EvictionPolicy::None && d_shards.at(shardIndex).d_entriesCount >= (d_maxEntries / d_shardCount)) {
     return;
   }
 
   const time_t now = time(nullptr);
   time_t newValidity = now + minTTL;
-  CacheValue newValue;
-  newValue.qname = qname;
+  CacheValue newValue(response, responseLen, qname, subnet);
   newValue.qtype = qtype;
   newValue.qclass = qclass;
   newValue.queryFlags = queryFlags;
-  newValue.len = responseLen;
   newValue.validity = newValidity;
   newValue.added = now;
   newValue.tcp = tcp;
   newValue.dnssecOK = dnssecOK;
-  newValue.value = std::string(response, responseLen);
-  newValue.subnet = subnet;
+
+  if (d_sharedTable) {
+    insertShared(key, newValue, qname, subnet, !d_deferrableInsertLock);
+    return;
+  }
 
   auto& shard = d_shards.at(shardIndex);
 
@@ -193,16 +644,121 @@ void DNSDistPacketCache::insert(uint32_t key, const boost::optional<Netmask>& su
       d_deferredInserts++;
       return;
     }
-    insertLocked(shard, key, newValue);
+    insertLocked(shard, key, std::move(newValue), qname, subnet);
   }
   else {
     WriteLock w(&shard.d_lock);
 
-    insertLocked(shard, key, newValue);
+    insertLocked(shard, key, std::move(newValue), qname, subnet);
   }
 }
 
-bool DNSDistPacketCache::get(const DNSQuestion& dq, uint16_t consumed, uint16_t queryId, char* response, uint16_t* responseLen, uint32_t* keyOut, boost::optional<Netmask>& subnet, bool dnssecOK, uint32_t allowExpired, bool skipAging)
+bool DNSDistPacketCache::getLocked(const CacheValue* cachedValue, const DNSQuestion& dq, const DNSName::string_t& dnsQName, uint16_t queryId, char* response, uint16_t* responseLen, const boost::optional<Netmask>& subnet, bool dnssecOK, time_t now, uint32_t allowExpired, time_t& age, bool& needsAging, bool* prefetch)
+{
+  if (cachedValue == nullptr) {
+    d_misses++;
+    return false;
+  }
+
+  const CacheValue& value = *cachedValue;
+  bool stale = false;
+  if (value.validity <= now) {
+    if ((now - value.validity) >= static_cast<time_t>(allowExpired)) {
+      d_misses++;
+      return false;
+    }
+    else {
+      stale = true;
+    }
+  }
+
+  if (*responseLen < value.len || value.len < sizeof(dnsheader)) {
+    return false;
+  }
+
+  /* check for collision */
+  if (!cachedValueMatches(value, *(getFlagsFromDNSHeader(dq.dh)), *dq.qname, dq.qtype, dq.qclass, dq.tcp, dnssecOK, subnet)) {
+    d_lookupCollisions++;
+    return false;
+  }
+
+  if (d_evictionPolicy != EvictionPolicy::None) {
+    /* only write when the value changes, to limit the contention on popular entries */
+    const uint32_t used = static_cast<uint32_t>(now);
+    if (value.usage.lastUsed.load(std::memory_order_relaxed) != used) {
+      value.usage.lastUsed.store(used, std::memory_order_relaxed);
+    }
+  }
+
+  if (prefetch != nullptr && !stale && d_prefetchTTLPercentage > 0) {
+    const uint32_t hits = ++value.usage.hits;
+    const time_t ttl = value.validity - value.added;
+    const time_t remaining = value.validity - now;
+    /* only the first hit meeting the conditions triggers a prefetch */
+    if (hits >= d_prefetchMinHits && (remaining * 100) <= (ttl * d_prefetchTTLPercentage) && !value.usage.prefetchRequested.exchange(true)) {
+      *prefetch = true;
+      ++d_prefetches;
+    }
+  }
+
+  memcpy(response, &queryId, sizeof(queryId));
+  memcpy(response + sizeof(queryId), value.getResponse() + sizeof(queryId), sizeof(dnsheader) - sizeof(queryId));
+
+  if (value.len == sizeof(dnsheader)) {
+    /* DNS header only, our work here is done */
+    *responseLen = value.len;
+    needsAging = false;
+    return true;
+  }
+
+  const size_t dnsQNameLen = dnsQName.length();
+  if (value.len < (sizeof(dnsheader) + dnsQNameLen)) {
+    return false;
+  }
+
+  memcpy(response + sizeof(dnsheader), dnsQName.c_str(), dnsQNameLen);
+  if (value.len > (sizeof(dnsheader) + dnsQNameLen)) {
+    memcpy(response + sizeof(dnsheader) + dnsQNameLen, value.getResponse() + sizeof(dnsheader) + dnsQNameLen, value.len - (sizeof(dnsheader) + dnsQNameLen));
+  }
+  *responseLen = value.len;
+  if (!stale) {
+    age = now - value.added;
+  }
+  else {
+    age = (value.validity - value.added) - d_staleTTL;
+  }
+  needsAging = true;
+  return true;
+}
+
+bool DNSDistPacketCache::getShared(uint32_t key, const DNSQuestion& dq, const DNSName::string_t& dnsQName, uint16_t queryId, char* response, uint16_t* responseLen, const boost::optional<Netmask>& subnet, bool dnssecOK, time_t now, uint32_t allowExpired, time_t& age, bool& needsAging, bool* prefetch)
+{
+  char buffer[s_sharedMaxPayloadSize];
+  SharedCacheTable::Location location;
+  SharedCacheTable::Usage usage;
+  CacheValue value;
+
+  const size_t size = d_sharedTable->find(key, buffer, static_cast<uint32_t>(now), location, usage);
+  if (size == 0 || !CacheValue::unserialize(buffer, size, value)) {
+    return getLocked(nullptr, dq, dnsQName, queryId, response, responseLen, subnet, dnssecOK, now, allowExpired, age, needsAging, prefetch);
+  }
+
+  /* the usage state is kept in the shared table, which has already counted
+     this hit: getLocked() will count it again on this copy */
+  value.usage.hits.store(usage.hits > 0 ? usage.hits - 1 : 0);
+  value.usage.prefetchRequested.store(usage.prefetchRequested);
+
+  bool found = getLocked(&value, dq, dnsQName, queryId, response, responseLen, subnet, dnssecOK, now, allowExpired, age, needsAging, prefetch);
+  if (found && prefetch != nullptr && *prefetch && !d_sharedTable->requestPrefetch(location)) {
+    /* another thread or process asked for it first */
+    *prefetch = false;
+    --d_prefetches;
+  }
+
+  return found;
+}
+
+bool DNSDistPacketCache::get(const DNSQuestion& dq, uint16_t consumed, uint16_t queryId, char* response, uint16_t* responseLen, uint32_t* keyOut, boost::optional<Netmask>& subnet, bool dnssecOK, uint32_t allowExpired, bool skipAging, bool* prefetch)
 {
   const auto& dnsQName = dq.qname->getStorage();
   uint32_t key = getKey(dnsQName, consumed, reinterpret_cast<const unsigned char*>(dq.dh), dq.len, dq.tcp);
@@ -217,73 +773,38 @@ bool DNSDistPacketCache::get(const DNSQuestion& dq, uint16_t consumed, uint16_t
 
   uint32_t shardIndex = getShardIndex(key);
   time_t now = time(nullptr);
-  time_t age;
-  bool stale = false;
+  time_t age = 0;
+  bool needsAging = false;
+  bool found = false;
   auto& shard = d_shards.at(shardIndex);
-  auto& map = shard.d_map;
-  {
+
+  if (d_evictionPolicy == EvictionPolicy::TinyLFU) {
+    shard.d_sketch.add(key);
+  }
+
+  if (d_sharedTable) {
+    found = getShared(key, dq, dnsQName, queryId, response, responseLen, subnet, dnssecOK, now, allowExpired, age, needsAging, prefetch);
+  }
+  else if (shard.d_table) {
+    /* never blocks, even if a writer is holding the lock */
+    LockFreeCacheTable<CacheValue>::ReadGuard guard(*shard.d_table);
+    found = getLocked(shard.d_table->find(key), dq, dnsQName, queryId, response, responseLen, subnet, dnssecOK, now, allowExpired, age, needsAging, prefetch);
+  }
+  else {
     TryReadLock r(&shard.d_lock);
     if (!r.gotIt()) {
       d_deferredLookups++;
       return false;
     }
 
-    std::unordered_map<uint32_t,CacheValue>::const_iterator it = map.find(key);
-    if (it == map.end()) {
-      d_misses++;
-      return false;
-    }
-
-    const CacheValue& value = it->second;
-    if (value.validity <= now) {
-      if ((now - value.validity) >= static_cast<time_t>(allowExpired)) {
-        d_misses++;
-        return false;
-      }
-      else {
-        stale = true;
-      }
-    }
-
-    if (*responseLen < value.len || value.len < sizeof(dnsheader)) {
-      return false;
-    }
-
-    /* check for collision */
-    if (!cachedValueMatches(value, *(getFlagsFromDNSHeader(dq.dh)), *dq.qname, dq.qtype, dq.qclass, dq.tcp, dnssecOK, subnet)) {
-      d_lookupCollisions++;
-      return false;
-    }
-
-    memcpy(response, &queryId, sizeof(queryId));
-    memcpy(response + sizeof(queryId), value.value.c_str() + sizeof(queryId), sizeof(dnsheader) - sizeof(queryId));
-
-    if (value.len == sizeof(dnsheader)) {
-      /* DNS header only, our work here is done */
-      *responseLen = value.len;
-      d_hits++;
-      return true;
-    }
-
-    const size_t dnsQNameLen = dnsQName.length();
-    if (value.len < (sizeof(dnsheader) + dnsQNameLen)) {
-      return false;
-    }
+    found = getLocked(shard.find(key), dq, dnsQName, queryId, response, responseLen, subnet, dnssecOK, now, allowExpired, age, needsAging, prefetch);
+  }
 
-    memcpy(response + sizeof(dnsheader), dnsQName.c_str(), dnsQNameLen);
-    if (value.len > (sizeof(dnsheader) + dnsQNameLen)) {
-      memcpy(response + sizeof(dnsheader) + dnsQNameLen, value.value.c_str() + sizeof(dnsheader) + dnsQNameLen, value.len - (sizeof(dnsheader) + dnsQNameLen));
-    }
-    *responseLen = value.len;
-    if (!stale) {
-      age = now - value.added;
-    }
-    else {
-      age = (value.validity - value.added) - d_staleTTL;
-    }
+  if (!found) {
+    return false;
   }
 
-  if (!d_dontAge && !skipAging) {
+  if (needsAging && !d_dontAge && !skipAging) {
     ageDNSPacket(response, *responseLen, age);
   }
 
@@ -308,24 +829,21 @@ size_t DNSDistPacketCache::purgeExpired(size_t upTo)
   size_t scannedMaps = 0;
 
   const time_t now = time(nullptr);
+  if (d_sharedTable) {
+    return d_sharedTable->eraseIf([now](uint32_t, time_t validity, const char*, size_t) {
+      return validity <= now;
+    }, toRemove);
+  }
+
   do {
     uint32_t shardIndex = (d_expungeIndex++ % d_shardCount);
     WriteLock w(&d_shards.at(shardIndex).d_lock);
-    auto& map = d_shards[shardIndex].d_map;
-
-    for(auto it = map.begin(); toRemove > 0 && it != map.end(); ) {
-      const CacheValue& value = it->second;
-
-      if (value.validity <= now) {
-        it = map.erase(it);
-        --toRemove;
-        d_shards[shardIndex].d_entriesCount--;
-        ++removed;
-      } else {
-        ++it;
-      }
-    }
+    size_t removedFromShard = d_shards[shardIndex].eraseIf([now](uint32_t, const CacheValue& value) {
+      return value.validity <= now;
+    }, toRemove);
 
+    toRemove -= removedFromShard;
+    removed += removedFromShard;
     scannedMaps++;
   }
   while (toRemove > 0 && scannedMaps < d_shardCount);
@@ -346,23 +864,18 @@ size_t DNSDistPacketCache::expunge(size_t upTo)
 
   size_t toRemove = size - upTo;
 
+  if (d_sharedTable) {
+    return d_sharedTable->eraseIf([](uint32_t, time_t, const char*, size_t) {
+      return true;
+    }, toRemove);
+  }
+
   for (uint32_t shardIndex = 0; shardIndex < d_shardCount; shardIndex++) {
     WriteLock w(&d_shards.at(shardIndex).d_lock);
-    auto& map = d_shards[shardIndex].d_map;
-    auto beginIt = map.begin();
-    auto endIt = beginIt;
     size_t removeFromThisShard = (toRemove - removed) / (d_shardCount - shardIndex);
-    if (map.size() >= removeFromThisShard) {
-      std::advance(endIt, removeFromThisShard);
-      map.erase(beginIt, endIt);
-      d_shards[shardIndex].d_entriesCount -= removeFromThisShard;
-      removed += removeFromThisShard;
-    }
-    else {
-      removed += map.size();
-      map.clear();
-      d_shards[shardIndex].d_entriesCount = 0;
-    }
+    removed += d_shards[shardIndex].eraseIf([](uint32_t, const CacheValue&) {
+      return true;
+    }, removeFromThisShard);
   }
 
   return removed;
@@ -371,22 +884,20 @@ size_t DNSDistPacketCache::expunge(size_t upTo)
 size_t DNSDistPacketCache::expungeByName(const DNSName& name, uint16_t qtype, bool suffixMatch)
 {
   size_t removed = 0;
+  auto matches = [&name, qtype, suffixMatch](uint32_t, const CacheValue& value) {
+    return (value.qnameMatches(name) || (suffixMatch && value.qnameIsPartOf(name))) && (qtype == QType::ANY || qtype == value.qtype);
+  };
+
+  if (d_sharedTable) {
+    return d_sharedTable->eraseIf([&matches](uint32_t key, time_t, const char* payload, size_t payloadSize) {
+      CacheValue value;
+      return CacheValue::unserialize(payload, payloadSize, value) && matches(key, value);
+    });
+  }
 
   for (uint32_t shardIndex = 0; shardIndex < d_shardCount; shardIndex++) {
     WriteLock w(&d_shards.at(shardIndex).d_lock);
-    auto& map = d_shards[shardIndex].d_map;
-
-    for(auto it = map.begin(); it != map.end(); ) {
-      const CacheValue& value = it->second;
-
-      if ((value.qname == name || (suffixMatch && value.qname.isPartOf(name))) && (qtype == QType::ANY || qtype == value.qtype)) {
-        it = map.erase(it);
-        d_shards[shardIndex].d_entriesCount--;
-        ++removed;
-      } else {
-        ++it;
-      }
-    }
+    removed += d_shards[shardIndex].eraseIf(matches);
   }
 
   return removed;
@@ -399,6 +910,10 @@ bool DNSDistPacketCache::isFull()
 
 uint64_t DNSDistPacketCache::getSize()
 {
+  if (d_sharedTable) {
+    return d_sharedTable->size();
+  }
+
   uint64_t count = 0;
 
   for (uint32_t shardIndex = 0; shardIndex < d_shardCount; shardIndex++) {
@@ -454,6 +969,50 @@ uint64_t DNSDistPacketCache::getEntriesCount()
   return getSize();
 }
 
+std::vector<DNSDistPacketCache::ShardMemoryUsage> DNSDistPacketCache::getMemoryUsage()
+{
+  std::vector<ShardMemoryUsage> result;
+
+  if (d_sharedTable) {
+    /* the whole file is mapped, whether the slots are used or not */
+    ShardMemoryUsage usage;
+    usage.entries = d_sharedTable->size();
+    usage.bytes = d_sharedTable->getMappedSize();
+    result.push_back(usage);
+    return result;
+  }
+
+  result.reserve(d_shardCount);
+
+  for (uint32_t shardIndex = 0; shardIndex < d_shardCount; shardIndex++) {
+    ReadLock r(&d_shards.at(shardIndex).d_lock);
+    ShardMemoryUsage usage;
+    usage.entries = d_shards[shardIndex].size();
+    usage.bytes = d_shards[shardIndex].getMemoryUsage();
+    result.push_back(usage);
+  }
+
+  return result;
+}
+
+void DNSDistPacketCache::forEachValue(const std::function<void(uint32_t key, const CacheValue& value)>& visitor)
+{
+  if (d_sharedTable) {
+    d_sharedTable->forEach([&visitor](uint32_t key, time_t, const char* payload, size_t payloadSize) {
+      CacheValue value;
+      if (CacheValue::unserialize(payload, payloadSize, value)) {
+        visitor(key, value);
+      }
+    });
+    return;
+  }
+
+  for (uint32_t shardIndex = 0; shardIndex < d_shardCount; shardIndex++) {
+    ReadLock r(&d_shards.at(shardIndex).d_lock);
+    d_shards[shardIndex].forEach(visitor);
+  }
+}
+
 uint64_t DNSDistPacketCache::dump(int fd)
 {
   auto fp = std::unique_ptr<FILE, int(*)(FILE*)>(fdopen(dup(fd), "w"), fclose);
@@ -465,20 +1024,268 @@ uint64_t DNSDistPacketCache::dump(int fd)
 
   uint64_t count = 0;
   time_t now = time(nullptr);
-  for (uint32_t shardIndex = 0; shardIndex < d_shardCount; shardIndex++) {
-    ReadLock w(&d_shards.at(shardIndex).d_lock);
-    auto& map = d_shards[shardIndex].d_map;
+  forEachValue([&fp, &count, now](uint32_t key, const CacheValue& value) {
+    count++;
 
-    for (const auto& entry : map) {
-      const CacheValue& value = entry.second;
-      count++;
+    try {
+      fprintf(fp.get(), "%s %" PRId64 " %s ; key %" PRIu32 ", length %" PRIu16 ", tcp %d, added %" PRId64 "\n", value.getQName().toString().c_str(), static_cast<int64_t>(value.validity - now), QType(value.qtype).getName().c_str(), key, value.len, value.tcp, static_cast<int64_t>(value.added));
+    }
+    catch(...) {
+      fprintf(fp.get(), "; error printing an entry of length %" PRIu16 "\n", value.len);
+    }
+  });
 
-      try {
-        fprintf(fp.get(), "%s %" PRId64 " %s ; key %" PRIu32 ", length %" PRIu16 ", tcp %d, added %" PRId64 "\n", value.qname.toString().c_str(), static_cast<int64_t>(value.validity - now), QType(value.qtype).getName().c_str(), entry.first, value.len, value.tcp, static_cast<int64_t>(value.added));
+  return count;
+}
+
+/* Binary format used by save() and load(), all integers in network byte order:
+   - header: magic (8 bytes), version (16 bits), flags (16 bits, 1 if cookie hashing is enabled),
+     time of the save in seconds since the epoch (64 bits)
+   - then for each entry: key (32), remaining TTL (32), age (32), qtype (16), qclass (16),
+     query flags (16), flags (8, tcp = 1, DNSSEC OK = 2, subnet = 4), if a subnet is present
+     its family (8, 4 or 6), its length (8) and its address (4 or 16 bytes), the length of
+     the qname in wire format (8) followed by the qname, the length of the response (16)
+     followed by the response.
+*/
+static const std::string s_cacheFileMagic{"DDPCACHE"};
+static const uint16_t s_cacheFileVersion{1};
+static const uint16_t s_cacheFileCookieHashing{1};
+static const uint8_t s_cacheEntryTCP{1};
+static const uint8_t s_cacheEntryDNSSECOK{2};
+static const uint8_t s_cacheEntrySubnet{4};
+
+static void appendUInt8(std::string& out, uint8_t value)
+{
+  out.append(1, static_cast<char>(value));
+}
+
+static void appendUInt16(std::string& out, uint16_t value)
+{
+  value = htons(value);
+  out.append(reinterpret_cast<const char*>(&value), sizeof(value));
+}
+
+static void appendUInt32(std::string& out, uint32_t value)
+{
+  value = htonl(value);
+  out.append(reinterpret_cast<const char*>(&value), sizeof(value));
+}
+
+static void appendUInt64(std::string& out, uint64_t value)
+{
+  appendUInt32(out, static_cast<uint32_t>(value >> 32));
+  appendUInt32(out, static_cast<uint32_t>(value & 0xffffffff));
+}
+
+/* returns false on a clean end of file, throws if the file is truncated */
+static bool readFromCacheFile(FILE* fp, void* buffer, size_t size, bool eofAllowed=false)
+{
+  size_t got = fread(buffer, 1, size, fp);
+  if (got == size) {
+    return true;
+  }
+  if (ferror(fp)) {
+    throw std::runtime_error("Error reading from the packet cache file: " + stringerror());
+  }
+  if (got == 0 && eofAllowed) {
+    return false;
+  }
+  throw std::runtime_error("Truncated packet cache file");
+}
+
+static uint8_t readUInt8(FILE* fp)
+{
+  uint8_t value;
+  readFromCacheFile(fp, &value, sizeof(value));
+  return value;
+}
+
+static uint16_t readUInt16(FILE* fp)
+{
+  uint16_t value;
+  readFromCacheFile(fp, &value, sizeof(value));
+  return ntohs(value);
+}
+
+static uint32_t readUInt32(FILE* fp)
+{
+  uint32_t value;
+  readFromCacheFile(fp, &value, sizeof(value));
+  return ntohl(value);
+}
+
+static uint64_t readUInt64(FILE* fp)
+{
+  uint64_t value = readUInt32(fp);
+  return (value << 32) | readUInt32(fp);
+}
+
+uint64_t DNSDistPacketCache::save(int fd)
+{
+  auto fp = std::unique_ptr<FILE, int(*)(FILE*)>(fdopen(dup(fd), "w"), fclose);
+  if (fp == nullptr) {
+    throw std::runtime_error("Error opening the packet cache file for writing: " + stringerror());
+  }
+
+  const time_t now = time(nullptr);
+  std::string buffer;
+  buffer.reserve(65536);
+  buffer.append(s_cacheFileMagic);
+  appendUInt16(buffer, s_cacheFileVersion);
+  appendUInt16(buffer, d_cookieHashing ? s_cacheFileCookieHashing : 0);
+  appendUInt64(buffer, static_cast<uint64_t>(now));
+
+  auto flush = [&fp,&buffer]() {
+    if (!buffer.empty() && fwrite(buffer.data(), 1, buffer.size(), fp.get()) != buffer.size()) {
+      throw std::runtime_error("Error writing to the packet cache file: " + stringerror());
+    }
+    buffer.clear();
+  };
+
+  uint64_t count = 0;
+  forEachValue([&buffer, &count, &flush, now](uint32_t key, const CacheValue& value) {
+    /* no need to save expired entries, or entries that could not be loaded back */
+    if (value.validity <= now || value.getQNameWireLength() == 0) {
+      return;
+    }
+
+    const auto subnet = value.getSubnet();
+    uint8_t flags = (value.tcp ? s_cacheEntryTCP : 0) | (value.dnssecOK ? s_cacheEntryDNSSECOK : 0) | (subnet ? s_cacheEntrySubnet : 0);
+    appendUInt32(buffer, key);
+    appendUInt32(buffer, static_cast<uint32_t>(value.validity - now));
+    appendUInt32(buffer, value.added < now ? static_cast<uint32_t>(now - value.added) : 0);
+    appendUInt16(buffer, value.qtype);
+    appendUInt16(buffer, value.qclass);
+    appendUInt16(buffer, value.queryFlags);
+    appendUInt8(buffer, flags);
+    if (subnet) {
+      const auto& network = subnet->getNetwork();
+      appendUInt8(buffer, network.isIPv4() ? 4 : 6);
+      appendUInt8(buffer, subnet->getBits());
+      if (network.isIPv4()) {
+        buffer.append(reinterpret_cast<const char*>(&network.sin4.sin_addr.s_addr), 4);
+      }
+      else {
+        buffer.append(reinterpret_cast<const char*>(&network.sin6.sin6_addr.s6_addr), 16);
+      }
+    }
+    appendUInt8(buffer, value.getQNameWireLength());
+    buffer.append(value.getQNameWire(), value.getQNameWireLength());
+    appendUInt16(buffer, value.len);
+    buffer.append(value.getResponse(), value.len);
+    count++;
+
+    if (buffer.size() >= 65536) {
+      flush();
+    }
+  });
+
+  flush();
+  if (fflush(fp.get()) != 0) {
+    throw std::runtime_error("Error writing to the packet cache file: " + stringerror());
+  }
+
+  return count;
+}
+
+uint64_t DNSDistPacketCache::load(int fd)
+{
+  auto fp = std::unique_ptr<FILE, int(*)(FILE*)>(fdopen(dup(fd), "r"), fclose);
+  if (fp == nullptr) {
+    throw std::runtime_error("Error opening the packet cache file for reading: " + stringerror());
+  }
+
+  std::string magic(s_cacheFileMagic.size(), '\0');
+  readFromCacheFile(fp.get(), &magic.at(0), magic.size());
+  if (magic != s_cacheFileMagic) {
+    throw std::runtime_error("Invalid packet cache file");
+  }
+  const uint16_t version = readUInt16(fp.get());
+  if (version != s_cacheFileVersion) {
+    throw std::runtime_error("Unsupported packet cache file version " + std::to_string(version));
+  }
+  const uint16_t fileFlags = readUInt16(fp.get());
+  if (((fileFlags & s_cacheFileCookieHashing) != 0) != d_cookieHashing) {
+    throw std::runtime_error("The packet cache file has been saved with a different cookie hashing setting");
+  }
+  const time_t savedAt = static_cast<time_t>(readUInt64(fp.get()));
+
+  uint64_t count = 0;
+  std::string qnameWire;
+  std::string response;
+  for (;;) {
+    uint32_t key;
+    if (!readFromCacheFile(fp.get(), &key, sizeof(key), true)) {
+      break;
+    }
+    key = ntohl(key);
+
+    const uint32_t ttl = readUInt32(fp.get());
+    const uint32_t age = readUInt32(fp.get());
+    const uint16_t qtype = readUInt16(fp.get());
+    const uint16_t qclass = readUInt16(fp.get());
+    const uint16_t queryFlags = readUInt16(fp.get());
+    const uint8_t flags = readUInt8(fp.get());
+    boost::optional<Netmask> subnet;
+    if (flags & s_cacheEntrySubnet) {
+      const uint8_t family = readUInt8(fp.get());
+      const uint8_t bits = readUInt8(fp.get());
+      ComboAddress network;
+      if (family == 4) {
+        network.sin4.sin_family = AF_INET;
+        readFromCacheFile(fp.get(), &network.sin4.sin_addr.s_addr, 4);
       }
-      catch(...) {
-        fprintf(fp.get(), "; error printing '%s'\n", value.qname.empty() ? "EMPTY" : value.qname.toString().c_str());
+      else if (family == 6) {
+        network.sin6.sin6_family = AF_INET6;
+        readFromCacheFile(fp.get(), &network.sin6.sin6_addr.s6_addr, 16);
       }
+      else {
+        throw std::runtime_error("Invalid subnet family " + std::to_string(family) + " in the packet cache file");
+      }
+      subnet = Netmask(network, bits);
+    }
+
+    qnameWire.resize(readUInt8(fp.get()));
+    if (qnameWire.empty()) {
+      throw std::runtime_error("Invalid empty qname in the packet cache file");
+    }
+    readFromCacheFile(fp.get(), &qnameWire.at(0), qnameWire.size());
+    const DNSName qname(qnameWire.data(), qnameWire.size(), 0, false);
+
+    const uint16_t responseLen = readUInt16(fp.get());
+    if (responseLen < sizeof(dnsheader)) {
+      throw std::runtime_error("Invalid response size " + std::to_string(responseLen) + " in the packet cache file");
+    }
+    response.resize(responseLen);
+    readFromCacheFile(fp.get(), &response.at(0), responseLen);
+
+    /* the entry might have expired since the file was saved */
+    if ((savedAt + ttl) <= time(nullptr)) {
+      continue;
+    }
+
+    CacheValue value(response.data(), responseLen, qname, subnet);
+    value.validity = savedAt + ttl;
+    value.added = savedAt - age;
+    value.qtype = qtype;
+    value.qclass = qclass;
+    value.queryFlags = queryFlags;
+    value.tcp = flags & s_cacheEntryTCP;
+    value.dnssecOK = flags & s_cacheEntryDNSSECOK;
+
+    if (d_sharedTable) {
+      if (insertShared(key, value, qname, subnet, true)) {
+        count++;
+      }
+      continue;
+    }
+
+    auto& shard = d_shards.at(getShardIndex(key));
+    WriteLock w(&shard.d_lock);
+    const auto before = shard.d_entriesCount.load();
+    insertLocked(shard, key, std::move(value), qname, subnet);
+    if (shard.d_entriesCount > before) {
+      count++;
     }
   }
 
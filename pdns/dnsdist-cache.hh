@@ -24,6 +24,8 @@
 #include <atomic>
 #include <unordered_map>
 
+#include "dnsdist-cache-lockfree.hh"
+#include "dnsdist-cache-shared.hh"
 #include "iputils.hh"
 #include "lock.hh"
 
@@ -32,11 +34,11 @@ struct DNSQuestion;
 class DNSDistPacketCache : boost::noncopyable
 {
 public:
-  DNSDistPacketCache(size_t maxEntries, uint32_t maxTTL=86400, uint32_t minTTL=0, uint32_t tempFailureTTL=60, uint32_t maxNegativeTTL=3600, uint32_t staleTTL=60, bool dontAge=false, uint32_t shards=1, bool deferrableInsertLock=true, bool parseECS=false);
+  DNSDistPacketCache(size_t maxEntries, uint32_t maxTTL=86400, uint32_t minTTL=0, uint32_t tempFailureTTL=60, uint32_t maxNegativeTTL=3600, uint32_t staleTTL=60, bool dontAge=false, uint32_t shards=1, bool deferrableInsertLock=true, bool parseECS=false, bool lockFreeLookups=false);
   ~DNSDistPacketCache();
 
   void insert(uint32_t key, const boost::optional<Netmask>& subnet, uint16_t queryFlags, bool dnssecOK, const DNSName& qname, uint16_t qtype, uint16_t qclass, const char* response, uint16_t responseLen, bool tcp, uint8_t rcode, boost::optional<uint32_t> tempFailureTTL);
-  bool get(const DNSQuestion& dq, uint16_t consumed, uint16_t queryId, char* response, uint16_t* responseLen, uint32_t* keyOut, boost::optional<Netmask>& subnetOut, bool dnssecOK, uint32_t allowExpired=0, bool skipAging=false);
+  bool get(const DNSQuestion& dq, uint16_t consumed, uint16_t queryId, char* response, uint16_t* responseLen, uint32_t* keyOut, boost::optional<Netmask>& subnetOut, bool dnssecOK, uint32_t allowExpired=0, bool skipAging=false, bool* prefetch=nullptr);
   size_t purgeExpired(size_t upTo=0);
   size_t expunge(size_t upTo=0);
   size_t expungeByName(const DNSName& name, uint16_t qtype=QType::ANY, bool suffixMatch=false);
@@ -51,11 +53,37 @@ public:
   uint64_t getInsertCollisions() const { return d_insertCollisions; }
   uint64_t getMaxEntries() const { return d_maxEntries; }
   uint64_t getTTLTooShorts() const { return d_ttlTooShorts; }
+  uint64_t getPrefetches() const { return d_prefetches; }
+  uint64_t getEvictions() const { return d_evictions; }
+  uint64_t getRejectedAdmissions() const { return d_rejectedAdmissions; }
   uint64_t getEntriesCount();
+
+  struct ShardMemoryUsage
+  {
+    uint64_t entries{0};
+    uint64_t bytes{0};
+  };
+  /* an estimation of the memory used by each shard, including the responses
+     and the overhead of the underlying table, but not the allocator's own */
+  std::vector<ShardMemoryUsage> getMemoryUsage();
+
   uint64_t dump(int fd);
+  /* save the entries to, or load them from, a binary file that keeps their
+     remaining TTL, so that the cache survives a restart */
+  uint64_t save(int fd);
+  uint64_t load(int fd);
 
   bool isECSParsingEnabled() const { return d_parseECS; }
+  bool isLockFreeLookupsEnabled() const { return d_lockFreeLookups; }
   bool isCookieHashingEnabled() const { return d_cookieHashing; }
+  bool isSharedMemoryEnabled() const { return d_sharedTable != nullptr; }
+
+  /* store the entries in a memory-mapped file, shared with the other dnsdist
+     processes using the same file on this host, instead of in the shards of
+     this cache. Responses larger than maxResponseSize are not cached. Has to be
+     called after the other settings, before the cache is used. The statistics
+     are still kept per process, except for the number of entries */
+  void setSharedMemory(const std::string& path, uint16_t maxResponseSize);
 
   bool keepStaleData() const
   {
@@ -76,6 +104,33 @@ public:
     d_parseECS = enabled;
   }
 
+  /* ask for an entry to be prefetched when a hit occurs during the last
+     ttlPercentage percent of its TTL, and it has been hit at least minHits times.
+     A percentage of 0 disables prefetching */
+  void setPrefetch(uint8_t ttlPercentage, uint32_t minHits)
+  {
+    d_prefetchTTLPercentage = ttlPercentage;
+    d_prefetchMinHits = minHits;
+  }
+
+  bool isPrefetchEnabled() const
+  {
+    return d_prefetchTTLPercentage > 0;
+  }
+
+  /* what to do when an entry is inserted into a full shard:
+     - None: the insertion is refused, the cache cleaning thread making room later ;
+     - LRU: an expired entry, or the least recently used one out of a few
+       randomly selected ones, is evicted ;
+     - TinyLFU: same as LRU, except that the new entry is only inserted if it
+       has been looked up more often than the one it would evict */
+  enum class EvictionPolicy : uint8_t { None, LRU, TinyLFU };
+  void setEvictionPolicy(EvictionPolicy policy);
+  EvictionPolicy getEvictionPolicy() const
+  {
+    return d_evictionPolicy;
+  }
+
   uint32_t getKey(const DNSName::string_t& qname, uint16_t consumed, const unsigned char* packet, uint16_t packetLen, bool tcp);
 
   static uint32_t getMinTTL(const char* packet, uint16_t length, bool* seenNoDataSOA);
@@ -83,20 +138,106 @@ public:
 
 private:
 
-  struct CacheValue
+  /* updated by concurrent lookups, and reset when the entry is copied or replaced */
+  struct UsageState
   {
+    UsageState()
+    {
+    }
+    UsageState(const UsageState&)
+    {
+    }
+    UsageState& operator=(const UsageState&)
+    {
+      hits = 0;
+      lastUsed = 0;
+      prefetchRequested = false;
+      return *this;
+    }
+
+    std::atomic<uint32_t> hits{0};
+    /* in seconds, 0 if the entry has not been used since it was added */
+    std::atomic<uint32_t> lastUsed{0};
+    std::atomic<bool> prefetchRequested{false};
+  };
+
+  /* A count-min sketch of the number of lookups for each key, with 4-bit
+     counters stored in bytes, halved once the number of additions reaches ten
+     times the width of the sketch so that old lookups are forgotten. Used by
+     the TinyLFU admission policy. Updated by concurrent lookups, the counts
+     are only estimations anyway so relaxed atomics are enough */
+  class FrequencySketch
+  {
+  public:
+    void setSize(size_t maxEntries);
+    void add(uint32_t key);
+    uint8_t estimate(uint32_t key) const;
+
+  private:
+    static const size_t s_depth = 4;
+    static const uint8_t s_maxCount = 15;
+
+    std::unique_ptr<std::atomic<uint8_t>[]> d_counters{nullptr};
+    std::atomic<uint64_t> d_additions{0};
+    size_t d_width{0};
+  };
+
+  /* To keep the overhead per entry low, the response, the qname in wire
+     format unless the response already starts with it, and the network of
+     the ECS subnet if any, are stored in a single allocation */
+  class CacheValue
+  {
+  public:
+    CacheValue()
+    {
+    }
+    CacheValue(const char* response, uint16_t responseLen, const DNSName& qname, const boost::optional<Netmask>& subnet);
+    CacheValue(CacheValue&&) = default;
+    CacheValue& operator=(CacheValue&&) = default;
+
     time_t getTTD() const { return validity; }
-    std::string value;
-    DNSName qname;
-    boost::optional<Netmask> subnet;
+    time_t getLastUsed() const
+    {
+      const uint32_t lastUsed = usage.lastUsed.load(std::memory_order_relaxed);
+      return lastUsed != 0 ? static_cast<time_t>(lastUsed) : added;
+    }
+    const char* getResponse() const { return d_data.get(); }
+    const char* getQNameWire() const { return d_data.get() + (d_qnameInResponse ? sizeof(dnsheader) : len); }
+    uint8_t getQNameWireLength() const { return d_qnameLen; }
+    DNSName getQName() const;
+    bool qnameMatches(const DNSName& qname) const;
+    bool qnameIsPartOf(const DNSName& zone) const;
+    boost::optional<Netmask> getSubnet() const;
+    bool subnetMatches(const boost::optional<Netmask>& subnet) const;
+    /* the size of the allocation holding the response, qname and subnet */
+    size_t getDataSize() const;
+
+    /* used to store the value in a shared memory table: serialize() needs a
+       buffer of getSerializedSize() bytes, unserialize() returns false if the
+       buffer does not hold a valid value */
+    size_t getSerializedSize() const;
+    void serialize(char* buffer) const;
+    static bool unserialize(const char* buffer, size_t size, CacheValue& value);
+
+    time_t added{0};
+    time_t validity{0};
     uint16_t qtype{0};
     uint16_t qclass{0};
     uint16_t queryFlags{0};
-    time_t added{0};
-    time_t validity{0};
     uint16_t len{0};
+    mutable UsageState usage;
     bool tcp{false};
     bool dnssecOK{false};
+
+  private:
+    const char* getSubnetData() const { return d_data.get() + len + (d_qnameInResponse ? 0 : d_qnameLen); }
+
+    std::unique_ptr<char[]> d_data{nullptr};
+    uint8_t d_qnameLen{0};
+    bool d_qnameInResponse{false};
+    /* 0 if there is no subnet, 4 or 6 otherwise */
+    uint8_t d_subnetFamily{0};
+    uint8_t d_subnetBits{0};
   };
 
   class CacheShard
@@ -109,21 +250,101 @@ private:
     {
     }
 
-    void setSize(size_t maxSize)
+    void setSize(size_t maxSize, bool lockFree)
+    {
+      if (lockFree) {
+        d_table = std::unique_ptr<LockFreeCacheTable<CacheValue>>(new LockFreeCacheTable<CacheValue>(maxSize));
+      }
+      else {
+        d_map.reserve(maxSize);
+      }
+    }
+
+    /* the methods below have to be called with the lock held, except
+       find() and forEach() which only need the read lock, or a
+       LockFreeCacheTable::ReadGuard if the lock-free table is used */
+    size_t size() const
+    {
+      return d_table ? d_table->size() : d_map.size();
+    }
+
+    const CacheValue* find(uint32_t key) const
     {
-      d_map.reserve(maxSize);
+      if (d_table) {
+        return d_table->find(key);
+      }
+      auto it = d_map.find(key);
+      return it != d_map.end() ? &it->second : nullptr;
     }
 
+    /* returns the existing value if there is one, leaving the new value
+       untouched, nullptr if the new value has been inserted */
+    const CacheValue* insert(uint32_t key, CacheValue&& value)
+    {
+      if (d_table) {
+        return d_table->insert(key, std::move(value));
+      }
+      auto it = d_map.find(key);
+      if (it != d_map.end()) {
+        return &it->second;
+      }
+      d_map.emplace(key, std::move(value));
+      return nullptr;
+    }
+
+    void replace(uint32_t key, CacheValue&& value)
+    {
+      if (d_table) {
+        d_table->replace(key, std::move(value));
+        return;
+      }
+      auto it = d_map.find(key);
+      if (it != d_map.end()) {
+        it->second = std::move(value);
+      }
+    }
+
+    bool erase(uint32_t key)
+    {
+      if (d_table) {
+        return d_table->erase(key);
+      }
+      return d_map.erase(key) > 0;
+    }
+
+    /* returns a random entry, or nullptr if the shard is empty */
+    const CacheValue* sample(uint32_t& key);
+
+    size_t eraseIf(const std::function<bool(uint32_t key, const CacheValue& value)>& predicate, size_t upTo=std::numeric_limits<size_t>::max());
+    void forEach(const std::function<void(uint32_t key, const CacheValue& value)>& visitor) const;
+    size_t getMemoryUsage() const;
+
     std::unordered_map<uint32_t,CacheValue> d_map;
+    /* only set when lock-free lookups are enabled, replacing d_map. The lock
+       is then only used to serialize writers */
+    std::unique_ptr<LockFreeCacheTable<CacheValue>> d_table{nullptr};
+    /* only used by the TinyLFU admission policy */
+    FrequencySketch d_sketch;
     ReadWriteLock d_lock;
     std::atomic<uint64_t> d_entriesCount;
+    /* state of the generator used to sample entries, only used by writers */
+    uint32_t d_sampleState{0x9E3779B9};
   };
 
   bool cachedValueMatches(const CacheValue& cachedValue, uint16_t queryFlags, const DNSName& qname, uint16_t qtype, uint16_t qclass, bool tcp, bool dnssecOK, const boost::optional<Netmask>& subnet) const;
+  bool shouldReplace(const CacheValue& existing, const CacheValue& newValue, const DNSName& qname, const boost::optional<Netmask>& subnet);
   uint32_t getShardIndex(uint32_t key) const;
-  void insertLocked(CacheShard& shard, uint32_t key, CacheValue& newValue);
+  void insertLocked(CacheShard& shard, uint32_t key, CacheValue&& newValue, const DNSName& qname, const boost::optional<Netmask>& subnet);
+  bool insertShared(uint32_t key, const CacheValue& newValue, const DNSName& qname, const boost::optional<Netmask>& subnet, bool wait);
+  bool evictLocked(CacheShard& shard, uint32_t key, time_t now);
+  bool getLocked(const CacheValue* value, const DNSQuestion& dq, const DNSName::string_t& dnsQName, uint16_t queryId, char* response, uint16_t* responseLen, const boost::optional<Netmask>& subnet, bool dnssecOK, time_t now, uint32_t allowExpired, time_t& age, bool& needsAging, bool* prefetch);
+  bool getShared(uint32_t key, const DNSQuestion& dq, const DNSName::string_t& dnsQName, uint16_t queryId, char* response, uint16_t* responseLen, const boost::optional<Netmask>& subnet, bool dnssecOK, time_t now, uint32_t allowExpired, time_t& age, bool& needsAging, bool* prefetch);
+  /* call the visitor on every entry, holding the read lock of its shard */
+  void forEachValue(const std::function<void(uint32_t key, const CacheValue& value)>& visitor);
 
   std::vector<CacheShard> d_shards;
+  /* only set when the entries are stored in shared memory, the shards are then only used for their frequency sketch */
+  std::unique_ptr<SharedCacheTable> d_sharedTable{nullptr};
 
   std::atomic<uint64_t> d_deferredLookups{0};
   std::atomic<uint64_t> d_deferredInserts{0};
@@ -132,6 +353,9 @@ private:
   std::atomic<uint64_t> d_insertCollisions{0};
   std::atomic<uint64_t> d_lookupCollisions{0};
   std::atomic<uint64_t> d_ttlTooShorts{0};
+  std::atomic<uint64_t> d_prefetches{0};
+  std::atomic<uint64_t> d_evictions{0};
+  std::atomic<uint64_t> d_rejectedAdmissions{0};
 
   size_t d_maxEntries;
   uint32_t d_expungeIndex{0};
@@ -141,9 +365,13 @@ private:
   uint32_t d_maxNegativeTTL;
   uint32_t d_minTTL;
   uint32_t d_staleTTL;
+  uint32_t d_prefetchMinHits{0};
+  uint8_t d_prefetchTTLPercentage{0};
+  EvictionPolicy d_evictionPolicy{EvictionPolicy::None};
   bool d_dontAge;
   bool d_deferrableInsertLock;
   bool d_parseECS;
+  bool d_lockFreeLookups;
   bool d_keepStaleData{false};
   bool d_cookieHashing{false};
 };
@@ -103,6 +103,15 @@ try
           str<<base<<"tcpcurrentconnections" << ' '<< state->tcpCurrentConnections.load() << " " << now << "\r\n";
           str<<base<<"tcpavgqueriesperconnection" << ' '<< state->tcpAvgQueriesPerConnection.load() << " " << now << "\r\n";
           str<<base<<"tcpavgconnectionduration" << ' '<< state->tcpAvgConnectionDuration.load() << " " << now << "\r\n";
+          str<<base<<"tlsresumptions" << ' '<< state->tlsResumptions.load() << " " << now << "\r\n";
+          if (state->isDoH()) {
+            str<<base<<"dohlatency" << ' '<< (state->dohLatencyUsec/1000.0) << " " << now << "\r\n";
+            str<<base<<"dohconnecterrors" << ' '<< state->dohConnectErrors.load() << " " << now << "\r\n";
+            str<<base<<"dohhttperrors" << ' '<< state->dohHTTPErrors.load() << " " << now << "\r\n";
+            str<<base<<"dohprotocolerrors" << ' '<< state->dohProtocolErrors.load() << " " << now << "\r\n";
+            str<<base<<"dohtimeouts" << ' '<< state->dohTimeouts.load() << " " << now << "\r\n";
+            str<<base<<"dohcurrentconnections" << ' '<< state->dohCurrentConnections.load() << " " << now << "\r\n";
+          }
         }
 
         std::map<std::string,uint64_t> frontendDuplicates;
@@ -179,6 +188,9 @@ try
             str<<base<<"cache-lookup-collisions" << " " << cache->getLookupCollisions() << " " << now << "\r\n";
             str<<base<<"cache-insert-collisions" << " " << cache->getInsertCollisions() << " " << now << "\r\n";
             str<<base<<"cache-ttl-too-shorts" << " " << cache->getTTLTooShorts() << " " << now << "\r\n";
+            str<<base<<"cache-prefetches" << " " << cache->getPrefetches() << " " << now << "\r\n";
+            str<<base<<"cache-evictions" << " " << cache->getEvictions() << " " << now << "\r\n";
+            str<<base<<"cache-rejected-admissions" << " " << cache->getRejectedAdmissions() << " " << now << "\r\n";
           }
         }
 
@@ -359,6 +359,7 @@ const std::vector<ConsoleKeyword> g_consoleKeywords{
   { "AllRule", true, "", "matches all traffic" },
   { "AndRule", true, "list of DNS rules", "matches if all sub-rules matches" },
   { "benchRule", true, "DNS Rule [, iterations [, suffix]]", "bench the specified DNS rule" },
+  { "benchRules", true, "[iterations [, suffix]]", "bench the query rules, reporting the cost of evaluating each of them and of the whole chain" },
   { "carbonServer", true, "serverIP, [ourname], [interval]", "report statistics to serverIP using our hostname, or 'ourname' if provided, every 'interval' seconds" },
   { "clearConsoleHistory", true, "", "clear the internal (in-memory) history of console commands" },
   { "clearDynBlocks", true, "", "clear all dynamic blocks" },
@@ -412,7 +413,7 @@ const std::vector<ConsoleKeyword> g_consoleKeywords{
   { "getTLSContext", true, "n", "returns the TLS context with index n" },
   { "getTLSFrontend", true, "n", "returns the TLS frontend with index n" },
   { "getTLSFrontendCount", true, "", "returns the number of DoT listeners" },
-  { "grepq", true, "Netmask|DNS Name|100ms|{\"::1\", \"powerdns.com\", \"100ms\"} [, n]", "shows the last n queries and responses matching the specified client address or range (Netmask), or the specified DNS Name, or slower than 100ms" },
+  { "grepq", true, "Netmask|DNS Name|100ms|{\"::1\", \"powerdns.com\", \"100ms\"} [, n [, lookback]]", "shows the last n queries and responses matching the specified client address or range (Netmask), or the specified DNS Name, or slower than 100ms, optionally from the last `lookback` seconds of the ringbuffers history" },
   { "HTTPHeaderRule", true, "name, regex", "matches DoH queries with a HTTP header 'name' whose content matches the regular expression 'regex'"},
   { "HTTPPathRegexRule", true, "regex", "matches DoH queries whose HTTP path matches 'regex'"},
   { "HTTPPathRule", true, "path", "matches DoH queries whose HTTP path is an exact match to 'path'"},
@@ -534,9 +535,12 @@ const std::vector<ConsoleKeyword> g_consoleKeywords{
   { "setPreserveTrailingData", true, "bool", "set whether trailing data should be preserved while adding ECS or XPF records to incoming queries" },
   { "setQueryCount", true, "bool", "set whether queries should be counted" },
   { "setQueryCountFilter", true, "func", "filter queries that would be counted, where `func` is a function with parameter `dq` which decides whether a query should and how it should be counted" },
+  { "setRingBuffersHistory", true, "path, size [, segmentSize]", "keep a compact history of the ringbuffers, of `size` bytes, in the memory-mapped file at `path`" },
   { "setRingBuffersLockRetries", true, "n", "set the number of attempts to get a non-blocking lock to a ringbuffer shard before blocking" },
+  { "setRingBuffersPerThreadShards", true, "enabled", "whether every thread inserting into the ringbuffers should get a shard of its own, so it never waits for a reader" },
   { "setRingBuffersSize", true, "n [, numberOfShards]", "set the capacity of the ringbuffers used for live traffic inspection to `n`, and optionally the number of shards to use to `numberOfShards`" },
   { "setRoundRobinFailOnNoServer", true, "value", "By default the roundrobin load-balancing policy will still try to select a backend even if all backends are currently down. Setting this to true will make the policy fail and return that no server is available instead" },
+  { "setRuleTimingSampleRate", true, "rate", "measure the time spent evaluating the selectors and running the actions of the rules for one query or response out of `rate`, 0 disabling the measurements" },
   { "setRules", true, "list of rules", "replace the current rules with the supplied list of pairs of DNS Rules and DNS Actions (see `newRuleAction()`)" },
   { "setSecurityPollInterval", true, "n", "set the security polling interval to `n` seconds" },
   { "setSecurityPollSuffix", true, "suffix", "set the security polling suffix to the specified value" },
@@ -560,7 +564,7 @@ const std::vector<ConsoleKeyword> g_consoleKeywords{
   { "show", true, "string", "outputs `string`" },
   { "showACL", true, "", "show our ACL set" },
   { "showBinds", true, "", "show listening addresses (frontends)" },
-  { "showCacheHitResponseRules", true, "[{showUUIDs=false, truncateRuleWidth=-1}]", "show all defined cache hit response rules, optionally with their UUIDs and optionally truncated to a given width" },
+  { "showCacheHitResponseRules", true, "[{showUUIDs=false, showTimings=false, truncateRuleWidth=-1}]", "show all defined cache hit response rules, optionally with their UUIDs or timings and optionally truncated to a given width" },
   { "showConsoleACL", true, "", "show our current console ACL set" },
   { "showDNSCryptBinds", true, "", "display the currently configured DNSCrypt binds" },
   { "showDOHFrontends", true, "", "list all the available DOH frontends" },
@@ -569,10 +573,10 @@ const std::vector<ConsoleKeyword> g_consoleKeywords{
   { "showPools", true, "", "show the available pools" },
   { "showPoolServerPolicy", true, "pool", "show server selection policy for this pool" },
   { "showResponseLatency", true, "", "show a plot of the response time latency distribution" },
-  { "showResponseRules", true, "[{showUUIDs=false, truncateRuleWidth=-1}]", "show all defined response rules, optionally with their UUIDs and optionally truncated to a given width" },
-  { "showRules", true, "[{showUUIDs=false, truncateRuleWidth=-1}]", "show all defined rules, optionally with their UUIDs and optionally truncated to a given width" },
+  { "showResponseRules", true, "[{showUUIDs=false, showTimings=false, truncateRuleWidth=-1}]", "show all defined response rules, optionally with their UUIDs or timings and optionally truncated to a given width" },
+  { "showRules", true, "[{showUUIDs=false, showTimings=false, truncateRuleWidth=-1}]", "show all defined rules, optionally with their UUIDs or timings and optionally truncated to a given width" },
   { "showSecurityStatus", true, "", "Show the security status"},
-  { "showSelfAnsweredResponseRules", true, "[{showUUIDs=false, truncateRuleWidth=-1}]", "show all defined self-answered response rules, optionally with their UUIDs and optionally truncated to a given width" },
+  { "showSelfAnsweredResponseRules", true, "[{showUUIDs=false, showTimings=false, truncateRuleWidth=-1}]", "show all defined self-answered response rules, optionally with their UUIDs or timings and optionally truncated to a given width" },
   { "showServerPolicy", true, "", "show name of currently operational server selection policy" },
   { "showServers", true, "[{showUUIDs=false}]", "output all servers, optionally with their UUIDs" },
   { "showTCPStats", true, "", "show some statistics regarding TCP" },
@@ -599,15 +603,15 @@ const std::vector<ConsoleKeyword> g_consoleKeywords{
   { "TempFailureCacheTTLAction", true, "ttl", "set packetcache TTL for temporary failure replies" },
   { "testCrypto", true, "", "test of the crypto all works" },
   { "TimedIPSetRule", true, "", "Create a rule which matches a set of IP addresses which expire"}, 
-  { "topBandwidth", true, "top", "show top-`top` clients that consume the most bandwidth over length of ringbuffer" },
+  { "topBandwidth", true, "top[, lookback]", "show top-`top` clients that consume the most bandwidth over length of ringbuffer, or over the last `lookback` seconds" },
   { "topCacheHitResponseRule", true, "", "move the last cache hit response rule to the first position" },
-  { "topClients", true, "n", "show top-`n` clients sending the most queries over length of ringbuffer" },
-  { "topQueries", true, "n[, labels]", "show top 'n' queries, as grouped when optionally cut down to 'labels' labels" },
-  { "topResponses", true, "n, kind[, labels]", "show top 'n' responses with RCODE=kind (0=NO Error, 2=ServFail, 3=NXDomain), as grouped when optionally cut down to 'labels' labels" },
+  { "topClients", true, "n[, lookback]", "show top-`n` clients sending the most queries over length of ringbuffer, or over the last `lookback` seconds" },
+  { "topQueries", true, "n[, labels[, lookback]]", "show top 'n' queries, as grouped when optionally cut down to 'labels' labels, optionally over the last 'lookback' seconds" },
+  { "topResponses", true, "n, kind[, labels[, lookback]]", "show top 'n' responses with RCODE=kind (0=NO Error, 2=ServFail, 3=NXDomain), as grouped when optionally cut down to 'labels' labels, optionally over the last 'lookback' seconds" },
   { "topResponseRule", true, "", "move the last response rule to the first position" },
   { "topRule", true, "", "move the last rule to the first position" },
   { "topSelfAnsweredResponseRule", true, "", "move the last self-answered response rule to the first position" },
-  { "topSlow", true, "[top][, limit][, labels]", "show `top` queries slower than `limit` milliseconds, grouped by last `labels` labels" },
+  { "topSlow", true, "[top][, limit][, labels][, lookback]", "show `top` queries slower than `limit` milliseconds, grouped by last `labels` labels, optionally over the last `lookback` seconds" },
   { "TrailingDataRule", true, "", "Matches if the query has trailing data" },
   { "truncateTC", true, "bool", "if set (defaults to no starting with dnsdist 1.2.0) truncate TC=1 answers so they are actually empty. Fixes an issue for PowerDNS Authoritative Server 2.9.22. Note: turning this on breaks compatibility with RFC 6891." },
   { "unregisterDynBPFFilter", true, "DynBPFFilter", "unregister this dynamic BPF filter" },
@@ -60,9 +60,17 @@ private:
 
   struct Counts
   {
+    void add(const Counts& rhs);
+    void remove(const Counts& rhs);
+    bool empty() const
+    {
+      return queries == 0 && responses == 0 && respBytes == 0 && d_rcodeCounts.empty() && d_qtypeCounts.empty();
+    }
+
     std::map<uint8_t, uint64_t> d_rcodeCounts;
     std::map<uint16_t, uint64_t> d_qtypeCounts;
     uint64_t queries{0};
+    uint64_t responses{0};
     uint64_t respBytes{0};
   };
 
@@ -211,6 +219,30 @@ private:
   };
 
   typedef std::unordered_map<ComboAddress, Counts, ComboAddress::addressOnlyHash, ComboAddress::addressOnlyEqual> counts_t;
+  typedef std::unordered_set<ComboAddress, ComboAddress::addressOnlyHash, ComboAddress::addressOnlyEqual> requestors_t;
+
+  /* In incremental mode, only the entries inserted into the rings since the previous run are read. They are
+     accounted into one-second buckets, and into the totals of every window length used by the rules of the
+     group, from which the buckets are subtracted as they move out of the window. */
+  struct Window
+  {
+    counts_t d_totals;
+    /* first second covered by this window */
+    time_t d_start{0};
+  };
+
+  struct IncrementalState
+  {
+    std::map<time_t, counts_t> d_buckets;
+    /* indexed by the length of the window, in seconds */
+    std::map<unsigned int, Window> d_windows;
+    /* requestors that have been blocked, or for which a warning has been issued, during the previous run */
+    requestors_t d_offenders;
+    /* number of entries inserted into each shard of the rings that have already been accounted */
+    std::vector<uint64_t> d_queryCursors;
+    std::vector<uint64_t> d_responseCursors;
+    uint64_t d_ringsGeneration{0};
+  };
 
 public:
   DynBlockRulesGroup()
@@ -314,6 +346,15 @@ public:
     d_beQuiet = quiet;
   }
 
+  /* only read the entries inserted into the rings since the previous run, instead of scanning them entirely.
+     This requires all the rules to have a non-zero number of seconds, and does not apply to the suffix match
+     rule which still needs to scan the response ring */
+  void setIncremental(bool incremental)
+  {
+    d_incremental = incremental;
+    d_incrementalState = IncrementalState();
+  }
+
 private:
 
   bool checkIfQueryTypeMatches(const Rings::Query& query);
@@ -351,6 +392,13 @@ private:
     return hasQueryRules() || hasResponseRules();
   }
 
+  bool canBeIncremental() const;
+  template<typename T> bool checkRequestor(const ComboAddress& requestor, const T& getCounts, boost::optional<NetmaskTree<DynBlock> >& blocks, const struct timespec& now, bool& updated);
+  void applyIncremental(const struct timespec& now);
+  void expireIncrementalCounters(const struct timespec& now);
+  template<typename T> void accountIncremental(const ComboAddress& requestor, time_t second, const T& update, requestors_t& touched);
+  void buildSuffixMatchTree(StatNode& root, const struct timespec& now);
+  void processSuffixMatchRule(const StatNode& root, const struct timespec& now);
   void processQueryRules(counts_t& counts, const struct timespec& now);
   void processResponseRules(counts_t& counts, StatNode& root, const struct timespec& now);
 
@@ -364,5 +412,7 @@ private:
   SuffixMatchNode d_excludedDomains;
   smtVisitor_t d_smtVisitor;
   dnsdist_ffi_stat_node_visitor_t d_smtVisitorFFI;
+  IncrementalState d_incrementalState;
   bool d_beQuiet{false};
+  bool d_incremental{false};
 };
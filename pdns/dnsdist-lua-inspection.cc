@@ -26,35 +26,30 @@
 
 #include "statnode.hh"
 
-static std::unordered_map<unsigned int, vector<boost::variant<string,double>>> getGenResponses(unsigned int top, boost::optional<int> labels, std::function<bool(const Rings::Response&)> pred)
+static std::unordered_map<unsigned int, vector<boost::variant<string,double>>> getGenResponses(unsigned int top, boost::optional<int> labels, std::function<bool(const Rings::Response&)> pred, boost::optional<unsigned int> lookback)
 {
   setLuaNoSideEffect();
   map<DNSName, unsigned int> counts;
   unsigned int total=0;
-  {
-    for (const auto& shard : g_rings.d_shards) {
-      std::lock_guard<std::mutex> rl(shard->respLock);
-      if(!labels) {
-        for(const auto& a : shard->respRing) {
-          if(!pred(a))
-            continue;
-          counts[a.name]++;
-          total++;
-        }
-      }
-      else {
-        unsigned int lab = *labels;
-        for(const auto& a : shard->respRing) {
-          if(!pred(a))
-            continue;
+  if(!labels) {
+    g_rings.visitResponses([&counts, &total, &pred](const Rings::Response& a) {
+      if(!pred(a))
+        return;
+      counts[a.name]++;
+      total++;
+    }, lookback);
+  }
+  else {
+    unsigned int lab = *labels;
+    g_rings.visitResponses([&counts, &total, &pred, lab](const Rings::Response& a) {
+      if(!pred(a))
+        return;
 
-          DNSName temp(a.name);
-          temp.trimToLabels(lab);
-          counts[temp]++;
-          total++;
-        }
-      }
-    }
+      DNSName temp(a.name);
+      temp.trimToLabels(lab);
+      counts[temp]++;
+      total++;
+    }, lookback);
   }
   //      cout<<"Looked at "<<total<<" responses, "<<counts.size()<<" different ones"<<endl;
   vector<pair<unsigned int, DNSName>> rcounts;
@@ -79,6 +74,19 @@ static std::unordered_map<unsigned int, vector<boost::variant<string,double>>> g
   return ret;
 }
 
+/* keep only the 'limit' most recent entries, if set, since the rings and the history are not visited in chronological order */
+template<typename T>
+static void addToMostRecent(std::multimap<struct timespec, T>& entries, const T& entry, const boost::optional<unsigned int>& limit)
+{
+  if (limit && *limit > 0 && entries.size() >= *limit) {
+    if (entry.when < entries.begin()->first) {
+      return;
+    }
+    entries.erase(entries.begin());
+  }
+  entries.insert(make_pair(entry.when, entry));
+}
+
 typedef std::unordered_map<ComboAddress, unsigned int, ComboAddress::addressOnlyHash, ComboAddress::addressOnlyEqual> counts_t;
 
 static counts_t filterScore(const counts_t& counts,
@@ -225,20 +233,15 @@ static counts_t exceedRespByterate(unsigned int rate, int seconds)
 
 void setupLuaInspection(LuaContext& luaCtx)
 {
-  luaCtx.writeFunction("topClients", [](boost::optional<unsigned int> top_) {
+  luaCtx.writeFunction("topClients", [](boost::optional<unsigned int> top_, boost::optional<unsigned int> lookback) {
       setLuaNoSideEffect();
       auto top = top_.get_value_or(10);
       map<ComboAddress, unsigned int,ComboAddress::addressOnlyLessThan > counts;
       unsigned int total=0;
-      {
-        for (const auto& shard : g_rings.d_shards) {
-          std::lock_guard<std::mutex> rl(shard->queryLock);
-          for(const auto& c : shard->queryRing) {
-            counts[c.requestor]++;
-            total++;
-          }
-        }
-      }
+      g_rings.visitQueries([&counts, &total](const Rings::Query& c) {
+        counts[c.requestor]++;
+        total++;
+      }, lookback);
       vector<pair<unsigned int, ComboAddress>> rcounts;
       rcounts.reserve(counts.size());
       for(const auto& c : counts)
@@ -259,29 +262,24 @@ void setupLuaInspection(LuaContext& luaCtx)
       g_outputBuffer += (fmt % (count) % "Rest" % rest % (total > 0 ? 100.0*rest/total : 100.0)).str();
     });
 
-  luaCtx.writeFunction("getTopQueries", [](unsigned int top, boost::optional<int> labels) {
+  luaCtx.writeFunction("getTopQueries", [](unsigned int top, boost::optional<int> labels, boost::optional<unsigned int> lookback) {
       setLuaNoSideEffect();
       map<DNSName, unsigned int> counts;
       unsigned int total=0;
       if(!labels) {
-        for (const auto& shard : g_rings.d_shards) {
-          std::lock_guard<std::mutex> rl(shard->queryLock);
-          for(const auto& a : shard->queryRing) {
-            counts[a.name]++;
-            total++;
-          }
-        }
+        g_rings.visitQueries([&counts, &total](const Rings::Query& a) {
+          counts[a.name]++;
+          total++;
+        }, lookback);
       }
       else {
 	unsigned int lab = *labels;
-        for (const auto& shard : g_rings.d_shards) {
-          std::lock_guard<std::mutex> rl(shard->queryLock);
-          for(auto a : shard->queryRing) {
-            a.name.trimToLabels(lab);
-            counts[a.name]++;
-            total++;
-          }
-        }
+        g_rings.visitQueries([&counts, &total, lab](const Rings::Query& a) {
+          DNSName temp(a.name);
+          temp.trimToLabels(lab);
+          counts[temp]++;
+          total++;
+        }, lookback);
       }
       // cout<<"Looked at "<<total<<" queries, "<<counts.size()<<" different ones"<<endl;
       vector<pair<unsigned int, DNSName>> rcounts;
@@ -307,7 +305,7 @@ void setupLuaInspection(LuaContext& luaCtx)
 
     });
 
-  luaCtx.executeCode(R"(function topQueries(top, labels) top = top or 10; for k,v in ipairs(getTopQueries(top,labels)) do show(string.format("%4d  %-40s %4d %4.1f%%",k,v[1],v[2], v[3])) end end)");
+  luaCtx.executeCode(R"(function topQueries(top, labels, lookback) top = top or 10; for k,v in ipairs(getTopQueries(top,labels,lookback)) do show(string.format("%4d  %-40s %4d %4.1f%%",k,v[1],v[2], v[3])) end end)");
 
   luaCtx.writeFunction("getResponseRing", []() {
       setLuaNoSideEffect();
@@ -336,26 +334,26 @@ void setupLuaInspection(LuaContext& luaCtx)
       return ret;
     });
 
-  luaCtx.writeFunction("getTopResponses", [](unsigned int top, unsigned int kind, boost::optional<int> labels) {
-      return getGenResponses(top, labels, [kind](const Rings::Response& r) { return r.dh.rcode == kind; });
+  luaCtx.writeFunction("getTopResponses", [](unsigned int top, unsigned int kind, boost::optional<int> labels, boost::optional<unsigned int> lookback) {
+      return getGenResponses(top, labels, [kind](const Rings::Response& r) { return r.dh.rcode == kind; }, lookback);
     });
 
-  luaCtx.executeCode(R"(function topResponses(top, kind, labels) top = top or 10; kind = kind or 0; for k,v in ipairs(getTopResponses(top, kind, labels)) do show(string.format("%4d  %-40s %4d %4.1f%%",k,v[1],v[2],v[3])) end end)");
+  luaCtx.executeCode(R"(function topResponses(top, kind, labels, lookback) top = top or 10; kind = kind or 0; for k,v in ipairs(getTopResponses(top, kind, labels, lookback)) do show(string.format("%4d  %-40s %4d %4.1f%%",k,v[1],v[2],v[3])) end end)");
 
 
-  luaCtx.writeFunction("getSlowResponses", [](unsigned int top, unsigned int msec, boost::optional<int> labels) {
-      return getGenResponses(top, labels, [msec](const Rings::Response& r) { return r.usec > msec*1000; });
+  luaCtx.writeFunction("getSlowResponses", [](unsigned int top, unsigned int msec, boost::optional<int> labels, boost::optional<unsigned int> lookback) {
+      return getGenResponses(top, labels, [msec](const Rings::Response& r) { return r.usec > msec*1000; }, lookback);
     });
 
 
-  luaCtx.executeCode(R"(function topSlow(top, msec, labels) top = top or 10; msec = msec or 500; for k,v in ipairs(getSlowResponses(top, msec, labels)) do show(string.format("%4d  %-40s %4d %4.1f%%",k,v[1],v[2],v[3])) end end)");
+  luaCtx.executeCode(R"(function topSlow(top, msec, labels, lookback) top = top or 10; msec = msec or 500; for k,v in ipairs(getSlowResponses(top, msec, labels, lookback)) do show(string.format("%4d  %-40s %4d %4.1f%%",k,v[1],v[2],v[3])) end end)");
 
-  luaCtx.writeFunction("getTopBandwidth", [](unsigned int top) {
+  luaCtx.writeFunction("getTopBandwidth", [](unsigned int top, boost::optional<unsigned int> lookback) {
       setLuaNoSideEffect();
-      return g_rings.getTopBandwidth(top);
+      return g_rings.getTopBandwidth(top, lookback);
     });
 
-  luaCtx.executeCode(R"(function topBandwidth(top) top = top or 10; for k,v in ipairs(getTopBandwidth(top)) do show(string.format("%4d  %-40s %4d %4.1f%%",k,v[1],v[2],v[3])) end end)");
+  luaCtx.executeCode(R"(function topBandwidth(top, lookback) top = top or 10; for k,v in ipairs(getTopBandwidth(top, lookback)) do show(string.format("%4d  %-40s %4d %4.1f%%",k,v[1],v[2],v[3])) end end)");
 
   luaCtx.writeFunction("delta", []() {
       setLuaNoSideEffect();
@@ -370,7 +368,7 @@ void setupLuaInspection(LuaContext& luaCtx)
       }
     });
 
-  luaCtx.writeFunction("grepq", [](boost::variant<string, vector<pair<int,string> > > inp, boost::optional<unsigned int> limit) {
+  luaCtx.writeFunction("grepq", [](boost::variant<string, vector<pair<int,string> > > inp, boost::optional<unsigned int> limit, boost::optional<unsigned int> lookback) {
       setLuaNoSideEffect();
       boost::optional<Netmask>  nm;
       boost::optional<DNSName> dn;
@@ -406,34 +404,35 @@ void setupLuaInspection(LuaContext& luaCtx)
         }
       }
 
-      std::vector<Rings::Query> qr;
-      std::vector<Rings::Response> rr;
-      qr.reserve(g_rings.getNumberOfQueryEntries());
-      rr.reserve(g_rings.getNumberOfResponseEntries());
-      for (const auto& shard : g_rings.d_shards) {
-        {
-          std::lock_guard<std::mutex> rl(shard->queryLock);
-          for (const auto& entry : shard->queryRing) {
-            qr.push_back(entry);
-          }
+      auto matches = [&nm, &dn](const ComboAddress& requestor, const DNSName& name) {
+        if (nm && !nm->match(requestor)) {
+          return false;
         }
-        {
-          std::lock_guard<std::mutex> rl(shard->respLock);
-          for (const auto& entry : shard->respRing) {
-            rr.push_back(entry);
-          }
+        if (dn && (name.empty() || !name.isPartOf(*dn))) {
+          return false;
         }
+        return true;
+      };
+
+      /* the selectors are applied while visiting, so that only the matching entries are copied */
+      std::multimap<struct timespec, Rings::Query> qr;
+      std::multimap<struct timespec, Rings::Response> rr;
+      if (msec == -1) {
+        g_rings.visitQueries([&qr, &matches, &limit](const Rings::Query& entry) {
+          if (matches(entry.requestor, entry.name)) {
+            addToMostRecent(qr, entry, limit);
+          }
+        }, lookback);
       }
+      g_rings.visitResponses([&rr, &matches, &limit, msec](const Rings::Response& entry) {
+        if (msec != -1 && entry.usec/1000 <= static_cast<unsigned int>(msec)) {
+          return;
+        }
+        if (matches(entry.requestor, entry.name)) {
+          addToMostRecent(rr, entry, limit);
+        }
+      }, lookback);
 
-      sort(qr.begin(), qr.end(), [](const decltype(qr)::value_type& a, const decltype(qr)::value_type& b) {
-        return b.when < a.when;
-      });
-
-      sort(rr.begin(), rr.end(), [](const decltype(rr)::value_type& a, const decltype(rr)::value_type& b) {
-        return b.when < a.when;
-      });
-
-      unsigned int num=0;
       struct timespec now;
       gettime(&now);
 
@@ -442,73 +441,32 @@ void setupLuaInspection(LuaContext& luaCtx)
       boost::format      fmt("%-7.1f %-47s %-12s %-5d %-25s %-5s %-6.1f %-2s %-2s %-2s %-s\n");
       g_outputBuffer+= (fmt % "Time" % "Client" % "Server" % "ID" % "Name" % "Type" % "Lat." % "TC" % "RD" % "AA" % "Rcode").str();
 
-      if(msec==-1) {
-        for(const auto& c : qr) {
-          bool nmmatch=true, dnmatch=true;
-          if (nm) {
-            nmmatch = nm->match(c.requestor);
-          }
-          if (dn) {
-            if (c.name.empty()) {
-              dnmatch = false;
-            }
-            else {
-              dnmatch = c.name.isPartOf(*dn);
-            }
-          }
-          if (nmmatch && dnmatch) {
-            QType qt(c.qtype);
-            std::string extra;
-            if (c.dh.opcode != 0) {
-              extra = " (" + Opcode::to_s(c.dh.opcode) + ")";
-            }
-            out.insert(make_pair(c.when, (fmt % DiffTime(now, c.when) % c.requestor.toStringWithPort() % "" % htons(c.dh.id) % c.name.toString() % qt.getName()  % "" % (c.dh.tc ? "TC" : "") % (c.dh.rd? "RD" : "") % (c.dh.aa? "AA" : "") % ("Question" + extra)).str() )) ;
-
-            if(limit && *limit==++num)
-              break;
-          }
+      for(const auto& entry : qr) {
+        const auto& c = entry.second;
+        QType qt(c.qtype);
+        std::string extra;
+        if (c.dh.opcode != 0) {
+          extra = " (" + Opcode::to_s(c.dh.opcode) + ")";
         }
+        out.insert(make_pair(c.when, (fmt % DiffTime(now, c.when) % c.requestor.toStringWithPort() % "" % htons(c.dh.id) % c.name.toString() % qt.getName()  % "" % (c.dh.tc ? "TC" : "") % (c.dh.rd? "RD" : "") % (c.dh.aa? "AA" : "") % ("Question" + extra)).str() )) ;
       }
-      num=0;
-
 
       string extra;
-      for(const auto& c : rr) {
-        bool nmmatch=true, dnmatch=true, msecmatch=true;
-        if (nm) {
-          nmmatch = nm->match(c.requestor);
-        }
-        if (dn) {
-          if (c.name.empty()) {
-            dnmatch = false;
-          }
-          else {
-            dnmatch = c.name.isPartOf(*dn);
-          }
+      for(const auto& entry : rr) {
+        const auto& c = entry.second;
+        QType qt(c.qtype);
+        if (!c.dh.rcode) {
+          extra=". " +std::to_string(htons(c.dh.ancount))+ " answers";
         }
-        if (msec != -1) {
-          msecmatch=(c.usec/1000 > (unsigned int)msec);
+        else {
+          extra.clear();
         }
 
-        if (nmmatch && dnmatch && msecmatch) {
-          QType qt(c.qtype);
-	  if (!c.dh.rcode) {
-	    extra=". " +std::to_string(htons(c.dh.ancount))+ " answers";
-          }
-	  else {
-	    extra.clear();
-          }
-
-          if (c.usec != std::numeric_limits<decltype(c.usec)>::max()) {
-            out.insert(make_pair(c.when, (fmt % DiffTime(now, c.when) % c.requestor.toStringWithPort() % c.ds.toStringWithPort() % htons(c.dh.id) % c.name.toString()  % qt.getName()  % (c.usec/1000.0) % (c.dh.tc ? "TC" : "") % (c.dh.rd? "RD" : "") % (c.dh.aa? "AA" : "") % (RCode::to_s(c.dh.rcode) + extra)).str()  )) ;
-          }
-          else {
-            out.insert(make_pair(c.when, (fmt % DiffTime(now, c.when) % c.requestor.toStringWithPort() % c.ds.toStringWithPort() % htons(c.dh.id) % c.name.toString()  % qt.getName()  % "T.O" % (c.dh.tc ? "TC" : "") % (c.dh.rd? "RD" : "") % (c.dh.aa? "AA" : "") % (RCode::to_s(c.dh.rcode) + extra)).str()  )) ;
-          }
-
-          if (limit && *limit == ++num) {
-            break;
-          }
+        if (c.usec != std::numeric_limits<decltype(c.usec)>::max()) {
+          out.insert(make_pair(c.when, (fmt % DiffTime(now, c.when) % c.requestor.toStringWithPort() % c.ds.toStringWithPort() % htons(c.dh.id) % c.name.toString()  % qt.getName()  % (c.usec/1000.0) % (c.dh.tc ? "TC" : "") % (c.dh.rd? "RD" : "") % (c.dh.aa? "AA" : "") % (RCode::to_s(c.dh.rcode) + extra)).str()  )) ;
+        }
+        else {
+          out.insert(make_pair(c.when, (fmt % DiffTime(now, c.when) % c.requestor.toStringWithPort() % c.ds.toStringWithPort() % htons(c.dh.id) % c.name.toString()  % qt.getName()  % "T.O" % (c.dh.tc ? "TC" : "") % (c.dh.rd? "RD" : "") % (c.dh.aa? "AA" : "") % (RCode::to_s(c.dh.rcode) + extra)).str()  )) ;
         }
       }
 
@@ -598,13 +556,13 @@ void setupLuaInspection(LuaContext& luaCtx)
       ret << endl;
 
       ret << "Backends:" << endl;
-      fmt = boost::format("%-3d %-20.20s %-20.20s %-20d %-20d %-25d %-20d %-20d %-20d %-20f %-20f");
-      ret << (fmt % "#" % "Name" % "Address" % "Connections" % "Died sending query" % "Died reading response" % "Gave up" % "Read timeouts" % "Write timeouts" % "Avg queries/conn" % "Avg duration") << endl;
+      fmt = boost::format("%-3d %-20.20s %-20.20s %-20d %-20d %-25d %-20d %-20d %-20d %-20f %-20f %-20d");
+      ret << (fmt % "#" % "Name" % "Address" % "Connections" % "Died sending query" % "Died reading response" % "Gave up" % "Read timeouts" % "Write timeouts" % "Avg queries/conn" % "Avg duration" % "TLS resumptions") << endl;
 
       auto states = g_dstates.getLocal();
       counter = 0;
       for(const auto& s : *states) {
-        ret << (fmt % counter % s->getName() % s->remote.toStringWithPort() % s->tcpCurrentConnections % s->tcpDiedSendingQuery % s->tcpDiedReadingResponse % s->tcpGaveUp % s->tcpReadTimeouts % s->tcpWriteTimeouts % s->tcpAvgQueriesPerConnection % s->tcpAvgConnectionDuration) << endl;
+        ret << (fmt % counter % s->getName() % s->remote.toStringWithPort() % s->tcpCurrentConnections % s->tcpDiedSendingQuery % s->tcpDiedReadingResponse % s->tcpGaveUp % s->tcpReadTimeouts % s->tcpWriteTimeouts % s->tcpAvgQueriesPerConnection % s->tcpAvgConnectionDuration % s->tlsResumptions) << endl;
         ++counter;
       }
 
@@ -806,5 +764,6 @@ void setupLuaInspection(LuaContext& luaCtx)
     group->apply();
   });
   luaCtx.registerFunction("setQuiet", &DynBlockRulesGroup::setQuiet);
+  luaCtx.registerFunction("setIncremental", &DynBlockRulesGroup::setIncremental);
   luaCtx.registerFunction("toString", &DynBlockRulesGroup::toString);
 }
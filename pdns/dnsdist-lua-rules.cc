@@ -85,24 +85,46 @@ void parseRuleParams(boost::optional<luaruleparams_t> params, boost::uuids::uuid
 
 typedef std::unordered_map<std::string, boost::variant<bool, int, std::string, std::vector<std::pair<int,int> > > > ruleparams_t;
 
+static std::string getAverageDuration(const TimingHistogram& timings)
+{
+  const auto count = timings.getCount();
+  if (count == 0) {
+    return "-";
+  }
+  return (boost::format("%.1f") % (1.0 * timings.getSum() / count)).str();
+}
+
 template<typename T>
 static void showRules(GlobalStateHolder<vector<T> > *someRulActions, boost::optional<ruleparams_t> vars) {
   setLuaNoSideEffect();
   int num=0;
   bool showUUIDs = false;
+  bool showTimings = false;
   size_t truncateRuleWidth = string::npos;
 
   if (vars) {
     if (vars->count("showUUIDs")) {
       showUUIDs = boost::get<bool>((*vars)["showUUIDs"]);
     }
+    if (vars->count("showTimings")) {
+      showTimings = boost::get<bool>((*vars)["showTimings"]);
+    }
     if (vars->count("truncateRuleWidth")) {
       truncateRuleWidth = boost::get<int>((*vars)["truncateRuleWidth"]);
     }
   }
 
   auto rules = someRulActions->getLocal();
-  if (showUUIDs) {
+  if (showTimings) {
+    boost::format fmt("%-3d %9d %9d %12s %12s %-56s %s\n");
+    g_outputBuffer += (fmt % "#" % "Matches" % "Sampled" % "Rule (ns)" % "Action (ns)" % "Rule" % "Action").str();
+    for(const auto& lim : *rules) {
+      string name = lim.d_rule->toString().substr(0, truncateRuleWidth);
+      g_outputBuffer += (fmt % num % lim.d_rule->d_matches % lim.d_rule->d_timings.getCount() % getAverageDuration(lim.d_rule->d_timings) % getAverageDuration(lim.d_action->d_timings) % name % lim.d_action->toString()).str();
+      ++num;
+    }
+  }
+  else if (showUUIDs) {
     boost::format fmt("%-3d %-38s %9d %9d %-56s %s\n");
     g_outputBuffer += (fmt % "#" % "UUID" % "Cr. Order" % "Matches" % "Rule" % "Action").str();
     for(const auto& lim : *rules) {
@@ -122,6 +144,79 @@ static void showRules(GlobalStateHolder<vector<T> > *someRulActions, boost::opti
   }
 }
 
+struct BenchItem
+{
+  vector<uint8_t> packet;
+  ComboAddress rem;
+  DNSName qname;
+  uint16_t qtype, qclass;
+};
+
+static vector<BenchItem> generateBenchItems(const DNSName& suffix)
+{
+  vector<BenchItem> items;
+  items.reserve(1000);
+  for(int n=0; n < 1000; ++n) {
+    BenchItem i;
+    i.qname=DNSName(std::to_string(random()));
+    i.qname += suffix;
+    i.qtype = random() % 0xff;
+    i.qclass = 1;
+    i.rem=ComboAddress("127.0.0.1");
+    i.rem.sin4.sin_addr.s_addr = random();
+    DNSPacketWriter pw(i.packet, i.qname, i.qtype);
+    items.push_back(i);
+  }
+  return items;
+}
+
+static void benchRules(int times, const DNSName& suffix)
+{
+  const auto rules = g_rulactions.getCopy();
+  const auto items = generateBenchItems(suffix);
+  RuleChainIndex index;
+  index.update(rules);
+
+  StopWatch sw;
+  boost::format fmt("%-3d %-7s %9d %12.1f %s\n");
+  g_outputBuffer = (fmt % "#" % "Indexed" % "Matches" % "Cost (ns)" % "Rule").str();
+  double linearCost = 0;
+  size_t num = 0;
+  for (const auto& rule : rules) {
+    int matches = 0;
+    sw.start();
+    for (int n = 0; n < times; ++n) {
+      const BenchItem& i = items[n % items.size()];
+      DNSQuestion dq(&i.qname, i.qtype, i.qclass, 0, &i.rem, &i.rem, (struct dnsheader*)&i.packet[0], i.packet.size(), i.packet.size(), false, &sw.d_start);
+      if (rule.d_rule->matches(&dq)) {
+        matches++;
+      }
+    }
+    double cost = 1000.0 * sw.udiff() / times;
+    linearCost += cost;
+    g_outputBuffer += (fmt % num % (index.isIndexed(num) ? "yes" : "no") % matches % cost % rule.d_rule->toString()).str();
+    ++num;
+  }
+
+  g_outputBuffer += (boost::format("Evaluating the whole chain in order costs %.1f ns per query\n") % linearCost).str();
+  if (!index.isEnabled()) {
+    g_outputBuffer += (boost::format("The chain is not indexed (fewer than %d indexable rules)\n") % RuleChainIndex::s_minIndexedRules).str();
+    return;
+  }
+
+  sw.start();
+  for (int n = 0; n < times; ++n) {
+    const BenchItem& i = items[n % items.size()];
+    DNSQuestion dq(&i.qname, i.qtype, i.qclass, 0, &i.rem, &i.rem, (struct dnsheader*)&i.packet[0], i.packet.size(), i.packet.size(), false, &sw.d_start);
+    for (const auto& candidate : index.getCandidates(dq)) {
+      if (!candidate.d_matches) {
+        rules[candidate.d_position].d_rule->matches(&dq);
+      }
+    }
+  }
+  g_outputBuffer += (boost::format("Evaluating the whole chain via the index costs %.1f ns per query\n") % (1000.0 * sw.udiff() / times)).str();
+}
+
 template<typename T>
 static void rmRule(GlobalStateHolder<vector<T> > *someRulActions, boost::variant<unsigned int, std::string> id) {
   setLuaSideEffect();
@@ -314,32 +409,14 @@ void setupLuaRules(LuaContext& luaCtx)
       setLuaNoSideEffect();
       int times = times_.get_value_or(100000);
       DNSName suffix(suffix_.get_value_or("powerdns.com"));
-      struct item {
-        vector<uint8_t> packet;
-        ComboAddress rem;
-        DNSName qname;
-        uint16_t qtype, qclass;
-      };
-      vector<item> items;
-      items.reserve(1000);
-      for(int n=0; n < 1000; ++n) {
-        struct item i;
-        i.qname=DNSName(std::to_string(random()));
-        i.qname += suffix;
-        i.qtype = random() % 0xff;
-        i.qclass = 1;
-        i.rem=ComboAddress("127.0.0.1");
-        i.rem.sin4.sin_addr.s_addr = random();
-        DNSPacketWriter pw(i.packet, i.qname, i.qtype);
-        items.push_back(i);
-      }
+      const auto items = generateBenchItems(suffix);
 
       int matches=0;
       ComboAddress dummy("127.0.0.1");
       StopWatch sw;
       sw.start();
       for(int n=0; n < times; ++n) {
-        const item& i = items[n % items.size()];
+        const BenchItem& i = items[n % items.size()];
         DNSQuestion dq(&i.qname, i.qtype, i.qclass, 0, &i.rem, &i.rem, (struct dnsheader*)&i.packet[0], i.packet.size(), i.packet.size(), false, &sw.d_start);
         if(rule->matches(&dq))
           matches++;
@@ -349,6 +426,11 @@ void setupLuaRules(LuaContext& luaCtx)
 
     });
 
+  luaCtx.writeFunction("benchRules", [](boost::optional<int> times_, boost::optional<string> suffix_)  {
+      setLuaNoSideEffect();
+      benchRules(times_.get_value_or(100000), DNSName(suffix_.get_value_or("powerdns.com")));
+    });
+
   luaCtx.writeFunction("AllRule", []() {
       return std::shared_ptr<DNSRule>(new AllRule());
     });
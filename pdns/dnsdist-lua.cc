@@ -39,7 +39,9 @@
 #ifdef LUAJIT_VERSION
 #include "dnsdist-lua-ffi.hh"
 #endif /* LUAJIT_VERSION */
+#include "dnsdist-nghttp2.hh"
 #include "dnsdist-rings.hh"
+#include "dnsdist-rings-history.hh"
 #include "dnsdist-secpoll.hh"
 #include "dnsdist-web.hh"
 
@@ -98,7 +100,7 @@ void resetLuaSideEffect()
 
 typedef std::unordered_map<std::string, boost::variant<bool, int, std::string, std::vector<std::pair<int,int> >, std::vector<std::pair<int, std::string> >, std::map<std::string,std::string>  > > localbind_t;
 
-static void parseLocalBindVars(boost::optional<localbind_t> vars, bool& reusePort, int& tcpFastOpenQueueSize, std::string& interface, std::set<int>& cpus, int& tcpListenQueueSize)
+static void parseLocalBindVars(boost::optional<localbind_t> vars, bool& reusePort, int& tcpFastOpenQueueSize, std::string& interface, std::set<int>& cpus, int& tcpListenQueueSize, size_t& maxInFlightQueriesPerConnection)
 {
   if (vars) {
     if (vars->count("reusePort")) {
@@ -110,6 +112,9 @@ static void parseLocalBindVars(boost::optional<localbind_t> vars, bool& reusePor
     if (vars->count("tcpListenQueueSize")) {
       tcpListenQueueSize = boost::get<int>((*vars)["tcpListenQueueSize"]);
     }
+    if (vars->count("maxInFlight")) {
+      maxInFlightQueriesPerConnection = boost::get<int>((*vars)["maxInFlight"]);
+    }
     if (vars->count("interface")) {
       interface = boost::get<std::string>((*vars)["interface"]);
     }
@@ -254,7 +259,15 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
       }
 
       try {
-        serverAddr = ComboAddress(serverAddressStr, 53);
+        /* DNS over TLS backends listen on port 853 by default, DNS over HTTPS ones on 443 (80 without TLS) */
+        uint16_t defaultPort = 53;
+        if (vars.count("dohPath")) {
+          defaultPort = vars.count("tls") ? 443 : 80;
+        }
+        else if (vars.count("tls")) {
+          defaultPort = 853;
+        }
+        serverAddr = ComboAddress(serverAddressStr, defaultPort);
       }
       catch(const PDNSException& e) {
         g_outputBuffer="Error creating new server: "+string(e.reason);
@@ -390,6 +403,14 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
         ret->tcpRecvTimeout=std::stoi(boost::get<string>(vars["tcpRecvTimeout"]));
       }
 
+      if (vars.count("maxInFlight")) {
+        ret->maxInFlightQueriesPerConn = std::stoul(boost::get<string>(vars["maxInFlight"]));
+        if (ret->maxInFlightQueriesPerConn > std::numeric_limits<uint16_t>::max()) {
+          warnlog("The maximum number of in-flight queries for downstream server %s is larger than the number of DNS IDs, using %d", boost::get<string>(vars["address"]), std::numeric_limits<uint16_t>::max());
+          ret->maxInFlightQueriesPerConn = std::numeric_limits<uint16_t>::max();
+        }
+      }
+
       if(vars.count("tcpFastOpen")) {
         bool fastOpen = boost::get<bool>(vars["tcpFastOpen"]);
         if (fastOpen) {
@@ -401,6 +422,72 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
         }
       }
 
+      if (vars.count("dohPath")) {
+        if (!isOutgoingDoHSupported()) {
+          g_outputBuffer = "Error creating new server: outgoing DNS over HTTPS support is not available\n";
+          errlog("Error creating new server %s: outgoing DNS over HTTPS support is not available", serverAddressStr);
+          return ret;
+        }
+
+        ret->d_dohPath = boost::get<string>(vars["dohPath"]);
+        if (vars.count("dohMaxConnections")) {
+          ret->dohMaxConnections = std::stoul(boost::get<string>(vars["dohMaxConnections"]));
+          if (ret->dohMaxConnections == 0) {
+            ret->dohMaxConnections = 1;
+          }
+        }
+
+        if (ret->tcpFastOpen) {
+          warnlog("TCP Fast Open is not supported with DNS over HTTPS, disabling it on downstream server %s", serverAddressStr);
+          ret->tcpFastOpen = false;
+        }
+      }
+
+      if (vars.count("tls")) {
+        TLSContextParameters tlsParams;
+        tlsParams.d_provider = boost::get<string>(vars["tls"]);
+        if (ret->isDoH()) {
+          tlsParams.d_alpnProtocols.push_back("h2");
+        }
+
+        if (vars.count("ciphers")) {
+          tlsParams.d_ciphers = boost::get<string>(vars["ciphers"]);
+        }
+        if (vars.count("ciphersTLS13")) {
+          tlsParams.d_ciphers13 = boost::get<string>(vars["ciphersTLS13"]);
+        }
+        if (vars.count("caStore")) {
+          tlsParams.d_caStore = boost::get<string>(vars["caStore"]);
+        }
+        if (vars.count("validateCertificates")) {
+          tlsParams.d_validateCertificates = boost::get<bool>(vars["validateCertificates"]);
+        }
+        if (vars.count("maxStoredSessions")) {
+          tlsParams.d_maxStoredSessions = std::stoul(boost::get<string>(vars["maxStoredSessions"]));
+        }
+
+        if (vars.count("subjectName")) {
+          ret->d_tlsSubjectName = boost::get<string>(vars["subjectName"]);
+        }
+        else {
+          ret->d_tlsSubjectName = serverAddr.toString();
+        }
+
+        try {
+          ret->d_tlsCtx = getTLSContext(tlsParams);
+        }
+        catch (const std::exception& e) {
+          g_outputBuffer = "Error creating new server: " + string(e.what());
+          errlog("Error setting up TLS on new server %s: %s", serverAddressStr, e.what());
+          return ret;
+        }
+
+        if (ret->tcpFastOpen) {
+          warnlog("TCP Fast Open is not supported with DNS over TLS, disabling it on downstream server %s", serverAddressStr);
+          ret->tcpFastOpen = false;
+        }
+      }
+
       if(vars.count("name")) {
         ret->setName(boost::get<string>(vars["name"]));
       }
@@ -443,6 +530,10 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
 
       if(vars.count("useProxyProtocol")) {
         ret->useProxyProtocol = boost::get<bool>(vars["useProxyProtocol"]);
+        if (ret->useProxyProtocol && ret->isDoH()) {
+          warnlog("The proxy protocol is not supported with DNS over HTTPS, disabling it on downstream server %s", serverAddressStr);
+          ret->useProxyProtocol = false;
+        }
       }
 
       if(vars.count("disableZeroScope")) {
@@ -475,6 +566,24 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
         }
       }
 
+      if (ret->isDoH()) {
+        try {
+          setupDoHClientBackend(ret);
+        }
+        catch (const std::exception& e) {
+          g_outputBuffer = "Error creating new server: " + string(e.what());
+          errlog("Error setting up DNS over HTTPS on new server %s: %s", serverAddressStr, e.what());
+          return ret;
+        }
+
+        if (g_launchWork) {
+          g_launchWork->push_back(startDoHClientThread);
+        }
+        else {
+          startDoHClientThread();
+        }
+      }
+
       /* this needs to be done _AFTER_ the order has been set,
          since the server are kept ordered inside the pool */
       auto localPools = g_pools.getCopy();
@@ -585,10 +694,11 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
       bool reusePort = false;
       int tcpFastOpenQueueSize = 0;
       int tcpListenQueueSize = 0;
+      size_t maxInFlightQueriesPerConn = 0;
       std::string interface;
       std::set<int> cpus;
 
-      parseLocalBindVars(vars, reusePort, tcpFastOpenQueueSize, interface, cpus, tcpListenQueueSize);
+      parseLocalBindVars(vars, reusePort, tcpFastOpenQueueSize, interface, cpus, tcpListenQueueSize, maxInFlightQueriesPerConn);
 
       try {
 	ComboAddress loc(addr, 53);
@@ -608,6 +718,7 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
         if (tcpListenQueueSize > 0) {
           tcpCS->tcpListenQueueSize = tcpListenQueueSize;
         }
+        tcpCS->maxInFlightQueriesPerConn = maxInFlightQueriesPerConn;
         g_frontends.push_back(std::move(tcpCS));
       }
       catch(const std::exception& e) {
@@ -626,10 +737,11 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
       bool reusePort = false;
       int tcpFastOpenQueueSize = 0;
       int tcpListenQueueSize = 0;
+      size_t maxInFlightQueriesPerConn = 0;
       std::string interface;
       std::set<int> cpus;
 
-      parseLocalBindVars(vars, reusePort, tcpFastOpenQueueSize, interface, cpus, tcpListenQueueSize);
+      parseLocalBindVars(vars, reusePort, tcpFastOpenQueueSize, interface, cpus, tcpListenQueueSize, maxInFlightQueriesPerConn);
 
       try {
 	ComboAddress loc(addr, 53);
@@ -639,6 +751,7 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
         if (tcpListenQueueSize > 0) {
           tcpCS->tcpListenQueueSize = tcpListenQueueSize;
         }
+        tcpCS->maxInFlightQueriesPerConn = maxInFlightQueriesPerConn;
         g_frontends.push_back(std::move(tcpCS));
       }
       catch(std::exception& e) {
@@ -1116,6 +1229,11 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
 
   luaCtx.writeFunction("setCacheCleaningPercentage", [](uint16_t percentage) { if (percentage < 100) g_cacheCleaningPercentage = percentage; else g_cacheCleaningPercentage = 100; });
 
+  luaCtx.writeFunction("setRuleTimingSampleRate", [](uint32_t rate) {
+      setLuaSideEffect();
+      g_ruleTimingSampleRate = rate;
+    });
+
   luaCtx.writeFunction("setECSSourcePrefixV4", [](uint16_t prefix) { g_ECSSourcePrefixV4=prefix; });
 
   luaCtx.writeFunction("setECSSourcePrefixV6", [](uint16_t prefix) { g_ECSSourcePrefixV6=prefix; });
@@ -1248,11 +1366,12 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
       bool reusePort = false;
       int tcpFastOpenQueueSize = 0;
       int tcpListenQueueSize = 0;
+      size_t maxInFlightQueriesPerConn = 0;
       std::string interface;
       std::set<int> cpus;
       std::vector<DNSCryptContext::CertKeyPaths> certKeys;
 
-      parseLocalBindVars(vars, reusePort, tcpFastOpenQueueSize, interface, cpus, tcpListenQueueSize);
+      parseLocalBindVars(vars, reusePort, tcpFastOpenQueueSize, interface, cpus, tcpListenQueueSize, maxInFlightQueriesPerConn);
 
       if (certFiles.type() == typeid(std::string) && keyFiles.type() == typeid(std::string)) {
         auto certFile = boost::get<std::string>(certFiles);
@@ -1294,6 +1413,7 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
         if (tcpListenQueueSize > 0) {
           cs->tcpListenQueueSize = tcpListenQueueSize;
         }
+        cs->maxInFlightQueriesPerConn = maxInFlightQueriesPerConn;
 
         g_frontends.push_back(std::move(cs));
       }
@@ -1719,11 +1839,38 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
       g_rings.setCapacity(capacity, numberOfShards ? *numberOfShards : 1);
     });
 
+  luaCtx.writeFunction("setRingBuffersHistory", [](const std::string& path, size_t size, boost::optional<size_t> segmentSize) {
+      setLuaSideEffect();
+      if (g_configurationDone) {
+        errlog("setRingBuffersHistory() cannot be used at runtime!");
+        g_outputBuffer="setRingBuffersHistory() cannot be used at runtime!\n";
+        return;
+      }
+      try {
+        /* 16 segments by default, so that reusing the oldest one only discards a small part of the history */
+        g_rings.setHistory(std::make_shared<RingsHistory>(path, size, segmentSize ? *segmentSize : std::max(size / 16, RingsHistory::s_minimumSegmentSize)));
+      }
+      catch (const std::exception& e) {
+        errlog("Error setting up the ring buffers history: %s", e.what());
+        g_outputBuffer="Error setting up the ring buffers history: " + std::string(e.what()) + "\n";
+      }
+    });
+
   luaCtx.writeFunction("setRingBuffersLockRetries", [](size_t retries) {
       setLuaSideEffect();
       g_rings.setNumberOfLockRetries(retries);
     });
 
+  luaCtx.writeFunction("setRingBuffersPerThreadShards", [](bool enabled) {
+      setLuaSideEffect();
+      if (g_configurationDone) {
+        errlog("setRingBuffersPerThreadShards() cannot be used at runtime!");
+        g_outputBuffer="setRingBuffersPerThreadShards() cannot be used at runtime!\n";
+        return;
+      }
+      g_rings.setPerThreadShards(enabled);
+    });
+
   luaCtx.writeFunction("setWHashedPertubation", [](uint32_t pertub) {
       setLuaSideEffect();
       g_hashperturb = pertub;
@@ -1950,11 +2097,12 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
     bool reusePort = false;
     int tcpFastOpenQueueSize = 0;
     int tcpListenQueueSize = 0;
+    size_t maxInFlightQueriesPerConn = 0;
     std::string interface;
     std::set<int> cpus;
 
     if (vars) {
-      parseLocalBindVars(vars, reusePort, tcpFastOpenQueueSize, interface, cpus, tcpListenQueueSize);
+      parseLocalBindVars(vars, reusePort, tcpFastOpenQueueSize, interface, cpus, tcpListenQueueSize, maxInFlightQueriesPerConn);
 
       if (vars->count("idleTimeout")) {
         frontend->d_idleTimeout = boost::get<int>((*vars)["idleTimeout"]);
@@ -2136,11 +2284,12 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
         bool reusePort = false;
         int tcpFastOpenQueueSize = 0;
         int tcpListenQueueSize = 0;
+        size_t maxInFlightQueriesPerConn = 0;
         std::string interface;
         std::set<int> cpus;
 
         if (vars) {
-          parseLocalBindVars(vars, reusePort, tcpFastOpenQueueSize, interface, cpus, tcpListenQueueSize);
+          parseLocalBindVars(vars, reusePort, tcpFastOpenQueueSize, interface, cpus, tcpListenQueueSize, maxInFlightQueriesPerConn);
 
           if (vars->count("provider")) {
             frontend->d_provider = boost::get<const string>((*vars)["provider"]);
@@ -2168,6 +2317,7 @@ static void setupLuaConfig(LuaContext& luaCtx, bool client, bool configCheck)
           if (tcpListenQueueSize > 0) {
             cs->tcpListenQueueSize = tcpListenQueueSize;
           }
+          cs->maxInFlightQueriesPerConn = maxInFlightQueriesPerConn;
           g_tlslocals.push_back(cs->tlsFrontend);
           g_frontends.push_back(std::move(cs));
         }
@@ -2327,7 +2477,7 @@ vector<std::function<void(void)>> setupLua(LuaContext& luaCtx, bool client, bool
   setupLuaBindingsDNSCrypt(luaCtx);
   setupLuaBindingsDNSQuestion(luaCtx);
   setupLuaBindingsKVS(luaCtx, client);
-  setupLuaBindingsPacketCache(luaCtx);
+  setupLuaBindingsPacketCache(luaCtx, client);
   setupLuaBindingsProtoBuf(luaCtx, client, configCheck);
   setupLuaInspection(luaCtx);
   setupLuaRules(luaCtx);
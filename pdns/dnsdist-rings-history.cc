@@ -0,0 +1,356 @@
+/*
+ * This file is part of PowerDNS or dnsdist.
+ * Copyright -- PowerDNS.COM B.V. and its contributors
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of version 2 of the GNU General Public License as
+ * published by the Free Software Foundation.
+ *
+ * In addition, for the avoidance of any doubt, permission is granted to
+ * link this program with OpenSSL and to (re)distribute the binaries
+ * produced as the result of such linking.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+ */
+#include <algorithm>
+#include <cstring>
+#include <fcntl.h>
+#include <limits>
+#include <stdexcept>
+#include <sys/mman.h>
+#include <unistd.h>
+
+#include "dnsdist-rings-history.hh"
+#include "misc.hh"
+
+const size_t RingsHistory::s_minimumSegmentSize;
+
+struct RingsHistory::Record
+{
+  /* in milliseconds, relative to the base of the segment */
+  int32_t when;
+  /* offset of the name from the beginning of the segment */
+  uint32_t name;
+  uint32_t usec;
+  uint32_t size;
+  uint8_t requestor[16];
+  uint8_t backend[16];
+  uint16_t requestorPort;
+  uint16_t backendPort;
+  uint16_t qtype;
+  uint8_t flags;
+  uint8_t reserved;
+  struct dnsheader dh;
+};
+
+static const uint8_t s_flagResponse{1};
+static const uint8_t s_flagRequestorV6{2};
+static const uint8_t s_flagBackendV6{4};
+static const uint32_t s_noName{std::numeric_limits<uint32_t>::max()};
+/* number of records copied from the history while holding the lock */
+static const size_t s_recordsPerBatch{1024};
+
+static void storeAddress(const ComboAddress& address, uint8_t* storage, uint16_t& port, uint8_t& flags, uint8_t v6Flag)
+{
+  if (address.isIPv4()) {
+    memcpy(storage, &address.sin4.sin_addr.s_addr, sizeof(address.sin4.sin_addr.s_addr));
+  }
+  else {
+    memcpy(storage, &address.sin6.sin6_addr.s6_addr, sizeof(address.sin6.sin6_addr.s6_addr));
+    flags |= v6Flag;
+  }
+  /* in network byte order, the same for IPv4 and IPv6 */
+  port = address.sin4.sin_port;
+}
+
+static ComboAddress loadAddress(const uint8_t* storage, uint16_t port, bool v6)
+{
+  ComboAddress address;
+  if (!v6) {
+    memcpy(&address.sin4.sin_addr.s_addr, storage, sizeof(address.sin4.sin_addr.s_addr));
+    address.sin4.sin_port = port;
+  }
+  else {
+    address.sin6.sin6_family = AF_INET6;
+    memcpy(&address.sin6.sin6_addr.s6_addr, storage, sizeof(address.sin6.sin6_addr.s6_addr));
+    address.sin6.sin6_port = port;
+  }
+  return address;
+}
+
+RingsHistory::RingsHistory(const std::string& path, size_t size, size_t segmentSize): d_segmentSize(segmentSize)
+{
+  static_assert(sizeof(Record) == 68, "Unexpected padding in the ring buffers history records");
+
+  if (d_segmentSize < s_minimumSegmentSize) {
+    throw std::runtime_error("The segments of the ring buffers history should be at least " + std::to_string(s_minimumSegmentSize) + " bytes long");
+  }
+  /* the offsets of the names in a segment are stored on 32 bits */
+  if (d_segmentSize >= s_noName) {
+    throw std::runtime_error("The segments of the ring buffers history should be smaller than " + std::to_string(s_noName) + " bytes");
+  }
+  if (size < d_segmentSize) {
+    throw std::runtime_error("The ring buffers history should be at least as large as one segment");
+  }
+
+  d_segments.resize(size / d_segmentSize);
+  d_mappedSize = d_segments.size() * d_segmentSize;
+
+  int fd = open(path.c_str(), O_RDWR | O_CREAT | O_TRUNC | O_CLOEXEC, 0600);
+  if (fd < 0) {
+    throw std::runtime_error("Error opening the ring buffers history file '" + path + "': " + stringerror());
+  }
+
+  if (ftruncate(fd, d_mappedSize) != 0) {
+    int err = errno;
+    close(fd);
+    throw std::runtime_error("Error setting the size of the ring buffers history file '" + path + "': " + stringerror(err));
+  }
+
+  void* mapped = mmap(nullptr, d_mappedSize, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+  int err = errno;
+  /* the mapping stays valid after the descriptor has been closed */
+  close(fd);
+  if (mapped == MAP_FAILED) {
+    throw std::runtime_error("Error mapping the ring buffers history file '" + path + "': " + stringerror(err));
+  }
+  d_mapped = static_cast<char*>(mapped);
+}
+
+RingsHistory::~RingsHistory()
+{
+  if (d_mapped != nullptr) {
+    munmap(d_mapped, d_mappedSize);
+  }
+}
+
+void RingsHistory::moveToNextSegment()
+{
+  d_current = (d_current + 1) % d_segments.size();
+  auto& segment = d_segments.at(d_current);
+  if (segment.d_inUse) {
+    d_entries -= segment.d_records;
+    d_discarded += segment.d_records;
+  }
+  segment = Segment();
+  segment.d_generation = ++d_generations;
+  d_names.clear();
+}
+
+bool RingsHistory::addToCurrentSegment(Record& record, const struct timespec& when, const DNSName& name)
+{
+  auto& segment = d_segments.at(d_current);
+  if (!segment.d_inUse) {
+    segment.d_inUse = true;
+    segment.d_base = when.tv_sec;
+    segment.d_newest = when.tv_sec;
+    segment.d_namesStart = d_segmentSize;
+  }
+
+  int64_t offset = static_cast<int64_t>(when.tv_sec - segment.d_base) * 1000 + when.tv_nsec / 1000000;
+  if (offset < std::numeric_limits<int32_t>::min() || offset > std::numeric_limits<int32_t>::max()) {
+    return false;
+  }
+
+  size_t recordsEnd = (segment.d_records + 1) * sizeof(Record);
+  if (recordsEnd > segment.d_namesStart) {
+    return false;
+  }
+
+  char* start = getSegmentStart(d_current);
+  record.name = s_noName;
+  if (!name.empty()) {
+    auto it = d_names.find(name);
+    if (it != d_names.end()) {
+      record.name = it->second;
+    }
+    else {
+      const auto& storage = name.getStorage();
+      /* the length of the name in wire format, which is at most 255, then the name itself */
+      size_t needed = 1 + storage.size();
+      if (recordsEnd + needed > segment.d_namesStart) {
+        return false;
+      }
+      segment.d_namesStart -= needed;
+      start[segment.d_namesStart] = static_cast<char>(storage.size());
+      memcpy(start + segment.d_namesStart + 1, storage.data(), storage.size());
+      record.name = static_cast<uint32_t>(segment.d_namesStart);
+      d_names.insert({name, record.name});
+    }
+  }
+
+  record.when = static_cast<int32_t>(offset);
+  memcpy(start + segment.d_records * sizeof(Record), &record, sizeof(record));
+  segment.d_records++;
+  if (when.tv_sec > segment.d_newest) {
+    segment.d_newest = when.tv_sec;
+  }
+  d_entries++;
+  return true;
+}
+
+void RingsHistory::add(Record& record, const struct timespec& when, const DNSName& name)
+{
+  std::lock_guard<std::mutex> lock(d_lock);
+  if (addToCurrentSegment(record, when, name)) {
+    return;
+  }
+
+  moveToNextSegment();
+  /* a new segment has enough room for any entry, but the time might still be too far away */
+  addToCurrentSegment(record, when, name);
+}
+
+void RingsHistory::addQuery(const Rings::Query& query)
+{
+  Record record;
+  memset(&record, 0, sizeof(record));
+  storeAddress(query.requestor, record.requestor, record.requestorPort, record.flags, s_flagRequestorV6);
+  record.size = query.size;
+  record.qtype = query.qtype;
+  record.dh = query.dh;
+  add(record, query.when, query.name);
+}
+
+void RingsHistory::addResponse(const Rings::Response& response)
+{
+  Record record;
+  memset(&record, 0, sizeof(record));
+  record.flags = s_flagResponse;
+  storeAddress(response.requestor, record.requestor, record.requestorPort, record.flags, s_flagRequestorV6);
+  storeAddress(response.ds, record.backend, record.backendPort, record.flags, s_flagBackendV6);
+  record.usec = response.usec;
+  record.size = response.size;
+  record.qtype = response.qtype;
+  record.dh = response.dh;
+  add(record, response.when, response.name);
+}
+
+void RingsHistory::visit(const struct timespec& since, bool responses, const std::function<void(const Record&, const struct timespec&, DNSName&&)>& visitor) const
+{
+  struct SegmentSnapshot
+  {
+    size_t d_idx;
+    uint64_t d_generation;
+    time_t d_base;
+    size_t d_records;
+  };
+
+  /* the segments to visit, from the oldest to the newest, as they are now.
+     Entries added to the current segment after this point are not visited */
+  std::vector<SegmentSnapshot> segments;
+  {
+    std::lock_guard<std::mutex> lock(d_lock);
+    segments.reserve(d_segments.size());
+    for (size_t count = 0; count < d_segments.size(); count++) {
+      /* start with the oldest segment, the one right after the current one */
+      size_t idx = (d_current + 1 + count) % d_segments.size();
+      const auto& segment = d_segments.at(idx);
+      if (!segment.d_inUse || segment.d_newest < since.tv_sec) {
+        continue;
+      }
+      segments.push_back({idx, segment.d_generation, segment.d_base, segment.d_records});
+    }
+  }
+
+  std::vector<Record> records;
+  std::vector<std::string> names;
+  records.reserve(s_recordsPerBatch);
+  names.reserve(s_recordsPerBatch);
+
+  for (const auto& snapshot : segments) {
+    size_t pos = 0;
+    while (pos < snapshot.d_records) {
+      records.clear();
+      names.clear();
+
+      {
+        std::lock_guard<std::mutex> lock(d_lock);
+        const auto& segment = d_segments.at(snapshot.d_idx);
+        if (!segment.d_inUse || segment.d_generation != snapshot.d_generation) {
+          /* this segment has been reused since we started, its remaining entries are gone */
+          break;
+        }
+
+        const char* start = getSegmentStart(snapshot.d_idx);
+        const size_t end = std::min(snapshot.d_records, pos + s_recordsPerBatch);
+        for (; pos < end; pos++) {
+          Record record;
+          memcpy(&record, start + pos * sizeof(Record), sizeof(record));
+          if (((record.flags & s_flagResponse) != 0) != responses) {
+            continue;
+          }
+
+          records.push_back(record);
+          if (record.name != s_noName) {
+            uint8_t length = static_cast<uint8_t>(start[record.name]);
+            names.emplace_back(start + record.name + 1, length);
+          }
+          else {
+            names.emplace_back();
+          }
+        }
+      }
+
+      for (size_t idx = 0; idx < records.size(); idx++) {
+        const auto& record = records.at(idx);
+        struct timespec when;
+        int64_t offset = record.when;
+        /* the offset might be negative, and so might the remainder */
+        when.tv_sec = snapshot.d_base + offset / 1000;
+        int64_t msec = offset % 1000;
+        if (msec < 0) {
+          msec += 1000;
+          when.tv_sec--;
+        }
+        when.tv_nsec = msec * 1000000;
+        if (when < since) {
+          continue;
+        }
+
+        DNSName name;
+        const auto& storage = names.at(idx);
+        if (!storage.empty()) {
+          name = DNSName(storage.data(), storage.size(), 0, false);
+        }
+
+        visitor(record, when, std::move(name));
+      }
+    }
+  }
+}
+
+void RingsHistory::visitQueries(const struct timespec& since, const std::function<void(const Rings::Query&)>& visitor) const
+{
+  visit(since, false, [&visitor](const Record& record, const struct timespec& when, DNSName&& name) {
+    Rings::Query query{when, loadAddress(record.requestor, record.requestorPort, record.flags & s_flagRequestorV6), std::move(name), static_cast<uint16_t>(record.size), record.qtype, record.dh};
+    visitor(query);
+  });
+}
+
+void RingsHistory::visitResponses(const struct timespec& since, const std::function<void(const Rings::Response&)>& visitor) const
+{
+  visit(since, true, [&visitor](const Record& record, const struct timespec& when, DNSName&& name) {
+    Rings::Response response{when, loadAddress(record.requestor, record.requestorPort, record.flags & s_flagRequestorV6), std::move(name), record.qtype, record.usec, record.size, record.dh, loadAddress(record.backend, record.backendPort, record.flags & s_flagBackendV6)};
+    visitor(response);
+  });
+}
+
+size_t RingsHistory::getNumberOfEntries() const
+{
+  std::lock_guard<std::mutex> lock(d_lock);
+  return d_entries;
+}
+
+uint64_t RingsHistory::getNumberOfDiscardedEntries() const
+{
+  std::lock_guard<std::mutex> lock(d_lock);
+  return d_discarded;
+}
@@ -0,0 +1,107 @@
+/*
+ * This file is part of PowerDNS or dnsdist.
+ * Copyright -- PowerDNS.COM B.V. and its contributors
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of version 2 of the GNU General Public License as
+ * published by the Free Software Foundation.
+ *
+ * In addition, for the avoidance of any doubt, permission is granted to
+ * link this program with OpenSSL and to (re)distribute the binaries
+ * produced as the result of such linking.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+ */
+#pragma once
+
+#include <functional>
+#include <mutex>
+#include <string>
+#include <unordered_map>
+#include <vector>
+
+#include <boost/noncopyable.hpp>
+
+#include "dnsdist-rings.hh"
+
+/* A compact history of the queries and responses seen by the rings, stored in a memory-mapped
+   file so that it can be much larger than the available memory and cover hours of traffic.
+
+   The file is divided into segments of the same size, filled one after the other, the oldest one
+   being reused once all of them are full. Entries are stored as fixed-size records from the
+   beginning of a segment, their time as a 32-bit number of milliseconds relative to the first
+   entry of the segment and their qname as the offset of that name, in wire format, in the same
+   segment. Names are stored once per segment, from the end of the segment toward its beginning,
+   and the segment is full when both areas meet. Only the names of the segment being filled are
+   indexed in memory.
+   The content of the file is not reused after a restart. */
+class RingsHistory : boost::noncopyable
+{
+public:
+  static const size_t s_minimumSegmentSize{65536};
+
+  /* creates, or truncates, the file at path to size bytes, divided into segments of segmentSize bytes */
+  RingsHistory(const std::string& path, size_t size, size_t segmentSize);
+  ~RingsHistory();
+
+  void addQuery(const Rings::Query& query);
+  void addResponse(const Rings::Response& response);
+
+  /* calls the visitor for every entry whose time is not before since, from the oldest segment to the newest.
+     The history is only locked while copying a batch of records, never while calling the visitor, and the
+     remaining entries of a segment reused in the meantime are skipped */
+  void visitQueries(const struct timespec& since, const std::function<void(const Rings::Query&)>& visitor) const;
+  void visitResponses(const struct timespec& since, const std::function<void(const Rings::Response&)>& visitor) const;
+
+  size_t getNumberOfSegments() const
+  {
+    return d_segments.size();
+  }
+
+  size_t getNumberOfEntries() const;
+  /* number of entries removed from the history to make room for new ones */
+  uint64_t getNumberOfDiscardedEntries() const;
+
+private:
+  struct Record;
+
+  struct Segment
+  {
+    time_t d_base{0};
+    time_t d_newest{0};
+    size_t d_records{0};
+    /* offset of the first name stored in this segment, names being added from the end */
+    size_t d_namesStart{0};
+    /* incremented every time the segment is reused, so that readers can notice it */
+    uint64_t d_generation{0};
+    bool d_inUse{false};
+  };
+
+  void add(Record& record, const struct timespec& when, const DNSName& name);
+  bool addToCurrentSegment(Record& record, const struct timespec& when, const DNSName& name);
+  void moveToNextSegment();
+  char* getSegmentStart(size_t idx) const
+  {
+    return d_mapped + idx * d_segmentSize;
+  }
+  void visit(const struct timespec& since, bool responses, const std::function<void(const Record&, const struct timespec&, DNSName&&)>& visitor) const;
+
+  mutable std::mutex d_lock;
+  /* the names stored in the current segment, and their offset */
+  std::unordered_map<DNSName, uint32_t> d_names;
+  std::vector<Segment> d_segments;
+  char* d_mapped{nullptr};
+  size_t d_mappedSize{0};
+  size_t d_segmentSize{0};
+  size_t d_current{0};
+  size_t d_entries{0};
+  uint64_t d_discarded{0};
+  uint64_t d_generations{0};
+};
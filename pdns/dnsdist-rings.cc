@@ -21,6 +21,8 @@
  */
 
 #include "dnsdist-rings.hh"
+#include "dnsdist-rings-history.hh"
+#include "gettime.hh"
 
 size_t Rings::numDistinctRequestors()
 {
@@ -34,26 +36,18 @@ size_t Rings::numDistinctRequestors()
   return s.size();
 }
 
-std::unordered_map<int, vector<boost::variant<string,double>>> Rings::getTopBandwidth(unsigned int numentries)
+std::unordered_map<int, vector<boost::variant<string,double>>> Rings::getTopBandwidth(unsigned int numentries, const boost::optional<unsigned int>& lookback)
 {
   map<ComboAddress, unsigned int, ComboAddress::addressOnlyLessThan> counts;
   uint64_t total=0;
-  for (const auto& shard : d_shards) {
-    {
-      std::lock_guard<std::mutex> rl(shard->queryLock);
-      for(const auto& q : shard->queryRing) {
-        counts[q.requestor]+=q.size;
-        total+=q.size;
-      }
-    }
-    {
-      std::lock_guard<std::mutex> rl(shard->respLock);
-      for(const auto& r : shard->respRing) {
-        counts[r.requestor]+=r.size;
-        total+=r.size;
-      }
-    }
-  }
+  visitQueries([&counts, &total](const Query& q) {
+    counts[q.requestor]+=q.size;
+    total+=q.size;
+  }, lookback);
+  visitResponses([&counts, &total](const Response& r) {
+    counts[r.requestor]+=r.size;
+    total+=r.size;
+  }, lookback);
 
   typedef vector<pair<unsigned int, ComboAddress>> ret_t;
   ret_t rcounts;
@@ -79,3 +73,109 @@ std::unordered_map<int, vector<boost::variant<string,double>>> Rings::getTopBand
   ret.insert({count, {"Rest", rest, total > 0 ? 100.0*rest/total : 100.0}});
   return ret;
 }
+
+void Rings::visitQueries(const std::function<void(const Query&)>& visitor, const boost::optional<unsigned int>& lookback)
+{
+  flushPendingEntries();
+
+  struct timespec cutoff{0, 0};
+  if (lookback) {
+    gettime(&cutoff);
+    cutoff.tv_sec -= *lookback;
+
+    auto history = d_history;
+    if (history) {
+      spillToHistory();
+      history->visitQueries(cutoff, visitor);
+      return;
+    }
+  }
+
+  for (const auto& shard : d_shards) {
+    std::lock_guard<std::mutex> rl(shard->queryLock);
+    for (const auto& q : shard->queryRing) {
+      if (lookback && q.when < cutoff) {
+        continue;
+      }
+      visitor(q);
+    }
+  }
+}
+
+void Rings::visitResponses(const std::function<void(const Response&)>& visitor, const boost::optional<unsigned int>& lookback)
+{
+  flushPendingEntries();
+
+  struct timespec cutoff{0, 0};
+  if (lookback) {
+    gettime(&cutoff);
+    cutoff.tv_sec -= *lookback;
+
+    auto history = d_history;
+    if (history) {
+      spillToHistory();
+      history->visitResponses(cutoff, visitor);
+      return;
+    }
+  }
+
+  for (const auto& shard : d_shards) {
+    std::lock_guard<std::mutex> rl(shard->respLock);
+    for (const auto& r : shard->respRing) {
+      if (lookback && r.when < cutoff) {
+        continue;
+      }
+      visitor(r);
+    }
+  }
+}
+
+size_t Rings::spillToHistory()
+{
+  auto history = d_history;
+  if (!history) {
+    return 0;
+  }
+
+  /* only one copy at a time, otherwise entries might be copied twice or out of order */
+  std::lock_guard<std::mutex> lock(d_historyLock);
+  size_t total = 0;
+  std::vector<Query> queries;
+  std::vector<Response> responses;
+
+  for (auto& shard : d_shards) {
+    queries.clear();
+    responses.clear();
+    {
+      std::lock_guard<std::mutex> rl(shard->queryLock);
+      uint64_t newEntries = shard->queryInserts - shard->querySpilled;
+      if (newEntries > shard->queryRing.size()) {
+        d_historyMissedEntries += newEntries - shard->queryRing.size();
+        newEntries = shard->queryRing.size();
+      }
+      queries.insert(queries.end(), shard->queryRing.end() - newEntries, shard->queryRing.end());
+      shard->querySpilled = shard->queryInserts;
+    }
+    {
+      std::lock_guard<std::mutex> rl(shard->respLock);
+      uint64_t newEntries = shard->respInserts - shard->respSpilled;
+      if (newEntries > shard->respRing.size()) {
+        d_historyMissedEntries += newEntries - shard->respRing.size();
+        newEntries = shard->respRing.size();
+      }
+      responses.insert(responses.end(), shard->respRing.end() - newEntries, shard->respRing.end());
+      shard->respSpilled = shard->respInserts;
+    }
+
+    /* the history has its own lock, no need to block the insertions into the rings while we copy */
+    for (const auto& q : queries) {
+      history->addQuery(q);
+    }
+    for (const auto& r : responses) {
+      history->addResponse(r);
+    }
+    total += queries.size() + responses.size();
+  }
+
+  return total;
+}
@@ -21,16 +21,21 @@
  */
 #pragma once
 
+#include <functional>
+#include <memory>
 #include <mutex>
 #include <time.h>
 #include <unordered_map>
+#include <vector>
 
+#include <boost/optional.hpp>
 #include <boost/variant.hpp>
 
 #include "circular_buffer.hh"
 #include "dnsname.hh"
 #include "iputils.hh"
 
+class RingsHistory;
 
 struct Rings {
   struct Query
@@ -60,17 +65,79 @@ struct Rings {
     boost::circular_buffer<Response> respRing;
     std::mutex queryLock;
     std::mutex respLock;
+    /* total number of entries ever inserted into this shard, protected by the corresponding lock.
+       Used to find the entries inserted since a given point, see DynBlockRulesGroup */
+    uint64_t queryInserts{0};
+    uint64_t respInserts{0};
+    /* when per-thread shards are enabled, entries that could not be inserted right away because
+       a reader was holding the lock. They are moved to the rings by the next insertion of the thread
+       owning this shard that gets the lock, or by flushPendingEntries(). Protected by pendingLock,
+       which is always acquired after the lock of the corresponding ring */
+    std::vector<Query> pendingQueries;
+    std::vector<Response> pendingResponses;
+    uint64_t pendingQueriesGeneration{0};
+    uint64_t pendingResponsesGeneration{0};
+    std::mutex pendingLock;
+    std::atomic<bool> hasPendingQueries{false};
+    std::atomic<bool> hasPendingResponses{false};
+    /* number of entries of this shard already copied to the history, protected by the corresponding lock */
+    uint64_t querySpilled{0};
+    uint64_t respSpilled{0};
   };
 
-  Rings(size_t capacity=10000, size_t numberOfShards=1, size_t nbLockTries=5, bool keepLockingStats=false): d_blockingQueryInserts(0), d_blockingResponseInserts(0), d_deferredQueryInserts(0), d_deferredResponseInserts(0), d_nbQueryEntries(0), d_nbResponseEntries(0), d_currentShardId(0), d_numberOfShards(numberOfShards), d_nbLockTries(nbLockTries), d_keepLockingStats(keepLockingStats)
+  Rings(size_t capacity=10000, size_t numberOfShards=1, size_t nbLockTries=5, bool keepLockingStats=false): d_blockingQueryInserts(0), d_blockingResponseInserts(0), d_deferredQueryInserts(0), d_deferredResponseInserts(0), d_nbQueryEntries(0), d_nbResponseEntries(0), d_currentShardId(0), d_nextWriterId(0), d_instanceId(getNextInstanceId()), d_numberOfShards(numberOfShards), d_nbLockTries(nbLockTries), d_keepLockingStats(keepLockingStats)
   {
     setCapacity(capacity, numberOfShards);
     if (numberOfShards <= 1) {
       d_nbLockTries = 0;
     }
   }
-  std::unordered_map<int, vector<boost::variant<string,double> > > getTopBandwidth(unsigned int numentries);
+  std::unordered_map<int, vector<boost::variant<string,double> > > getTopBandwidth(unsigned int numentries, const boost::optional<unsigned int>& lookback = boost::none);
   size_t numDistinctRequestors();
+
+  /* call the visitor for every query, or response, present in the rings. If lookback is set, only
+     the entries of the last lookback seconds are visited, from the history if there is one */
+  void visitQueries(const std::function<void(const Query&)>& visitor, const boost::optional<unsigned int>& lookback = boost::none);
+  void visitResponses(const std::function<void(const Response&)>& visitor, const boost::optional<unsigned int>& lookback = boost::none);
+
+  /* This function should only be called at configuration time */
+  void setHistory(std::shared_ptr<RingsHistory> history)
+  {
+    d_history = history;
+  }
+
+  std::shared_ptr<RingsHistory> getHistory() const
+  {
+    return d_history;
+  }
+
+  /* move the entries kept aside by the owners of the per-thread shards to the rings, skipping the shards
+     whose lock is currently held so that we never wait for a reader */
+  void flushPendingEntries()
+  {
+    if (!d_perThreadShards) {
+      return;
+    }
+
+    for (auto& shard : d_shards) {
+      if (shard->hasPendingQueries) {
+        std::unique_lock<std::mutex> wl(shard->queryLock, std::try_to_lock);
+        if (wl.owns_lock()) {
+          flushPendingQueriesLocked(shard);
+        }
+      }
+      if (shard->hasPendingResponses) {
+        std::unique_lock<std::mutex> wl(shard->respLock, std::try_to_lock);
+        if (wl.owns_lock()) {
+          flushPendingResponsesLocked(shard);
+        }
+      }
+    }
+  }
+
+  /* copy the entries inserted since the last call to the history, if any, and return how many were copied.
+     Entries that have already been removed from the rings by newer ones are lost, and counted in d_historyMissedEntries */
+  size_t spillToHistory();
   /* This function should only be called at configuration time before any query or response has been inserted */
   void setCapacity(size_t newCapacity, size_t numberOfShards)
   {
@@ -97,6 +164,7 @@ struct Rings {
     /* we just recreated the shards so they are now empty */
     d_nbQueryEntries = 0;
     d_nbResponseEntries = 0;
+    d_generation++;
   }
 
   void setNumberOfLockRetries(size_t retries)
@@ -108,6 +176,21 @@ struct Rings {
     }
   }
 
+  /* When enabled, every thread inserting into the rings gets a shard of its own as long as there
+     are enough shards, instead of picking one in a round-robin fashion. The owner of a shard never
+     waits for a reader holding the lock: the entry is kept aside and inserted on the next call.
+     Threads coming after all shards have been assigned use the regular round-robin method.
+     This function should only be called at configuration time. */
+  void setPerThreadShards(bool enabled)
+  {
+    d_perThreadShards = enabled;
+  }
+
+  bool hasPerThreadShards() const
+  {
+    return d_perThreadShards;
+  }
+
   size_t getNumberOfShards() const
   {
     return d_numberOfShards;
@@ -123,8 +206,22 @@ struct Rings {
     return d_nbResponseEntries;
   }
 
+  /* incremented every time the content of the rings is discarded by clear() or setCapacity() */
+  uint64_t getGeneration() const
+  {
+    return d_generation;
+  }
+
   void insertQuery(const struct timespec& when, const ComboAddress& requestor, const DNSName& name, uint16_t qtype, uint16_t size, const struct dnsheader& dh)
   {
+    if (d_perThreadShards) {
+      auto shard = getOwnShard();
+      if (shard != nullptr) {
+        insertQueryOwned(*shard, when, requestor, name, qtype, size, dh);
+        return;
+      }
+    }
+
     for (size_t idx = 0; idx < d_nbLockTries; idx++) {
       auto& shard = getOneShard();
       std::unique_lock<std::mutex> wl(shard->queryLock, std::try_to_lock);
@@ -148,6 +245,14 @@ struct Rings {
 
   void insertResponse(const struct timespec& when, const ComboAddress& requestor, const DNSName& name, uint16_t qtype, unsigned int usec, unsigned int size, const struct dnsheader& dh, const ComboAddress& backend)
   {
+    if (d_perThreadShards) {
+      auto shard = getOwnShard();
+      if (shard != nullptr) {
+        insertResponseOwned(*shard, when, requestor, name, qtype, usec, size, dh, backend);
+        return;
+      }
+    }
+
     for (size_t idx = 0; idx < d_nbLockTries; idx++) {
       auto& shard = getOneShard();
       std::unique_lock<std::mutex> wl(shard->respLock, std::try_to_lock);
@@ -175,10 +280,12 @@ struct Rings {
       {
         std::lock_guard<std::mutex> wl(shard->queryLock);
         shard->queryRing.clear();
+        shard->querySpilled = shard->queryInserts;
       }
       {
         std::lock_guard<std::mutex> wl(shard->respLock);
         shard->respRing.clear();
+        shard->respSpilled = shard->respInserts;
       }
     }
 
@@ -189,6 +296,7 @@ struct Rings {
     d_blockingResponseInserts.store(0);
     d_deferredQueryInserts.store(0);
     d_deferredResponseInserts.store(0);
+    d_generation++;
   }
 
   std::vector<std::unique_ptr<Shard> > d_shards;
@@ -196,8 +304,130 @@ struct Rings {
   std::atomic<uint64_t> d_blockingResponseInserts;
   std::atomic<uint64_t> d_deferredQueryInserts;
   std::atomic<uint64_t> d_deferredResponseInserts;
+  std::atomic<uint64_t> d_historyMissedEntries{0};
+
+  /* maximum number of entries a shard owner keeps aside while a reader holds the lock,
+     before blocking */
+  static const size_t s_maxPendingEntries{1000};
 
 private:
+  static uint64_t getNextInstanceId()
+  {
+    static std::atomic<uint64_t> s_instances{0};
+    return ++s_instances;
+  }
+
+  /* returns the shard owned by the current thread, assigning one if needed,
+     or nullptr if all shards are already owned by other threads */
+  std::unique_ptr<Shard>* getOwnShard()
+  {
+    /* we only remember the last Rings object this thread inserted into, which is fine
+       since dnsdist only uses one */
+    static thread_local std::pair<uint64_t, size_t> t_writer{0, 0};
+    if (t_writer.first != d_instanceId) {
+      t_writer = { d_instanceId, d_nextWriterId++ };
+    }
+
+    if (t_writer.second >= d_numberOfShards) {
+      return nullptr;
+    }
+    return &d_shards[t_writer.second];
+  }
+
+  void insertQueryOwned(std::unique_ptr<Shard>& shard, const struct timespec& when, const ComboAddress& requestor, const DNSName& name, uint16_t qtype, uint16_t size, const struct dnsheader& dh)
+  {
+    std::unique_lock<std::mutex> wl(shard->queryLock, std::try_to_lock);
+    if (!wl.owns_lock()) {
+      {
+        std::lock_guard<std::mutex> pl(shard->pendingLock);
+        if (shard->pendingQueries.size() < s_maxPendingEntries) {
+          if (shard->pendingQueries.empty()) {
+            shard->pendingQueriesGeneration = d_generation;
+          }
+          shard->pendingQueries.push_back({when, requestor, name, size, qtype, dh});
+          shard->hasPendingQueries = true;
+          if (d_keepLockingStats) {
+            d_deferredQueryInserts++;
+          }
+          return;
+        }
+      }
+
+      if (d_keepLockingStats) {
+        d_blockingQueryInserts++;
+      }
+      wl.lock();
+    }
+
+    flushPendingQueriesLocked(shard);
+    insertQueryLocked(shard, when, requestor, name, qtype, size, dh);
+  }
+
+  void insertResponseOwned(std::unique_ptr<Shard>& shard, const struct timespec& when, const ComboAddress& requestor, const DNSName& name, uint16_t qtype, unsigned int usec, unsigned int size, const struct dnsheader& dh, const ComboAddress& backend)
+  {
+    std::unique_lock<std::mutex> wl(shard->respLock, std::try_to_lock);
+    if (!wl.owns_lock()) {
+      {
+        std::lock_guard<std::mutex> pl(shard->pendingLock);
+        if (shard->pendingResponses.size() < s_maxPendingEntries) {
+          if (shard->pendingResponses.empty()) {
+            shard->pendingResponsesGeneration = d_generation;
+          }
+          shard->pendingResponses.push_back({when, requestor, name, qtype, usec, size, dh, backend});
+          shard->hasPendingResponses = true;
+          if (d_keepLockingStats) {
+            d_deferredResponseInserts++;
+          }
+          return;
+        }
+      }
+
+      if (d_keepLockingStats) {
+        d_blockingResponseInserts++;
+      }
+      wl.lock();
+    }
+
+    flushPendingResponsesLocked(shard);
+    insertResponseLocked(shard, when, requestor, name, qtype, usec, size, dh, backend);
+  }
+
+  /* the query lock of the shard must be held */
+  void flushPendingQueriesLocked(std::unique_ptr<Shard>& shard)
+  {
+    if (!shard->hasPendingQueries) {
+      return;
+    }
+
+    std::lock_guard<std::mutex> pl(shard->pendingLock);
+    /* entries kept aside before the rings were cleared are discarded */
+    if (shard->pendingQueriesGeneration == d_generation) {
+      for (const auto& query : shard->pendingQueries) {
+        insertQueryLocked(shard, query.when, query.requestor, query.name, query.qtype, query.size, query.dh);
+      }
+    }
+    shard->pendingQueries.clear();
+    shard->hasPendingQueries = false;
+  }
+
+  /* the response lock of the shard must be held */
+  void flushPendingResponsesLocked(std::unique_ptr<Shard>& shard)
+  {
+    if (!shard->hasPendingResponses) {
+      return;
+    }
+
+    std::lock_guard<std::mutex> pl(shard->pendingLock);
+    /* entries kept aside before the rings were cleared are discarded */
+    if (shard->pendingResponsesGeneration == d_generation) {
+      for (const auto& response : shard->pendingResponses) {
+        insertResponseLocked(shard, response.when, response.requestor, response.name, response.qtype, response.usec, response.size, response.dh, response.ds);
+      }
+    }
+    shard->pendingResponses.clear();
+    shard->hasPendingResponses = false;
+  }
+
   size_t getShardId()
   {
     return (d_currentShardId++ % d_numberOfShards);
@@ -214,6 +444,7 @@ private:
       d_nbQueryEntries++;
     }
     shard->queryRing.push_back({when, requestor, name, size, qtype, dh});
+    shard->queryInserts++;
   }
 
   void insertResponseLocked(std::unique_ptr<Shard>& shard, const struct timespec& when, const ComboAddress& requestor, const DNSName& name, uint16_t qtype, unsigned int usec, unsigned int size, const struct dnsheader& dh, const ComboAddress& backend)
@@ -222,15 +453,22 @@ private:
       d_nbResponseEntries++;
     }
     shard->respRing.push_back({when, requestor, name, qtype, usec, size, dh, backend});
+    shard->respInserts++;
   }
 
   std::atomic<size_t> d_nbQueryEntries;
   std::atomic<size_t> d_nbResponseEntries;
   std::atomic<size_t> d_currentShardId;
+  std::atomic<uint64_t> d_generation{0};
+  std::atomic<size_t> d_nextWriterId;
+  const uint64_t d_instanceId;
 
   size_t d_numberOfShards;
   size_t d_nbLockTries = 5;
   bool d_keepLockingStats{false};
+  std::shared_ptr<RingsHistory> d_history{nullptr};
+  std::mutex d_historyLock;
+  bool d_perThreadShards{false};
 };
 
 extern Rings g_rings;
@@ -21,6 +21,7 @@
  */
 #include "dnsdist.hh"
 #include "dnsdist-ecs.hh"
+#include "dnsdist-nghttp2.hh"
 #include "dnsdist-proxy-protocol.hh"
 #include "dnsdist-rings.hh"
 #include "dnsdist-xpf.hh"
@@ -34,6 +35,8 @@
 #include "threadname.hh"
 #include <thread>
 #include <atomic>
+#include <deque>
+#include <unordered_map>
 #include <netinet/tcp.h>
 
 #include "sstuff.hh"
@@ -54,6 +57,12 @@ using std::atomic;
    So whenever an answer comes in, we know where it needs to go.
 
    Let's start naively.
+
+   Queries read from a client connection are processed one at a time and in order unless the frontend
+   has been configured with a maxInFlight value, in which case we keep reading queries while the previous
+   ones are being handled by a backend, and send the responses back as soon as they arrive, possibly out
+   of order. Likewise, a backend configured with a maxInFlight value gets several queries over the same
+   connection, using a query ID that is unique over that connection to match the responses.
 */
 
 static std::mutex tcpClientsCountMutex;
@@ -73,6 +82,12 @@ static std::unique_ptr<Socket> setupTCPDownstream(shared_ptr<DownstreamState>& d
   do {
     vinfolog("TCP connecting to downstream %s (%d)", ds->remote.toStringWithPort(), downstreamFailures);
     try {
+      if (ds->isDoH()) {
+        /* the DoH client thread does the actual work, we only need to talk DNS over TCP to it */
+        result = std::unique_ptr<Socket>(new Socket(getDoHClientStreamSocket(ds)));
+        return result;
+      }
+
       result = std::unique_ptr<Socket>(new Socket(ds->remote.sin4.sin_family, SOCK_STREAM, 0));
       if (!IsAnyAddress(ds->sourceAddr)) {
         SSetsockopt(result->getHandle(), SOL_SOCKET, SO_REUSEADDR, 1);
@@ -112,144 +127,6 @@ static std::unique_ptr<Socket> setupTCPDownstream(shared_ptr<DownstreamState>& d
 
   return nullptr;
 }
-
-class TCPConnectionToBackend
-{
-public:
-  TCPConnectionToBackend(std::shared_ptr<DownstreamState>& ds, uint16_t& downstreamFailures, const struct timeval& now): d_ds(ds), d_connectionStartTime(now), d_enableFastOpen(ds->tcpFastOpen)
-  {
-    d_socket = setupTCPDownstream(d_ds, downstreamFailures);
-    ++d_ds->tcpCurrentConnections;
-  }
-
-  ~TCPConnectionToBackend()
-  {
-    if (d_ds && d_socket) {
-      --d_ds->tcpCurrentConnections;
-      struct timeval now;
-      gettimeofday(&now, nullptr);
-
-      auto diff = now - d_connectionStartTime;
-      d_ds->updateTCPMetrics(d_queries, diff.tv_sec * 1000 + diff.tv_usec / 1000);
-    }
-  }
-
-  int getHandle() const
-  {
-    if (!d_socket) {
-      throw std::runtime_error("Attempt to get the socket handle from a non-established TCP connection");
-    }
-
-    return d_socket->getHandle();
-  }
-
-  const ComboAddress& getRemote() const
-  {
-    return d_ds->remote;
-  }
-
-  bool isFresh() const
-  {
-    return d_fresh;
-  }
-
-  void incQueries()
-  {
-    ++d_queries;
-  }
-
-  void setReused()
-  {
-    d_fresh = false;
-  }
-
-  void disableFastOpen()
-  {
-    d_enableFastOpen = false;
-  }
-
-  bool isFastOpenEnabled()
-  {
-    return d_enableFastOpen;
-  }
-
-  bool canBeReused() const
-  {
-    /* we can't reuse a connection where a proxy protocol payload has been sent,
-       since:
-       - it cannot be reused for a different client
-       - we might have different TLV values for each query
-    */
-    if (d_ds && d_ds->useProxyProtocol) {
-      return false;
-    }
-    return true;
-  }
-
-  bool matches(const std::shared_ptr<DownstreamState>& ds) const
-  {
-    if (!ds || !d_ds) {
-      return false;
-    }
-    return ds == d_ds;
-  }
-
-private:
-  std::unique_ptr<Socket> d_socket{nullptr};
-  std::shared_ptr<DownstreamState> d_ds{nullptr};
-  struct timeval d_connectionStartTime;
-  uint64_t d_queries{0};
-  bool d_fresh{true};
-  bool d_enableFastOpen{false};
-};
-
-static thread_local map<ComboAddress, std::deque<std::unique_ptr<TCPConnectionToBackend>>> t_downstreamConnections;
-
-static std::unique_ptr<TCPConnectionToBackend> getConnectionToDownstream(std::shared_ptr<DownstreamState>& ds, uint16_t& downstreamFailures, const struct timeval& now)
-{
-  std::unique_ptr<TCPConnectionToBackend> result;
-
-  const auto& it = t_downstreamConnections.find(ds->remote);
-  if (it != t_downstreamConnections.end()) {
-    auto& list = it->second;
-    if (!list.empty()) {
-      result = std::move(list.front());
-      list.pop_front();
-      result->setReused();
-      return result;
-    }
-  }
-
-  return std::unique_ptr<TCPConnectionToBackend>(new TCPConnectionToBackend(ds, downstreamFailures, now));
-}
-
-static void releaseDownstreamConnection(std::unique_ptr<TCPConnectionToBackend>&& conn)
-{
-  if (conn == nullptr) {
-    return;
-  }
-
-  if (!conn->canBeReused()) {
-    conn.reset();
-    return;
-  }
-
-  const auto& remote = conn->getRemote();
-  const auto& it = t_downstreamConnections.find(remote);
-  if (it != t_downstreamConnections.end()) {
-    auto& list = it->second;
-    if (list.size() >= g_maxCachedConnectionsPerDownstream) {
-      /* too many connections queued already */
-      conn.reset();
-      return;
-    }
-    list.push_back(std::move(conn));
-  }
-  else {
-    t_downstreamConnections[remote].push_back(std::move(conn));
-  }
-}
-
 struct ConnectionInfo
 {
   ConnectionInfo(ClientState* cs_): cs(cs_), fd(-1)
@@ -367,89 +244,267 @@ void TCPClientCollection::addTCPClientThread()
   }
 }
 
-static void cleanupClosedTCPConnections()
+std::unique_ptr<TCPClientCollection> g_tcpclientthreads;
+
+class TCPClientThreadData
 {
-  for(auto dsIt = t_downstreamConnections.begin(); dsIt != t_downstreamConnections.end(); ) {
-    for (auto connIt = dsIt->second.begin(); connIt != dsIt->second.end(); ) {
-      if (*connIt && isTCPSocketUsable((*connIt)->getHandle())) {
-        ++connIt;
-      }
-      else {
-        connIt = dsIt->second.erase(connIt);
-      }
-    }
+public:
+  TCPClientThreadData(): localRespRulactions(g_resprulactions.getLocal()), mplexer(std::unique_ptr<FDMultiplexer>(FDMultiplexer::getMultiplexerSilent()))
+  {
+  }
 
-    if (!dsIt->second.empty()) {
-      ++dsIt;
-    }
-    else {
-      dsIt = t_downstreamConnections.erase(dsIt);
-    }
+  LocalHolders holders;
+  LocalStateHolder<vector<DNSDistResponseRuleAction> > localRespRulactions;
+  std::unique_ptr<FDMultiplexer> mplexer{nullptr};
+};
+
+class IncomingTCPConnectionState;
+class TCPConnectionToBackend;
+
+/* a query read from a client connection, processed and ready to be sent to a backend */
+struct TCPQuery
+{
+  TCPQuery()
+  {
   }
-}
 
-/* Tries to read exactly toRead bytes into the buffer, starting at position pos.
-   Updates pos everytime a successful read occurs,
-   throws an std::runtime_error in case of IO error,
-   return Done when toRead bytes have been read, needRead or needWrite if the IO operation
-   would block.
-*/
-// XXX could probably be implemented as a TCPIOHandler
-static IOState tryRead(int fd, std::vector<uint8_t>& buffer, size_t& pos, size_t toRead)
+  TCPQuery(const TCPQuery& rhs) = delete;
+  TCPQuery& operator=(const TCPQuery& rhs) = delete;
+
+  IDState d_ids;
+  /* the query, prefixed by its size */
+  std::vector<uint8_t> d_buffer;
+  bool d_isXFR{false};
+  /* at least one message of the response to this XFR has been relayed to the client,
+     so the query can't be sent again */
+  bool d_xfrStarted{false};
+};
+
+/* a response waiting to be sent to a client */
+struct TCPResponse
+{
+  /* the response, prefixed by its size */
+  std::vector<uint8_t> d_buffer;
+  std::shared_ptr<DownstreamState> d_ds{nullptr};
+  /* when relaying a XFR, the connection to resume reading from once this message has been sent */
+  std::shared_ptr<TCPConnectionToBackend> d_xfrConnection{nullptr};
+  DNSName d_qname;
+  StopWatch d_sentTime;
+  dnsheader d_cleartextDH;
+  uint16_t d_qtype{0};
+  bool d_selfGenerated{false};
+};
+
+/* A connection to a backend, over which several queries, possibly coming from different
+   client connections, can be in flight at the same time, up to the maxInFlightQueriesPerConn
+   value of the backend.
+   The queries are written one after the other, the ID of each one being replaced by one that
+   is unique over this connection, and the responses, which can arrive in any order, are
+   matched to their query using that ID. */
+class TCPConnectionToBackend : public std::enable_shared_from_this<TCPConnectionToBackend>
 {
-  if (buffer.size() < (pos + toRead)) {
-    throw std::out_of_range("Calling tryRead() with a too small buffer (" + std::to_string(buffer.size()) + ") for a read of " + std::to_string(toRead) + " bytes starting at " + std::to_string(pos));
+public:
+  TCPConnectionToBackend(std::shared_ptr<DownstreamState>& ds, TCPClientThreadData& threadData, const struct timeval& now);
+  ~TCPConnectionToBackend();
+
+  TCPConnectionToBackend(const TCPConnectionToBackend& rhs) = delete;
+  TCPConnectionToBackend& operator=(const TCPConnectionToBackend& rhs) = delete;
+
+  const ComboAddress& getRemote() const
+  {
+    return d_ds->remote;
   }
 
-  size_t got = 0;
-  do {
-    ssize_t res = ::read(fd, reinterpret_cast<char*>(&buffer.at(pos)), toRead - got);
-    if (res == 0) {
-      throw runtime_error("EOF while reading message");
+  const std::shared_ptr<DownstreamState>& getDS() const
+  {
+    return d_ds;
+  }
+
+  bool hasFailed() const
+  {
+    return d_connectionDied;
+  }
+
+  bool isIdle() const
+  {
+    return d_pendingQueries.empty() && d_pendingResponses.empty();
+  }
+
+  /* whether the connection has not been closed by the other end, which is likely
+     to happen to a connection that has been idle for a while */
+  bool isUsable() const
+  {
+    if (d_connectionDied || !d_socket) {
+      return false;
     }
-    if (res < 0) {
-      if (errno == EAGAIN || errno == EWOULDBLOCK || errno == ENOTCONN) {
-        return IOState::NeedRead;
-      }
-      else {
-        throw std::runtime_error(std::string("Error while reading message: ") + stringerror());
-      }
+    return isTCPSocketUsable(d_socket->getHandle());
+  }
+
+  bool canAcceptNewQueries() const
+  {
+    if (d_connectionDied) {
+      return false;
     }
 
-    pos += static_cast<size_t>(res);
-    got += static_cast<size_t>(res);
+    const size_t maxInFlight = std::max(d_ds->maxInFlightQueriesPerConn, static_cast<size_t>(1));
+    return (d_pendingQueries.size() + d_pendingResponses.size()) < maxInFlight;
   }
-  while (got < toRead);
 
-  return IOState::Done;
-}
+  /* the Proxy Protocol payload will be sent before the first query, and again every time
+     we have to reconnect */
+  void setProxyProtocolPayload(std::vector<uint8_t>&& payload)
+  {
+    d_proxyProtocolPayload = std::move(payload);
+  }
 
-std::unique_ptr<TCPClientCollection> g_tcpclientthreads;
+  /* the response will be passed to the sender once it has been received */
+  void queueQuery(std::unique_ptr<TCPQuery>&& query, std::shared_ptr<IncomingTCPConnectionState>& sender, struct timeval& now);
+  /* read the next message of a XFR, now that the client has been sent the previous one */
+  void resumeXFR(struct timeval& now);
+  void handleTimeout(struct timeval& now, bool write);
 
-class TCPClientThreadData
-{
-public:
-  TCPClientThreadData(): localRespRulactions(g_resprulactions.getLocal()), mplexer(std::unique_ptr<FDMultiplexer>(FDMultiplexer::getMultiplexerSilent()))
+private:
+  struct PendingRequest
+  {
+    std::shared_ptr<IncomingTCPConnectionState> d_sender{nullptr};
+    std::unique_ptr<TCPQuery> d_query{nullptr};
+  };
+
+  enum class State : uint8_t { idle, sendingProxyProtocolPayload, doingHandshake, sendingQuery, readingResponseSize, readingResponse };
+  enum class FailureReason : uint8_t { gaveUp, timeout };
+
+  static void handleIOCallback(int fd, FDMultiplexer::funcparam_t& param);
+  static void handleIO(std::shared_ptr<TCPConnectionToBackend>& conn, struct timeval& now);
+  static void handleConnectionError(std::shared_ptr<TCPConnectionToBackend>& conn, struct timeval& now);
+
+  void updateIOState(IOState iostate, const struct timeval& now);
+  void moveToNextState();
+  void prepareQueryForSending();
+  IOState sendBuffer(const std::vector<uint8_t>& buffer);
+  void dispatchResponse(std::shared_ptr<TCPConnectionToBackend>& conn, struct timeval& now);
+  void notifyAllQueriesFailed(struct timeval& now, FailureReason reason);
+  bool reconnect(const struct timeval& now);
+  void attachHandler();
+  void closeSocket();
+
+  boost::optional<struct timeval> getBackendReadTTD(const struct timeval& now) const
   {
+    if (d_ds->tcpRecvTimeout == 0) {
+      return boost::none;
+    }
+
+    struct timeval res = now;
+    res.tv_sec += d_ds->tcpRecvTimeout;
+
+    return res;
   }
 
-  LocalHolders holders;
-  LocalStateHolder<vector<DNSDistResponseRuleAction> > localRespRulactions;
-  std::unique_ptr<FDMultiplexer> mplexer{nullptr};
+  boost::optional<struct timeval> getBackendWriteTTD(const struct timeval& now) const
+  {
+    if (d_ds->tcpSendTimeout == 0) {
+      return boost::none;
+    }
+
+    struct timeval res = now;
+    res.tv_sec += d_ds->tcpSendTimeout;
+
+    return res;
+  }
+
+  /* queries waiting to be sent, the first one might be partially written already */
+  std::deque<PendingRequest> d_pendingQueries;
+  /* queries waiting for a response, indexed by the ID they were sent with */
+  std::unordered_map<uint16_t, PendingRequest> d_pendingResponses;
+  std::vector<uint8_t> d_responseBuffer;
+  std::vector<uint8_t> d_proxyProtocolPayload;
+  std::unique_ptr<Socket> d_socket{nullptr};
+  /* takes care of the TLS layer, if any */
+  std::unique_ptr<TCPIOHandler> d_handler{nullptr};
+  std::shared_ptr<DownstreamState> d_ds{nullptr};
+  TCPClientThreadData& d_threadData;
+  struct timeval d_connectionStartTime;
+  size_t d_currentPos{0};
+  uint64_t d_queries{0};
+  uint16_t d_responseSize{0};
+  uint16_t d_downstreamFailures{0};
+  uint16_t d_currentQueryID{0};
+  uint16_t d_nextQueryID{0};
+  State d_state{State::idle};
+  IOState d_lastIOState{IOState::Done};
+  /* no response has been received over this socket yet */
+  bool d_fresh{true};
+  bool d_enableFastOpen{false};
+  bool d_connectionDied{false};
+  bool d_proxyProtocolPayloadSent{false};
+  bool d_handshakeDone{false};
+  bool d_xfrResumeRequested{false};
 };
 
-static void handleDownstreamIOCallback(int fd, FDMultiplexer::funcparam_t& param);
+/* connections that can be shared between client connections */
+static thread_local map<ComboAddress, std::deque<std::shared_ptr<TCPConnectionToBackend>>> t_downstreamConnections;
+
+static std::shared_ptr<TCPConnectionToBackend> getConnectionToDownstream(std::shared_ptr<DownstreamState>& ds, TCPClientThreadData& threadData, const struct timeval& now)
+{
+  auto& list = t_downstreamConnections[ds->remote];
+  for (auto it = list.begin(); it != list.end(); ) {
+    /* an idle connection might have been closed by the backend in the meantime */
+    if ((*it)->hasFailed() || ((*it)->isIdle() && !(*it)->isUsable())) {
+      it = list.erase(it);
+      continue;
+    }
+
+    if ((*it)->canAcceptNewQueries()) {
+      return *it;
+    }
+    ++it;
+  }
+
+  auto conn = std::make_shared<TCPConnectionToBackend>(ds, threadData, now);
+  /* if there are already too many connections in the list, this one will be
+     closed once the queries sent over it have been answered */
+  if (list.size() < g_maxCachedConnectionsPerDownstream) {
+    list.push_back(conn);
+  }
+
+  return conn;
+}
+
+static void cleanupClosedTCPConnections()
+{
+  for(auto dsIt = t_downstreamConnections.begin(); dsIt != t_downstreamConnections.end(); ) {
+    for (auto connIt = dsIt->second.begin(); connIt != dsIt->second.end(); ) {
+      if (*connIt && (!(*connIt)->isIdle() || (*connIt)->isUsable())) {
+        ++connIt;
+      }
+      else {
+        connIt = dsIt->second.erase(connIt);
+      }
+    }
+
+    if (!dsIt->second.empty()) {
+      ++dsIt;
+    }
+    else {
+      dsIt = t_downstreamConnections.erase(dsIt);
+    }
+  }
+}
 
+/* An incoming connection, from which several queries can be read and processed at the
+   same time, up to the maxInFlightQueriesPerConn value of the frontend.
+   We never read and write at the same time: responses received while we are reading
+   a query, or sending a response, are queued, and sent, in the order they were received,
+   once we are done. */
 class IncomingTCPConnectionState
 {
 public:
-  IncomingTCPConnectionState(ConnectionInfo&& ci, TCPClientThreadData& threadData, const struct timeval& now): d_buffer(s_maxPacketCacheEntrySize), d_responseBuffer(s_maxPacketCacheEntrySize), d_threadData(threadData), d_ci(std::move(ci)), d_handler(d_ci.fd, g_tcpRecvTimeout, d_ci.cs->tlsFrontend ? d_ci.cs->tlsFrontend->getContext() : nullptr, now.tv_sec), d_connectionStartTime(now)
+  IncomingTCPConnectionState(ConnectionInfo&& ci, TCPClientThreadData& threadData, const struct timeval& now): d_buffer(s_maxPacketCacheEntrySize), d_threadData(threadData), d_ci(std::move(ci)), d_handler(d_ci.fd, g_tcpRecvTimeout, d_ci.cs->tlsFrontend ? d_ci.cs->tlsFrontend->getContext() : nullptr, now.tv_sec), d_connectionStartTime(now)
   {
-    d_ids.origDest.reset();
-    d_ids.origDest.sin4.sin_family = d_ci.remote.sin4.sin_family;
-    socklen_t socklen = d_ids.origDest.getSocklen();
-    if (getsockname(d_ci.fd, reinterpret_cast<sockaddr*>(&d_ids.origDest), &socklen)) {
-      d_ids.origDest = d_ci.cs->local;
+    d_origDest.reset();
+    d_origDest.sin4.sin_family = d_ci.remote.sin4.sin_family;
+    socklen_t socklen = d_origDest.getSocklen();
+    if (getsockname(d_ci.fd, reinterpret_cast<sockaddr*>(&d_origDest), &socklen)) {
+      d_origDest = d_ci.cs->local;
     }
   }
 
@@ -467,33 +522,6 @@ public:
       d_ci.cs->updateTCPMetrics(d_queriesCount, diff.tv_sec * 1000.0 + diff.tv_usec / 1000.0);
     }
 
-    if (d_ds != nullptr) {
-      if (d_outstanding) {
-        --d_ds->outstanding;
-        d_outstanding = false;
-      }
-
-      if (d_downstreamConnection) {
-        try {
-          if (d_lastIOState == IOState::NeedRead) {
-            cerr<<__func__<<": removing leftover backend read FD "<<d_downstreamConnection->getHandle()<<endl;
-            d_threadData.mplexer->removeReadFD(d_downstreamConnection->getHandle());
-          }
-          else if (d_lastIOState == IOState::NeedWrite) {
-            cerr<<__func__<<": removing leftover backend write FD "<<d_downstreamConnection->getHandle()<<endl;
-            d_threadData.mplexer->removeWriteFD(d_downstreamConnection->getHandle());
-          }
-        }
-        catch(const FDMultiplexerException& e) {
-          vinfolog("Got an exception when trying to remove a pending IO operation on the socket to the %s backend: %s", d_ds->getName(), e.what());
-        }
-        catch(const std::runtime_error& e) {
-          /* might be thrown by getHandle() */
-          vinfolog("Got an exception when trying to remove a pending IO operation on the socket to the %s backend: %s", d_ds->getName(), e.what());
-        }
-      }
-    }
-
     try {
       if (d_lastIOState == IOState::NeedRead) {
         cerr<<__func__<<": removing leftover client read FD "<<d_ci.fd<<endl;
@@ -514,11 +542,7 @@ public:
     d_buffer.resize(sizeof(uint16_t));
     d_currentPos = 0;
     d_querySize = 0;
-    d_responseSize = 0;
-    d_downstreamFailures = 0;
     d_state = State::readingQuerySize;
-    d_lastIOState = IOState::Done;
-    d_selfGeneratedResponse = false;
   }
 
   boost::optional<struct timeval> getClientReadTTD(struct timeval now) const
@@ -543,21 +567,6 @@ public:
     return now;
   }
 
-  boost::optional<struct timeval> getBackendReadTTD(const struct timeval& now) const
-  {
-    if (d_ds == nullptr) {
-      throw std::runtime_error("getBackendReadTTD() without any backend selected");
-    }
-    if (d_ds->tcpRecvTimeout == 0) {
-      return boost::none;
-    }
-
-    struct timeval res = now;
-    res.tv_sec += d_ds->tcpRecvTimeout;
-
-    return res;
-  }
-
   boost::optional<struct timeval> getClientWriteTTD(const struct timeval& now) const
   {
     if (g_maxTCPConnectionDuration == 0 && g_tcpSendTimeout == 0) {
@@ -582,21 +591,6 @@ public:
     return res;
   }
 
-  boost::optional<struct timeval> getBackendWriteTTD(const struct timeval& now) const
-  {
-    if (d_ds == nullptr) {
-      throw std::runtime_error("getBackendReadTTD() called without any backend selected");
-    }
-    if (d_ds->tcpSendTimeout == 0) {
-      return boost::none;
-    }
-
-    struct timeval res = now;
-    res.tv_sec += d_ds->tcpSendTimeout;
-
-    return res;
-  }
-
   bool maxConnectionDurationReached(unsigned int maxConnectionDuration, const struct timeval& now)
   {
     if (maxConnectionDuration) {
@@ -614,104 +608,161 @@ public:
     return false;
   }
 
-  void dump() const
+  bool canReadNewQuery(const struct timeval& now)
   {
-    static std::mutex s_mutex;
+    if (d_closing || d_isXFR) {
+      return false;
+    }
 
-    struct timeval now;
-    gettimeofday(&now, 0);
+    if (g_maxTCPQueriesPerConn && d_queriesCount >= g_maxTCPQueriesPerConn) {
+      vinfolog("Terminating TCP connection from %s because it reached the maximum number of queries per conn (%d / %d)", d_ci.remote.toStringWithPort(), d_queriesCount, g_maxTCPQueriesPerConn);
+      d_closing = true;
+      return false;
+    }
 
-    {
-      std::lock_guard<std::mutex> lock(s_mutex);
-      fprintf(stderr, "State is %p\n", this);
-      cerr << "Current state is " << static_cast<int>(d_state) << ", got "<<d_queriesCount<<" queries so far" << endl;
-      cerr << "Current time is " << now.tv_sec << " - " << now.tv_usec << endl;
-      cerr << "Connection started at " << d_connectionStartTime.tv_sec << " - " << d_connectionStartTime.tv_usec << endl;
-      if (d_state > State::doingHandshake) {
-        cerr << "Handshake done at " << d_handshakeDoneTime.tv_sec << " - " << d_handshakeDoneTime.tv_usec << endl;
-      }
-      if (d_state > State::readingQuerySize) {
-        cerr << "Got first query size at " << d_firstQuerySizeReadTime.tv_sec << " - " << d_firstQuerySizeReadTime.tv_usec << endl;
-      }
-      if (d_state > State::readingQuerySize) {
-        cerr << "Got query size at " << d_querySizeReadTime.tv_sec << " - " << d_querySizeReadTime.tv_usec << endl;
-      }
-      if (d_state > State::readingQuery) {
-        cerr << "Got query at " << d_queryReadTime.tv_sec << " - " << d_queryReadTime.tv_usec << endl;
-      }
-      if (d_state > State::sendingQueryToBackend) {
-        cerr << "Sent query at " << d_querySentTime.tv_sec << " - " << d_querySentTime.tv_usec << endl;
-      }
-      if (d_state > State::readingResponseFromBackend) {
-        cerr << "Got response at " << d_responseReadTime.tv_sec << " - " << d_responseReadTime.tv_usec << endl;
-      }
+    if (maxConnectionDurationReached(g_maxTCPConnectionDuration, now)) {
+      vinfolog("Terminating TCP connection from %s because it reached the maximum TCP connection duration", d_ci.remote.toStringWithPort());
+      d_closing = true;
+      return false;
     }
+
+    const size_t maxInFlight = std::max(d_ci.cs->maxInFlightQueriesPerConn, static_cast<size_t>(1));
+    return d_currentQueriesCount < maxInFlight;
   }
 
-  enum class State { doingHandshake, readingQuerySize, readingQuery, sendingQueryToBackend, readingResponseSizeFromBackend, readingResponseFromBackend, sendingResponse };
+  /* we are waiting for the responses to the queries in flight when idle, and we
+     are not going to do anything with this connection anymore once closed */
+  enum class State { doingHandshake, readingQuerySize, readingQuery, sendingResponse, idle, closed };
 
   std::vector<uint8_t> d_buffer;
-  std::vector<uint8_t> d_responseBuffer;
+  std::deque<TCPResponse> d_queuedResponses;
+  TCPResponse d_currentResponse;
+  /* connections over which we sent a Proxy Protocol payload without any TLV value,
+     which can only be reused for this client */
+  std::map<std::shared_ptr<DownstreamState>, std::shared_ptr<TCPConnectionToBackend>> d_ownedConnectionsToBackend;
   TCPClientThreadData& d_threadData;
-  IDState d_ids;
   ConnectionInfo d_ci;
+  ComboAddress d_origDest;
   TCPIOHandler d_handler;
-  std::unique_ptr<TCPConnectionToBackend> d_downstreamConnection{nullptr};
-  std::shared_ptr<DownstreamState> d_ds{nullptr};
-  dnsheader d_cleartextDH;
   struct timeval d_connectionStartTime;
-  struct timeval d_handshakeDoneTime;
-  struct timeval d_firstQuerySizeReadTime;
-  struct timeval d_querySizeReadTime;
-  struct timeval d_queryReadTime;
-  struct timeval d_querySentTime;
-  struct timeval d_responseReadTime;
   size_t d_currentPos{0};
   size_t d_queriesCount{0};
+  /* queries that have been passed to a backend and for which we have not received a response yet */
+  size_t d_currentQueriesCount{0};
   unsigned int d_remainingTime{0};
   uint16_t d_querySize{0};
-  uint16_t d_responseSize{0};
-  uint16_t d_downstreamFailures{0};
   State d_state{State::doingHandshake};
   IOState d_lastIOState{IOState::Done};
   bool d_readingFirstQuery{true};
-  bool d_outstanding{false};
-  bool d_firstResponsePacket{true};
+  /* a XFR has been passed to a backend, we are not going to read any other query */
   bool d_isXFR{false};
-  bool d_xfrStarted{false};
-  bool d_selfGeneratedResponse{false};
-  bool d_proxyProtocolPayloadAdded{false};
-  bool d_proxyProtocolPayloadHasTLV{false};
+  /* we are not going to read any other query, and the connection will be closed
+     once the responses to the queries in flight have been sent */
+  bool d_closing{false};
 };
 
 static void handleIOCallback(int fd, FDMultiplexer::funcparam_t& param);
 static void handleNewIOState(std::shared_ptr<IncomingTCPConnectionState>& state, IOState iostate, const int fd, FDMultiplexer::callbackfunc_t callback, boost::optional<struct timeval> ttd=boost::none);
 static void handleIO(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now);
-static void handleDownstreamIO(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now);
 
-static void handleResponseSent(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now)
+static void terminateClientConnection(std::shared_ptr<IncomingTCPConnectionState>& state)
 {
+  state->d_state = IncomingTCPConnectionState::State::closed;
   handleNewIOState(state, IOState::Done, state->d_ci.fd, handleIOCallback);
+  /* a response to a XFR holds a reference to the connection to the backend,
+     which holds a reference to us */
+  state->d_queuedResponses.clear();
+  state->d_currentResponse = TCPResponse();
+  state->d_ownedConnectionsToBackend.clear();
+}
 
-  if (state->d_isXFR && state->d_downstreamConnection) {
-    /* we need to resume reading from the backend! */
-    state->d_state = IncomingTCPConnectionState::State::readingResponseSizeFromBackend;
-    state->d_currentPos = 0;
-    handleDownstreamIO(state, now);
+static void sendResponse(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now, TCPResponse&& response)
+{
+  state->d_state = IncomingTCPConnectionState::State::sendingResponse;
+  state->d_currentResponse = std::move(response);
+  state->d_currentPos = 0;
+
+  handleIO(state, now);
+}
+
+/* send the next queued response if any, otherwise read the next query if we can,
+   otherwise wait for the responses to the queries in flight. If there is none left,
+   nothing holds a reference to this state anymore and the connection is closed */
+static void resumeClientIO(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now)
+{
+  if (!state->d_queuedResponses.empty()) {
+    TCPResponse response = std::move(state->d_queuedResponses.front());
+    state->d_queuedResponses.pop_front();
+    sendResponse(state, now, std::move(response));
+    return;
+  }
+
+  if (state->canReadNewQuery(now)) {
+    state->resetForNewQuery();
+    handleIO(state, now);
+    return;
+  }
+
+  state->d_state = IncomingTCPConnectionState::State::idle;
+  handleNewIOState(state, IOState::Done, state->d_ci.fd, handleIOCallback);
+}
+
+static void queueResponse(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now, TCPResponse&& response)
+{
+  /* we can send it right away unless we are already sending a response or in the middle of reading a query */
+  if (state->d_state == IncomingTCPConnectionState::State::idle ||
+      (state->d_state == IncomingTCPConnectionState::State::readingQuerySize && state->d_currentPos == 0)) {
+    sendResponse(state, now, std::move(response));
     return;
   }
 
-  if (state->d_selfGeneratedResponse == false && state->d_ds) {
-    /* if we have no downstream server selected, this was a self-answered response
-       but cache hits have a selected server as well, so be careful */
+  state->d_queuedResponses.push_back(std::move(response));
+}
+
+static void queueSelfGeneratedResponse(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now, std::vector<uint8_t>&& buffer)
+{
+  TCPResponse response;
+  memcpy(&response.d_cleartextDH, buffer.data(), sizeof(response.d_cleartextDH));
+  response.d_selfGenerated = true;
+
+  const uint16_t responseSize = buffer.size();
+  const uint8_t sizeBytes[] = { static_cast<uint8_t>(responseSize / 256), static_cast<uint8_t>(responseSize % 256) };
+  /* prepend the size. Yes, this is not the most efficient way but it prevents mistakes
+     that could occur if we had to deal with the size during the processing,
+     especially alignment issues */
+  buffer.insert(buffer.begin(), sizeBytes, sizeBytes + 2);
+  response.d_buffer = std::move(buffer);
+
+  queueResponse(state, now, std::move(response));
+}
+
+/* we are not going to read any new query from this connection, which will be closed
+   once the responses to the queries still in flight have been sent */
+static void stopReadingQueries(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now)
+{
+  state->d_closing = true;
+
+  if (state->d_state == IncomingTCPConnectionState::State::idle ||
+      (state->d_state == IncomingTCPConnectionState::State::readingQuerySize && state->d_currentPos == 0)) {
+    resumeClientIO(state, now);
+  }
+}
+
+static void handleResponseSent(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now)
+{
+  TCPResponse response = std::move(state->d_currentResponse);
+  state->d_state = IncomingTCPConnectionState::State::idle;
+
+  if (!response.d_selfGenerated && response.d_ds) {
+    /* cache hits have a selected server as well, so be careful */
     struct timespec answertime;
     gettime(&answertime);
-    double udiff = state->d_ids.sentTime.udiff();
-    g_rings.insertResponse(answertime, state->d_ci.remote, state->d_ids.qname, state->d_ids.qtype, static_cast<unsigned int>(udiff), static_cast<unsigned int>(state->d_responseBuffer.size()), state->d_cleartextDH, state->d_ds->remote);
-    vinfolog("Got answer from %s, relayed to %s (%s), took %f usec", state->d_ds->remote.toStringWithPort(), state->d_ids.origRemote.toStringWithPort(), (state->d_ci.cs->tlsFrontend ? "DoT" : "TCP"), udiff);
+    double udiff = response.d_sentTime.udiff();
+    g_rings.insertResponse(answertime, state->d_ci.remote, response.d_qname, response.d_qtype, static_cast<unsigned int>(udiff), static_cast<unsigned int>(response.d_buffer.size()), response.d_cleartextDH, response.d_ds->remote);
+    vinfolog("Got answer from %s, relayed to %s (%s), took %f usec", response.d_ds->remote.toStringWithPort(), state->d_ci.remote.toStringWithPort(), (state->d_ci.cs->tlsFrontend ? "DoT" : "TCP"), udiff);
   }
 
-  switch (state->d_cleartextDH.rcode) {
+  switch (response.d_cleartextDH.rcode) {
   case RCode::NXDomain:
     ++g_stats.frontendNXDomain;
     break;
@@ -724,148 +775,116 @@ static void handleResponseSent(std::shared_ptr<IncomingTCPConnectionState>& stat
     break;
   }
 
-  if (g_maxTCPQueriesPerConn && state->d_queriesCount > g_maxTCPQueriesPerConn) {
-    vinfolog("Terminating TCP connection from %s because it reached the maximum number of queries per conn (%d / %d)", state->d_ci.remote.toStringWithPort(), state->d_queriesCount, g_maxTCPQueriesPerConn);
-    return;
+  if (response.d_xfrConnection) {
+    /* we need to resume reading from the backend! */
+    response.d_xfrConnection->resumeXFR(now);
   }
 
-  if (state->maxConnectionDurationReached(g_maxTCPConnectionDuration, now)) {
-    vinfolog("Terminating TCP connection from %s because it reached the maximum TCP connection duration", state->d_ci.remote.toStringWithPort());
-    return;
+  /* resuming the XFR might have led to a new response being sent already */
+  if (state->d_state == IncomingTCPConnectionState::State::idle) {
+    resumeClientIO(state, now);
   }
-
-  state->resetForNewQuery();
-
-  handleIO(state, now);
 }
 
-static void sendResponse(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now)
+/* called by the connection to the backend when a response to one of our queries has been received */
+static void handleBackendResponse(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now, const std::shared_ptr<TCPConnectionToBackend>& conn, TCPQuery& query, std::vector<uint8_t>&& buffer, uint16_t responseSize)
 {
-  state->d_state = IncomingTCPConnectionState::State::sendingResponse;
-  const uint8_t sizeBytes[] = { static_cast<uint8_t>(state->d_responseSize / 256), static_cast<uint8_t>(state->d_responseSize % 256) };
-  /* prepend the size. Yes, this is not the most efficient way but it prevents mistakes
-     that could occur if we had to deal with the size during the processing,
-     especially alignment issues */
-  state->d_responseBuffer.insert(state->d_responseBuffer.begin(), sizeBytes, sizeBytes + 2);
-
-  state->d_currentPos = 0;
-
-  handleIO(state, now);
-}
+  const bool firstResponse = !query.d_xfrStarted;
+  if (firstResponse) {
+    --state->d_currentQueriesCount;
+  }
 
-static void handleResponse(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now)
-{
-  if (state->d_responseSize < sizeof(dnsheader) || !state->d_ds) {
+  if (state->d_state == IncomingTCPConnectionState::State::closed) {
     return;
   }
 
-  auto response = reinterpret_cast<char*>(&state->d_responseBuffer.at(0));
+  const auto& ds = conn->getDS();
+  auto response = reinterpret_cast<char*>(&buffer.at(0));
   unsigned int consumed;
-  if (state->d_firstResponsePacket && !responseContentMatches(response, state->d_responseSize, state->d_ids.qname, state->d_ids.qtype, state->d_ids.qclass, state->d_ds->remote, consumed)) {
+  if (firstResponse && !responseContentMatches(response, responseSize, query.d_ids.qname, query.d_ids.qtype, query.d_ids.qclass, ds->remote, consumed)) {
+    stopReadingQueries(state, now);
     return;
   }
-  state->d_firstResponsePacket = false;
-
-  if (state->d_outstanding) {
-    --state->d_ds->outstanding;
-    state->d_outstanding = false;
-  }
+  query.d_xfrStarted = query.d_isXFR;
 
   auto dh = reinterpret_cast<struct dnsheader*>(response);
+  /* restore the ID the client used, we replaced it with one that is unique over the connection to the backend */
+  dh->id = query.d_ids.origID;
+
   uint16_t addRoom = 0;
-  DNSResponse dr = makeDNSResponseFromIDState(state->d_ids, dh, state->d_responseBuffer.size(), state->d_responseSize, true);
+  DNSResponse dr = makeDNSResponseFromIDState(query.d_ids, dh, buffer.size(), responseSize, true);
   if (dr.dnsCryptQuery) {
     addRoom = DNSCRYPT_MAX_RESPONSE_PADDING_AND_MAC_SIZE;
   }
 
-  memcpy(&state->d_cleartextDH, dr.dh, sizeof(state->d_cleartextDH));
+  TCPResponse tcpResponse;
+  memcpy(&tcpResponse.d_cleartextDH, dr.dh, sizeof(tcpResponse.d_cleartextDH));
 
   std::vector<uint8_t> rewrittenResponse;
-  size_t responseSize = state->d_responseBuffer.size();
-  if (!processResponse(&response, &state->d_responseSize, &responseSize, state->d_threadData.localRespRulactions, dr, addRoom, rewrittenResponse, false)) {
+  size_t responseCapacity = buffer.size();
+  if (!processResponse(&response, &responseSize, &responseCapacity, state->d_threadData.localRespRulactions, dr, addRoom, rewrittenResponse, false)) {
+    stopReadingQueries(state, now);
     return;
   }
 
   if (!rewrittenResponse.empty()) {
     /* responseSize has been updated as well but we don't really care since it will match
        the capacity of rewrittenResponse anyway */
-    state->d_responseBuffer = std::move(rewrittenResponse);
-    state->d_responseSize = state->d_responseBuffer.size();
+    buffer = std::move(rewrittenResponse);
+    responseSize = buffer.size();
   } else {
     /* the size might have been updated (shrinked) if we removed the whole OPT RR, for example) */
-    state->d_responseBuffer.resize(state->d_responseSize);
+    buffer.resize(responseSize);
   }
 
-  if (state->d_isXFR && !state->d_xfrStarted) {
-    /* don't bother parsing the content of the response for now */
-    state->d_xfrStarted = true;
+  if (firstResponse) {
+    /* don't bother parsing the content of the XFR messages for now */
     ++g_stats.responses;
     ++state->d_ci.cs->responses;
-    ++state->d_ds->responses;
+    ++ds->responses;
   }
 
-  if (!state->d_isXFR) {
-    ++g_stats.responses;
-    ++state->d_ci.cs->responses;
-    ++state->d_ds->responses;
+  const uint8_t sizeBytes[] = { static_cast<uint8_t>(responseSize / 256), static_cast<uint8_t>(responseSize % 256) };
+  /* prepend the size. Yes, this is not the most efficient way but it prevents mistakes
+     that could occur if we had to deal with the size during the processing,
+     especially alignment issues */
+  buffer.insert(buffer.begin(), sizeBytes, sizeBytes + 2);
+
+  tcpResponse.d_buffer = std::move(buffer);
+  tcpResponse.d_ds = ds;
+  tcpResponse.d_qname = query.d_ids.qname;
+  tcpResponse.d_qtype = query.d_ids.qtype;
+  tcpResponse.d_sentTime = query.d_ids.sentTime;
+  if (query.d_isXFR) {
+    tcpResponse.d_xfrConnection = conn;
   }
 
-  sendResponse(state, now);
+  queueResponse(state, now, std::move(tcpResponse));
 }
 
-static void sendQueryToBackend(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now)
+/* called by the connection to the backend when we are not going to get a response to one of our queries */
+static void handleBackendFailure(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now, TCPQuery& query)
 {
-  auto ds = state->d_ds;
-  state->d_state = IncomingTCPConnectionState::State::sendingQueryToBackend;
-  state->d_currentPos = 0;
-  state->d_firstResponsePacket = true;
-
-  if (state->d_xfrStarted) {
-    /* sorry, but we are not going to resume a XFR if we have already sent some packets
-       to the client */
-    return;
+  if (!query.d_xfrStarted) {
+    --state->d_currentQueriesCount;
   }
 
-  if (!state->d_downstreamConnection) {
-    if (state->d_downstreamFailures < state->d_ds->retries) {
-      try {
-        state->d_downstreamConnection = getConnectionToDownstream(ds, state->d_downstreamFailures, now);
-      }
-      catch (const std::runtime_error& e) {
-        state->d_downstreamConnection.reset();
-      }
-    }
-
-    if (!state->d_downstreamConnection) {
-      ++ds->tcpGaveUp;
-      ++state->d_ci.cs->tcpGaveUp;
-      vinfolog("Downstream connection to %s failed %d times in a row, giving up.", ds->getName(), state->d_downstreamFailures);
-      return;
-    }
-
-    if (ds->useProxyProtocol && !state->d_proxyProtocolPayloadAdded) {
-      /* we know there is no TLV values to add, otherwise we would not have tried
-         to reuse the connection and d_proxyProtocolPayloadAdded would be true already */
-      addProxyProtocol(state->d_buffer, true, state->d_ci.remote, state->d_ids.origDest, std::vector<ProxyProtocolValue>());
-      state->d_proxyProtocolPayloadAdded = true;
-    }
+  if (state->d_state == IncomingTCPConnectionState::State::closed) {
+    return;
   }
 
-  vinfolog("Got query for %s|%s from %s (%s), relayed to %s", state->d_ids.qname.toLogString(), QType(state->d_ids.qtype).getName(), state->d_ci.remote.toStringWithPort(), (state->d_ci.cs->tlsFrontend ? "DoT" : "TCP"), ds->getName());
-
-  handleDownstreamIO(state, now);
-  return;
+  stopReadingQueries(state, now);
 }
 
 static void handleQuery(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now)
 {
   if (state->d_querySize < sizeof(dnsheader)) {
     ++g_stats.nonCompliantQueries;
+    state->d_closing = true;
     return;
   }
 
   state->d_readingFirstQuery = false;
-  state->d_proxyProtocolPayloadAdded = false;
   ++state->d_queriesCount;
   ++state->d_ci.cs->queries;
   ++g_stats.queries;
@@ -900,81 +919,109 @@ static void handleQuery(std::shared_ptr<IncomingTCPConnectionState>& state, stru
   std::shared_ptr<DNSCryptQuery> dnsCryptQuery{nullptr};
   auto dnsCryptResponse = checkDNSCryptQuery(*state->d_ci.cs, query, state->d_querySize, dnsCryptQuery, queryRealTime.tv_sec, true);
   if (dnsCryptResponse) {
-    state->d_responseBuffer = std::move(*dnsCryptResponse);
-    state->d_responseSize = state->d_responseBuffer.size();
-    sendResponse(state, now);
+    queueSelfGeneratedResponse(state, now, std::move(*dnsCryptResponse));
     return;
   }
 
   const auto& dh = reinterpret_cast<dnsheader*>(query);
   if (!checkQueryHeaders(dh)) {
+    state->d_closing = true;
     return;
   }
+  const uint16_t queryID = dh->id;
 
   uint16_t qtype, qclass;
   unsigned int consumed = 0;
   DNSName qname(query, state->d_querySize, sizeof(dnsheader), false, &qtype, &qclass, &consumed);
-  DNSQuestion dq(&qname, qtype, qclass, consumed, &state->d_ids.origDest, &state->d_ci.remote, reinterpret_cast<dnsheader*>(query), state->d_buffer.size(), state->d_querySize, true, &queryRealTime);
+  DNSQuestion dq(&qname, qtype, qclass, consumed, &state->d_origDest, &state->d_ci.remote, reinterpret_cast<dnsheader*>(query), state->d_buffer.size(), state->d_querySize, true, &queryRealTime);
   dq.dnsCryptQuery = std::move(dnsCryptQuery);
   dq.sni = state->d_handler.getServerNameIndication();
 
-  state->d_isXFR = (dq.qtype == QType::AXFR || dq.qtype == QType::IXFR);
-  if (state->d_isXFR) {
+  const bool isXFR = (dq.qtype == QType::AXFR || dq.qtype == QType::IXFR);
+  if (isXFR) {
     dq.skipCache = true;
   }
 
-  state->d_ds.reset();
-  auto result = processQuery(dq, *state->d_ci.cs, state->d_threadData.holders, state->d_ds);
+  std::shared_ptr<DownstreamState> ds{nullptr};
+  auto result = processQuery(dq, *state->d_ci.cs, state->d_threadData.holders, ds);
 
   if (result == ProcessQueryResult::Drop) {
+    state->d_closing = true;
     return;
   }
 
   if (result == ProcessQueryResult::SendAnswer) {
-    state->d_selfGeneratedResponse = true;
     state->d_buffer.resize(dq.len);
-    state->d_responseBuffer = std::move(state->d_buffer);
-    state->d_responseSize = state->d_responseBuffer.size();
-    sendResponse(state, now);
+    queueSelfGeneratedResponse(state, now, std::move(state->d_buffer));
     return;
   }
 
-  if (result != ProcessQueryResult::PassToBackend || state->d_ds == nullptr) {
+  if (result != ProcessQueryResult::PassToBackend || ds == nullptr) {
+    state->d_closing = true;
     return;
   }
 
-  setIDStateFromDNSQuestion(state->d_ids, dq, std::move(qname));
+  std::unique_ptr<TCPQuery> tcpQuery(new TCPQuery());
+  setIDStateFromDNSQuestion(tcpQuery->d_ids, dq, std::move(qname));
+  tcpQuery->d_ids.origID = queryID;
+  tcpQuery->d_isXFR = isXFR;
 
   const uint8_t sizeBytes[] = { static_cast<uint8_t>(dq.len / 256), static_cast<uint8_t>(dq.len % 256) };
   /* prepend the size. Yes, this is not the most efficient way but it prevents mistakes
      that could occur if we had to deal with the size during the processing,
      especially alignment issues */
   state->d_buffer.insert(state->d_buffer.begin(), sizeBytes, sizeBytes + 2);
-  dq.len = dq.len + 2;
-  dq.dh = reinterpret_cast<dnsheader*>(&state->d_buffer.at(0));
-  dq.size = state->d_buffer.size();
-  state->d_buffer.resize(dq.len);
+  state->d_buffer.resize(dq.len + 2);
+  tcpQuery->d_buffer = std::move(state->d_buffer);
 
-  if (state->d_ds->useProxyProtocol) {
-    /* if we ever sent a TLV over a connection, we can never go back */
-    if (!state->d_proxyProtocolPayloadHasTLV) {
-      state->d_proxyProtocolPayloadHasTLV = dq.proxyProtocolValues && !dq.proxyProtocolValues->empty();
-    }
+  std::shared_ptr<TCPConnectionToBackend> downstreamConnection{nullptr};
+  try {
+    if (ds->useProxyProtocol) {
+      /* a connection over which we sent a Proxy Protocol payload can't be used for a different client,
+         and not even for the same one if the payload contained TLV values, since they might differ
+         from one query to the next */
+      const bool hasTLVValues = dq.proxyProtocolValues && !dq.proxyProtocolValues->empty();
+      const bool reusable = !hasTLVValues && !isXFR;
+      if (reusable) {
+        const auto& it = state->d_ownedConnectionsToBackend.find(ds);
+        if (it != state->d_ownedConnectionsToBackend.end() && it->second->canAcceptNewQueries()) {
+          downstreamConnection = it->second;
+        }
+      }
 
-    if (state->d_downstreamConnection && !state->d_proxyProtocolPayloadHasTLV && state->d_downstreamConnection->matches(state->d_ds)) {
-      /* we have an existing connection, on which we already sent a Proxy Protocol header with no values
-         (in the previous query had TLV values we would have reset the connection afterwards),
-         so let's reuse it as long as we still don't have any values */
-      state->d_proxyProtocolPayloadAdded = false;
+      if (!downstreamConnection) {
+        downstreamConnection = std::make_shared<TCPConnectionToBackend>(ds, state->d_threadData, now);
+        std::vector<uint8_t> payload;
+        addProxyProtocol(payload, true, state->d_ci.remote, state->d_origDest, hasTLVValues ? *dq.proxyProtocolValues : std::vector<ProxyProtocolValue>());
+        downstreamConnection->setProxyProtocolPayload(std::move(payload));
+        if (reusable) {
+          state->d_ownedConnectionsToBackend[ds] = downstreamConnection;
+        }
+      }
+    }
+    else if (isXFR) {
+      /* the response might span several messages, don't share this connection */
+      downstreamConnection = std::make_shared<TCPConnectionToBackend>(ds, state->d_threadData, now);
     }
     else {
-      state->d_downstreamConnection.reset();
-      addProxyProtocol(state->d_buffer, true, state->d_ci.remote, state->d_ids.origDest, dq.proxyProtocolValues ? *dq.proxyProtocolValues : std::vector<ProxyProtocolValue>());
-      state->d_proxyProtocolPayloadAdded = true;
+      downstreamConnection = getConnectionToDownstream(ds, state->d_threadData, now);
     }
   }
+  catch (const std::runtime_error& e) {
+    ++ds->tcpGaveUp;
+    ++state->d_ci.cs->tcpGaveUp;
+    vinfolog("Downstream connection to %s failed %d times in a row, giving up.", ds->getName(), ds->retries);
+    state->d_closing = true;
+    return;
+  }
 
-  sendQueryToBackend(state, now);
+  vinfolog("Got query for %s|%s from %s (%s), relayed to %s", tcpQuery->d_ids.qname.toLogString(), QType(tcpQuery->d_ids.qtype).getName(), state->d_ci.remote.toStringWithPort(), (state->d_ci.cs->tlsFrontend ? "DoT" : "TCP"), ds->getName());
+
+  ++state->d_currentQueriesCount;
+  if (isXFR) {
+    state->d_isXFR = true;
+  }
+  downstreamConnection->queueQuery(std::move(tcpQuery), state, now);
 }
 
 static void handleNewIOState(std::shared_ptr<IncomingTCPConnectionState>& state, IOState iostate, const int fd, FDMultiplexer::callbackfunc_t callback, boost::optional<struct timeval> ttd)
@@ -1019,163 +1066,6 @@ static void handleNewIOState(std::shared_ptr<IncomingTCPConnectionState>& state,
   }
 }
 
-static void handleDownstreamIO(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now)
-{
-  if (state->d_downstreamConnection == nullptr) {
-    throw std::runtime_error("No downstream socket in " + std::string(__func__) + "!");
-  }
-
-  int fd = state->d_downstreamConnection->getHandle();
-  IOState iostate = IOState::Done;
-  bool connectionDied = false;
-
-  try {
-    if (state->d_state == IncomingTCPConnectionState::State::sendingQueryToBackend) {
-      int socketFlags = 0;
-#ifdef MSG_FASTOPEN
-      if (state->d_downstreamConnection->isFastOpenEnabled()) {
-        socketFlags |= MSG_FASTOPEN;
-      }
-#endif /* MSG_FASTOPEN */
-
-      size_t sent = sendMsgWithOptions(fd, reinterpret_cast<const char *>(&state->d_buffer.at(state->d_currentPos)), state->d_buffer.size() - state->d_currentPos, &state->d_ds->remote, &state->d_ds->sourceAddr, state->d_ds->sourceItf, socketFlags);
-      if (sent == state->d_buffer.size()) {
-        /* request sent ! */
-        state->d_downstreamConnection->incQueries();
-        state->d_state = IncomingTCPConnectionState::State::readingResponseSizeFromBackend;
-        state->d_currentPos = 0;
-        state->d_querySentTime = now;
-        iostate = IOState::NeedRead;
-        if (!state->d_isXFR && !state->d_outstanding) {
-          /* don't bother with the outstanding count for XFR queries */
-          ++state->d_ds->outstanding;
-          state->d_outstanding = true;
-        }
-      }
-      else {
-        state->d_currentPos += sent;
-        iostate = IOState::NeedWrite;
-        /* disable fast open on partial write */
-        state->d_downstreamConnection->disableFastOpen();
-      }
-    }
-
-    if (state->d_state == IncomingTCPConnectionState::State::readingResponseSizeFromBackend) {
-      // then we need to allocate a new buffer (new because we might need to re-send the query if the
-      // backend dies on us
-      // We also might need to read and send to the client more than one response in case of XFR (yeah!)
-      // should very likely be a TCPIOHandler d_downstreamHandler
-      iostate = tryRead(fd, state->d_responseBuffer, state->d_currentPos, sizeof(uint16_t) - state->d_currentPos);
-      if (iostate == IOState::Done) {
-        state->d_state = IncomingTCPConnectionState::State::readingResponseFromBackend;
-        state->d_responseSize = state->d_responseBuffer.at(0) * 256 + state->d_responseBuffer.at(1);
-        state->d_responseBuffer.resize((state->d_ids.dnsCryptQuery && (UINT16_MAX - state->d_responseSize) > static_cast<uint16_t>(DNSCRYPT_MAX_RESPONSE_PADDING_AND_MAC_SIZE)) ? state->d_responseSize + DNSCRYPT_MAX_RESPONSE_PADDING_AND_MAC_SIZE : state->d_responseSize);
-        state->d_currentPos = 0;
-      }
-    }
-
-    if (state->d_state == IncomingTCPConnectionState::State::readingResponseFromBackend) {
-      iostate = tryRead(fd, state->d_responseBuffer, state->d_currentPos, state->d_responseSize - state->d_currentPos);
-      if (iostate == IOState::Done) {
-        handleNewIOState(state, IOState::Done, fd, handleDownstreamIOCallback);
-
-        if (state->d_isXFR) {
-          /* Don't reuse the TCP connection after an {A,I}XFR */
-          /* but don't reset it either, we will need to read more messages */
-        }
-        else {
-          /* if we did not send a Proxy Protocol header, let's pool the connection */
-          if (state->d_ds && state->d_ds->useProxyProtocol == false) {
-            releaseDownstreamConnection(std::move(state->d_downstreamConnection));
-          }
-          else {
-            if (state->d_proxyProtocolPayloadHasTLV) {
-              /* sent a Proxy Protocol header with TLV values, we can't reuse it */
-              state->d_downstreamConnection.reset();
-            }
-            else {
-              /* if we did but there was no TLV values, let's try to reuse it but only
-                 for this incoming connection */
-            }
-          }
-        }
-        fd = -1;
-
-        state->d_responseReadTime = now;
-        try {
-          handleResponse(state, now);
-        }
-        catch (const std::exception& e) {
-          vinfolog("Got an exception while handling TCP response from %s (client is %s): %s", state->d_ds ? state->d_ds->getName() : "unknown", state->d_ci.remote.toStringWithPort(), e.what());
-        }
-        return;
-      }
-    }
-
-    if (state->d_state != IncomingTCPConnectionState::State::sendingQueryToBackend &&
-        state->d_state != IncomingTCPConnectionState::State::readingResponseSizeFromBackend &&
-        state->d_state != IncomingTCPConnectionState::State::readingResponseFromBackend) {
-      vinfolog("Unexpected state %d in handleDownstreamIOCallback", static_cast<int>(state->d_state));
-    }
-  }
-  catch(const std::exception& e) {
-    /* most likely an EOF because the other end closed the connection,
-       but it might also be a real IO error or something else.
-       Let's just drop the connection
-    */
-    vinfolog("Got an exception while handling (%s backend) TCP query from %s: %s", (state->d_lastIOState == IOState::NeedRead ? "reading from" : "writing to"), state->d_ci.remote.toStringWithPort(), e.what());
-    if (state->d_state == IncomingTCPConnectionState::State::sendingQueryToBackend) {
-      ++state->d_ds->tcpDiedSendingQuery;
-    }
-    else {
-      ++state->d_ds->tcpDiedReadingResponse;
-    }
-
-    /* don't increase this counter when reusing connections */
-    if (state->d_downstreamConnection && state->d_downstreamConnection->isFresh()) {
-      ++state->d_downstreamFailures;
-    }
-
-    if (state->d_outstanding) {
-      state->d_outstanding = false;
-
-      if (state->d_ds != nullptr) {
-        --state->d_ds->outstanding;
-      }
-    }
-    /* remove this FD from the IO multiplexer */
-    iostate = IOState::Done;
-    connectionDied = true;
-  }
-
-  if (iostate == IOState::Done) {
-    handleNewIOState(state, iostate, fd, handleDownstreamIOCallback);
-  }
-  else {
-    handleNewIOState(state, iostate, fd, handleDownstreamIOCallback, iostate == IOState::NeedRead ? state->getBackendReadTTD(now) : state->getBackendWriteTTD(now));
-  }
-
-  if (connectionDied) {
-    state->d_downstreamConnection.reset();
-    sendQueryToBackend(state, now);
-  }
-}
-
-static void handleDownstreamIOCallback(int fd, FDMultiplexer::funcparam_t& param)
-{
-  auto state = boost::any_cast<std::shared_ptr<IncomingTCPConnectionState>>(param);
-  if (state->d_downstreamConnection == nullptr) {
-    throw std::runtime_error("No downstream socket in " + std::string(__func__) + "!");
-  }
-  if (fd != state->d_downstreamConnection->getHandle()) {
-    throw std::runtime_error("Unexpected socket descriptor " + std::to_string(fd) + " received in " + std::string(__func__) + ", expected " + std::to_string(state->d_downstreamConnection->getHandle()));
-  }
-
-  struct timeval now;
-  gettimeofday(&now, 0);
-  handleDownstreamIO(state, now);
-}
-
 static void handleIO(std::shared_ptr<IncomingTCPConnectionState>& state, struct timeval& now)
 {
   int fd = state->d_ci.fd;
@@ -1183,7 +1073,7 @@ static void handleIO(std::shared_ptr<IncomingTCPConnectionState>& state, struct
 
   if (state->maxConnectionDurationReached(g_maxTCPConnectionDuration, now)) {
     vinfolog("Terminating TCP connection from %s because it reached the maximum TCP connection duration", state->d_ci.remote.toStringWithPort());
-    handleNewIOState(state, IOState::Done, fd, handleIOCallback);
+    terminateClientConnection(state);
     return;
   }
 
@@ -1206,8 +1096,7 @@ static void handleIO(std::shared_ptr<IncomingTCPConnectionState>& state, struct
           }
         }
 
-        state->d_handshakeDoneTime = now;
-        state->d_state = IncomingTCPConnectionState::State::readingQuerySize;
+        state->resetForNewQuery();
       }
     }
 
@@ -1215,14 +1104,10 @@ static void handleIO(std::shared_ptr<IncomingTCPConnectionState>& state, struct
       iostate = state->d_handler.tryRead(state->d_buffer, state->d_currentPos, sizeof(uint16_t));
       if (iostate == IOState::Done) {
         state->d_state = IncomingTCPConnectionState::State::readingQuery;
-        state->d_querySizeReadTime = now;
-        if (state->d_queriesCount == 0) {
-          state->d_firstQuerySizeReadTime = now;
-        }
         state->d_querySize = state->d_buffer.at(0) * 256 + state->d_buffer.at(1);
         if (state->d_querySize < sizeof(dnsheader)) {
           /* go away */
-          handleNewIOState(state, IOState::Done, fd, handleIOCallback);
+          terminateClientConnection(state);
           return;
         }
 
@@ -1236,14 +1121,14 @@ static void handleIO(std::shared_ptr<IncomingTCPConnectionState>& state, struct
     if (state->d_state == IncomingTCPConnectionState::State::readingQuery) {
       iostate = state->d_handler.tryRead(state->d_buffer, state->d_currentPos, state->d_querySize);
       if (iostate == IOState::Done) {
-        handleNewIOState(state, IOState::Done, fd, handleIOCallback);
         handleQuery(state, now);
+        resumeClientIO(state, now);
         return;
       }
     }
 
     if (state->d_state == IncomingTCPConnectionState::State::sendingResponse) {
-      iostate = state->d_handler.tryWrite(state->d_responseBuffer, state->d_currentPos, state->d_responseBuffer.size());
+      iostate = state->d_handler.tryWrite(state->d_currentResponse.d_buffer, state->d_currentPos, state->d_currentResponse.d_buffer.size());
       if (iostate == IOState::Done) {
         handleResponseSent(state, now);
         return;
@@ -1278,7 +1163,8 @@ static void handleIO(std::shared_ptr<IncomingTCPConnectionState>& state, struct
       vinfolog("Closing TCP client connection with %s", state->d_ci.remote.toStringWithPort());
     }
     /* remove this FD from the IO multiplexer */
-    iostate = IOState::Done;
+    terminateClientConnection(state);
+    return;
   }
 
   if (iostate == IOState::Done) {
@@ -1301,6 +1187,460 @@ static void handleIOCallback(int fd, FDMultiplexer::funcparam_t& param)
   handleIO(state, now);
 }
 
+TCPConnectionToBackend::TCPConnectionToBackend(std::shared_ptr<DownstreamState>& ds, TCPClientThreadData& threadData, const struct timeval& now): d_responseBuffer(sizeof(uint16_t)), d_ds(ds), d_threadData(threadData), d_connectionStartTime(now), d_enableFastOpen(ds->tcpFastOpen)
+{
+  d_socket = setupTCPDownstream(d_ds, d_downstreamFailures);
+  if (!d_socket) {
+    throw std::runtime_error("Unable to connect to backend " + d_ds->getNameWithAddr());
+  }
+  ++d_ds->tcpCurrentConnections;
+  attachHandler();
+}
+
+TCPConnectionToBackend::~TCPConnectionToBackend()
+{
+  closeSocket();
+}
+
+void TCPConnectionToBackend::attachHandler()
+{
+  /* the TLS context of a DoH backend is used by the DoH client thread, not by us */
+  d_handler = std::unique_ptr<TCPIOHandler>(new TCPIOHandler(d_ds->d_tlsSubjectName, d_socket->getHandle(), d_ds->tcpRecvTimeout, d_ds->isTCPOnly() ? d_ds->d_tlsCtx : nullptr));
+  d_handshakeDone = false;
+}
+
+void TCPConnectionToBackend::closeSocket()
+{
+  if (!d_socket) {
+    return;
+  }
+
+  --d_ds->tcpCurrentConnections;
+  struct timeval now;
+  gettimeofday(&now, nullptr);
+
+  auto diff = now - d_connectionStartTime;
+  d_ds->updateTCPMetrics(d_queries, diff.tv_sec * 1000 + diff.tv_usec / 1000);
+
+  /* the TLS layer, if any, needs to be shut down before the socket is closed */
+  d_handler.reset();
+  d_socket.reset();
+  d_queries = 0;
+}
+
+bool TCPConnectionToBackend::reconnect(const struct timeval& now)
+{
+  closeSocket();
+
+  try {
+    d_socket = setupTCPDownstream(d_ds, d_downstreamFailures);
+  }
+  catch (const std::runtime_error& e) {
+    return false;
+  }
+
+  if (!d_socket) {
+    return false;
+  }
+
+  ++d_ds->tcpCurrentConnections;
+  attachHandler();
+  d_connectionStartTime = now;
+  d_fresh = true;
+  d_enableFastOpen = d_ds->tcpFastOpen;
+  d_proxyProtocolPayloadSent = false;
+  return true;
+}
+
+void TCPConnectionToBackend::queueQuery(std::unique_ptr<TCPQuery>&& query, std::shared_ptr<IncomingTCPConnectionState>& sender, struct timeval& now)
+{
+  PendingRequest request;
+  request.d_sender = sender;
+  request.d_query = std::move(query);
+  d_pendingQueries.push_back(std::move(request));
+
+  /* otherwise we are already sending, or in the middle of reading a response,
+     and the query will be sent as soon as we are done */
+  if (d_state == State::idle || (d_state == State::readingResponseSize && d_currentPos == 0)) {
+    auto conn = shared_from_this();
+    moveToNextState();
+    handleIO(conn, now);
+  }
+}
+
+void TCPConnectionToBackend::resumeXFR(struct timeval& now)
+{
+  if (d_state != State::idle) {
+    /* we are still passing the previous message to the client */
+    d_xfrResumeRequested = true;
+    return;
+  }
+
+  if (d_connectionDied || d_pendingResponses.empty()) {
+    return;
+  }
+
+  auto conn = shared_from_this();
+  moveToNextState();
+  handleIO(conn, now);
+}
+
+void TCPConnectionToBackend::moveToNextState()
+{
+  d_currentPos = 0;
+
+  if (!d_pendingQueries.empty()) {
+    if (!d_proxyProtocolPayload.empty() && !d_proxyProtocolPayloadSent) {
+      /* sent in clear text, before the TLS handshake if any */
+      d_state = State::sendingProxyProtocolPayload;
+    }
+    else if (d_handler->isTLS() && !d_handshakeDone) {
+      d_state = State::doingHandshake;
+    }
+    else {
+      d_state = State::sendingQuery;
+      prepareQueryForSending();
+    }
+  }
+  else if (!d_pendingResponses.empty()) {
+    d_state = State::readingResponseSize;
+    d_responseBuffer.resize(sizeof(uint16_t));
+  }
+  else {
+    d_state = State::idle;
+  }
+}
+
+void TCPConnectionToBackend::prepareQueryForSending()
+{
+  /* pick an ID that is not used by any of the queries waiting for a response */
+  while (d_pendingResponses.count(d_nextQueryID) != 0) {
+    ++d_nextQueryID;
+  }
+  d_currentQueryID = d_nextQueryID++;
+
+  auto& buffer = d_pendingQueries.front().d_query->d_buffer;
+  auto dh = reinterpret_cast<struct dnsheader*>(&buffer.at(sizeof(uint16_t)));
+  dh->id = htons(d_currentQueryID);
+}
+
+IOState TCPConnectionToBackend::sendBuffer(const std::vector<uint8_t>& buffer)
+{
+  int socketFlags = 0;
+#ifdef MSG_FASTOPEN
+  if (d_enableFastOpen) {
+    socketFlags |= MSG_FASTOPEN;
+  }
+#endif /* MSG_FASTOPEN */
+
+  size_t sent = sendMsgWithOptions(d_socket->getHandle(), reinterpret_cast<const char *>(&buffer.at(d_currentPos)), buffer.size() - d_currentPos, &d_ds->remote, &d_ds->sourceAddr, d_ds->sourceItf, socketFlags);
+  /* only the first write over a new connection can be done using fast open */
+  d_enableFastOpen = false;
+
+  d_currentPos += sent;
+  if (d_currentPos == buffer.size()) {
+    return IOState::Done;
+  }
+
+  return IOState::NeedWrite;
+}
+
+void TCPConnectionToBackend::dispatchResponse(std::shared_ptr<TCPConnectionToBackend>& conn, struct timeval& now)
+{
+  if (d_responseSize < sizeof(dnsheader)) {
+    throw std::runtime_error("Got a response of only " + std::to_string(d_responseSize) + " bytes from " + d_ds->getNameWithAddr());
+  }
+
+  const auto dh = reinterpret_cast<const struct dnsheader*>(&d_responseBuffer.at(0));
+  const uint16_t id = ntohs(dh->id);
+  auto it = d_pendingResponses.find(id);
+  if (it == d_pendingResponses.end()) {
+    throw std::runtime_error("Got a response with an unexpected ID (" + std::to_string(id) + ") from " + d_ds->getNameWithAddr());
+  }
+
+  d_fresh = false;
+  d_downstreamFailures = 0;
+  std::vector<uint8_t> response = std::move(d_responseBuffer);
+
+  if (it->second.d_query->d_isXFR) {
+    /* the response might span several messages, which we read one at a time,
+       once the client has been sent the previous one */
+    auto sender = it->second.d_sender;
+    d_xfrResumeRequested = false;
+    try {
+      handleBackendResponse(sender, now, conn, *it->second.d_query, std::move(response), d_responseSize);
+    }
+    catch (const std::exception& e) {
+      vinfolog("Got an exception while handling TCP response from %s (client is %s): %s", d_ds->getName(), sender->d_ci.remote.toStringWithPort(), e.what());
+    }
+
+    if (d_xfrResumeRequested) {
+      d_xfrResumeRequested = false;
+      moveToNextState();
+    }
+    else {
+      d_state = State::idle;
+    }
+    return;
+  }
+
+  PendingRequest request = std::move(it->second);
+  d_pendingResponses.erase(it);
+  --d_ds->outstanding;
+
+  try {
+    handleBackendResponse(request.d_sender, now, conn, *request.d_query, std::move(response), d_responseSize);
+  }
+  catch (const std::exception& e) {
+    vinfolog("Got an exception while handling TCP response from %s (client is %s): %s", d_ds->getName(), request.d_sender->d_ci.remote.toStringWithPort(), e.what());
+  }
+
+  moveToNextState();
+}
+
+void TCPConnectionToBackend::notifyAllQueriesFailed(struct timeval& now, FailureReason reason)
+{
+  d_connectionDied = true;
+  d_state = State::idle;
+
+  auto pendingQueries = std::move(d_pendingQueries);
+  d_pendingQueries.clear();
+  auto pendingResponses = std::move(d_pendingResponses);
+  d_pendingResponses.clear();
+
+  auto notify = [&now, reason](PendingRequest& request) {
+    auto& sender = request.d_sender;
+    if (!request.d_query->d_xfrStarted) {
+      if (reason == FailureReason::gaveUp) {
+        ++sender->d_ci.cs->tcpGaveUp;
+      }
+      else {
+        ++sender->d_ci.cs->tcpDownstreamTimeouts;
+      }
+    }
+
+    try {
+      handleBackendFailure(sender, now, *request.d_query);
+    }
+    catch (const std::exception& e) {
+      vinfolog("Got an exception while notifying the TCP client %s of a backend failure: %s", sender->d_ci.remote.toStringWithPort(), e.what());
+    }
+  };
+
+  for (auto& request : pendingQueries) {
+    notify(request);
+  }
+
+  for (auto& response : pendingResponses) {
+    if (!response.second.d_query->d_isXFR) {
+      --d_ds->outstanding;
+    }
+    notify(response.second);
+  }
+}
+
+void TCPConnectionToBackend::handleTimeout(struct timeval& now, bool write)
+{
+  /* we might have been notified of a failure while processing another timeout */
+  if (d_lastIOState != (write ? IOState::NeedWrite : IOState::NeedRead)) {
+    return;
+  }
+
+  /* removing the FD from the multiplexer might release the last reference to this connection */
+  auto conn = shared_from_this();
+
+  vinfolog("Timeout (%s) from remote backend %s", write ? "write" : "read", d_ds->getName());
+  if (write) {
+    ++d_ds->tcpWriteTimeouts;
+  }
+  else {
+    ++d_ds->tcpReadTimeouts;
+  }
+
+  updateIOState(IOState::Done, now);
+  notifyAllQueriesFailed(now, FailureReason::timeout);
+  closeSocket();
+}
+
+void TCPConnectionToBackend::updateIOState(IOState iostate, const struct timeval& now)
+{
+  if (d_lastIOState == IOState::NeedRead && iostate != IOState::NeedRead) {
+    d_threadData.mplexer->removeReadFD(d_socket->getHandle());
+    d_lastIOState = IOState::Done;
+  }
+  else if (d_lastIOState == IOState::NeedWrite && iostate != IOState::NeedWrite) {
+    d_threadData.mplexer->removeWriteFD(d_socket->getHandle());
+    d_lastIOState = IOState::Done;
+  }
+
+  if (iostate == IOState::NeedRead) {
+    auto ttd = getBackendReadTTD(now);
+    if (d_lastIOState == IOState::NeedRead) {
+      if (ttd) {
+        /* let's update the TTD ! */
+        d_threadData.mplexer->setReadTTD(d_socket->getHandle(), *ttd, /* we pass 0 here because we already have a TTD */0);
+      }
+      return;
+    }
+
+    d_lastIOState = IOState::NeedRead;
+    d_threadData.mplexer->addReadFD(d_socket->getHandle(), handleIOCallback, shared_from_this(), ttd ? &*ttd : nullptr);
+  }
+  else if (iostate == IOState::NeedWrite) {
+    if (d_lastIOState == IOState::NeedWrite) {
+      return;
+    }
+
+    auto ttd = getBackendWriteTTD(now);
+    d_lastIOState = IOState::NeedWrite;
+    d_threadData.mplexer->addWriteFD(d_socket->getHandle(), handleIOCallback, shared_from_this(), ttd ? &*ttd : nullptr);
+  }
+}
+
+void TCPConnectionToBackend::handleIO(std::shared_ptr<TCPConnectionToBackend>& conn, struct timeval& now)
+{
+  IOState iostate = IOState::Done;
+
+  try {
+    while (conn->d_state != State::idle) {
+      if (conn->d_state == State::sendingProxyProtocolPayload) {
+        iostate = conn->sendBuffer(conn->d_proxyProtocolPayload);
+        if (iostate != IOState::Done) {
+          break;
+        }
+        conn->d_proxyProtocolPayloadSent = true;
+        conn->moveToNextState();
+      }
+      else if (conn->d_state == State::doingHandshake) {
+        iostate = conn->d_handler->tryHandshake();
+        if (iostate != IOState::Done) {
+          break;
+        }
+
+        conn->d_handshakeDone = true;
+        if (conn->d_handler->hasTLSSessionBeenResumed()) {
+          ++conn->d_ds->tlsResumptions;
+        }
+        conn->moveToNextState();
+      }
+      else if (conn->d_state == State::sendingQuery) {
+        auto& buffer = conn->d_pendingQueries.front().d_query->d_buffer;
+        /* TCP Fast Open is not available over TLS, and the DoH client socket is already connected */
+        iostate = (conn->d_handler->isTLS() || conn->d_ds->isDoH()) ? conn->d_handler->tryWrite(buffer, conn->d_currentPos, buffer.size()) : conn->sendBuffer(buffer);
+        if (iostate != IOState::Done) {
+          break;
+        }
+
+        /* query sent ! */
+        PendingRequest request = std::move(conn->d_pendingQueries.front());
+        conn->d_pendingQueries.pop_front();
+        ++conn->d_queries;
+        if (!request.d_query->d_isXFR) {
+          /* don't bother with the outstanding count for XFR queries */
+          ++conn->d_ds->outstanding;
+        }
+        conn->d_pendingResponses.insert(std::make_pair(conn->d_currentQueryID, std::move(request)));
+        conn->moveToNextState();
+      }
+      else if (conn->d_state == State::readingResponseSize) {
+        iostate = conn->d_handler->tryRead(conn->d_responseBuffer, conn->d_currentPos, sizeof(uint16_t));
+        if (iostate != IOState::Done) {
+          break;
+        }
+
+        conn->d_state = State::readingResponse;
+        conn->d_responseSize = conn->d_responseBuffer.at(0) * 256 + conn->d_responseBuffer.at(1);
+        /* we don't know yet which query this response is for, so leave enough room for a DNSCrypt encryption */
+        conn->d_responseBuffer.resize((UINT16_MAX - conn->d_responseSize) > static_cast<uint16_t>(DNSCRYPT_MAX_RESPONSE_PADDING_AND_MAC_SIZE) ? conn->d_responseSize + DNSCRYPT_MAX_RESPONSE_PADDING_AND_MAC_SIZE : conn->d_responseSize);
+        conn->d_currentPos = 0;
+      }
+      else if (conn->d_state == State::readingResponse) {
+        iostate = conn->d_handler->tryRead(conn->d_responseBuffer, conn->d_currentPos, conn->d_responseSize);
+        if (iostate != IOState::Done) {
+          break;
+        }
+
+        conn->dispatchResponse(conn, now);
+      }
+    }
+  }
+  catch (const std::exception& e) {
+    /* most likely an EOF because the other end closed the connection,
+       but it might also be a real IO error or something else.
+       Let's just drop the connection
+    */
+    const bool sending = conn->d_state == State::sendingProxyProtocolPayload || conn->d_state == State::doingHandshake || conn->d_state == State::sendingQuery;
+    vinfolog("Got an exception while %s the TCP connection to backend %s: %s", (sending ? "writing to" : "reading from"), conn->d_ds->getName(), e.what());
+    if (sending) {
+      ++conn->d_ds->tcpDiedSendingQuery;
+    }
+    else {
+      ++conn->d_ds->tcpDiedReadingResponse;
+    }
+
+    handleConnectionError(conn, now);
+    return;
+  }
+
+  conn->updateIOState(conn->d_state == State::idle ? IOState::Done : iostate, now);
+}
+
+void TCPConnectionToBackend::handleConnectionError(std::shared_ptr<TCPConnectionToBackend>& conn, struct timeval& now)
+{
+  /* remove this FD from the IO multiplexer */
+  conn->updateIOState(IOState::Done, now);
+
+  /* don't increase this counter when reusing connections */
+  if (conn->d_fresh) {
+    ++conn->d_downstreamFailures;
+  }
+
+  /* sorry, but we are not going to resume a XFR if we have already sent some messages
+     to the client */
+  bool xfrStarted = false;
+  for (const auto& response : conn->d_pendingResponses) {
+    if (response.second.d_query->d_xfrStarted) {
+      xfrStarted = true;
+      break;
+    }
+  }
+
+  if (!xfrStarted) {
+    if (conn->d_downstreamFailures < conn->d_ds->retries && conn->reconnect(now)) {
+      /* send the queries we did not get a response for again */
+      for (auto& response : conn->d_pendingResponses) {
+        if (!response.second.d_query->d_isXFR) {
+          --conn->d_ds->outstanding;
+        }
+        conn->d_pendingQueries.push_front(std::move(response.second));
+      }
+      conn->d_pendingResponses.clear();
+
+      conn->moveToNextState();
+      handleIO(conn, now);
+      return;
+    }
+
+    ++conn->d_ds->tcpGaveUp;
+    vinfolog("Downstream connection to %s failed %d times in a row, giving up.", conn->d_ds->getName(), conn->d_downstreamFailures);
+  }
+
+  conn->notifyAllQueriesFailed(now, FailureReason::gaveUp);
+  conn->closeSocket();
+}
+
+void TCPConnectionToBackend::handleIOCallback(int fd, FDMultiplexer::funcparam_t& param)
+{
+  auto conn = boost::any_cast<std::shared_ptr<TCPConnectionToBackend>>(param);
+  if (!conn->d_socket || fd != conn->d_socket->getHandle()) {
+    throw std::runtime_error("Unexpected socket descriptor " + std::to_string(fd) + " received in " + std::string(__func__));
+  }
+
+  struct timeval now;
+  gettimeofday(&now, 0);
+  handleIO(conn, now);
+}
+
 static void handleIncomingTCPQuery(int pipefd, FDMultiplexer::funcparam_t& param)
 {
   auto threadData = boost::any_cast<TCPClientThreadData*>(param);
@@ -1367,36 +1707,25 @@ void tcpClientThread(int pipefd)
 
     if (now.tv_sec > lastTimeoutScan) {
       lastTimeoutScan = now.tv_sec;
-      auto expiredReadConns = data.mplexer->getTimeouts(now, false);
-      for(const auto& conn : expiredReadConns) {
-        auto state = boost::any_cast<std::shared_ptr<IncomingTCPConnectionState>>(conn.second);
-        if (conn.first == state->d_ci.fd) {
-          vinfolog("Timeout (read) from remote TCP client %s", state->d_ci.remote.toStringWithPort());
-          ++state->d_ci.cs->tcpClientTimeouts;
-        }
-        else if (state->d_ds) {
-          vinfolog("Timeout (read) from remote backend %s", state->d_ds->getName());
-          ++state->d_ci.cs->tcpDownstreamTimeouts;
-          ++state->d_ds->tcpReadTimeouts;
-        }
-        data.mplexer->removeReadFD(conn.first);
-        state->d_lastIOState = IOState::Done;
-      }
 
-      auto expiredWriteConns = data.mplexer->getTimeouts(now, true);
-      for(const auto& conn : expiredWriteConns) {
-        auto state = boost::any_cast<std::shared_ptr<IncomingTCPConnectionState>>(conn.second);
-        if (conn.first == state->d_ci.fd) {
-          vinfolog("Timeout (write) from remote TCP client %s", state->d_ci.remote.toStringWithPort());
-          ++state->d_ci.cs->tcpClientTimeouts;
-        }
-        else if (state->d_ds) {
-          vinfolog("Timeout (write) from remote backend %s", state->d_ds->getName());
-          ++state->d_ci.cs->tcpDownstreamTimeouts;
-          ++state->d_ds->tcpWriteTimeouts;
+      for (const bool write : { false, true }) {
+        auto expiredConns = data.mplexer->getTimeouts(now, write);
+        for(const auto& cbData : expiredConns) {
+          if (cbData.second.type() == typeid(std::shared_ptr<IncomingTCPConnectionState>)) {
+            auto state = boost::any_cast<std::shared_ptr<IncomingTCPConnectionState>>(cbData.second);
+            /* we might have closed this connection while processing another timeout */
+            if (cbData.first != state->d_ci.fd || state->d_lastIOState != (write ? IOState::NeedWrite : IOState::NeedRead)) {
+              continue;
+            }
+            vinfolog("Timeout (%s) from remote TCP client %s", (write ? "write" : "read"), state->d_ci.remote.toStringWithPort());
+            ++state->d_ci.cs->tcpClientTimeouts;
+            terminateClientConnection(state);
+          }
+          else if (cbData.second.type() == typeid(std::shared_ptr<TCPConnectionToBackend>)) {
+            auto conn = boost::any_cast<std::shared_ptr<TCPConnectionToBackend>>(cbData.second);
+            conn->handleTimeout(now, write);
+          }
         }
-        data.mplexer->removeWriteFD(conn.first);
-        state->d_lastIOState = IOState::Done;
       }
     }
   }
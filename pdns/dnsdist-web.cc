@@ -91,6 +91,8 @@ const std::map<std::string, MetricDefinition> MetricDefinitionStorage::metrics{
   { "security-status",        MetricDefinition(PrometheusMetricType::gauge,   "Security status of this software. 0=unknown, 1=OK, 2=upgrade recommended, 3=upgrade mandatory") },
   { "doh-query-pipe-full",    MetricDefinition(PrometheusMetricType::counter, "Number of DoH queries dropped because the internal pipe used to distribute queries was full") },
   { "doh-response-pipe-full", MetricDefinition(PrometheusMetricType::counter, "Number of DoH responses dropped because the internal pipe used to distribute responses was full") },
+  { "udp-out-batches",        MetricDefinition(PrometheusMetricType::counter, "Number of sendmmsg() calls used to send UDP datagrams in batch") },
+  { "udp-out-batched-datagrams", MetricDefinition(PrometheusMetricType::counter, "Number of UDP datagrams sent in batch via sendmmsg()") },
   { "udp-in-errors",          MetricDefinition(PrometheusMetricType::counter, "From /proc/net/snmp InErrors") },
   { "udp-noport-errors",      MetricDefinition(PrometheusMetricType::counter, "From /proc/net/snmp NoPorts") },
   { "udp-recvbuf-errors",     MetricDefinition(PrometheusMetricType::counter, "From /proc/net/snmp RcvbufErrors") },
@@ -286,6 +288,51 @@ static void addCustomHeaders(YaHTTP::Response& resp, const boost::optional<std::
   }
 }
 
+static json11::Json::object timingsToJson(const TimingHistogram& timings)
+{
+  using namespace json11;
+  Json::array buckets;
+  for (size_t idx = 0; idx < TimingHistogram::s_bucketsCount; idx++) {
+    buckets.push_back((double)timings.getBucket(idx));
+  }
+  return Json::object{
+    {"count", (double)timings.getCount()},
+    {"sum", (double)timings.getSum()},
+    {"buckets", buckets}
+  };
+}
+
+template<typename T>
+static void addRuleTimingsToPrometheus(std::ostringstream& output, const std::string& metricName, const std::string& chain, GlobalStateHolder<vector<T>>& someRules, bool actions)
+{
+  auto localRules = someRules.getLocal();
+  int num = 0;
+  for (const auto& a : *localRules) {
+    const TimingHistogram& timings = actions ? a.d_action->d_timings : a.d_rule->d_timings;
+    const std::string label = boost::str(boost::format("chain=\"%1%\",id=\"%2%\",uuid=\"%3%\"") % chain % num++ % boost::uuids::to_string(a.d_id));
+    uint64_t amounts = 0;
+    for (size_t idx = 0; idx < TimingHistogram::s_bucketsCount; idx++) {
+      amounts += timings.getBucket(idx);
+      if (idx == TimingHistogram::s_bucketsCount - 1) {
+        output << metricName << "_bucket{" << label << ",le=\"+Inf\"} " << amounts << "\n";
+      }
+      else {
+        output << metricName << "_bucket{" << label << ",le=\"" << TimingHistogram::getBucketUpperBound(idx) / 1000.0 << "\"} " << amounts << "\n";
+      }
+    }
+    output << metricName << "_sum{" << label << "} " << timings.getSum() / 1000.0 << "\n";
+    output << metricName << "_count{" << label << "} " << timings.getCount() << "\n";
+  }
+}
+
+static void addAllRuleTimingsToPrometheus(std::ostringstream& output, const std::string& metricName, bool actions)
+{
+  addRuleTimingsToPrometheus(output, metricName, "rules", g_rulactions, actions);
+  addRuleTimingsToPrometheus(output, metricName, "response-rules", g_resprulactions, actions);
+  addRuleTimingsToPrometheus(output, metricName, "cache-hit-response-rules", g_cachehitresprulactions, actions);
+  addRuleTimingsToPrometheus(output, metricName, "self-answered-response-rules", g_selfansweredresprulactions, actions);
+}
+
 template<typename T>
 static json11::Json::array someResponseRulesToJson(GlobalStateHolder<vector<T>>* someResponseRules)
 {
@@ -301,6 +348,8 @@ static json11::Json::array someResponseRulesToJson(GlobalStateHolder<vector<T>>*
       {"matches", (double)a.d_rule->d_matches},
       {"rule", a.d_rule->toString()},
       {"action", a.d_action->toString()},
+      {"rule-timings", timingsToJson(a.d_rule->d_timings)},
+      {"action-timings", timingsToJson(a.d_action->d_timings)},
     };
     responseRules.push_back(rule);
   }
@@ -526,6 +575,15 @@ static void connectionThread(int sock, ComboAddress remote)
         output << "dnsdist_latency_sum " << g_stats.latencySum << "\n";
         output << "dnsdist_latency_count " << getLatencyCount(std::string()) << "\n";
 
+        if (g_ruleTimingSampleRate > 0) {
+          output << "# HELP dnsdist_rule_selector_duration Sampled histogram of the time spent evaluating the selector of a rule (in microseconds)\n";
+          output << "# TYPE dnsdist_rule_selector_duration histogram\n";
+          addAllRuleTimingsToPrometheus(output, "dnsdist_rule_selector_duration", false);
+          output << "# HELP dnsdist_rule_action_duration Sampled histogram of the time spent running the action of a rule (in microseconds)\n";
+          output << "# TYPE dnsdist_rule_action_duration histogram\n";
+          addAllRuleTimingsToPrometheus(output, "dnsdist_rule_action_duration", true);
+        }
+
         auto states = g_dstates.getLocal();
         const string statesbase = "dnsdist_server_";
 
@@ -563,6 +621,20 @@ static void connectionThread(int sock, ComboAddress remote)
         output << "# TYPE " << statesbase << "tcpavgqueriesperconn "   << "gauge"                                                             << "\n";
         output << "# HELP " << statesbase << "tcpavgconnduration "     << "The average duration of a TCP connection (ms)"                     << "\n";
         output << "# TYPE " << statesbase << "tcpavgconnduration "     << "gauge"                                                             << "\n";
+        output << "# HELP " << statesbase << "tlsresumptions "         << "The number of times a TLS session has been resumed"                << "\n";
+        output << "# TYPE " << statesbase << "tlsresumptions "         << "counter"                                                           << "\n";
+        output << "# HELP " << statesbase << "dohlatency "             << "Server's latency when answering DNS over HTTPS queries in milliseconds" << "\n";
+        output << "# TYPE " << statesbase << "dohlatency "             << "gauge"                                                             << "\n";
+        output << "# HELP " << statesbase << "dohconnecterrors "       << "The number of errors while connecting to a DNS over HTTPS backend" << "\n";
+        output << "# TYPE " << statesbase << "dohconnecterrors "       << "counter"                                                           << "\n";
+        output << "# HELP " << statesbase << "dohhttperrors "          << "The number of DNS over HTTPS responses with a HTTP status other than 200" << "\n";
+        output << "# TYPE " << statesbase << "dohhttperrors "          << "counter"                                                           << "\n";
+        output << "# HELP " << statesbase << "dohprotocolerrors "      << "The number of DNS over HTTPS queries that failed because of a HTTP/2 error" << "\n";
+        output << "# TYPE " << statesbase << "dohprotocolerrors "      << "counter"                                                           << "\n";
+        output << "# HELP " << statesbase << "dohtimeouts "            << "The number of timeouts on DNS over HTTPS connections"              << "\n";
+        output << "# TYPE " << statesbase << "dohtimeouts "            << "counter"                                                           << "\n";
+        output << "# HELP " << statesbase << "dohcurrentconnections "  << "The number of current DNS over HTTPS connections"                  << "\n";
+        output << "# TYPE " << statesbase << "dohcurrentconnections "  << "gauge"                                                             << "\n";
 
         for (const auto& state : *states) {
           string serverName;
@@ -594,6 +666,15 @@ static void connectionThread(int sock, ComboAddress remote)
           output << statesbase << "tcpcurrentconnections"  << label << " " << state->tcpCurrentConnections      << "\n";
           output << statesbase << "tcpavgqueriesperconn"   << label << " " << state->tcpAvgQueriesPerConnection << "\n";
           output << statesbase << "tcpavgconnduration"     << label << " " << state->tcpAvgConnectionDuration   << "\n";
+          output << statesbase << "tlsresumptions"         << label << " " << state->tlsResumptions             << "\n";
+          if (state->isDoH()) {
+            output << statesbase << "dohlatency"             << label << " " << state->dohLatencyUsec/1000.0      << "\n";
+            output << statesbase << "dohconnecterrors"       << label << " " << state->dohConnectErrors           << "\n";
+            output << statesbase << "dohhttperrors"          << label << " " << state->dohHTTPErrors              << "\n";
+            output << statesbase << "dohprotocolerrors"      << label << " " << state->dohProtocolErrors          << "\n";
+            output << statesbase << "dohtimeouts"            << label << " " << state->dohTimeouts                << "\n";
+            output << statesbase << "dohcurrentconnections"  << label << " " << state->dohCurrentConnections      << "\n";
+          }
         }
 
         const string frontsbase = "dnsdist_frontend_";
@@ -777,6 +858,12 @@ static void connectionThread(int sock, ComboAddress remote)
         output << "# TYPE dnsdist_pool_cache_insert_collisions " << "counter" << "\n";
         output << "# HELP dnsdist_pool_cache_ttl_too_shorts " << "Number of insertions into that cache skipped because the TTL of the answer was not long enough" << "\n";
         output << "# TYPE dnsdist_pool_cache_ttl_too_shorts " << "counter" << "\n";
+        output << "# HELP dnsdist_pool_cache_prefetches " << "Number of entries of that cache refreshed from a backend before they expired" << "\n";
+        output << "# TYPE dnsdist_pool_cache_prefetches " << "counter" << "\n";
+        output << "# HELP dnsdist_pool_cache_evictions " << "Number of entries of that cache evicted to make room for a new one" << "\n";
+        output << "# TYPE dnsdist_pool_cache_evictions " << "counter" << "\n";
+        output << "# HELP dnsdist_pool_cache_rejected_admissions " << "Number of insertions into that cache skipped because the new entry was less popular than the one it would have evicted" << "\n";
+        output << "# TYPE dnsdist_pool_cache_rejected_admissions " << "counter" << "\n";
 
         for (const auto& entry : *localPools) {
           string poolName = entry.first;
@@ -801,6 +888,9 @@ static void connectionThread(int sock, ComboAddress remote)
             output << cachebase << "cache_lookup_collisions" <<label << " " << cache->getLookupCollisions() << "\n";
             output << cachebase << "cache_insert_collisions" <<label << " " << cache->getInsertCollisions() << "\n";
             output << cachebase << "cache_ttl_too_shorts"    <<label << " " << cache->getTTLTooShorts()     << "\n";
+            output << cachebase << "cache_prefetches"        <<label << " " << cache->getPrefetches()       << "\n";
+            output << cachebase << "cache_evictions"         <<label << " " << cache->getEvictions()        << "\n";
+            output << cachebase << "cache_rejected_admissions" <<label << " " << cache->getRejectedAdmissions() << "\n";
           }
         }
 
@@ -856,6 +946,13 @@ static void connectionThread(int sock, ComboAddress remote)
           {"tcpCurrentConnections", (double)a->tcpCurrentConnections},
           {"tcpAvgQueriesPerConnection", (double)a->tcpAvgQueriesPerConnection},
           {"tcpAvgConnectionDuration", (double)a->tcpAvgConnectionDuration},
+          {"tlsResumptions", (double)a->tlsResumptions},
+          {"dohLatency", (double)(a->dohLatencyUsec/1000.0)},
+          {"dohConnectErrors", (double)a->dohConnectErrors},
+          {"dohHTTPErrors", (double)a->dohHTTPErrors},
+          {"dohProtocolErrors", (double)a->dohProtocolErrors},
+          {"dohTimeouts", (double)a->dohTimeouts},
+          {"dohCurrentConnections", (double)a->dohCurrentConnections},
           {"dropRate", (double)a->dropRate}
         };
 
@@ -970,7 +1067,10 @@ static void connectionThread(int sock, ComboAddress remote)
           { "cacheDeferredLookups", (double) (cache ? cache->getDeferredLookups() : 0) },
           { "cacheLookupCollisions", (double) (cache ? cache->getLookupCollisions() : 0) },
           { "cacheInsertCollisions", (double) (cache ? cache->getInsertCollisions() : 0) },
-          { "cacheTTLTooShorts", (double) (cache ? cache->getTTLTooShorts() : 0) }
+          { "cacheTTLTooShorts", (double) (cache ? cache->getTTLTooShorts() : 0) },
+          { "cachePrefetches", (double) (cache ? cache->getPrefetches() : 0) },
+          { "cacheEvictions", (double) (cache ? cache->getEvictions() : 0) },
+          { "cacheRejectedAdmissions", (double) (cache ? cache->getRejectedAdmissions() : 0) }
         };
         pools.push_back(entry);
       }
@@ -986,7 +1086,9 @@ static void connectionThread(int sock, ComboAddress remote)
           {"matches", (double)a.d_rule->d_matches},
           {"rule", a.d_rule->toString()},
           {"action", a.d_action->toString()},
-          {"action-stats", a.d_action->getStats()}
+          {"action-stats", a.d_action->getStats()},
+          {"rule-timings", timingsToJson(a.d_rule->d_timings)},
+          {"action-timings", timingsToJson(a.d_action->d_timings)}
         };
 	rules.push_back(rule);
       }
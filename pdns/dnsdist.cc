@@ -140,6 +140,7 @@ bool g_servFailOnNoPolicy{false};
 bool g_truncateTC{false};
 bool g_fixupCase{false};
 bool g_preserveTrailingData{false};
+std::atomic<uint32_t> g_ruleTimingSampleRate{0};
 
 std::set<std::string> g_capabilitiesToRetain;
 
@@ -420,14 +421,58 @@ static bool encryptResponse(char* response, uint16_t* responseLen, size_t respon
 }
 #endif /* HAVE_DNSCRYPT */
 
+/* whether the selectors and actions should be timed for this query, see setRuleTimingSampleRate() */
+static bool shouldTimeRules()
+{
+  const auto rate = g_ruleTimingSampleRate.load(std::memory_order_relaxed);
+  if (rate == 0) {
+    return false;
+  }
+
+  static thread_local uint32_t counter{0};
+  if (++counter < rate) {
+    return false;
+  }
+  counter = 0;
+  return true;
+}
+
+static bool ruleMatches(const DNSRule& rule, const DNSQuestion* dq, bool timed)
+{
+  if (!timed) {
+    return rule.matches(dq);
+  }
+
+  StopWatch sw;
+  sw.start();
+  bool result = rule.matches(dq);
+  rule.d_timings.add(static_cast<uint64_t>(sw.udiff() * 1000));
+  return result;
+}
+
+template<typename A, typename Q>
+static typename A::Action runAction(const A& action, Q* dq, std::string* ruleresult, bool timed)
+{
+  if (!timed) {
+    return action(dq, ruleresult);
+  }
+
+  StopWatch sw;
+  sw.start();
+  auto result = action(dq, ruleresult);
+  action.d_timings.add(static_cast<uint64_t>(sw.udiff() * 1000));
+  return result;
+}
+
 static bool applyRulesToResponse(LocalStateHolder<vector<DNSDistResponseRuleAction> >& localRespRulactions, DNSResponse& dr)
 {
   DNSResponseAction::Action action=DNSResponseAction::Action::None;
   std::string ruleresult;
+  const bool timed = shouldTimeRules();
   for(const auto& lr : *localRespRulactions) {
-    if(lr.d_rule->matches(&dr)) {
+    if(ruleMatches(*lr.d_rule, &dr, timed)) {
       lr.d_rule->d_matches++;
-      action=(*lr.d_action)(&dr, &ruleresult);
+      action=runAction(*lr.d_action, &dr, &ruleresult, timed);
       switch(action) {
       case DNSResponseAction::Action::Allow:
         return true;
@@ -516,6 +561,122 @@ static bool sendUDPResponse(int origFD, const char* response, const uint16_t res
   return true;
 }
 
+class UDPOutgoingBatch;
+
+#if defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE)
+/* Outgoing datagrams, queued so that they can be sent with a single sendmmsg() call per socket.
+   The data is not copied and has to stay valid until flush() has been called. */
+class UDPOutgoingBatch
+{
+public:
+  struct Entry
+  {
+    std::shared_ptr<DownstreamState> d_ds{nullptr};
+    const char* d_data{nullptr};
+    size_t d_len{0};
+    ComboAddress d_dest;
+    ComboAddress d_source;
+    struct msghdr d_msg;
+    struct iovec d_iov;
+    int d_fd{-1};
+    int d_flags{0};
+    /* has to be the last member, it ends with a flexible array */
+    cmsgbuf_aligned d_cbuf;
+  };
+
+  UDPOutgoingBatch(size_t maxSize): d_entries(new Entry[maxSize]), d_msgs(new struct mmsghdr[maxSize]), d_maxSize(maxSize)
+  {
+    d_order.reserve(maxSize);
+  }
+
+  size_t size() const
+  {
+    return d_count;
+  }
+
+  /* dest should be nullptr for connected sockets, source only set if the source address and interface need to be set explicitly */
+  void queue(int fd, int flags, const char* data, size_t len, const ComboAddress* dest, const ComboAddress* source, int sourceItf, const std::shared_ptr<DownstreamState>& ds)
+  {
+    if (d_count >= d_maxSize) {
+      throw std::runtime_error("Trying to queue more than " + std::to_string(d_maxSize) + " datagrams into an UDP batch");
+    }
+
+    auto& entry = d_entries[d_count++];
+    entry.d_ds = ds;
+    entry.d_data = data;
+    entry.d_len = len;
+    entry.d_fd = fd;
+    entry.d_flags = flags;
+    entry.d_dest.sin4.sin_family = 0;
+    entry.d_source.sin4.sin_family = 0;
+
+    if (dest != nullptr) {
+      entry.d_dest = *dest;
+    }
+    fillMSGHdr(&entry.d_msg, &entry.d_iov, nullptr, 0, const_cast<char*>(data), len, &entry.d_dest);
+    if (dest == nullptr) {
+      entry.d_msg.msg_name = nullptr;
+      entry.d_msg.msg_namelen = 0;
+    }
+
+    if (source != nullptr) {
+      entry.d_source = *source;
+      addCMsgSrcAddr(&entry.d_msg, &entry.d_cbuf, &entry.d_source, sourceItf);
+    }
+    else {
+      entry.d_msg.msg_control = nullptr;
+    }
+  }
+
+  /* sends the queued datagrams, with one sendmmsg() call per socket. The ones that could not
+     be sent that way, if any, are passed to the fallback function so that errors can be
+     handled exactly as for single datagrams */
+  template<typename T> void flush(T fallback)
+  {
+    d_order.clear();
+    for (size_t idx = 0; idx < d_count; idx++) {
+      d_order.push_back(idx);
+    }
+    /* keep the order of the datagrams sent over the same socket */
+    std::stable_sort(d_order.begin(), d_order.end(), [this](size_t a, size_t b) {
+      return d_entries[a].d_fd < d_entries[b].d_fd;
+    });
+
+    size_t pos = 0;
+    while (pos < d_count) {
+      const auto& first = d_entries[d_order.at(pos)];
+      size_t end = pos;
+      for (; end < d_count && d_entries[d_order.at(end)].d_fd == first.d_fd; end++) {
+        d_msgs[end - pos].msg_hdr = d_entries[d_order.at(end)].d_msg;
+        d_msgs[end - pos].msg_len = 0;
+      }
+
+      int sent = sendmmsg(first.d_fd, d_msgs.get(), end - pos, first.d_flags);
+      if (sent > 0) {
+        ++g_stats.udpOutBatches;
+        g_stats.udpOutBatchedDatagrams += sent;
+      }
+
+      for (size_t idx = pos + (sent > 0 ? sent : 0); idx < end; idx++) {
+        fallback(d_entries[d_order.at(idx)]);
+      }
+      pos = end;
+    }
+
+    for (size_t idx = 0; idx < d_count; idx++) {
+      d_entries[idx].d_ds.reset();
+    }
+    d_count = 0;
+  }
+
+private:
+  std::unique_ptr<Entry[]> d_entries;
+  std::unique_ptr<struct mmsghdr[]> d_msgs;
+  std::vector<size_t> d_order;
+  size_t d_maxSize;
+  size_t d_count{0};
+};
+#endif /* defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE) */
 
 int pickBackendSocketForSending(std::shared_ptr<DownstreamState>& state)
 {
@@ -542,8 +703,30 @@ void responderThread(std::shared_ptr<DownstreamState> dss)
 try {
   setThreadName("dnsdist/respond");
   auto localRespRulactions = g_resprulactions.getLocal();
-  char packet[s_maxPacketCacheEntrySize + DNSCRYPT_MAX_RESPONSE_PADDING_AND_MAC_SIZE];
-  static_assert(sizeof(packet) <= UINT16_MAX, "Packet size should fit in a uint16_t");
+  struct ResponseBuffer
+  {
+    char packet[s_maxPacketCacheEntrySize + DNSCRYPT_MAX_RESPONSE_PADDING_AND_MAC_SIZE];
+    struct iovec iov;
+  };
+  static const size_t packetSize = sizeof(ResponseBuffer::packet);
+  static_assert(packetSize <= UINT16_MAX, "Packet size should fit in a uint16_t");
+  const size_t vectSize = std::max(g_udpVectorSize, static_cast<size_t>(1));
+  auto buffers = std::unique_ptr<ResponseBuffer[]>(new ResponseBuffer[vectSize]);
+#if defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE)
+  /* when enabled, we read several responses at once and send the ones going to UDP clients in batch */
+  auto msgVec = std::unique_ptr<struct mmsghdr[]>(new struct mmsghdr[vectSize]);
+  for (size_t idx = 0; idx < vectSize; idx++) {
+    memset(&msgVec[idx].msg_hdr, 0, sizeof(msgVec[idx].msg_hdr));
+    buffers[idx].iov.iov_base = buffers[idx].packet;
+    buffers[idx].iov.iov_len = packetSize;
+    msgVec[idx].msg_hdr.msg_iov = &buffers[idx].iov;
+    msgVec[idx].msg_hdr.msg_iovlen = 1;
+  }
+  std::unique_ptr<UDPOutgoingBatch> responsesBatch{nullptr};
+  if (vectSize > 1) {
+    responsesBatch = std::unique_ptr<UDPOutgoingBatch>(new UDPOutgoingBatch(vectSize));
+  }
+#endif /* defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE) */
   /* when the answer is encrypted in place, we need to get a copy
      of the original header before encryption to fill the ring buffer */
   dnsheader cleartextDH;
@@ -554,162 +737,217 @@ try {
   sockets.reserve(dss->sockets.size());
 
   for(; !dss->isStopped(); ) {
-    dnsheader* dh = reinterpret_cast<struct dnsheader*>(packet);
     try {
       pickBackendSocketsReadyForReceiving(dss, sockets);
-      for (const auto& fd : sockets) {
-        ssize_t got = recv(fd, packet, sizeof(packet), 0);
-        char * response = packet;
-        size_t responseSize = sizeof(packet);
+    }
+    catch(const std::exception& e){
+      vinfolog("Got an error in UDP responder thread while waiting for a response from %s: %s", dss->remote.toStringWithPort(), e.what());
+      continue;
+    }
 
+    for (const auto& fd : sockets) {
+      size_t msgsGot = 1;
+      ssize_t got = 0;
+#if defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE)
+      if (vectSize > 1) {
+        /* block until we have at least one response, but get as many as possible */
+        int res = recvmmsg(fd, msgVec.get(), vectSize, MSG_WAITFORONE, nullptr);
+        if (res <= 0) {
+          continue;
+        }
+        msgsGot = res;
+      }
+      else
+#endif /* defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE) */
+      {
+        got = recv(fd, buffers[0].packet, packetSize, 0);
         if (got == 0 && dss->isStopped()) {
           break;
         }
+      }
 
-        if (got < 0 || static_cast<size_t>(got) < sizeof(dnsheader)) {
-          continue;
-        }
+      for (size_t msgIdx = 0; msgIdx < msgsGot; msgIdx++) {
+        try {
+          char* packet = buffers[msgIdx].packet;
+#if defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE)
+          if (vectSize > 1) {
+            got = msgVec[msgIdx].msg_len;
+          }
+#endif /* defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE) */
+          dnsheader* dh = reinterpret_cast<struct dnsheader*>(packet);
+          char * response = packet;
+          size_t responseSize = packetSize;
 
-        uint16_t responseLen = static_cast<uint16_t>(got);
-        queryId = dh->id;
+          if (got < 0 || static_cast<size_t>(got) < sizeof(dnsheader)) {
+            continue;
+          }
 
-        if(queryId >= dss->idStates.size()) {
-          continue;
-        }
+          uint16_t responseLen = static_cast<uint16_t>(got);
+          queryId = dh->id;
+
+          if(queryId >= dss->idStates.size()) {
+            continue;
+          }
+
+          IDState* ids = &dss->idStates[queryId];
+          int64_t usageIndicator = ids->usageIndicator;
 
-        IDState* ids = &dss->idStates[queryId];
-        int64_t usageIndicator = ids->usageIndicator;
+          if(!IDState::isInUse(usageIndicator)) {
+            /* the corresponding state is marked as not in use, meaning that:
+               - it was already cleaned up by another thread and the state is gone ;
+               - we already got a response for this query and this one is a duplicate.
+               Either way, we don't touch it.
+            */
+            continue;
+          }
 
-        if(!IDState::isInUse(usageIndicator)) {
-          /* the corresponding state is marked as not in use, meaning that:
-             - it was already cleaned up by another thread and the state is gone ;
-             - we already got a response for this query and this one is a duplicate.
-             Either way, we don't touch it.
+          /* read the potential DOHUnit state as soon as possible, but don't use it
+             until we have confirmed that we own this state by updating usageIndicator */
+          auto du = ids->du;
+          /* setting age to 0 to prevent the maintainer thread from
+             cleaning this IDS while we process the response.
           */
-          continue;
-        }
+          ids->age = 0;
+          int origFD = ids->origFD;
 
-        /* read the potential DOHUnit state as soon as possible, but don't use it
-           until we have confirmed that we own this state by updating usageIndicator */
-        auto du = ids->du;
-        /* setting age to 0 to prevent the maintainer thread from
-           cleaning this IDS while we process the response.
-        */
-        ids->age = 0;
-        int origFD = ids->origFD;
-
-        unsigned int consumed = 0;
-        if (!responseContentMatches(response, responseLen, ids->qname, ids->qtype, ids->qclass, dss->remote, consumed)) {
-          continue;
-        }
+          unsigned int consumed = 0;
+          if (!responseContentMatches(response, responseLen, ids->qname, ids->qtype, ids->qclass, dss->remote, consumed)) {
+            continue;
+          }
 
-        bool isDoH = du != nullptr;
-        /* atomically mark the state as available, but only if it has not been altered
-           in the meantime */
-        if (ids->tryMarkUnused(usageIndicator)) {
-          /* clear the potential DOHUnit asap, it's ours now
-           and since we just marked the state as unused,
-           someone could overwrite it. */
-          ids->du = nullptr;
-          /* we only decrement the outstanding counter if the value was not
-             altered in the meantime, which would mean that the state has been actively reused
-             and the other thread has not incremented the outstanding counter, so we don't
-             want it to be decremented twice. */
-          --dss->outstanding;  // you'd think an attacker could game this, but we're using connected socket
-        } else {
-          /* someone updated the state in the meantime, we can't touch the existing pointer */
-          du = nullptr;
-          /* since the state has been updated, we can't safely access it so let's just drop
-             this response */
-          continue;
-        }
+          bool isDoH = du != nullptr;
+          /* atomically mark the state as available, but only if it has not been altered
+             in the meantime */
+          if (ids->tryMarkUnused(usageIndicator)) {
+            /* clear the potential DOHUnit asap, it's ours now
+             and since we just marked the state as unused,
+             someone could overwrite it. */
+            ids->du = nullptr;
+            /* we only decrement the outstanding counter if the value was not
+               altered in the meantime, which would mean that the state has been actively reused
+               and the other thread has not incremented the outstanding counter, so we don't
+               want it to be decremented twice. */
+            --dss->outstanding;  // you'd think an attacker could game this, but we're using connected socket
+          } else {
+            /* someone updated the state in the meantime, we can't touch the existing pointer */
+            du = nullptr;
+            /* since the state has been updated, we can't safely access it so let's just drop
+               this response */
+            continue;
+          }
 
-        if(dh->tc && g_truncateTC) {
-          truncateTC(response, &responseLen, responseSize, consumed);
-        }
+          if(dh->tc && g_truncateTC) {
+            truncateTC(response, &responseLen, responseSize, consumed);
+          }
 
-        dh->id = ids->origID;
+          dh->id = ids->origID;
 
-        uint16_t addRoom = 0;
-        DNSResponse dr = makeDNSResponseFromIDState(*ids, dh, sizeof(packet), responseLen, false);
-        if (dr.dnsCryptQuery) {
-          addRoom = DNSCRYPT_MAX_RESPONSE_PADDING_AND_MAC_SIZE;
-        }
+          uint16_t addRoom = 0;
+          DNSResponse dr = makeDNSResponseFromIDState(*ids, dh, packetSize, responseLen, false);
+          if (dr.dnsCryptQuery) {
+            addRoom = DNSCRYPT_MAX_RESPONSE_PADDING_AND_MAC_SIZE;
+          }
 
-        memcpy(&cleartextDH, dr.dh, sizeof(cleartextDH));
-        if (!processResponse(&response, &responseLen, &responseSize, localRespRulactions, dr, addRoom, rewrittenResponse, ids->cs && ids->cs->muted)) {
-          continue;
-        }
+          memcpy(&cleartextDH, dr.dh, sizeof(cleartextDH));
+          if (!processResponse(&response, &responseLen, &responseSize, localRespRulactions, dr, addRoom, rewrittenResponse, ids->cs && ids->cs->muted)) {
+            continue;
+          }
 
-        if (ids->cs && !ids->cs->muted) {
-          if (du) {
+          if (ids->cs && !ids->cs->muted) {
+            if (du) {
 #ifdef HAVE_DNS_OVER_HTTPS
-            // DoH query
-            du->response = std::string(response, responseLen);
-            static_assert(sizeof(du) <= PIPE_BUF, "Writes up to PIPE_BUF are guaranteed not to be interleaved and to either fully succeed or fail");
-            ssize_t sent = write(du->rsock, &du, sizeof(du));
-            if (sent != sizeof(du)) {
-              if (errno == EAGAIN || errno == EWOULDBLOCK) {
-                ++g_stats.dohResponsePipeFull;
-                vinfolog("Unable to pass a DoH response to the DoH worker thread because the pipe is full");
+              // DoH query
+              du->response = std::string(response, responseLen);
+              static_assert(sizeof(du) <= PIPE_BUF, "Writes up to PIPE_BUF are guaranteed not to be interleaved and to either fully succeed or fail");
+              ssize_t sent = write(du->rsock, &du, sizeof(du));
+              if (sent != sizeof(du)) {
+                if (errno == EAGAIN || errno == EWOULDBLOCK) {
+                  ++g_stats.dohResponsePipeFull;
+                  vinfolog("Unable to pass a DoH response to the DoH worker thread because the pipe is full");
+                }
+                else {
+                  vinfolog("Unable to pass a DoH response to the DoH worker thread because we couldn't write to the pipe: %s", stringerror());
+                }
+
+                /* at this point we have the only remaining pointer on this
+                   DOHUnit object since we did set ids->du to nullptr earlier,
+                   except if we got the response before the pointer could be
+                   released by the frontend */
+                du->release();
               }
-              else {
-                vinfolog("Unable to pass a DoH response to the DoH worker thread because we couldn't write to the pipe: %s", stringerror());
+#endif /* HAVE_DNS_OVER_HTTPS */
+              du = nullptr;
+            }
+            else {
+              ComboAddress empty;
+              empty.sin4.sin_family = 0;
+              /* if ids->destHarvested is false, origDest holds the listening address.
+                 We don't want to use that as a source since it could be 0.0.0.0 for example. */
+#if defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE)
+              /* responses rewritten into a separate buffer might not survive until the batch is sent */
+              if (responsesBatch && dr.delayMsec == 0 && response == packet) {
+                responsesBatch->queue(origFD, 0, response, responseLen, &ids->origRemote, ids->destHarvested ? &ids->origDest : nullptr, 0, nullptr);
+              }
+              else
+#endif /* defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE) */
+              {
+                sendUDPResponse(origFD, response, responseLen, dr.delayMsec, ids->destHarvested ? ids->origDest : empty, ids->origRemote);
               }
-
-              /* at this point we have the only remaining pointer on this
-                 DOHUnit object since we did set ids->du to nullptr earlier,
-                 except if we got the response before the pointer could be
-                 released by the frontend */
-              du->release();
             }
-#endif /* HAVE_DNS_OVER_HTTPS */
-            du = nullptr;
           }
-          else {
-            ComboAddress empty;
-            empty.sin4.sin_family = 0;
-            /* if ids->destHarvested is false, origDest holds the listening address.
-               We don't want to use that as a source since it could be 0.0.0.0 for example. */
-            sendUDPResponse(origFD, response, responseLen, dr.delayMsec, ids->destHarvested ? ids->origDest : empty, ids->origRemote);
+
+          ++dss->responses;
+          double udiff = ids->sentTime.udiff();
+
+          if (ids->cs == nullptr) {
+            /* response to a prefetch query sent by ourselves, it has been
+               inserted into the cache and there is no client to send it to */
+            vinfolog("Got prefetch answer from %s for %s|%s, took %f usec", dss->remote.toStringWithPort(), ids->qname.toLogString(), QType(ids->qtype).getName(), udiff);
+            dss->latencyUsec = (127.0 * dss->latencyUsec / 128.0) + udiff/128.0;
+            rewrittenResponse.clear();
+            continue;
           }
-        }
 
-        ++g_stats.responses;
-        if (ids->cs) {
+          ++g_stats.responses;
           ++ids->cs->responses;
-        }
-        ++dss->responses;
 
-        double udiff = ids->sentTime.udiff();
-        vinfolog("Got answer from %s, relayed to %s%s, took %f usec", dss->remote.toStringWithPort(), ids->origRemote.toStringWithPort(),
-                 isDoH ? " (https)": "", udiff);
+          vinfolog("Got answer from %s, relayed to %s%s, took %f usec", dss->remote.toStringWithPort(), ids->origRemote.toStringWithPort(),
+                   isDoH ? " (https)": "", udiff);
 
-        struct timespec ts;
-        gettime(&ts);
-        g_rings.insertResponse(ts, *dr.remote, *dr.qname, dr.qtype, static_cast<unsigned int>(udiff), static_cast<unsigned int>(got), cleartextDH, dss->remote);
+          struct timespec ts;
+          gettime(&ts);
+          g_rings.insertResponse(ts, *dr.remote, *dr.qname, dr.qtype, static_cast<unsigned int>(udiff), static_cast<unsigned int>(got), cleartextDH, dss->remote);
+
+          switch (cleartextDH.rcode) {
+          case RCode::NXDomain:
+            ++g_stats.frontendNXDomain;
+            break;
+          case RCode::ServFail:
+            ++g_stats.servfailResponses;
+            ++g_stats.frontendServFail;
+            break;
+          case RCode::NoError:
+            ++g_stats.frontendNoError;
+            break;
+          }
+          dss->latencyUsec = (127.0 * dss->latencyUsec / 128.0) + udiff/128.0;
 
-        switch (cleartextDH.rcode) {
-        case RCode::NXDomain:
-          ++g_stats.frontendNXDomain;
-          break;
-        case RCode::ServFail:
-          ++g_stats.servfailResponses;
-          ++g_stats.frontendServFail;
-          break;
-        case RCode::NoError:
-          ++g_stats.frontendNoError;
-          break;
-        }
-        dss->latencyUsec = (127.0 * dss->latencyUsec / 128.0) + udiff/128.0;
+          doLatencyStats(udiff);
 
-        doLatencyStats(udiff);
+          rewrittenResponse.clear();
+        }
+        catch(const std::exception& e){
+          vinfolog("Got an error in UDP responder thread while parsing a response from %s, id %d: %s", dss->remote.toStringWithPort(), queryId, e.what());
+        }
+      }
 
-        rewrittenResponse.clear();
+#if defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE)
+      if (responsesBatch && responsesBatch->size() > 0) {
+        responsesBatch->flush([](const UDPOutgoingBatch::Entry& entry) {
+          sendUDPResponse(entry.d_fd, entry.d_data, static_cast<uint16_t>(entry.d_len), 0, entry.d_source, entry.d_dest);
+        });
       }
-    }
-    catch(const std::exception& e){
-      vinfolog("Got an error in UDP responder thread while parsing a response from %s, id %d: %s", dss->remote.toStringWithPort(), queryId, e.what());
+#endif /* defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE) */
     }
   }
 }
@@ -982,12 +1220,42 @@ static bool applyRulesToQuery(LocalHolders& holders, DNSQuestion& dq, const stru
   DNSAction::Action action=DNSAction::Action::None;
   string ruleresult;
   bool drop = false;
-  for(const auto& lr : *holders.rulactions) {
-    if(lr.d_rule->matches(&dq)) {
-      lr.d_rule->d_matches++;
-      action=(*lr.d_action)(&dq, &ruleresult);
-      if (processRulesResult(action, dq, ruleresult, drop)) {
-        break;
+  const auto& rulactions = *holders.rulactions;
+  holders.rulactionsIndex.update(rulactions);
+  const bool timed = shouldTimeRules();
+
+  if (holders.rulactionsIndex.isEnabled()) {
+    StopWatch sw;
+    if (timed) {
+      sw.start();
+    }
+    /* the qname and qtype can't be altered by an action, so what the index told us stays valid for the whole chain */
+    const auto& candidates = holders.rulactionsIndex.getCandidates(dq);
+    /* the selectors the index fully evaluated are accounted for the time of the lookup */
+    const uint64_t lookupTime = timed ? static_cast<uint64_t>(sw.udiff() * 1000) : 0;
+
+    for (const auto& candidate : candidates) {
+      const auto& lr = rulactions[candidate.d_position];
+      if (candidate.d_matches && timed) {
+        lr.d_rule->d_timings.add(lookupTime);
+      }
+      if (candidate.d_matches || ruleMatches(*lr.d_rule, &dq, timed)) {
+        lr.d_rule->d_matches++;
+        action=runAction(*lr.d_action, &dq, &ruleresult, timed);
+        if (processRulesResult(action, dq, ruleresult, drop)) {
+          break;
+        }
+      }
+    }
+  }
+  else {
+    for(const auto& lr : rulactions) {
+      if(ruleMatches(*lr.d_rule, &dq, timed)) {
+        lr.d_rule->d_matches++;
+        action=runAction(*lr.d_action, &dq, &ruleresult, timed);
+        if (processRulesResult(action, dq, ruleresult, drop)) {
+          break;
+        }
       }
     }
   }
@@ -1003,7 +1271,11 @@ ssize_t udpClientSendRequestToBackend(const std::shared_ptr<DownstreamState>& ss
 {
   ssize_t result;
 
-  if (ss->sourceItf == 0) {
+  if (ss->isDoH()) {
+    /* the socket is connected to the DoH client thread, which might be busy: better drop the query than block */
+    result = send(sd, request, requestLen, MSG_DONTWAIT);
+  }
+  else if (ss->sourceItf == 0) {
     result = send(sd, request, requestLen, 0);
   }
   else {
@@ -1166,6 +1438,70 @@ static bool prepareOutgoingResponse(LocalHolders& holders, ClientState& cs, DNSQ
   return true;
 }
 
+/* send a copy of a query that got a cache hit to the backend, so that the
+   entry is refreshed before it expires. The IDState has no ClientState, so
+   the responder thread only inserts the response into the cache */
+static void prefetchFromBackend(DNSQuestion& dq, std::shared_ptr<DownstreamState>& ss, std::vector<uint8_t>& query)
+{
+  unsigned int idOffset = (ss->idOffset++) % ss->idStates.size();
+  IDState* ids = &ss->idStates[idOffset];
+  ids->age = 0;
+  DOHUnit* du = nullptr;
+
+  if (ids->isInUse()) {
+    du = ids->du;
+  }
+
+  if (!ids->markAsUsed()) {
+    du = nullptr;
+    ++ss->outstanding;
+  }
+  else {
+    ids->du = nullptr;
+    ++ss->reuseds;
+    ++g_stats.downstreamTimeouts;
+    handleDOHTimeout(du);
+  }
+
+  struct dnsheader* dh = reinterpret_cast<struct dnsheader*>(query.data());
+  ids->cs = nullptr;
+  ids->origFD = -1;
+  ids->origID = dh->id;
+
+  /* the query is still going to be answered from the cache, so the
+     DNSCrypt and protobuf states have to stay with it */
+  auto dnsCryptQuery = std::move(dq.dnsCryptQuery);
+#ifdef HAVE_PROTOBUF
+  auto uniqueId = dq.uniqueId;
+#endif
+  setIDStateFromDNSQuestion(*ids, dq, DNSName(*dq.qname));
+  ids->dnsCryptQuery = nullptr;
+  dq.dnsCryptQuery = std::move(dnsCryptQuery);
+#ifdef HAVE_PROTOBUF
+  ids->uniqueId = boost::none;
+  dq.uniqueId = std::move(uniqueId);
+#endif
+  ids->delayMsec = 0;
+  ids->destHarvested = false;
+
+  dh->id = idOffset;
+
+  if (ss->useProxyProtocol) {
+    addProxyProtocol(query, false, *dq.remote, *dq.local, dq.proxyProtocolValues ? *dq.proxyProtocolValues : std::vector<ProxyProtocolValue>());
+  }
+
+  int fd = pickBackendSocketForSending(ss);
+  ssize_t ret = udpClientSendRequestToBackend(ss, fd, reinterpret_cast<const char*>(query.data()), query.size());
+
+  if (ret < 0) {
+    ++ss->sendErrors;
+    ++g_stats.downstreamSendErrors;
+  }
+
+  ++ss->queries;
+  vinfolog("Prefetching %s|%s from %s", ids->qname.toLogString(), QType(ids->qtype).getName(), ss->getName());
+}
+
 ProcessQueryResult processQuery(DNSQuestion& dq, ClientState& cs, LocalHolders& holders, std::shared_ptr<DownstreamState>& selectedBackend)
 {
   const uint16_t queryId = ntohs(dq.dh->id);
@@ -1237,9 +1573,23 @@ ProcessQueryResult processQuery(DNSQuestion& dq, ClientState& cs, LocalHolders&
     }
 
     if (dq.packetCache && !dq.skipCache) {
-      if (dq.packetCache->get(dq, dq.consumed, dq.dh->id, reinterpret_cast<char*>(dq.dh), &cachedResponseSize, &dq.cacheKey, dq.subnet, dq.dnssecOK, allowExpired)) {
+      /* prefetching is only done over UDP, DoH included, and not for backends
+         expecting XPF since the query is sent as it was before the lookup */
+      const bool canPrefetch = selectedBackend && !dq.tcp && !selectedBackend->isTCPOnly() && dq.packetCache->isPrefetchEnabled() && !(dq.addXPF && selectedBackend->xpfRRCode != 0);
+      bool prefetch = false;
+      std::vector<uint8_t> prefetchQuery;
+      if (canPrefetch) {
+        /* a hit overwrites the query with the response */
+        prefetchQuery.assign(reinterpret_cast<const uint8_t*>(dq.dh), reinterpret_cast<const uint8_t*>(dq.dh) + dq.len);
+      }
+
+      if (dq.packetCache->get(dq, dq.consumed, dq.dh->id, reinterpret_cast<char*>(dq.dh), &cachedResponseSize, &dq.cacheKey, dq.subnet, dq.dnssecOK, allowExpired, false, canPrefetch ? &prefetch : nullptr)) {
         dq.len = cachedResponseSize;
 
+        if (prefetch) {
+          prefetchFromBackend(dq, selectedBackend, prefetchQuery);
+        }
+
         if (!prepareOutgoingResponse(holders, cs, dq, true)) {
           return ProcessQueryResult::Drop;
         }
@@ -1269,6 +1619,31 @@ ProcessQueryResult processQuery(DNSQuestion& dq, ClientState& cs, LocalHolders&
       return ProcessQueryResult::Drop;
     }
 
+    if (!dq.tcp && selectedBackend->isTCPOnly()) {
+      restoreFlags(dq.dh, dq.origFlags);
+
+      if (dq.du != nullptr) {
+        /* a DoH client is already using a stream transport, so it has nothing to retry over */
+        vinfolog("DoH query from %s for %s ServFailed because the selected backend %s can only be reached over TCP", dq.remote->toStringWithPort(), dq.qname->toLogString(), selectedBackend->getNameWithAddr());
+        dq.dh->rcode = RCode::ServFail;
+        dq.dh->qr = true;
+      }
+      else {
+        /* this backend can only be reached over TCP, let the client retry over TCP */
+        vinfolog("Query from %s for %s truncated because the selected backend %s can only be reached over TCP", dq.remote->toStringWithPort(), dq.qname->toLogString(), selectedBackend->getNameWithAddr());
+        dq.dh->tc = true;
+        dq.dh->qr = true;
+        dq.dh->ra = dq.dh->rd;
+        dq.dh->aa = false;
+        dq.dh->ad = false;
+      }
+
+      if (!prepareOutgoingResponse(holders, cs, dq, false)) {
+        return ProcessQueryResult::Drop;
+      }
+      return ProcessQueryResult::SendAnswer;
+    }
+
     if (dq.addXPF && selectedBackend->xpfRRCode != 0) {
       addXPF(dq, selectedBackend->xpfRRCode, g_preserveTrailingData);
     }
@@ -1282,7 +1657,7 @@ ProcessQueryResult processQuery(DNSQuestion& dq, ClientState& cs, LocalHolders&
   return ProcessQueryResult::Drop;
 }
 
-static void processUDPQuery(ClientState& cs, LocalHolders& holders, const struct msghdr* msgh, const ComboAddress& remote, ComboAddress& dest, char* query, uint16_t len, size_t queryBufferSize, struct mmsghdr* responsesVect, unsigned int* queuedResponses, struct iovec* respIOV, cmsgbuf_aligned* respCBuf)
+static void processUDPQuery(ClientState& cs, LocalHolders& holders, const struct msghdr* msgh, const ComboAddress& remote, ComboAddress& dest, char* query, uint16_t len, size_t queryBufferSize, struct mmsghdr* responsesVect, unsigned int* queuedResponses, struct iovec* respIOV, cmsgbuf_aligned* respCBuf, UDPOutgoingBatch* queriesBatch)
 {
   assert(responsesVect == nullptr || (queuedResponses != nullptr && respIOV != nullptr && respCBuf != nullptr));
   uint16_t queryId = 0;
@@ -1396,11 +1771,21 @@ static void processUDPQuery(ClientState& cs, LocalHolders& holders, const struct
     }
 
     int fd = pickBackendSocketForSending(ss);
-    ssize_t ret = udpClientSendRequestToBackend(ss, fd, query, dq.len);
+#if defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE)
+    if (queriesBatch != nullptr) {
+      /* the query stays in the receive buffer until the batch has been sent, see udpClientSendRequestToBackend() for the flags and addresses */
+      const bool setSource = ss->sourceItf != 0 && !ss->isDoH();
+      queriesBatch->queue(fd, ss->isDoH() ? MSG_DONTWAIT : 0, query, dq.len, setSource ? &ss->remote : nullptr, setSource ? &ss->sourceAddr : nullptr, ss->sourceItf, ss);
+    }
+    else
+#endif /* defined(HAVE_RECVMMSG) && defined(HAVE_SENDMMSG) && defined(MSG_WAITFORONE) */
+    {
+      ssize_t ret = udpClientSendRequestToBackend(ss, fd, query, dq.len);
 
-    if(ret < 0) {
-      ++ss->sendErrors;
-      ++g_stats.downstreamSendErrors;
+      if(ret < 0) {
+        ++ss->sendErrors;
+        ++g_stats.downstreamSendErrors;
+      }
     }
 
     vinfolog("Got query for %s|%s from %s, relayed to %s", ids->qname.toLogString(), QType(ids->qtype).getName(), remote.toStringWithPort(), ss->getName());
@@ -1433,6 +1818,7 @@ static void MultipleMessagesUDPClientThread(ClientState* cs, LocalHolders& holde
   auto recvData = std::unique_ptr<MMReceiver[]>(new MMReceiver[vectSize]);
   auto msgVec = std::unique_ptr<struct mmsghdr[]>(new struct mmsghdr[vectSize]);
   auto outMsgVec = std::unique_ptr<struct mmsghdr[]>(new struct mmsghdr[vectSize]);
+  UDPOutgoingBatch queriesBatch(vectSize);
 
   /* initialize the structures needed to receive our messages */
   for (size_t idx = 0; idx < vectSize; idx++) {
@@ -1472,8 +1858,19 @@ static void MultipleMessagesUDPClientThread(ClientState* cs, LocalHolders& holde
         continue;
       }
 
-      processUDPQuery(*cs, holders, msgh, remote, recvData[msgIdx].dest, recvData[msgIdx].packet, static_cast<uint16_t>(got), sizeof(recvData[msgIdx].packet), outMsgVec.get(), &msgsToSend, &recvData[msgIdx].iov, &recvData[msgIdx].cbuf);
+      processUDPQuery(*cs, holders, msgh, remote, recvData[msgIdx].dest, recvData[msgIdx].packet, static_cast<uint16_t>(got), sizeof(recvData[msgIdx].packet), outMsgVec.get(), &msgsToSend, &recvData[msgIdx].iov, &recvData[msgIdx].cbuf, &queriesBatch);
+
+    }
 
+    /* queries to backends are sent in batch, one sendmmsg() call per backend socket */
+    if (queriesBatch.size() > 0) {
+      queriesBatch.flush([](const UDPOutgoingBatch::Entry& entry) {
+        ssize_t ret = udpClientSendRequestToBackend(entry.d_ds, entry.d_fd, entry.d_data, entry.d_len);
+        if (ret < 0) {
+          ++entry.d_ds->sendErrors;
+          ++g_stats.downstreamSendErrors;
+        }
+      });
     }
 
     /* immediate (not delayed or sent to a backend) responses (mostly from a rule, dynamic block
@@ -1481,6 +1878,10 @@ static void MultipleMessagesUDPClientThread(ClientState* cs, LocalHolders& holde
 
     if (msgsToSend > 0 && msgsToSend <= static_cast<unsigned int>(msgsGot)) {
       int sent = sendmmsg(cs->udpFD, outMsgVec.get(), msgsToSend, 0);
+      if (sent > 0) {
+        ++g_stats.udpOutBatches;
+        g_stats.udpOutBatchedDatagrams += sent;
+      }
 
       if (sent < 0 || static_cast<unsigned int>(sent) != msgsToSend) {
         vinfolog("Error sending responses with sendmmsg() (%d on %u): %s", sent, msgsToSend, stringerror());
@@ -1531,7 +1932,7 @@ try
         continue;
       }
 
-      processUDPQuery(*cs, holders, &msgh, remote, dest, packet, static_cast<uint16_t>(got), sizeof(packet), nullptr, nullptr, nullptr, nullptr);
+      processUDPQuery(*cs, holders, &msgh, remote, dest, packet, static_cast<uint16_t>(got), sizeof(packet), nullptr, nullptr, nullptr, nullptr, nullptr);
     }
   }
 }
@@ -1571,6 +1972,9 @@ static void maintThread()
   for(;;) {
     sleep(interval);
 
+    /* entries kept aside by idle threads would otherwise only reach the rings on their next insertion */
+    g_rings.flushPendingEntries();
+
     {
       std::lock_guard<std::mutex> lock(g_luamutex);
       auto f = g_lua.readVariable<boost::optional<std::function<void()> > >("maintenance");
@@ -1589,6 +1993,9 @@ static void maintThread()
       }
     }
 
+    /* copy the entries inserted into the rings during the last second to the history, if any */
+    g_rings.spillToHistory();
+
     counter++;
     if (counter >= g_cacheCleaningDelay) {
       /* keep track, for each cache, of whether we should keep
@@ -2364,6 +2771,14 @@ try
 
   checkFileDescriptorsLimits(udpBindsCount, tcpBindsCount);
 
+  if (!g_dohlocals.empty()) {
+    for (const auto& dss : *g_dstates.getLocal()) {
+      if (dss->isTCPOnly()) {
+        warnlog("Queries received over DoH and routed to the DNS over TLS backend %s will get a ServFail answer, since DoH queries can't be forwarded over TCP", dss->getNameWithAddr());
+      }
+    }
+  }
+
   auto mplexer = std::shared_ptr<FDMultiplexer>(FDMultiplexer::getMultiplexerSilent());
   for(auto& dss : g_dstates.getCopy()) { // it is a copy, but the internal shared_ptrs are the real deal
     if (dss->availability == DownstreamState::Availability::Auto) {
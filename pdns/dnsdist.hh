@@ -23,6 +23,7 @@
 #include "config.h"
 #include "ext/luawrapper/include/LuaContext.hpp"
 
+#include <array>
 #include <atomic>
 #include <mutex>
 #include <string>
@@ -125,6 +126,61 @@ struct DNSResponse : DNSQuestion
   DNSResponse(DNSResponse&&) = default;
 };
 
+/* Histogram of the time spent evaluating a selector or running an action. Only the queries sampled
+   according to setRuleTimingSampleRate() are accounted for, to keep the overhead low. */
+class TimingHistogram
+{
+public:
+  /* bucket n holds the durations between 10^(n+1) and 10^(n+2) nanoseconds,
+     the first one everything below 100 ns and the last one everything above 1 ms */
+  static const size_t s_bucketsCount{6};
+
+  static uint64_t getBucketUpperBound(size_t bucket)
+  {
+    uint64_t bound = 100;
+    for (size_t idx = 0; idx < bucket; idx++) {
+      bound *= 10;
+    }
+    return bound;
+  }
+
+  void add(uint64_t nsec)
+  {
+    size_t bucket = 0;
+    uint64_t bound = 100;
+    while (bucket < (s_bucketsCount - 1) && nsec > bound) {
+      bucket++;
+      bound *= 10;
+    }
+    d_buckets.at(bucket)++;
+    d_sum += nsec;
+    d_count++;
+  }
+
+  uint64_t getBucket(size_t bucket) const
+  {
+    return d_buckets.at(bucket).load();
+  }
+
+  /* in nanoseconds */
+  uint64_t getSum() const
+  {
+    return d_sum.load();
+  }
+
+  uint64_t getCount() const
+  {
+    return d_count.load();
+  }
+
+private:
+  std::array<std::atomic<uint64_t>, s_bucketsCount> d_buckets{};
+  std::atomic<uint64_t> d_sum{0};
+  std::atomic<uint64_t> d_count{0};
+};
+
+extern std::atomic<uint32_t> g_ruleTimingSampleRate;
+
 /* so what could you do:
    drop,
    fake up nxdomain,
@@ -182,6 +238,7 @@ public:
   {
     return {{}};
   }
+  mutable TimingHistogram d_timings;
 };
 
 class DNSResponseAction
@@ -193,6 +250,7 @@ public:
   {
   }
   virtual string toString() const = 0;
+  mutable TimingHistogram d_timings;
 };
 
 struct DynBlock
@@ -265,6 +323,8 @@ struct DNSDistStats
   stat_t securityStatus{0};
   stat_t dohQueryPipeFull{0};
   stat_t dohResponsePipeFull{0};
+  stat_t udpOutBatches{0};
+  stat_t udpOutBatchedDatagrams{0};
 
   double latencyAvg100{0}, latencyAvg1000{0}, latencyAvg10000{0}, latencyAvg1000000{0};
   typedef std::function<uint64_t(const std::string&)> statfunction_t;
@@ -319,6 +379,8 @@ struct DNSDistStats
     {"security-status", &securityStatus},
     {"doh-query-pipe-full", &dohQueryPipeFull},
     {"doh-response-pipe-full", &dohResponsePipeFull},
+    {"udp-out-batches", &udpOutBatches},
+    {"udp-out-batched-datagrams", &udpOutBatchedDatagrams},
     // Latency histogram
     {"latency-sum", &latencySum},
     {"latency-count", getLatencyCount},
@@ -622,6 +684,9 @@ struct ClientState
   std::atomic<double> tcpAvgQueriesPerConnection{0.0};
   /* in ms */
   std::atomic<double> tcpAvgConnectionDuration{0.0};
+  /* maximum number of queries read from a single TCP connection that can be
+     processed at the same time, 0 meaning one at a time, in order */
+  size_t maxInFlightQueriesPerConn{0};
   int udpFD{-1};
   int tcpFD{-1};
   int tcpListenQueueSize{SOMAXCONN};
@@ -775,6 +840,13 @@ struct DownstreamState
   std::mutex socketsLock;
   std::mutex connectLock;
   std::unique_ptr<FDMultiplexer> mplexer{nullptr};
+  /* set when TCP connections to this backend use DNS over TLS */
+  std::shared_ptr<TLSCtx> d_tlsCtx{nullptr};
+  /* the name the certificate presented by this backend has to be valid for, sent as SNI as well */
+  std::string d_tlsSubjectName;
+  /* set when this backend is reached over DNS over HTTPS, the queries being passed to the DoH client
+     worker thread over local sockets */
+  std::string d_dohPath;
   std::thread tid;
   const ComboAddress remote;
   QPSLimiter qps;
@@ -801,13 +873,26 @@ struct DownstreamState
   std::atomic<uint64_t> tcpReadTimeouts{0};
   std::atomic<uint64_t> tcpWriteTimeouts{0};
   std::atomic<uint64_t> tcpCurrentConnections{0};
+  std::atomic<uint64_t> tlsResumptions{0};
+  std::atomic<uint64_t> dohConnectErrors{0};   // a DoH connection could not be established
+  std::atomic<uint64_t> dohHTTPErrors{0};      // a DoH response had a status other than 200
+  std::atomic<uint64_t> dohProtocolErrors{0};  // HTTP/2 error on an established connection, or stream reset
+  std::atomic<uint64_t> dohTimeouts{0};
+  std::atomic<uint64_t> dohCurrentConnections{0};
   std::atomic<double> tcpAvgQueriesPerConnection{0.0};
   /* in ms */
   std::atomic<double> tcpAvgConnectionDuration{0.0};
   size_t socketsOffset{0};
+  /* maximum number of queries sent over a single TCP connection at the same time,
+     0 meaning one at a time */
+  size_t maxInFlightQueriesPerConn{0};
+  /* maximum number of HTTP/2 connections opened to a DoH backend */
+  size_t dohMaxConnections{2};
   double queryLoad{0.0};
   double dropRate{0.0};
   double latencyUsec{0.0};
+  /* time between a query being sent over HTTP/2 and the full response being received, in usec */
+  double dohLatencyUsec{0.0};
   int order{1};
   int weight{1};
   int tcpConnectTimeout{5};
@@ -846,6 +931,15 @@ struct DownstreamState
       return true;
     return upStatus;
   }
+  /* backends reached over DNS over TLS can't get UDP queries */
+  bool isTCPOnly() const
+  {
+    return d_tlsCtx != nullptr && !isDoH();
+  }
+  bool isDoH() const
+  {
+    return !d_dohPath.empty();
+  }
   void setUp() { availability = Availability::Up; }
   void setDown() { availability = Availability::Down; }
   void setAuto() { availability = Availability::Auto; }
@@ -908,6 +1002,7 @@ public:
   virtual bool matches(const DNSQuestion* dq) const =0;
   virtual string toString() const = 0;
   mutable std::atomic<uint64_t> d_matches{0};
+  mutable TimingHistogram d_timings;
 };
 
 struct ServerPool
@@ -1039,6 +1134,48 @@ struct DNSDistResponseRuleAction
   uint64_t d_creationOrder;
 };
 
+/* Index of a chain of rules set via addAction() or setRules(). The rules whose outcome only depends on the qname
+   or the qtype (QNameRule, QNameSetRule, SuffixMatchNodeRule, QTypeRule) are grouped into a few hash lookups,
+   while the other ones are still evaluated, in order, via matches(). The candidates are returned in the order
+   of the chain, so that first-match semantics are preserved. */
+class RuleChainIndex
+{
+public:
+  struct Candidate
+  {
+    size_t d_position;
+    /* we already know that this rule matches, no need to call matches() */
+    bool d_matches;
+  };
+
+  /* rebuilds the index if the chain has changed since the last call */
+  void update(const std::vector<DNSDistRuleAction>& rules);
+  /* whether the index is worth using for the current chain, otherwise the rules should be evaluated in order */
+  bool isEnabled() const
+  {
+    return d_enabled;
+  }
+  const std::vector<Candidate>& getCandidates(const DNSQuestion& dq);
+  /* whether the rule at this position is part of the index */
+  bool isIndexed(size_t position) const;
+
+  /* below that many indexable rules, evaluating the chain in order is as fast as doing the lookups */
+  static const size_t s_minIndexedRules{4};
+
+private:
+  std::unordered_map<DNSName, std::vector<size_t>> d_exact;
+  std::unordered_map<DNSName, std::vector<size_t>> d_suffixes;
+  std::unordered_map<uint16_t, std::vector<size_t>> d_qtypes;
+  std::vector<size_t> d_generic;
+  std::vector<bool> d_indexed;
+  std::vector<size_t> d_matched;
+  std::vector<Candidate> d_candidates;
+  /* the LocalStateHolder keeps the previous chain alive until it picks up the new one,
+     so a new chain can't be allocated at the same address */
+  const void* d_source{nullptr};
+  bool d_enabled{false};
+};
+
 extern GlobalStateHolder<SuffixMatchTree<DynBlock>> g_dynblockSMT;
 extern DNSAction::Action g_dynBlockAction;
 
@@ -1101,6 +1238,7 @@ struct LocalHolders
   LocalStateHolder<NetmaskTree<DynBlock> > dynNMGBlock;
   LocalStateHolder<SuffixMatchTree<DynBlock> > dynSMTBlock;
   LocalStateHolder<pools_t> pools;
+  RuleChainIndex rulactionsIndex;
 };
 
 struct dnsheader;
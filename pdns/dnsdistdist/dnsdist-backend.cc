@@ -25,6 +25,11 @@
 
 bool DownstreamState::reconnect()
 {
+  if (isDoH()) {
+    /* our sockets are connected to the DoH client thread, see setupDoHClientBackend() */
+    return connected;
+  }
+
   std::unique_lock<std::mutex> tl(connectLock, std::try_to_lock);
   if (!tl.owns_lock()) {
     /* we are already reconnecting */
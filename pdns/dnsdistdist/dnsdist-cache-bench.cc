@@ -0,0 +1 @@
+../dnsdist-cache-bench.cc
\ No newline at end of file
@@ -0,0 +1 @@
+../dnsdist-cache-lockfree.hh
\ No newline at end of file
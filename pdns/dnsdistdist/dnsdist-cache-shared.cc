@@ -0,0 +1 @@
+../dnsdist-cache-shared.cc
\ No newline at end of file
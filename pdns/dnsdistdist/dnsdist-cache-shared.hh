@@ -0,0 +1 @@
+../dnsdist-cache-shared.hh
\ No newline at end of file
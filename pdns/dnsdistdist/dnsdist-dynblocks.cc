@@ -2,8 +2,140 @@
 #include "dnsdist.hh"
 #include "dnsdist-dynblocks.hh"
 
+void DynBlockRulesGroup::Counts::add(const Counts& rhs)
+{
+  queries += rhs.queries;
+  responses += rhs.responses;
+  respBytes += rhs.respBytes;
+  for (const auto& rcode : rhs.d_rcodeCounts) {
+    d_rcodeCounts[rcode.first] += rcode.second;
+  }
+  for (const auto& qtype : rhs.d_qtypeCounts) {
+    d_qtypeCounts[qtype.first] += qtype.second;
+  }
+}
+
+void DynBlockRulesGroup::Counts::remove(const Counts& rhs)
+{
+  queries -= rhs.queries;
+  responses -= rhs.responses;
+  respBytes -= rhs.respBytes;
+  for (const auto& rcode : rhs.d_rcodeCounts) {
+    auto it = d_rcodeCounts.find(rcode.first);
+    if (it != d_rcodeCounts.end()) {
+      it->second -= rcode.second;
+      if (it->second == 0) {
+        d_rcodeCounts.erase(it);
+      }
+    }
+  }
+  for (const auto& qtype : rhs.d_qtypeCounts) {
+    auto it = d_qtypeCounts.find(qtype.first);
+    if (it != d_qtypeCounts.end()) {
+      it->second -= qtype.second;
+      if (it->second == 0) {
+        d_qtypeCounts.erase(it);
+      }
+    }
+  }
+}
+
+/* returns true if the requestor exceeded the rate or ratio of at least one rule, whether it resulted in a block or in a warning */
+template<typename T>
+bool DynBlockRulesGroup::checkRequestor(const ComboAddress& requestor, const T& getCounts, boost::optional<NetmaskTree<DynBlock> >& blocks, const struct timespec& now, bool& updated)
+{
+  bool exceeded = false;
+
+  const auto& queryCounters = getCounts(d_queryRateRule);
+  if (d_queryRateRule.warningRateExceeded(queryCounters.queries, now)) {
+    handleWarning(blocks, now, requestor, d_queryRateRule, updated);
+    exceeded = true;
+  }
+
+  if (d_queryRateRule.rateExceeded(queryCounters.queries, now)) {
+    addBlock(blocks, now, requestor, d_queryRateRule, updated);
+    return true;
+  }
+
+  const auto& respCounters = getCounts(d_respRateRule);
+  if (d_respRateRule.warningRateExceeded(respCounters.respBytes, now)) {
+    handleWarning(blocks, now, requestor, d_respRateRule, updated);
+    exceeded = true;
+  }
+
+  if (d_respRateRule.rateExceeded(respCounters.respBytes, now)) {
+    addBlock(blocks, now, requestor, d_respRateRule, updated);
+    return true;
+  }
+
+  for (const auto& pair : d_qtypeRules) {
+    const auto qtype = pair.first;
+    const auto& counters = getCounts(pair.second);
+
+    const auto& typeIt = counters.d_qtypeCounts.find(qtype);
+    if (typeIt != counters.d_qtypeCounts.cend()) {
+
+      if (pair.second.warningRateExceeded(typeIt->second, now)) {
+        handleWarning(blocks, now, requestor, pair.second, updated);
+        exceeded = true;
+      }
+
+      if (pair.second.rateExceeded(typeIt->second, now)) {
+        addBlock(blocks, now, requestor, pair.second, updated);
+        exceeded = true;
+        break;
+      }
+    }
+  }
+
+  for (const auto& pair : d_rcodeRules) {
+    const auto rcode = pair.first;
+    const auto& counters = getCounts(pair.second);
+
+    const auto& rcodeIt = counters.d_rcodeCounts.find(rcode);
+    if (rcodeIt != counters.d_rcodeCounts.cend()) {
+      if (pair.second.warningRateExceeded(rcodeIt->second, now)) {
+        handleWarning(blocks, now, requestor, pair.second, updated);
+        exceeded = true;
+      }
+
+      if (pair.second.rateExceeded(rcodeIt->second, now)) {
+        addBlock(blocks, now, requestor, pair.second, updated);
+        exceeded = true;
+        break;
+      }
+    }
+  }
+
+  for (const auto& pair : d_rcodeRatioRules) {
+    const auto rcode = pair.first;
+    const auto& counters = getCounts(pair.second);
+
+    const auto& rcodeIt = counters.d_rcodeCounts.find(rcode);
+    if (rcodeIt != counters.d_rcodeCounts.cend()) {
+      if (pair.second.warningRatioExceeded(counters.responses, rcodeIt->second)) {
+        handleWarning(blocks, now, requestor, pair.second, updated);
+        exceeded = true;
+      }
+
+      if (pair.second.ratioExceeded(counters.responses, rcodeIt->second)) {
+        addBlock(blocks, now, requestor, pair.second, updated);
+        exceeded = true;
+        break;
+      }
+    }
+  }
+
+  return exceeded;
+}
+
 void DynBlockRulesGroup::apply(const struct timespec& now)
 {
+  if (d_incremental && canBeIncremental()) {
+    applyIncremental(now);
+    return;
+  }
+
   counts_t counts;
   StatNode statNodeRoot;
 
@@ -27,74 +159,245 @@ void DynBlockRulesGroup::apply(const struct timespec& now)
   bool updated = false;
 
   for (const auto& entry : counts) {
-    const auto& requestor = entry.first;
     const auto& counters = entry.second;
+    checkRequestor(entry.first, [&counters](const DynBlockRule&) -> const Counts& { return counters; }, blocks, now, updated);
+  }
 
-    if (d_queryRateRule.warningRateExceeded(counters.queries, now)) {
-      handleWarning(blocks, now, requestor, d_queryRateRule, updated);
+  if (updated && blocks) {
+    g_dynblockNMG.setState(std::move(*blocks));
+  }
+
+  processSuffixMatchRule(statNodeRoot, now);
+}
+
+bool DynBlockRulesGroup::canBeIncremental() const
+{
+  if (!hasRules()) {
+    return false;
+  }
+
+  /* a rule without a number of seconds covers the whole content of the rings, which can't be tracked incrementally */
+  auto hasWindow = [](const DynBlockRule& rule) {
+    return !rule.isEnabled() || rule.d_seconds > 0;
+  };
+
+  if (!hasWindow(d_queryRateRule) || !hasWindow(d_respRateRule)) {
+    return false;
+  }
+  for (const auto& rule : d_qtypeRules) {
+    if (!hasWindow(rule.second)) {
+      return false;
+    }
+  }
+  for (const auto& rule : d_rcodeRules) {
+    if (!hasWindow(rule.second)) {
+      return false;
+    }
+  }
+  for (const auto& rule : d_rcodeRatioRules) {
+    if (!hasWindow(rule.second)) {
+      return false;
     }
+  }
 
-    if (d_queryRateRule.rateExceeded(counters.queries, now)) {
-      addBlock(blocks, now, requestor, d_queryRateRule, updated);
-      continue;
+  return true;
+}
+
+template<typename T>
+void DynBlockRulesGroup::accountIncremental(const ComboAddress& requestor, time_t second, const T& update, requestors_t& touched)
+{
+  auto& state = d_incrementalState;
+  update(state.d_buckets[second][requestor]);
+
+  for (auto& window : state.d_windows) {
+    if (second >= window.second.d_start) {
+      update(window.second.d_totals[requestor]);
     }
+  }
+
+  touched.insert(requestor);
+}
 
-    if (d_respRateRule.warningRateExceeded(counters.respBytes, now)) {
-      handleWarning(blocks, now, requestor, d_respRateRule, updated);
+void DynBlockRulesGroup::expireIncrementalCounters(const struct timespec& now)
+{
+  auto& state = d_incrementalState;
+
+  for (auto& pair : state.d_windows) {
+    auto& window = pair.second;
+    const time_t newStart = now.tv_sec - pair.first + 1;
+
+    /* remove the buckets that are moving out of this window from its totals */
+    for (auto bucket = state.d_buckets.lower_bound(window.d_start); bucket != state.d_buckets.end() && bucket->first < newStart; ++bucket) {
+      for (const auto& entry : bucket->second) {
+        auto total = window.d_totals.find(entry.first);
+        if (total == window.d_totals.end()) {
+          continue;
+        }
+        total->second.remove(entry.second);
+        if (total->second.empty()) {
+          window.d_totals.erase(total);
+        }
+      }
     }
 
-    if (d_respRateRule.rateExceeded(counters.respBytes, now)) {
-      addBlock(blocks, now, requestor, d_respRateRule, updated);
-      continue;
+    if (newStart > window.d_start) {
+      window.d_start = newStart;
     }
+  }
+
+  /* and discard the buckets that are not covered by any window anymore */
+  const time_t oldest = now.tv_sec - state.d_windows.rbegin()->first + 1;
+  state.d_buckets.erase(state.d_buckets.begin(), state.d_buckets.lower_bound(oldest));
+}
+
+void DynBlockRulesGroup::applyIncremental(const struct timespec& now)
+{
+  auto& state = d_incrementalState;
 
-    for (const auto& pair : d_qtypeRules) {
-      const auto qtype = pair.first;
+  std::set<unsigned int> windows;
+  auto addWindow = [&windows](const DynBlockRule& rule) {
+    if (rule.isEnabled()) {
+      windows.insert(rule.d_seconds);
+    }
+  };
+  addWindow(d_queryRateRule);
+  addWindow(d_respRateRule);
+  for (const auto& rule : d_qtypeRules) {
+    addWindow(rule.second);
+  }
+  for (const auto& rule : d_rcodeRules) {
+    addWindow(rule.second);
+  }
+  for (const auto& rule : d_rcodeRatioRules) {
+    addWindow(rule.second);
+  }
 
-      const auto& typeIt = counters.d_qtypeCounts.find(qtype);
-      if (typeIt != counters.d_qtypeCounts.cend()) {
+  bool sameWindows = windows.size() == state.d_windows.size() && std::equal(windows.cbegin(), windows.cend(), state.d_windows.cbegin(), [](unsigned int seconds, const std::pair<const unsigned int, Window>& window) { return seconds == window.first; });
 
-        if (pair.second.warningRateExceeded(typeIt->second, now)) {
-          handleWarning(blocks, now, requestor, pair.second, updated);
+  if (!sameWindows || state.d_ringsGeneration != g_rings.getGeneration()) {
+    /* the rules or the content of the rings have changed, start over from what the rings currently hold */
+    state = IncrementalState();
+    state.d_ringsGeneration = g_rings.getGeneration();
+    for (const auto seconds : windows) {
+      state.d_windows[seconds].d_start = now.tv_sec - seconds + 1;
+    }
+  }
+  else {
+    expireIncrementalCounters(now);
+  }
+
+  const time_t oldest = now.tv_sec - *windows.rbegin() + 1;
+  requestors_t touched;
+
+  if (hasQueryRules()) {
+    state.d_queryCursors.resize(g_rings.d_shards.size(), 0);
+    size_t shardIdx = 0;
+    for (const auto& shard : g_rings.d_shards) {
+      auto& cursor = state.d_queryCursors.at(shardIdx++);
+      std::lock_guard<std::mutex> rl(shard->queryLock);
+      const auto& ring = shard->queryRing;
+      /* entries that have been inserted and then overwritten since the previous run are lost */
+      const size_t newEntries = std::min(static_cast<uint64_t>(ring.size()), shard->queryInserts - cursor);
+      cursor = shard->queryInserts;
+
+      for (auto it = ring.end() - newEntries; it != ring.end(); ++it) {
+        const auto& c = *it;
+        const time_t second = std::min(c.when.tv_sec, now.tv_sec);
+        if (second < oldest) {
+          continue;
         }
 
-        if (pair.second.rateExceeded(typeIt->second, now)) {
-          addBlock(blocks, now, requestor, pair.second, updated);
-          break;
+        const bool qRateMatches = d_queryRateRule.isEnabled();
+        const bool typeRuleMatches = d_qtypeRules.count(c.qtype) > 0;
+        if (!qRateMatches && !typeRuleMatches) {
+          continue;
         }
+
+        accountIncremental(c.requestor, second, [&c, qRateMatches, typeRuleMatches](Counts& counts) {
+          if (qRateMatches) {
+            ++counts.queries;
+          }
+          if (typeRuleMatches) {
+            ++counts.d_qtypeCounts[c.qtype];
+          }
+        }, touched);
       }
     }
+  }
 
-    for (const auto& pair : d_rcodeRules) {
-      const auto rcode = pair.first;
-
-      const auto& rcodeIt = counters.d_rcodeCounts.find(rcode);
-      if (rcodeIt != counters.d_rcodeCounts.cend()) {
-        if (pair.second.warningRateExceeded(rcodeIt->second, now)) {
-          handleWarning(blocks, now, requestor, pair.second, updated);
+  if (hasResponseRules()) {
+    state.d_responseCursors.resize(g_rings.d_shards.size(), 0);
+    size_t shardIdx = 0;
+    for (const auto& shard : g_rings.d_shards) {
+      auto& cursor = state.d_responseCursors.at(shardIdx++);
+      std::lock_guard<std::mutex> rl(shard->respLock);
+      const auto& ring = shard->respRing;
+      const size_t newEntries = std::min(static_cast<uint64_t>(ring.size()), shard->respInserts - cursor);
+      cursor = shard->respInserts;
+
+      for (auto it = ring.end() - newEntries; it != ring.end(); ++it) {
+        const auto& c = *it;
+        const time_t second = std::min(c.when.tv_sec, now.tv_sec);
+        if (second < oldest) {
+          continue;
         }
 
-        if (pair.second.rateExceeded(rcodeIt->second, now)) {
-          addBlock(blocks, now, requestor, pair.second, updated);
-          break;
+        const bool countResponses = !d_rcodeRatioRules.empty();
+        const bool respRateMatches = d_respRateRule.isEnabled();
+        const bool rcodeRuleMatches = d_rcodeRules.count(c.dh.rcode) > 0 || d_rcodeRatioRules.count(c.dh.rcode) > 0;
+        if (!countResponses && !respRateMatches && !rcodeRuleMatches) {
+          continue;
         }
+
+        accountIncremental(c.requestor, second, [&c, countResponses, respRateMatches, rcodeRuleMatches](Counts& counts) {
+          if (countResponses) {
+            ++counts.responses;
+          }
+          if (respRateMatches) {
+            counts.respBytes += c.size;
+          }
+          if (rcodeRuleMatches) {
+            ++counts.d_rcodeCounts[c.dh.rcode];
+          }
+        }, touched);
       }
     }
+  }
 
-    for (const auto& pair : d_rcodeRatioRules) {
-      const auto rcode = pair.first;
+  /* the counters of a requestor that did not send any query since the previous run can only decrease, so it can't start
+     exceeding a rate. Its ratios might increase, though, as older responses move out of the window */
+  if (!d_rcodeRatioRules.empty()) {
+    for (const auto& window : state.d_windows) {
+      for (const auto& entry : window.second.d_totals) {
+        touched.insert(entry.first);
+      }
+    }
+  }
+  /* the ones that are still exceeding a rate need to have their block refreshed */
+  for (const auto& offender : state.d_offenders) {
+    touched.insert(offender);
+  }
+  state.d_offenders.clear();
 
-      const auto& rcodeIt = counters.d_rcodeCounts.find(rcode);
-      if (rcodeIt != counters.d_rcodeCounts.cend()) {
-        if (pair.second.warningRatioExceeded(counters.queries, rcodeIt->second)) {
-          handleWarning(blocks, now, requestor, pair.second, updated);
-        }
+  boost::optional<NetmaskTree<DynBlock> > blocks;
+  bool updated = false;
+  const Counts emptyCounts;
 
-        if (pair.second.ratioExceeded(counters.queries, rcodeIt->second)) {
-          addBlock(blocks, now, requestor, pair.second, updated);
-          break;
-        }
+  for (const auto& requestor : touched) {
+    auto getCounts = [&state, &requestor, &emptyCounts](const DynBlockRule& rule) -> const Counts& {
+      const auto window = state.d_windows.find(rule.d_seconds);
+      if (window == state.d_windows.cend()) {
+        return emptyCounts;
+      }
+      const auto counts = window->second.d_totals.find(requestor);
+      if (counts == window->second.d_totals.cend()) {
+        return emptyCounts;
       }
+      return counts->second;
+    };
+
+    if (checkRequestor(requestor, getCounts, blocks, now, updated)) {
+      state.d_offenders.insert(requestor);
     }
   }
 
@@ -102,35 +405,46 @@ void DynBlockRulesGroup::apply(const struct timespec& now)
     g_dynblockNMG.setState(std::move(*blocks));
   }
 
-  if (!statNodeRoot.empty()) {
-    StatNode::Stat node;
-    std::unordered_set<DNSName> namesToBlock;
-    statNodeRoot.visit([this,&namesToBlock](const StatNode* node_, const StatNode::Stat& self, const StatNode::Stat& children) {
-                         bool block = false;
-
-                         if (d_smtVisitorFFI) {
-                           dnsdist_ffi_stat_node_t tmp(*node_, self, children);
-                           block = d_smtVisitorFFI(&tmp);
-                         }
-                         else {
-                           block = d_smtVisitor(*node_, self, children);
-                         }
-
-                         if (block) {
-                           namesToBlock.insert(DNSName(node_->fullname));
-                         }
-                       },
-      node);
-
-    if (!namesToBlock.empty()) {
-      updated = false;
-      SuffixMatchTree<DynBlock> smtBlocks = g_dynblockSMT.getCopy();
-      for (const auto& name : namesToBlock) {
-        addOrRefreshBlockSMT(smtBlocks, now, name, d_suffixMatchRule, updated);
-      }
-      if (updated) {
-        g_dynblockSMT.setState(std::move(smtBlocks));
-      }
+  if (hasSuffixMatchRules()) {
+    StatNode statNodeRoot;
+    buildSuffixMatchTree(statNodeRoot, now);
+    processSuffixMatchRule(statNodeRoot, now);
+  }
+}
+
+void DynBlockRulesGroup::processSuffixMatchRule(const StatNode& root, const struct timespec& now)
+{
+  if (root.empty()) {
+    return;
+  }
+
+  StatNode::Stat node;
+  std::unordered_set<DNSName> namesToBlock;
+  root.visit([this,&namesToBlock](const StatNode* node_, const StatNode::Stat& self, const StatNode::Stat& children) {
+               bool block = false;
+
+               if (d_smtVisitorFFI) {
+                 dnsdist_ffi_stat_node_t tmp(*node_, self, children);
+                 block = d_smtVisitorFFI(&tmp);
+               }
+               else {
+                 block = d_smtVisitor(*node_, self, children);
+               }
+
+               if (block) {
+                 namesToBlock.insert(DNSName(node_->fullname));
+               }
+             },
+    node);
+
+  if (!namesToBlock.empty()) {
+    bool updated = false;
+    SuffixMatchTree<DynBlock> smtBlocks = g_dynblockSMT.getCopy();
+    for (const auto& name : namesToBlock) {
+      addOrRefreshBlockSMT(smtBlocks, now, name, d_suffixMatchRule, updated);
+    }
+    if (updated) {
+      g_dynblockSMT.setState(std::move(smtBlocks));
     }
   }
 }
@@ -305,9 +619,24 @@ void DynBlockRulesGroup::processResponseRules(counts_t& counts, StatNode& root,
     rule.second.d_cutOff.tv_sec -= rule.second.d_seconds;
   }
 
+  /* the total number of responses the ratios are computed against only covers the window of the ratio rules,
+     the largest one if they don't all have the same */
+  bool countResponses = false;
+  bool countAllResponses = false;
+  struct timespec responsesCutOff = now;
   for (auto& rule : d_rcodeRatioRules) {
     rule.second.d_cutOff = rule.second.d_minTime = now;
     rule.second.d_cutOff.tv_sec -= rule.second.d_seconds;
+    if (!rule.second.isEnabled()) {
+      continue;
+    }
+    countResponses = true;
+    if (rule.second.d_seconds == 0) {
+      countAllResponses = true;
+    }
+    else if (rule.second.d_cutOff < responsesCutOff) {
+      responsesCutOff = rule.second.d_cutOff;
+    }
   }
 
   for (const auto& shard : g_rings.d_shards) {
@@ -317,13 +646,16 @@ void DynBlockRulesGroup::processResponseRules(counts_t& counts, StatNode& root,
         continue;
       }
 
-      auto& entry = counts[c.requestor];
-      ++entry.queries;
+      bool responseCounted = countResponses && (countAllResponses || !(c.when < responsesCutOff));
       bool respRateMatches = d_respRateRule.matches(c.when);
       bool suffixMatchRuleMatches = d_suffixMatchRule.matches(c.when);
       bool rcodeRuleMatches = checkIfResponseCodeMatches(c);
 
-      if (respRateMatches || rcodeRuleMatches) {
+      if (responseCounted || respRateMatches || rcodeRuleMatches) {
+        auto& entry = counts[c.requestor];
+        if (responseCounted) {
+          ++entry.responses;
+        }
         if (respRateMatches) {
           entry.respBytes += c.size;
         }
@@ -338,3 +670,22 @@ void DynBlockRulesGroup::processResponseRules(counts_t& counts, StatNode& root,
     }
   }
 }
+
+void DynBlockRulesGroup::buildSuffixMatchTree(StatNode& root, const struct timespec& now)
+{
+  d_suffixMatchRule.d_cutOff = d_suffixMatchRule.d_minTime = now;
+  d_suffixMatchRule.d_cutOff.tv_sec -= d_suffixMatchRule.d_seconds;
+
+  for (const auto& shard : g_rings.d_shards) {
+    std::lock_guard<std::mutex> rl(shard->respLock);
+    for(const auto& c : shard->respRing) {
+      if (now < c.when) {
+        continue;
+      }
+
+      if (d_suffixMatchRule.matches(c.when)) {
+        root.submit(c.name, ((c.dh.rcode == 0 && c.usec == std::numeric_limits<unsigned int>::max()) ? -1 : c.dh.rcode), c.size, boost::none);
+      }
+    }
+  }
+}
@@ -21,6 +21,7 @@
  */
 
 #include "dnsdist-healthchecks.hh"
+#include "dnsdist-nghttp2.hh"
 #include "dnswriter.hh"
 #include "dolog.hh"
 
@@ -77,69 +78,78 @@ void updateHealthCheckResult(const std::shared_ptr<DownstreamState>& dss, bool n
   }
 }
 
-static bool handleResponse(std::shared_ptr<HealthCheckData>& data)
+/* might throw if the response can't be parsed */
+static bool isHealthCheckResponseValid(const std::shared_ptr<HealthCheckData>& data, const char* reply, size_t replySize)
 {
   auto& ds = data->d_ds;
-  try {
-    string reply;
-    ComboAddress from;
-    data->d_sock.recvFrom(reply, from);
+  const dnsheader * responseHeader = reinterpret_cast<const dnsheader *>(reply);
 
-    /* we are using a connected socket but hey.. */
-    if (from != ds->remote) {
-      if (g_verboseHealthChecks) {
-        infolog("Invalid health check response received from %s, expecting one from %s", from.toStringWithPort(), ds->remote.toStringWithPort());
-      }
-      return false;
+  if (replySize < sizeof(*responseHeader)) {
+    if (g_verboseHealthChecks) {
+      infolog("Invalid health check response of size %d from backend %s, expecting at least %d", replySize, ds->getNameWithAddr(), sizeof(*responseHeader));
     }
+    return false;
+  }
 
-    const dnsheader * responseHeader = reinterpret_cast<const dnsheader *>(reply.c_str());
-
-    if (reply.size() < sizeof(*responseHeader)) {
-      if (g_verboseHealthChecks) {
-        infolog("Invalid health check response of size %d from backend %s, expecting at least %d", reply.size(), ds->getNameWithAddr(), sizeof(*responseHeader));
-      }
-      return false;
+  if (responseHeader->id != data->d_queryID) {
+    if (g_verboseHealthChecks) {
+      infolog("Invalid health check response id %d from backend %s, expecting %d", data->d_queryID, ds->getNameWithAddr(), data->d_queryID);
     }
+    return false;
+  }
 
-    if (responseHeader->id != data->d_queryID) {
-      if (g_verboseHealthChecks) {
-        infolog("Invalid health check response id %d from backend %s, expecting %d", data->d_queryID, ds->getNameWithAddr(), data->d_queryID);
-      }
-      return false;
+  if (!responseHeader->qr) {
+    if (g_verboseHealthChecks) {
+      infolog("Invalid health check response from backend %s, expecting QR to be set", ds->getNameWithAddr());
     }
+    return false;
+  }
 
-    if (!responseHeader->qr) {
-      if (g_verboseHealthChecks) {
-        infolog("Invalid health check response from backend %s, expecting QR to be set", ds->getNameWithAddr());
-      }
-      return false;
+  if (responseHeader->rcode == RCode::ServFail) {
+    if (g_verboseHealthChecks) {
+      infolog("Backend %s responded to health check with ServFail", ds->getNameWithAddr());
     }
+    return false;
+  }
 
-    if (responseHeader->rcode == RCode::ServFail) {
-      if (g_verboseHealthChecks) {
-        infolog("Backend %s responded to health check with ServFail", ds->getNameWithAddr());
-      }
-      return false;
+  if (ds->mustResolve && (responseHeader->rcode == RCode::NXDomain || responseHeader->rcode == RCode::Refused)) {
+    if (g_verboseHealthChecks) {
+      infolog("Backend %s responded to health check with %s while mustResolve is set", ds->getNameWithAddr(), responseHeader->rcode == RCode::NXDomain ? "NXDomain" : "Refused");
     }
+    return false;
+  }
 
-    if (ds->mustResolve && (responseHeader->rcode == RCode::NXDomain || responseHeader->rcode == RCode::Refused)) {
-      if (g_verboseHealthChecks) {
-        infolog("Backend %s responded to health check with %s while mustResolve is set", ds->getNameWithAddr(), responseHeader->rcode == RCode::NXDomain ? "NXDomain" : "Refused");
-      }
-      return false;
+  uint16_t receivedType;
+  uint16_t receivedClass;
+  DNSName receivedName(reply, replySize, sizeof(dnsheader), false, &receivedType, &receivedClass);
+
+  if (receivedName != data->d_checkName || receivedType != data->d_checkType || receivedClass != data->d_checkClass) {
+    if (g_verboseHealthChecks) {
+      infolog("Backend %s responded to health check with an invalid qname (%s vs %s), qtype (%s vs %s) or qclass (%d vs %d)", ds->getNameWithAddr(), receivedName.toLogString(), data->d_checkName.toLogString(), QType(receivedType).getName(), QType(data->d_checkType).getName(), receivedClass, data->d_checkClass);
     }
+    return false;
+  }
 
-    uint16_t receivedType;
-    uint16_t receivedClass;
-    DNSName receivedName(reply.c_str(), reply.size(), sizeof(dnsheader), false, &receivedType, &receivedClass);
+  return true;
+}
 
-    if (receivedName != data->d_checkName || receivedType != data->d_checkType || receivedClass != data->d_checkClass) {
+static bool handleResponse(std::shared_ptr<HealthCheckData>& data)
+{
+  auto& ds = data->d_ds;
+  try {
+    string reply;
+    ComboAddress from;
+    data->d_sock.recvFrom(reply, from);
+
+    /* we are using a connected socket but hey.. */
+    if (!ds->isDoH() && from != ds->remote) {
       if (g_verboseHealthChecks) {
-        infolog("Backend %s responded to health check with an invalid qname (%s vs %s), qtype (%s vs %s) or qclass (%d vs %d)", ds->getNameWithAddr(), receivedName.toLogString(), data->d_checkName.toLogString(), QType(receivedType).getName(), QType(data->d_checkType).getName(), receivedClass, data->d_checkClass);
+        infolog("Invalid health check response received from %s, expecting one from %s", from.toStringWithPort(), ds->remote.toStringWithPort());
       }
       return false;
     }
+
+    return isHealthCheckResponseValid(data, reply.c_str(), reply.size());
   }
   catch(const std::exception& e)
   {
@@ -155,8 +165,6 @@ static bool handleResponse(std::shared_ptr<HealthCheckData>& data)
     }
     return false;
   }
-
-  return true;
 }
 
 static void healthCheckCallback(int fd, FDMultiplexer::funcparam_t& param)
@@ -175,6 +183,114 @@ static void initialHealthCheckCallback(int fd, FDMultiplexer::funcparam_t& param
   data->d_ds->upStatus = up;
 }
 
+static void reportHealthCheckResult(const std::shared_ptr<HealthCheckData>& data, bool up)
+{
+  if (data->d_initial) {
+    warnlog("Marking downstream %s as '%s'", data->d_ds->getNameWithAddr(), up ? "up" : "down");
+    data->d_ds->upStatus = up;
+  }
+  else {
+    updateHealthCheckResult(data->d_ds, up);
+  }
+}
+
+static void healthCheckTCPCallback(int fd, FDMultiplexer::funcparam_t& param)
+{
+  auto data = boost::any_cast<std::shared_ptr<HealthCheckData>>(param);
+  auto& ds = data->d_ds;
+  IOState newState = IOState::Done;
+  bool up = false;
+
+  try {
+    if (data->d_tcpState == HealthCheckData::TCPState::SendingProxyProtocolPayload) {
+      /* the Proxy Protocol payload is sent in clear text, before the TLS handshake */
+      if (!data->d_proxyProtocolPayload.empty()) {
+        data->d_bufferPos += sendMsgWithOptions(fd, reinterpret_cast<const char*>(&data->d_proxyProtocolPayload.at(data->d_bufferPos)), data->d_proxyProtocolPayload.size() - data->d_bufferPos, nullptr, nullptr, 0, 0);
+        newState = data->d_bufferPos == data->d_proxyProtocolPayload.size() ? IOState::Done : IOState::NeedWrite;
+      }
+      if (newState == IOState::Done) {
+        data->d_bufferPos = 0;
+        data->d_tcpState = HealthCheckData::TCPState::DoingHandshake;
+      }
+    }
+
+    if (data->d_tcpState == HealthCheckData::TCPState::DoingHandshake) {
+      newState = data->d_tcpHandler->tryHandshake();
+      if (newState == IOState::Done) {
+        data->d_tcpState = HealthCheckData::TCPState::SendingQuery;
+      }
+    }
+
+    if (data->d_tcpState == HealthCheckData::TCPState::SendingQuery) {
+      newState = data->d_tcpHandler->tryWrite(data->d_buffer, data->d_bufferPos, data->d_buffer.size());
+      if (newState == IOState::Done) {
+        data->d_bufferPos = 0;
+        data->d_buffer.resize(sizeof(uint16_t));
+        data->d_tcpState = HealthCheckData::TCPState::ReadingResponseSize;
+      }
+    }
+
+    if (data->d_tcpState == HealthCheckData::TCPState::ReadingResponseSize) {
+      newState = data->d_tcpHandler->tryRead(data->d_buffer, data->d_bufferPos, sizeof(uint16_t));
+      if (newState == IOState::Done) {
+        data->d_responseSize = data->d_buffer.at(0) * 256 + data->d_buffer.at(1);
+        if (data->d_responseSize == 0) {
+          throw std::runtime_error("Received an empty response");
+        }
+        data->d_bufferPos = 0;
+        data->d_buffer.resize(data->d_responseSize);
+        data->d_tcpState = HealthCheckData::TCPState::ReadingResponse;
+      }
+    }
+
+    if (data->d_tcpState == HealthCheckData::TCPState::ReadingResponse) {
+      newState = data->d_tcpHandler->tryRead(data->d_buffer, data->d_bufferPos, data->d_responseSize);
+      if (newState == IOState::Done) {
+        up = isHealthCheckResponseValid(data, reinterpret_cast<const char*>(data->d_buffer.data()), data->d_buffer.size());
+      }
+    }
+  }
+  catch(const std::exception& e)
+  {
+    if (g_verboseHealthChecks) {
+      infolog("Error checking the health of backend %s over TCP: %s", ds->getNameWithAddr(), e.what());
+    }
+    newState = IOState::Done;
+    up = false;
+  }
+  catch(...)
+  {
+    if (g_verboseHealthChecks) {
+      infolog("Unknown exception while checking the health of backend %s over TCP", ds->getNameWithAddr());
+    }
+    newState = IOState::Done;
+    up = false;
+  }
+
+  if (newState == data->d_ioState) {
+    /* still waiting for the same event, keeping the existing registration and its TTD */
+    return;
+  }
+
+  if (data->d_ioState == IOState::NeedRead) {
+    data->d_mplexer->removeReadFD(fd);
+  }
+  else if (data->d_ioState == IOState::NeedWrite) {
+    data->d_mplexer->removeWriteFD(fd);
+  }
+  data->d_ioState = newState;
+
+  if (newState == IOState::Done) {
+    reportHealthCheckResult(data, up);
+  }
+  else if (newState == IOState::NeedRead) {
+    data->d_mplexer->addReadFD(fd, &healthCheckTCPCallback, data, &data->d_ttd);
+  }
+  else {
+    data->d_mplexer->addWriteFD(fd, &healthCheckTCPCallback, data, &data->d_ttd);
+  }
+}
+
 bool queueHealthCheck(std::shared_ptr<FDMultiplexer>& mplexer, const std::shared_ptr<DownstreamState>& ds, bool initialCheck)
 {
   try
@@ -207,14 +323,15 @@ bool queueHealthCheck(std::shared_ptr<FDMultiplexer>& mplexer, const std::shared
     dnsheader * requestHeader = dpw.getHeader();
     *requestHeader = checkHeader;
 
+    std::string proxyProtocolPayload;
     if (ds->useProxyProtocol) {
-      auto payload = makeLocalProxyHeader();
-      packet.insert(packet.begin(), payload.begin(), payload.end());
+      proxyProtocolPayload = makeLocalProxyHeader();
     }
 
-    Socket sock(ds->remote.sin4.sin_family, SOCK_DGRAM);
+    /* the health check queries to a DoH backend go through the DoH client thread */
+    Socket sock = ds->isDoH() ? Socket(getDoHClientDatagramSocket(ds)) : Socket(ds->remote.sin4.sin_family, ds->isTCPOnly() ? SOCK_STREAM : SOCK_DGRAM);
     sock.setNonBlocking();
-    if (!IsAnyAddress(ds->sourceAddr)) {
+    if (!ds->isDoH() && !IsAnyAddress(ds->sourceAddr)) {
       sock.setReuseAddr();
       if (!ds->sourceItfName.empty()) {
 #ifdef SO_BINDTODEVICE
@@ -226,16 +343,7 @@ bool queueHealthCheck(std::shared_ptr<FDMultiplexer>& mplexer, const std::shared
       }
       sock.bind(ds->sourceAddr);
     }
-    sock.connect(ds->remote);
-    ssize_t sent = udpClientSendRequestToBackend(ds, sock.getHandle(), reinterpret_cast<char*>(&packet[0]), packet.size(), true);
-    if (sent < 0) {
-      int ret = errno;
-      if (g_verboseHealthChecks)
-        infolog("Error while sending a health check query to backend %s: %d", ds->getNameWithAddr(), ret);
-      return false;
-    }
 
-    auto data = std::make_shared<HealthCheckData>(mplexer, ds, std::move(sock), std::move(checkName), checkType, checkClass, queryID);
     struct timeval ttd;
     gettimeofday(&ttd, nullptr);
     ttd.tv_sec += ds->checkTimeout / 1000; /* ms to seconds */
@@ -244,6 +352,41 @@ bool queueHealthCheck(std::shared_ptr<FDMultiplexer>& mplexer, const std::shared
       ++ttd.tv_sec;
       ttd.tv_usec -= 1000000;
     }
+
+    if (ds->isTCPOnly()) {
+      /* non-blocking connect, the rest of the exchange is handled by healthCheckTCPCallback() */
+      SConnectWithTimeout(sock.getHandle(), ds->remote, 0);
+
+      auto data = std::make_shared<HealthCheckData>(mplexer, ds, std::move(sock), std::move(checkName), checkType, checkClass, queryID);
+      data->d_proxyProtocolPayload.assign(proxyProtocolPayload.begin(), proxyProtocolPayload.end());
+      const uint16_t packetSize = htons(static_cast<uint16_t>(packet.size()));
+      data->d_buffer.reserve(sizeof(packetSize) + packet.size());
+      data->d_buffer.insert(data->d_buffer.end(), reinterpret_cast<const uint8_t*>(&packetSize), reinterpret_cast<const uint8_t*>(&packetSize) + sizeof(packetSize));
+      data->d_buffer.insert(data->d_buffer.end(), packet.begin(), packet.end());
+      data->d_tcpHandler = std::unique_ptr<TCPIOHandler>(new TCPIOHandler(ds->d_tlsSubjectName, data->d_sock.getHandle(), 0, ds->d_tlsCtx));
+      data->d_ttd = ttd;
+      data->d_initial = initialCheck;
+      data->d_ioState = IOState::NeedWrite;
+      mplexer->addWriteFD(data->d_sock.getHandle(), &healthCheckTCPCallback, data, &data->d_ttd);
+      return true;
+    }
+
+    if (!proxyProtocolPayload.empty()) {
+      packet.insert(packet.begin(), proxyProtocolPayload.begin(), proxyProtocolPayload.end());
+    }
+
+    if (!ds->isDoH()) {
+      sock.connect(ds->remote);
+    }
+    ssize_t sent = udpClientSendRequestToBackend(ds, sock.getHandle(), reinterpret_cast<char*>(&packet[0]), packet.size(), true);
+    if (sent < 0) {
+      int ret = errno;
+      if (g_verboseHealthChecks)
+        infolog("Error while sending a health check query to backend %s: %d", ds->getNameWithAddr(), ret);
+      return false;
+    }
+
+    auto data = std::make_shared<HealthCheckData>(mplexer, ds, std::move(sock), std::move(checkName), checkType, checkClass, queryID);
     mplexer->addReadFD(data->d_sock.getHandle(), initialCheck ? &initialHealthCheckCallback : &healthCheckCallback, data, &ttd);
 
     return true;
@@ -264,9 +407,23 @@ bool queueHealthCheck(std::shared_ptr<FDMultiplexer>& mplexer, const std::shared
   }
 }
 
+static void handleHealthCheckTimeout(const std::shared_ptr<HealthCheckData>& data, bool initial)
+{
+  if (g_verboseHealthChecks) {
+    infolog("Timeout while waiting for the health check response from backend %s", data->d_ds->getNameWithAddr());
+  }
+  if (initial) {
+    warnlog("Marking downstream %s as 'down'", data->d_ds->getNameWithAddr());
+    data->d_ds->upStatus = false;
+  }
+  else {
+    updateHealthCheckResult(data->d_ds, false);
+  }
+}
+
 void handleQueuedHealthChecks(std::shared_ptr<FDMultiplexer>& mplexer, bool initial)
 {
-  while (mplexer->getWatchedFDCount(false) > 0) {
+  while (mplexer->getWatchedFDCount(false) > 0 || mplexer->getWatchedFDCount(true) > 0) {
     struct timeval now;
     int ret = mplexer->run(&now, 100);
     if (ret == -1) {
@@ -278,17 +435,14 @@ void handleQueuedHealthChecks(std::shared_ptr<FDMultiplexer>& mplexer, bool init
     auto timeouts = mplexer->getTimeouts(now);
     for (const auto& timeout : timeouts) {
       mplexer->removeReadFD(timeout.first);
-      auto data = boost::any_cast<std::shared_ptr<HealthCheckData>>(timeout.second);
-      if (g_verboseHealthChecks) {
-        infolog("Timeout while waiting for the health check response from backend %s", data->d_ds->getNameWithAddr());
-      }
-      if (initial) {
-        warnlog("Marking downstream %s as 'down'", data->d_ds->getNameWithAddr());
-        data->d_ds->upStatus = false;
-      }
-      else {
-        updateHealthCheckResult(data->d_ds, false);
-      }
+      handleHealthCheckTimeout(boost::any_cast<std::shared_ptr<HealthCheckData>>(timeout.second), initial);
+    }
+
+    /* TCP health checks might be waiting for the socket to become writable */
+    timeouts = mplexer->getTimeouts(now, true);
+    for (const auto& timeout : timeouts) {
+      mplexer->removeWriteFD(timeout.first);
+      handleHealthCheckTimeout(boost::any_cast<std::shared_ptr<HealthCheckData>>(timeout.second), initial);
     }
   }
 }
@@ -24,9 +24,13 @@
 #include "dnsdist.hh"
 #include "mplexer.hh"
 #include "sstuff.hh"
+#include "tcpiohandler.hh"
 
 struct HealthCheckData
 {
+  /* states of a health check done over TCP, or TLS, for backends that are only reachable that way */
+  enum class TCPState : uint8_t { SendingProxyProtocolPayload, DoingHandshake, SendingQuery, ReadingResponseSize, ReadingResponse };
+
   HealthCheckData(std::shared_ptr<FDMultiplexer>& mplexer, const std::shared_ptr<DownstreamState>& ds, Socket&& sock, DNSName&& checkName, uint16_t checkType, uint16_t checkClass, uint16_t queryID): d_mplexer(mplexer), d_ds(ds), d_sock(std::move(sock)), d_checkName(std::move(checkName)), d_checkType(checkType), d_checkClass(checkClass), d_queryID(queryID)
   {
   }
@@ -38,6 +42,18 @@ struct HealthCheckData
   uint16_t d_checkType;
   uint16_t d_checkClass;
   uint16_t d_queryID;
+
+  /* only used for TCP health checks. The handler has to be destroyed before the socket it uses */
+  std::unique_ptr<TCPIOHandler> d_tcpHandler{nullptr};
+  std::vector<uint8_t> d_proxyProtocolPayload;
+  /* the query, size-prefixed, then the response */
+  std::vector<uint8_t> d_buffer;
+  struct timeval d_ttd;
+  size_t d_bufferPos{0};
+  uint16_t d_responseSize{0};
+  TCPState d_tcpState{TCPState::SendingProxyProtocolPayload};
+  IOState d_ioState{IOState::Done};
+  bool d_initial{false};
 };
 
 extern bool g_verboseHealthChecks;
@@ -22,15 +22,20 @@
 #include <fcntl.h>
 #include <sys/stat.h>
 #include <sys/types.h>
+#include <thread>
+
+#include <boost/format.hpp>
 
 #include "config.h"
 #include "dnsdist.hh"
 #include "dnsdist-lua.hh"
+#include "dolog.hh"
+#include "threadname.hh"
 
-void setupLuaBindingsPacketCache(LuaContext& luaCtx)
+void setupLuaBindingsPacketCache(LuaContext& luaCtx, bool client)
 {
   /* PacketCache */
-  luaCtx.writeFunction("newPacketCache", [](size_t maxEntries, boost::optional<std::unordered_map<std::string, boost::variant<bool, size_t>>> vars) {
+  luaCtx.writeFunction("newPacketCache", [client](size_t maxEntries, boost::optional<std::unordered_map<std::string, boost::variant<bool, size_t, std::string>>> vars) {
 
       bool keepStaleData = false;
       size_t maxTTL = 86400;
@@ -43,6 +48,12 @@ void setupLuaBindingsPacketCache(LuaContext& luaCtx)
       bool deferrableInsertLock = true;
       bool ecsParsing = false;
       bool cookieHashing = false;
+      bool lockFreeLookups = false;
+      size_t prefetchTTLPercentage = 0;
+      size_t prefetchMinHits = 10;
+      DNSDistPacketCache::EvictionPolicy evictionPolicy = DNSDistPacketCache::EvictionPolicy::None;
+      std::string sharedMemoryFile;
+      size_t sharedMemoryMaxResponseSize = 1232;
 
       if (vars) {
 
@@ -54,10 +65,30 @@ void setupLuaBindingsPacketCache(LuaContext& luaCtx)
           dontAge = boost::get<bool>((*vars)["dontAge"]);
         }
 
+        if (vars->count("evictionPolicy")) {
+          const auto policy = boost::get<std::string>((*vars)["evictionPolicy"]);
+          if (policy == "none") {
+            evictionPolicy = DNSDistPacketCache::EvictionPolicy::None;
+          }
+          else if (policy == "lru") {
+            evictionPolicy = DNSDistPacketCache::EvictionPolicy::LRU;
+          }
+          else if (policy == "tinylfu") {
+            evictionPolicy = DNSDistPacketCache::EvictionPolicy::TinyLFU;
+          }
+          else {
+            throw std::runtime_error("Unsupported value '" + policy + "' for the 'evictionPolicy' parameter of newPacketCache(), expected 'none', 'lru' or 'tinylfu'");
+          }
+        }
+
         if (vars->count("keepStaleData")) {
           keepStaleData = boost::get<bool>((*vars)["keepStaleData"]);
         }
 
+        if (vars->count("lockFreeLookups")) {
+          lockFreeLookups = boost::get<bool>((*vars)["lockFreeLookups"]);
+        }
+
         if (vars->count("maxNegativeTTL")) {
           maxNegativeTTL = boost::get<size_t>((*vars)["maxNegativeTTL"]);
         }
@@ -78,6 +109,28 @@ void setupLuaBindingsPacketCache(LuaContext& luaCtx)
           ecsParsing = boost::get<bool>((*vars)["parseECS"]);
         }
 
+        if (vars->count("prefetchMinHits")) {
+          prefetchMinHits = boost::get<size_t>((*vars)["prefetchMinHits"]);
+        }
+
+        if (vars->count("prefetchTTLPercentage")) {
+          prefetchTTLPercentage = boost::get<size_t>((*vars)["prefetchTTLPercentage"]);
+          if (prefetchTTLPercentage > 100) {
+            throw std::runtime_error("The value of 'prefetchTTLPercentage' passed to newPacketCache() should be between 0 and 100, not " + std::to_string(prefetchTTLPercentage));
+          }
+        }
+
+        if (vars->count("sharedMemoryFile")) {
+          sharedMemoryFile = boost::get<std::string>((*vars)["sharedMemoryFile"]);
+        }
+
+        if (vars->count("sharedMemoryMaxResponseSize")) {
+          sharedMemoryMaxResponseSize = boost::get<size_t>((*vars)["sharedMemoryMaxResponseSize"]);
+          if (sharedMemoryMaxResponseSize > std::numeric_limits<uint16_t>::max()) {
+            throw std::runtime_error("The value of 'sharedMemoryMaxResponseSize' passed to newPacketCache() is too large: " + std::to_string(sharedMemoryMaxResponseSize));
+          }
+        }
+
         if (vars->count("staleTTL")) {
           staleTTL = boost::get<size_t>((*vars)["staleTTL"]);
         }
@@ -91,10 +144,16 @@ void setupLuaBindingsPacketCache(LuaContext& luaCtx)
         }
       }
 
-      auto res = std::make_shared<DNSDistPacketCache>(maxEntries, maxTTL, minTTL, tempFailTTL, maxNegativeTTL, staleTTL, dontAge, numberOfShards, deferrableInsertLock, ecsParsing);
+      auto res = std::make_shared<DNSDistPacketCache>(maxEntries, maxTTL, minTTL, tempFailTTL, maxNegativeTTL, staleTTL, dontAge, numberOfShards, deferrableInsertLock, ecsParsing, lockFreeLookups);
 
       res->setKeepStaleData(keepStaleData);
       res->setCookieHashing(cookieHashing);
+      res->setPrefetch(prefetchTTLPercentage, prefetchMinHits);
+      res->setEvictionPolicy(evictionPolicy);
+      /* last, since the other settings have to be the same in every process sharing the file */
+      if (!sharedMemoryFile.empty() && !client) {
+        res->setSharedMemory(sharedMemoryFile, sharedMemoryMaxResponseSize);
+      }
 
       return res;
     });
@@ -148,6 +207,24 @@ void setupLuaBindingsPacketCache(LuaContext& luaCtx)
         g_outputBuffer+="Lookup Collisions: " + std::to_string(cache->getLookupCollisions()) + "\n";
         g_outputBuffer+="Insert Collisions: " + std::to_string(cache->getInsertCollisions()) + "\n";
         g_outputBuffer+="TTL Too Shorts: " + std::to_string(cache->getTTLTooShorts()) + "\n";
+        g_outputBuffer+="Prefetches: " + std::to_string(cache->getPrefetches()) + "\n";
+        g_outputBuffer+="Evictions: " + std::to_string(cache->getEvictions()) + "\n";
+        g_outputBuffer+="Rejected Admissions: " + std::to_string(cache->getRejectedAdmissions()) + "\n";
+      }
+    });
+  luaCtx.registerFunction<void(std::shared_ptr<DNSDistPacketCache>::*)()>("printMemoryUsage", [](const std::shared_ptr<DNSDistPacketCache>& cache) {
+      if (cache) {
+        boost::format fmt("%-7s %12d %15d %10d\n");
+        g_outputBuffer = (fmt % "Shard" % "Entries" % "Memory (bytes)" % "Per entry").str();
+        DNSDistPacketCache::ShardMemoryUsage total;
+        size_t shardIndex = 0;
+        for (const auto& usage : cache->getMemoryUsage()) {
+          g_outputBuffer += (fmt % shardIndex % usage.entries % usage.bytes % (usage.entries > 0 ? usage.bytes / usage.entries : 0)).str();
+          total.entries += usage.entries;
+          total.bytes += usage.bytes;
+          shardIndex++;
+        }
+        g_outputBuffer += (fmt % "Total" % total.entries % total.bytes % (total.entries > 0 ? total.bytes / total.entries : 0)).str();
       }
     });
   luaCtx.registerFunction<std::unordered_map<std::string, uint64_t>(std::shared_ptr<DNSDistPacketCache>::*)()>("getStats", [](const std::shared_ptr<DNSDistPacketCache>& cache) {
@@ -162,6 +239,9 @@ void setupLuaBindingsPacketCache(LuaContext& luaCtx)
         stats["lookupCollisions"] = cache->getLookupCollisions();
         stats["insertCollisions"] = cache->getInsertCollisions();
         stats["ttlTooShorts"] = cache->getTTLTooShorts();
+        stats["prefetches"] = cache->getPrefetches();
+        stats["evictions"] = cache->getEvictions();
+        stats["rejectedAdmissions"] = cache->getRejectedAdmissions();
       }
       return stats;
     });
@@ -188,4 +268,82 @@ void setupLuaBindingsPacketCache(LuaContext& luaCtx)
         g_outputBuffer += "Dumped " + std::to_string(records) + " records\n";
       }
     });
+  luaCtx.registerFunction<void(std::shared_ptr<DNSDistPacketCache>::*)(const std::string& fname)>("saveToFile", [](const std::shared_ptr<DNSDistPacketCache>& cache, const std::string& fname) {
+      if (cache) {
+        /* write to a temporary file first so that a crash or a full disk
+           does not leave a truncated file behind */
+        const std::string tmpName = fname + ".tmp";
+        int fd = open(tmpName.c_str(), O_CREAT | O_TRUNC | O_WRONLY, 0660);
+        if (fd < 0) {
+          g_outputBuffer = "Error opening cache file for writing: " + stringerror() + "\n";
+          return;
+        }
+
+        uint64_t entries = 0;
+        try {
+          entries = cache->save(fd);
+        }
+        catch (const std::exception& e) {
+          close(fd);
+          unlink(tmpName.c_str());
+          g_outputBuffer = "Error saving the cache to " + fname + ": " + std::string(e.what()) + "\n";
+          return;
+        }
+
+        if (close(fd) != 0 || rename(tmpName.c_str(), fname.c_str()) != 0) {
+          g_outputBuffer = "Error saving the cache to " + fname + ": " + stringerror() + "\n";
+          unlink(tmpName.c_str());
+          return;
+        }
+
+        g_outputBuffer += "Saved " + std::to_string(entries) + " entries\n";
+      }
+    });
+  luaCtx.registerFunction<void(std::shared_ptr<DNSDistPacketCache>::*)(const std::string& fname, boost::optional<bool> background)>("loadFromFile", [client](const std::shared_ptr<DNSDistPacketCache>& cache, const std::string& fname, boost::optional<bool> background) {
+      if (!cache || client) {
+        return;
+      }
+
+      auto loadCache = [](std::shared_ptr<DNSDistPacketCache> cache, const std::string& fname) {
+        int fd = open(fname.c_str(), O_RDONLY);
+        if (fd < 0) {
+          throw std::runtime_error("Error opening cache file " + fname + " for reading: " + stringerror());
+        }
+
+        uint64_t entries = 0;
+        try {
+          entries = cache->load(fd);
+        }
+        catch (...) {
+          close(fd);
+          throw;
+        }
+        close(fd);
+        return entries;
+      };
+
+      if (background && *background) {
+        std::thread loader([cache, fname, loadCache]() {
+            setThreadName("dnsdist/cacheLoad");
+            try {
+              auto entries = loadCache(cache, fname);
+              infolog("Loaded %d entries into the packet cache from %s", entries, fname);
+            }
+            catch (const std::exception& e) {
+              errlog("Error loading the packet cache from %s: %s", fname, e.what());
+            }
+          });
+        loader.detach();
+        return;
+      }
+
+      try {
+        auto entries = loadCache(cache, fname);
+        g_outputBuffer += "Loaded " + std::to_string(entries) + " entries\n";
+      }
+      catch (const std::exception& e) {
+        g_outputBuffer = "Error loading the packet cache from " + fname + ": " + std::string(e.what()) + "\n";
+        errlog("Error loading the packet cache from %s: %s", fname, e.what());
+      }
+    });
 }
@@ -0,0 +1,1167 @@
+/*
+ * This file is part of PowerDNS or dnsdist.
+ * Copyright -- PowerDNS.COM B.V. and its contributors
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of version 2 of the GNU General Public License as
+ * published by the Free Software Foundation.
+ *
+ * In addition, for the avoidance of any doubt, permission is granted to
+ * link this program with OpenSSL and to (re)distribute the binaries
+ * produced as the result of such linking.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+ */
+#include <algorithm>
+#include <map>
+#include <mutex>
+#include <thread>
+#include <unordered_map>
+
+#include <sys/socket.h>
+#include <sys/types.h>
+#include <unistd.h>
+
+#include "dnsdist-nghttp2.hh"
+
+#include "dnsdist.hh"
+#include "dolog.hh"
+#include "iputils.hh"
+#include "mplexer.hh"
+#include "sstuff.hh"
+#include "tcpiohandler.hh"
+#include "threadname.hh"
+
+#ifdef HAVE_NGHTTP2
+#include <nghttp2/nghttp2.h>
+
+/* we never send more than that many concurrent queries over a single connection, whatever the backend says */
+static const uint32_t s_maxConcurrentStreamsPerConnection{100};
+static const std::string s_dnsMessageContentType{"application/dns-message"};
+
+class DoHClientThreadData;
+
+/* The local end of a socket pair, over which the rest of dnsdist sends queries to a DoH backend and
+   gets responses back. Datagram sources carry one query per message, stream sources use the DNS over
+   TCP framing. */
+class DoHClientSource : public std::enable_shared_from_this<DoHClientSource>
+{
+public:
+  DoHClientSource(DoHClientThreadData& threadData, const std::shared_ptr<DownstreamState>& ds, int fd, bool stream): d_threadData(threadData), d_ds(ds), d_fd(fd), d_stream(stream)
+  {
+  }
+
+  ~DoHClientSource()
+  {
+    if (d_fd != -1) {
+      ::close(d_fd);
+      d_fd = -1;
+    }
+  }
+
+  DoHClientSource(const DoHClientSource&) = delete;
+  DoHClientSource& operator=(const DoHClientSource&) = delete;
+
+  static void handleReadableCallback(int fd, FDMultiplexer::funcparam_t& param);
+  static void handleWritableCallback(int fd, FDMultiplexer::funcparam_t& param);
+
+  void sendResponse(const std::vector<uint8_t>& response);
+  void queryFailed();
+  void close();
+
+private:
+  void readQueries(const struct timeval& now);
+  void flushResponses();
+
+  DoHClientThreadData& d_threadData;
+  std::shared_ptr<DownstreamState> d_ds;
+  std::vector<uint8_t> d_readBuffer;
+  std::vector<uint8_t> d_writeBuffer;
+  size_t d_readPos{0};
+  size_t d_writePos{0};
+  int d_fd{-1};
+  bool d_stream{false};
+  bool d_writing{false};
+};
+
+class DoHConnectionToBackend : public std::enable_shared_from_this<DoHConnectionToBackend>
+{
+public:
+  DoHConnectionToBackend(DoHClientThreadData& threadData, const std::shared_ptr<DownstreamState>& ds);
+  ~DoHConnectionToBackend();
+
+  DoHConnectionToBackend(const DoHConnectionToBackend&) = delete;
+  DoHConnectionToBackend& operator=(const DoHConnectionToBackend&) = delete;
+
+  static void handleIOCallback(int fd, FDMultiplexer::funcparam_t& param);
+
+  void queueQuery(std::vector<uint8_t>&& query, const std::shared_ptr<DoHClientSource>& source, const struct timeval& now);
+  void handleTimeout(const struct timeval& now, bool write);
+  void expireStreams(const struct timeval& now);
+  void stop();
+
+  size_t getInFlightQueriesCount() const
+  {
+    return d_streams.size();
+  }
+
+  bool canAcceptNewQueries() const
+  {
+    return d_state != State::dead && nghttp2_session_check_request_allowed(d_session.get()) != 0;
+  }
+
+  bool isSaturated() const
+  {
+    uint32_t maxStreams = std::min(s_maxConcurrentStreamsPerConnection, nghttp2_session_get_remote_settings(d_session.get(), NGHTTP2_SETTINGS_MAX_CONCURRENT_STREAMS));
+    return d_streams.size() >= maxStreams;
+  }
+
+private:
+  enum class State : uint8_t { connecting, established, dead };
+
+  struct PendingStream
+  {
+    std::vector<uint8_t> d_query;
+    std::vector<uint8_t> d_response;
+    std::weak_ptr<DoHClientSource> d_source;
+    struct timeval d_queryTime;
+    size_t d_queryPos{0};
+    uint16_t d_status{0};
+    bool d_responseTooLarge{false};
+  };
+
+  static ssize_t sendCallback(nghttp2_session* session, const uint8_t* data, size_t length, int flags, void* user_data);
+  static int onHeaderCallback(nghttp2_session* session, const nghttp2_frame* frame, const uint8_t* name, size_t namelen, const uint8_t* value, size_t valuelen, uint8_t flags, void* user_data);
+  static int onDataChunkRecvCallback(nghttp2_session* session, uint8_t flags, int32_t stream_id, const uint8_t* data, size_t len, void* user_data);
+  static int onStreamCloseCallback(nghttp2_session* session, int32_t stream_id, uint32_t error_code, void* user_data);
+  static ssize_t dataReadCallback(nghttp2_session* session, int32_t stream_id, uint8_t* buf, size_t length, uint32_t* data_flags, nghttp2_data_source* source, void* user_data);
+
+  void handleIO(const struct timeval& now);
+  void updateIO(IOState newState, const struct timeval& now);
+  void handleStreamClosed(int32_t streamId, uint32_t errorCode);
+
+  DoHClientThreadData& d_threadData;
+  std::shared_ptr<DownstreamState> d_ds;
+  std::unique_ptr<Socket> d_socket{nullptr};
+  std::unique_ptr<TCPIOHandler> d_handler{nullptr};
+  std::unique_ptr<nghttp2_session, void(*)(nghttp2_session*)> d_session;
+  std::unordered_map<int32_t, PendingStream> d_streams;
+  std::vector<uint8_t> d_out;
+  std::vector<uint8_t> d_in;
+  std::string d_authority;
+  size_t d_outPos{0};
+  State d_state{State::connecting};
+  IOState d_ioState{IOState::Done};
+  bool d_hasTTD{false};
+};
+
+class DoHClientThreadData
+{
+public:
+  DoHClientThreadData(): mplexer(std::unique_ptr<FDMultiplexer>(FDMultiplexer::getMultiplexerSilent()))
+  {
+  }
+
+  void sendQuery(const std::shared_ptr<DownstreamState>& ds, std::vector<uint8_t>&& query, const std::shared_ptr<DoHClientSource>& source, const struct timeval& now);
+  void removeConnection(const std::shared_ptr<DownstreamState>& ds, const DoHConnectionToBackend* conn);
+  void addSource(const std::shared_ptr<DownstreamState>& ds, const std::shared_ptr<DoHClientSource>& source);
+  void cleanupStoppedBackends();
+  void expireStreams(const struct timeval& now);
+
+  std::unique_ptr<FDMultiplexer> mplexer{nullptr};
+  std::map<std::shared_ptr<DownstreamState>, std::vector<std::shared_ptr<DoHConnectionToBackend>>> connections;
+  /* the sources are owned by the multiplexer, we only need to be able to close them when their backend is stopped */
+  std::map<std::shared_ptr<DownstreamState>, std::vector<std::weak_ptr<DoHClientSource>>> sources;
+};
+
+/* a socket to start reading queries from, passed to the worker thread over a pipe */
+struct DoHClientSourceRequest
+{
+  std::shared_ptr<DownstreamState> d_ds{nullptr};
+  int d_fd{-1};
+  bool d_stream{false};
+};
+
+static int s_dohClientPipe[2] = { -1, -1 };
+static std::once_flag s_dohClientPipeInitialized;
+static std::once_flag s_dohClientThreadStarted;
+
+void DoHClientSource::handleReadableCallback(int fd, FDMultiplexer::funcparam_t& param)
+{
+  auto source = boost::any_cast<std::shared_ptr<DoHClientSource>>(param);
+  struct timeval now;
+  gettimeofday(&now, nullptr);
+
+  try {
+    source->readQueries(now);
+  }
+  catch (const std::exception& e) {
+    vinfolog("Error while reading queries for the DoH backend %s: %s", source->d_ds->getNameWithAddr(), e.what());
+    source->close();
+  }
+}
+
+void DoHClientSource::handleWritableCallback(int fd, FDMultiplexer::funcparam_t& param)
+{
+  auto source = boost::any_cast<std::shared_ptr<DoHClientSource>>(param);
+  source->flushResponses();
+}
+
+void DoHClientSource::readQueries(const struct timeval& now)
+{
+  if (!d_stream) {
+    /* don't starve the other sources and connections if we are flooded with queries */
+    for (size_t count = 0; count < 100 && d_fd != -1; count++) {
+      d_readBuffer.resize(std::numeric_limits<uint16_t>::max());
+      ssize_t got = recv(d_fd, d_readBuffer.data(), d_readBuffer.size(), 0);
+      if (got == 0) {
+        close();
+        return;
+      }
+      if (got < 0) {
+        if (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR) {
+          return;
+        }
+        throw std::runtime_error("Error while reading from the local DoH socket: " + stringerror());
+      }
+      if (static_cast<size_t>(got) < sizeof(dnsheader)) {
+        continue;
+      }
+
+      std::vector<uint8_t> query(d_readBuffer.begin(), d_readBuffer.begin() + got);
+      d_threadData.sendQuery(d_ds, std::move(query), shared_from_this(), now);
+    }
+    return;
+  }
+
+  while (d_fd != -1) {
+    /* make sure we have enough room for a full query */
+    d_readBuffer.resize(d_readPos + std::numeric_limits<uint16_t>::max() + 2);
+    ssize_t got = recv(d_fd, &d_readBuffer.at(d_readPos), d_readBuffer.size() - d_readPos, 0);
+    if (got == 0) {
+      close();
+      return;
+    }
+    if (got < 0) {
+      if (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR) {
+        return;
+      }
+      throw std::runtime_error("Error while reading from the local DoH socket: " + stringerror());
+    }
+
+    d_readPos += got;
+    size_t offset = 0;
+    while (d_fd != -1 && (d_readPos - offset) >= sizeof(uint16_t)) {
+      uint16_t querySize = d_readBuffer.at(offset) * 256 + d_readBuffer.at(offset + 1);
+      if ((d_readPos - offset - sizeof(uint16_t)) < querySize) {
+        break;
+      }
+
+      if (querySize >= sizeof(dnsheader)) {
+        auto start = d_readBuffer.begin() + offset + sizeof(uint16_t);
+        std::vector<uint8_t> query(start, start + querySize);
+        d_threadData.sendQuery(d_ds, std::move(query), shared_from_this(), now);
+      }
+      offset += sizeof(uint16_t) + querySize;
+    }
+
+    if (offset > 0 && d_fd != -1) {
+      d_readBuffer.erase(d_readBuffer.begin(), d_readBuffer.begin() + offset);
+      d_readPos -= offset;
+    }
+  }
+}
+
+void DoHClientSource::sendResponse(const std::vector<uint8_t>& response)
+{
+  if (d_fd == -1) {
+    return;
+  }
+
+  if (!d_stream) {
+    /* if the other end is not keeping up, the response is dropped, as it would be over UDP */
+    ssize_t sent = send(d_fd, response.data(), response.size(), MSG_DONTWAIT | MSG_NOSIGNAL);
+    if (sent < 0) {
+      vinfolog("Error sending a response from the DoH backend %s: %s", d_ds->getNameWithAddr(), stringerror());
+    }
+    return;
+  }
+
+  uint16_t responseSize = response.size();
+  d_writeBuffer.reserve(d_writeBuffer.size() + sizeof(responseSize) + response.size());
+  d_writeBuffer.push_back(responseSize / 256);
+  d_writeBuffer.push_back(responseSize % 256);
+  d_writeBuffer.insert(d_writeBuffer.end(), response.begin(), response.end());
+  if (!d_writing) {
+    flushResponses();
+  }
+}
+
+void DoHClientSource::flushResponses()
+{
+  while (d_fd != -1 && d_writePos < d_writeBuffer.size()) {
+    ssize_t sent = send(d_fd, &d_writeBuffer.at(d_writePos), d_writeBuffer.size() - d_writePos, MSG_NOSIGNAL);
+    if (sent < 0) {
+      if (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR) {
+        if (!d_writing) {
+          d_threadData.mplexer->removeReadFD(d_fd);
+          d_threadData.mplexer->addWriteFD(d_fd, handleWritableCallback, shared_from_this());
+          d_writing = true;
+        }
+        return;
+      }
+      vinfolog("Error sending a response from the DoH backend %s: %s", d_ds->getNameWithAddr(), stringerror());
+      close();
+      return;
+    }
+    d_writePos += sent;
+  }
+
+  d_writeBuffer.clear();
+  d_writePos = 0;
+
+  if (d_writing && d_fd != -1) {
+    d_threadData.mplexer->removeWriteFD(d_fd);
+    d_threadData.mplexer->addReadFD(d_fd, handleReadableCallback, shared_from_this());
+    d_writing = false;
+  }
+}
+
+void DoHClientSource::queryFailed()
+{
+  /* there is no way to signal an error over a stream, but closing it will make the
+     TCP code retry its queries. The query will simply time out over datagrams. */
+  if (d_stream) {
+    close();
+  }
+}
+
+void DoHClientSource::close()
+{
+  if (d_fd == -1) {
+    return;
+  }
+
+  try {
+    if (d_writing) {
+      d_threadData.mplexer->removeWriteFD(d_fd);
+    }
+    else {
+      d_threadData.mplexer->removeReadFD(d_fd);
+    }
+  }
+  catch (const FDMultiplexerException& e) {
+  }
+
+  ::close(d_fd);
+  d_fd = -1;
+}
+
+DoHConnectionToBackend::DoHConnectionToBackend(DoHClientThreadData& threadData, const std::shared_ptr<DownstreamState>& ds): d_threadData(threadData), d_ds(ds), d_session(nullptr, nghttp2_session_del)
+{
+  d_socket = std::unique_ptr<Socket>(new Socket(ds->remote.sin4.sin_family, SOCK_STREAM, 0));
+  if (!IsAnyAddress(ds->sourceAddr)) {
+    SSetsockopt(d_socket->getHandle(), SOL_SOCKET, SO_REUSEADDR, 1);
+#ifdef IP_BIND_ADDRESS_NO_PORT
+    if (ds->ipBindAddrNoPort) {
+      SSetsockopt(d_socket->getHandle(), SOL_IP, IP_BIND_ADDRESS_NO_PORT, 1);
+    }
+#endif
+#ifdef SO_BINDTODEVICE
+    if (!ds->sourceItfName.empty()) {
+      int res = setsockopt(d_socket->getHandle(), SOL_SOCKET, SO_BINDTODEVICE, ds->sourceItfName.c_str(), ds->sourceItfName.length());
+      if (res != 0) {
+        vinfolog("Error setting up the interface on backend DoH socket '%s': %s", ds->getNameWithAddr(), stringerror());
+      }
+    }
+#endif
+    d_socket->bind(ds->sourceAddr, false);
+  }
+  d_socket->setNonBlocking();
+  SConnectWithTimeout(d_socket->getHandle(), ds->remote, /* no timeout, we will handle it ourselves */ 0);
+
+  /* no TLS context means HTTP/2 over cleartext TCP */
+  d_handler = std::unique_ptr<TCPIOHandler>(new TCPIOHandler(ds->d_tlsSubjectName, d_socket->getHandle(), ds->tcpRecvTimeout, ds->d_tlsCtx));
+  d_authority = !ds->d_tlsSubjectName.empty() ? ds->d_tlsSubjectName : ds->remote.toStringWithPort();
+  d_in.resize(16384);
+
+  nghttp2_session_callbacks* cbs = nullptr;
+  if (nghttp2_session_callbacks_new(&cbs) != 0) {
+    throw std::runtime_error("Unable to allocate the HTTP/2 session callbacks");
+  }
+  std::unique_ptr<nghttp2_session_callbacks, void(*)(nghttp2_session_callbacks*)> callbacks(cbs, nghttp2_session_callbacks_del);
+  nghttp2_session_callbacks_set_send_callback(cbs, sendCallback);
+  nghttp2_session_callbacks_set_on_header_callback(cbs, onHeaderCallback);
+  nghttp2_session_callbacks_set_on_data_chunk_recv_callback(cbs, onDataChunkRecvCallback);
+  nghttp2_session_callbacks_set_on_stream_close_callback(cbs, onStreamCloseCallback);
+
+  nghttp2_session* sess = nullptr;
+  if (nghttp2_session_client_new(&sess, cbs, this) != 0) {
+    throw std::runtime_error("Unable to create a new HTTP/2 session");
+  }
+  d_session = std::unique_ptr<nghttp2_session, void(*)(nghttp2_session*)>(sess, nghttp2_session_del);
+
+  nghttp2_settings_entry settings[] = {
+    { NGHTTP2_SETTINGS_MAX_CONCURRENT_STREAMS, s_maxConcurrentStreamsPerConnection },
+    { NGHTTP2_SETTINGS_ENABLE_PUSH, 0 }
+  };
+  int rv = nghttp2_submit_settings(d_session.get(), NGHTTP2_FLAG_NONE, settings, sizeof(settings) / sizeof(*settings));
+  if (rv != 0) {
+    throw std::runtime_error("Unable to submit the HTTP/2 settings: " + std::string(nghttp2_strerror(rv)));
+  }
+
+  ++d_ds->dohCurrentConnections;
+}
+
+DoHConnectionToBackend::~DoHConnectionToBackend()
+{
+  --d_ds->dohCurrentConnections;
+}
+
+void DoHConnectionToBackend::handleIOCallback(int fd, FDMultiplexer::funcparam_t& param)
+{
+  auto conn = boost::any_cast<std::shared_ptr<DoHConnectionToBackend>>(param);
+  struct timeval now;
+  gettimeofday(&now, nullptr);
+  conn->handleIO(now);
+}
+
+static nghttp2_nv makeNV(const std::string& name, const std::string& value)
+{
+  nghttp2_nv nv;
+  nv.name = const_cast<uint8_t*>(reinterpret_cast<const uint8_t*>(name.c_str()));
+  nv.value = const_cast<uint8_t*>(reinterpret_cast<const uint8_t*>(value.c_str()));
+  nv.namelen = name.size();
+  nv.valuelen = value.size();
+  nv.flags = NGHTTP2_NV_FLAG_NONE;
+  return nv;
+}
+
+void DoHConnectionToBackend::queueQuery(std::vector<uint8_t>&& query, const std::shared_ptr<DoHClientSource>& source, const struct timeval& now)
+{
+  auto conn = shared_from_this();
+
+  static const std::string methodHeader{":method"}, schemeHeader{":scheme"}, authorityHeader{":authority"}, pathHeader{":path"}, acceptHeader{"accept"}, contentTypeHeader{"content-type"}, contentLengthHeader{"content-length"};
+  static const std::string post{"POST"}, https{"https"}, http{"http"};
+  const std::string contentLength = std::to_string(query.size());
+
+  nghttp2_nv headers[] = {
+    makeNV(methodHeader, post),
+    makeNV(schemeHeader, d_handler->isTLS() ? https : http),
+    makeNV(authorityHeader, d_authority),
+    makeNV(pathHeader, d_ds->d_dohPath),
+    makeNV(acceptHeader, s_dnsMessageContentType),
+    makeNV(contentTypeHeader, s_dnsMessageContentType),
+    makeNV(contentLengthHeader, contentLength)
+  };
+
+  nghttp2_data_provider provider;
+  provider.source.ptr = nullptr;
+  provider.read_callback = dataReadCallback;
+
+  int32_t streamId = nghttp2_submit_request(d_session.get(), nullptr, headers, sizeof(headers) / sizeof(*headers), &provider, nullptr);
+  if (streamId < 0) {
+    vinfolog("Error submitting a query to the DoH backend %s: %s", d_ds->getNameWithAddr(), nghttp2_strerror(streamId));
+    ++d_ds->dohProtocolErrors;
+    source->queryFailed();
+    return;
+  }
+
+  auto& stream = d_streams[streamId];
+  stream.d_query = std::move(query);
+  stream.d_source = source;
+  stream.d_queryTime = now;
+
+  int rv = nghttp2_session_send(d_session.get());
+  if (rv != 0) {
+    vinfolog("Error sending a query to the DoH backend %s: %s", d_ds->getNameWithAddr(), nghttp2_strerror(rv));
+    ++d_ds->dohProtocolErrors;
+    stop();
+    return;
+  }
+
+  /* if we are already waiting for the socket to become writable, the data will be sent then */
+  if (d_ioState != IOState::NeedWrite) {
+    handleIO(now);
+  }
+}
+
+void DoHConnectionToBackend::handleIO(const struct timeval& now)
+{
+  if (d_state == State::dead) {
+    return;
+  }
+
+  /* stop() might release the last reference to this object */
+  auto conn = shared_from_this();
+  IOState newState = IOState::Done;
+
+  try {
+    if (d_state == State::connecting) {
+      newState = d_handler->tryHandshake();
+      if (newState != IOState::Done) {
+        updateIO(newState, now);
+        return;
+      }
+      d_state = State::established;
+      if (d_handler->isTLS() && d_handler->hasTLSSessionBeenResumed()) {
+        ++d_ds->tlsResumptions;
+      }
+    }
+
+    for (;;) {
+      if (d_outPos < d_out.size()) {
+        newState = d_handler->tryWrite(d_out, d_outPos, d_out.size());
+        if (newState != IOState::Done) {
+          break;
+        }
+        d_out.clear();
+        d_outPos = 0;
+      }
+
+      size_t got = 0;
+      newState = d_handler->tryRead(d_in, got, d_in.size(), true);
+      if (got == 0) {
+        break;
+      }
+
+      ssize_t processed = nghttp2_session_mem_recv(d_session.get(), d_in.data(), got);
+      if (processed < 0) {
+        throw std::runtime_error("Error processing the HTTP/2 data: " + std::string(nghttp2_strerror(processed)));
+      }
+      /* we might need to acknowledge settings, update windows or send new queries */
+      int rv = nghttp2_session_send(d_session.get());
+      if (rv != 0) {
+        throw std::runtime_error("Error sending HTTP/2 data: " + std::string(nghttp2_strerror(rv)));
+      }
+    }
+
+    if (d_out.empty() && nghttp2_session_want_read(d_session.get()) == 0 && nghttp2_session_want_write(d_session.get()) == 0) {
+      /* the backend asked us to go away and every stream is done */
+      stop();
+      return;
+    }
+  }
+  catch (const std::exception& e) {
+    if (d_state == State::connecting) {
+      ++d_ds->dohConnectErrors;
+    }
+    else if (!d_streams.empty()) {
+      ++d_ds->dohProtocolErrors;
+    }
+    vinfolog("Error on the DoH connection to %s: %s", d_ds->getNameWithAddr(), e.what());
+    stop();
+    return;
+  }
+
+  updateIO(newState, now);
+}
+
+void DoHConnectionToBackend::updateIO(IOState newState, const struct timeval& now)
+{
+  int fd = d_socket->getHandle();
+  int timeout = 0;
+  if (d_state == State::connecting) {
+    timeout = d_ds->tcpConnectTimeout;
+  }
+  else if (newState == IOState::NeedWrite) {
+    timeout = d_ds->tcpSendTimeout;
+  }
+  else if (!d_streams.empty()) {
+    timeout = d_ds->tcpRecvTimeout;
+  }
+
+  if (newState == d_ioState && (timeout > 0) == d_hasTTD) {
+    if (timeout > 0) {
+      if (newState == IOState::NeedRead) {
+        d_threadData.mplexer->setReadTTD(fd, now, timeout);
+      }
+      else {
+        d_threadData.mplexer->setWriteTTD(fd, now, timeout);
+      }
+    }
+    return;
+  }
+
+  if (d_ioState == IOState::NeedRead) {
+    d_threadData.mplexer->removeReadFD(fd);
+  }
+  else if (d_ioState == IOState::NeedWrite) {
+    d_threadData.mplexer->removeWriteFD(fd);
+  }
+
+  struct timeval ttd = now;
+  ttd.tv_sec += timeout;
+  if (newState == IOState::NeedRead) {
+    d_threadData.mplexer->addReadFD(fd, handleIOCallback, shared_from_this(), timeout > 0 ? &ttd : nullptr);
+  }
+  else if (newState == IOState::NeedWrite) {
+    d_threadData.mplexer->addWriteFD(fd, handleIOCallback, shared_from_this(), timeout > 0 ? &ttd : nullptr);
+  }
+
+  d_ioState = newState;
+  d_hasTTD = timeout > 0;
+}
+
+void DoHConnectionToBackend::handleTimeout(const struct timeval& now, bool write)
+{
+  if (d_state == State::dead) {
+    return;
+  }
+
+  auto conn = shared_from_this();
+  if (!write && d_state == State::established && d_streams.empty()) {
+    /* this connection is now idle, and idle connections are kept until the backend closes them */
+    updateIO(IOState::NeedRead, now);
+    return;
+  }
+
+  if (d_state == State::connecting) {
+    ++d_ds->dohConnectErrors;
+  }
+  else {
+    ++d_ds->dohTimeouts;
+  }
+  vinfolog("Timeout while %s the DoH backend %s", d_state == State::connecting ? "connecting to" : (write ? "writing to" : "reading from"), d_ds->getNameWithAddr());
+  stop();
+}
+
+/* the read timeout of the connection is pushed back by every I/O event, so a query the backend never
+   answers would otherwise stay there, holding a stream, as long as the other ones make progress */
+void DoHConnectionToBackend::expireStreams(const struct timeval& now)
+{
+  if (d_state != State::established || d_streams.empty()) {
+    return;
+  }
+
+  auto conn = shared_from_this();
+  const int64_t timeoutUsec = static_cast<int64_t>(d_ds->tcpRecvTimeout) * 1000000;
+  std::vector<int32_t> expired;
+  for (const auto& entry : d_streams) {
+    const auto& queryTime = entry.second.d_queryTime;
+    int64_t elapsed = static_cast<int64_t>(now.tv_sec - queryTime.tv_sec) * 1000000 + (now.tv_usec - queryTime.tv_usec);
+    if (elapsed >= timeoutUsec) {
+      expired.push_back(entry.first);
+    }
+  }
+
+  if (expired.empty()) {
+    return;
+  }
+
+  for (const auto streamId : expired) {
+    auto it = d_streams.find(streamId);
+    if (it == d_streams.end()) {
+      continue;
+    }
+    /* removed before resetting it, so that its closure does not report the query a second time */
+    auto source = it->second.d_source.lock();
+    d_streams.erase(it);
+
+    ++d_ds->dohTimeouts;
+    vinfolog("Timeout while waiting for a response from the DoH backend %s", d_ds->getNameWithAddr());
+    nghttp2_submit_rst_stream(d_session.get(), NGHTTP2_FLAG_NONE, streamId, NGHTTP2_CANCEL);
+    if (source) {
+      source->queryFailed();
+    }
+  }
+
+  int rv = nghttp2_session_send(d_session.get());
+  if (rv != 0) {
+    vinfolog("Error resetting streams to the DoH backend %s: %s", d_ds->getNameWithAddr(), nghttp2_strerror(rv));
+    ++d_ds->dohProtocolErrors;
+    stop();
+    return;
+  }
+
+  /* if we are already waiting for the socket to become writable, the data will be sent then */
+  if (d_ioState != IOState::NeedWrite) {
+    handleIO(now);
+  }
+}
+
+void DoHConnectionToBackend::stop()
+{
+  if (d_state == State::dead) {
+    return;
+  }
+
+  auto conn = shared_from_this();
+  d_state = State::dead;
+
+  try {
+    if (d_ioState == IOState::NeedRead) {
+      d_threadData.mplexer->removeReadFD(d_socket->getHandle());
+    }
+    else if (d_ioState == IOState::NeedWrite) {
+      d_threadData.mplexer->removeWriteFD(d_socket->getHandle());
+    }
+  }
+  catch (const FDMultiplexerException& e) {
+  }
+  d_ioState = IOState::Done;
+
+  auto streams = std::move(d_streams);
+  d_streams.clear();
+  for (const auto& stream : streams) {
+    auto source = stream.second.d_source.lock();
+    if (source) {
+      source->queryFailed();
+    }
+  }
+
+  d_handler.reset();
+  d_socket.reset();
+  d_threadData.removeConnection(d_ds, this);
+}
+
+void DoHConnectionToBackend::handleStreamClosed(int32_t streamId, uint32_t errorCode)
+{
+  auto it = d_streams.find(streamId);
+  if (it == d_streams.end()) {
+    return;
+  }
+
+  PendingStream stream = std::move(it->second);
+  d_streams.erase(it);
+
+  auto source = stream.d_source.lock();
+  if (errorCode != NGHTTP2_NO_ERROR || stream.d_responseTooLarge || stream.d_response.size() < sizeof(dnsheader)) {
+    ++d_ds->dohProtocolErrors;
+    if (source) {
+      source->queryFailed();
+    }
+    return;
+  }
+
+  if (stream.d_status != 200) {
+    vinfolog("Got a HTTP status of %d from the DoH backend %s", stream.d_status, d_ds->getNameWithAddr());
+    ++d_ds->dohHTTPErrors;
+    if (source) {
+      source->queryFailed();
+    }
+    return;
+  }
+
+  struct timeval now;
+  gettimeofday(&now, nullptr);
+  double udiff = (now.tv_sec - stream.d_queryTime.tv_sec) * 1000000.0 + (now.tv_usec - stream.d_queryTime.tv_usec);
+  d_ds->dohLatencyUsec = (127.0 * d_ds->dohLatencyUsec / 128.0) + udiff / 128.0;
+
+  if (source) {
+    source->sendResponse(stream.d_response);
+  }
+}
+
+ssize_t DoHConnectionToBackend::sendCallback(nghttp2_session* session, const uint8_t* data, size_t length, int flags, void* user_data)
+{
+  auto conn = static_cast<DoHConnectionToBackend*>(user_data);
+  conn->d_out.insert(conn->d_out.end(), data, data + length);
+  return length;
+}
+
+int DoHConnectionToBackend::onHeaderCallback(nghttp2_session* session, const nghttp2_frame* frame, const uint8_t* name, size_t namelen, const uint8_t* value, size_t valuelen, uint8_t flags, void* user_data)
+{
+  static const std::string statusHeader{":status"};
+
+  if (frame->hd.type != NGHTTP2_HEADERS || frame->headers.cat != NGHTTP2_HCAT_RESPONSE) {
+    return 0;
+  }
+
+  if (namelen != statusHeader.size() || memcmp(name, statusHeader.c_str(), namelen) != 0) {
+    return 0;
+  }
+
+  auto conn = static_cast<DoHConnectionToBackend*>(user_data);
+  auto it = conn->d_streams.find(frame->hd.stream_id);
+  if (it == conn->d_streams.end()) {
+    return 0;
+  }
+
+  uint16_t status = 0;
+  for (size_t idx = 0; idx < valuelen && idx < 3; idx++) {
+    if (value[idx] < '0' || value[idx] > '9') {
+      status = 0;
+      break;
+    }
+    status = status * 10 + (value[idx] - '0');
+  }
+  it->second.d_status = status;
+  return 0;
+}
+
+int DoHConnectionToBackend::onDataChunkRecvCallback(nghttp2_session* session, uint8_t flags, int32_t stream_id, const uint8_t* data, size_t len, void* user_data)
+{
+  auto conn = static_cast<DoHConnectionToBackend*>(user_data);
+  auto it = conn->d_streams.find(stream_id);
+  if (it == conn->d_streams.end()) {
+    return 0;
+  }
+
+  auto& stream = it->second;
+  if (stream.d_responseTooLarge) {
+    return 0;
+  }
+
+  if (stream.d_response.size() + len > std::numeric_limits<uint16_t>::max()) {
+    stream.d_responseTooLarge = true;
+    nghttp2_submit_rst_stream(session, NGHTTP2_FLAG_NONE, stream_id, NGHTTP2_REFUSED_STREAM);
+    return 0;
+  }
+
+  stream.d_response.insert(stream.d_response.end(), data, data + len);
+  return 0;
+}
+
+int DoHConnectionToBackend::onStreamCloseCallback(nghttp2_session* session, int32_t stream_id, uint32_t error_code, void* user_data)
+{
+  auto conn = static_cast<DoHConnectionToBackend*>(user_data);
+  conn->handleStreamClosed(stream_id, error_code);
+  return 0;
+}
+
+ssize_t DoHConnectionToBackend::dataReadCallback(nghttp2_session* session, int32_t stream_id, uint8_t* buf, size_t length, uint32_t* data_flags, nghttp2_data_source* source, void* user_data)
+{
+  auto conn = static_cast<DoHConnectionToBackend*>(user_data);
+  auto it = conn->d_streams.find(stream_id);
+  if (it == conn->d_streams.end()) {
+    return NGHTTP2_ERR_TEMPORAL_CALLBACK_FAILURE;
+  }
+
+  auto& stream = it->second;
+  size_t toCopy = std::min(length, stream.d_query.size() - stream.d_queryPos);
+  if (toCopy > 0) {
+    memcpy(buf, &stream.d_query.at(stream.d_queryPos), toCopy);
+    stream.d_queryPos += toCopy;
+  }
+
+  if (stream.d_queryPos >= stream.d_query.size()) {
+    *data_flags |= NGHTTP2_DATA_FLAG_EOF;
+  }
+
+  return toCopy;
+}
+
+void DoHClientThreadData::sendQuery(const std::shared_ptr<DownstreamState>& ds, std::vector<uint8_t>&& query, const std::shared_ptr<DoHClientSource>& source, const struct timeval& now)
+{
+  auto& conns = connections[ds];
+
+  /* pick the least loaded connection, opening a new one if they are all busy and we are allowed to */
+  std::shared_ptr<DoHConnectionToBackend> selected{nullptr};
+  for (const auto& conn : conns) {
+    if (!conn->canAcceptNewQueries()) {
+      continue;
+    }
+    if (!selected || conn->getInFlightQueriesCount() < selected->getInFlightQueriesCount()) {
+      selected = conn;
+    }
+  }
+
+  if ((!selected || selected->isSaturated()) && conns.size() < std::max(ds->dohMaxConnections, static_cast<size_t>(1))) {
+    try {
+      auto conn = std::make_shared<DoHConnectionToBackend>(*this, ds);
+      conns.push_back(conn);
+      selected = conn;
+    }
+    catch (const std::exception& e) {
+      ++ds->dohConnectErrors;
+      vinfolog("Error connecting to the DoH backend %s: %s", ds->getNameWithAddr(), e.what());
+    }
+  }
+
+  if (!selected) {
+    source->queryFailed();
+    return;
+  }
+
+  selected->queueQuery(std::move(query), source, now);
+}
+
+void DoHClientThreadData::removeConnection(const std::shared_ptr<DownstreamState>& ds, const DoHConnectionToBackend* conn)
+{
+  auto it = connections.find(ds);
+  if (it == connections.end()) {
+    return;
+  }
+
+  auto& conns = it->second;
+  for (auto connIt = conns.begin(); connIt != conns.end(); ++connIt) {
+    if (connIt->get() == conn) {
+      conns.erase(connIt);
+      break;
+    }
+  }
+
+  if (conns.empty()) {
+    connections.erase(it);
+  }
+}
+
+void DoHClientThreadData::addSource(const std::shared_ptr<DownstreamState>& ds, const std::shared_ptr<DoHClientSource>& source)
+{
+  sources[ds].push_back(source);
+}
+
+void DoHClientThreadData::cleanupStoppedBackends()
+{
+  std::vector<std::shared_ptr<DoHConnectionToBackend>> toStop;
+  for (const auto& entry : connections) {
+    if (entry.first->isStopped()) {
+      toStop.insert(toStop.end(), entry.second.begin(), entry.second.end());
+    }
+  }
+
+  for (auto& conn : toStop) {
+    conn->stop();
+  }
+
+  for (auto it = sources.begin(); it != sources.end(); ) {
+    auto& list = it->second;
+    if (it->first->isStopped()) {
+      /* closing our end of the socket pair removes the source from the multiplexer, releasing it */
+      for (const auto& weak : list) {
+        auto source = weak.lock();
+        if (source) {
+          source->close();
+        }
+      }
+      list.clear();
+    }
+    else {
+      list.erase(std::remove_if(list.begin(), list.end(), [](const std::weak_ptr<DoHClientSource>& weak) { return weak.expired(); }), list.end());
+    }
+
+    if (list.empty()) {
+      it = sources.erase(it);
+    }
+    else {
+      ++it;
+    }
+  }
+}
+
+void DoHClientThreadData::expireStreams(const struct timeval& now)
+{
+  /* expiring a stream might stop its connection, removing it from the map */
+  std::vector<std::shared_ptr<DoHConnectionToBackend>> conns;
+  for (const auto& entry : connections) {
+    conns.insert(conns.end(), entry.second.begin(), entry.second.end());
+  }
+
+  for (auto& conn : conns) {
+    conn->expireStreams(now);
+  }
+}
+
+static void handleNewSourceCallback(int pipefd, FDMultiplexer::funcparam_t& param)
+{
+  auto threadData = boost::any_cast<DoHClientThreadData*>(param);
+  DoHClientSourceRequest* tmp{nullptr};
+
+  ssize_t got = read(pipefd, &tmp, sizeof(tmp));
+  if (got == 0) {
+    throw std::runtime_error("EOF while reading from the DoH client thread pipe");
+  }
+  if (got == -1) {
+    if (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR) {
+      return;
+    }
+    throw std::runtime_error("Error while reading from the DoH client thread pipe: " + stringerror());
+  }
+  if (got != sizeof(tmp)) {
+    throw std::runtime_error("Partial read while reading from the DoH client thread pipe");
+  }
+
+  std::unique_ptr<DoHClientSourceRequest> request(tmp);
+  auto source = std::make_shared<DoHClientSource>(*threadData, request->d_ds, request->d_fd, request->d_stream);
+  threadData->mplexer->addReadFD(request->d_fd, DoHClientSource::handleReadableCallback, source);
+  threadData->addSource(request->d_ds, source);
+}
+
+static void dohClientThread(int pipefd)
+{
+  setThreadName("dnsdist/doh-cli");
+
+  DoHClientThreadData data;
+  data.mplexer->addReadFD(pipefd, handleNewSourceCallback, &data);
+
+  struct timeval now;
+  gettimeofday(&now, nullptr);
+  time_t lastTimeoutScan = now.tv_sec;
+
+  for (;;) {
+    try {
+      data.mplexer->run(&now);
+
+      if (now.tv_sec > lastTimeoutScan) {
+        lastTimeoutScan = now.tv_sec;
+
+        for (const bool write : { false, true }) {
+          auto expired = data.mplexer->getTimeouts(now, write);
+          for (const auto& cbData : expired) {
+            if (cbData.second.type() == typeid(std::shared_ptr<DoHConnectionToBackend>)) {
+              auto conn = boost::any_cast<std::shared_ptr<DoHConnectionToBackend>>(cbData.second);
+              conn->handleTimeout(now, write);
+            }
+          }
+        }
+
+        data.expireStreams(now);
+        data.cleanupStoppedBackends();
+      }
+    }
+    catch (const std::exception& e) {
+      warnlog("Error in the DoH client thread: %s", e.what());
+    }
+  }
+}
+
+static void initDoHClientPipe()
+{
+  std::call_once(s_dohClientPipeInitialized, []() {
+    if (pipe(s_dohClientPipe) < 0) {
+      throw std::runtime_error("Error creating the DoH client thread pipe: " + stringerror());
+    }
+
+    if (!setNonBlocking(s_dohClientPipe[0])) {
+      int err = errno;
+      close(s_dohClientPipe[0]);
+      close(s_dohClientPipe[1]);
+      throw std::runtime_error("Error setting the DoH client thread pipe non-blocking: " + stringerror(err));
+    }
+  });
+}
+
+static void passSourceToDoHClientThread(const std::shared_ptr<DownstreamState>& ds, int fd, bool stream)
+{
+  initDoHClientPipe();
+
+  auto request = new DoHClientSourceRequest();
+  request->d_ds = ds;
+  request->d_fd = fd;
+  request->d_stream = stream;
+
+  static_assert(sizeof(request) <= PIPE_BUF, "Writes up to PIPE_BUF are guaranteed not to be interleaved and to either fully succeed or fail");
+  ssize_t sent = write(s_dohClientPipe[1], &request, sizeof(request));
+  if (sent != sizeof(request)) {
+    int err = errno;
+    delete request;
+    throw std::runtime_error("Error passing a socket to the DoH client thread: " + stringerror(err));
+  }
+}
+
+static int getDoHClientSocket(const std::shared_ptr<DownstreamState>& ds, int type)
+{
+  int fds[2] = { -1, -1 };
+  if (socketpair(AF_UNIX, type, 0, fds) != 0) {
+    throw std::runtime_error("Error creating a socket pair for the DoH backend " + ds->getNameWithAddr() + ": " + stringerror());
+  }
+
+  try {
+    if (!setNonBlocking(fds[1])) {
+      throw std::runtime_error("Error setting the DoH client socket non-blocking: " + stringerror());
+    }
+    passSourceToDoHClientThread(ds, fds[1], type == SOCK_STREAM);
+  }
+  catch (...) {
+    close(fds[0]);
+    close(fds[1]);
+    throw;
+  }
+
+  return fds[0];
+}
+
+bool isOutgoingDoHSupported()
+{
+  return true;
+}
+
+void setupDoHClientBackend(const std::shared_ptr<DownstreamState>& ds)
+{
+  std::lock_guard<std::mutex> lock(ds->connectLock);
+
+  for (auto& fd : ds->sockets) {
+    if (fd != -1) {
+      if (ds->sockets.size() > 1) {
+        std::lock_guard<std::mutex> socketsLock(ds->socketsLock);
+        ds->mplexer->removeReadFD(fd);
+      }
+      close(fd);
+      fd = -1;
+    }
+  }
+  ds->connected = false;
+
+  for (auto& fd : ds->sockets) {
+    /* our end stays blocking, the responder thread waits for responses on it */
+    fd = getDoHClientSocket(ds, SOCK_SEQPACKET);
+    if (ds->sockets.size() > 1) {
+      std::lock_guard<std::mutex> socketsLock(ds->socketsLock);
+      ds->mplexer->addReadFD(fd, [](int, boost::any) {});
+    }
+  }
+
+  ds->connected = true;
+}
+
+void startDoHClientThread()
+{
+  initDoHClientPipe();
+
+  std::call_once(s_dohClientThreadStarted, []() {
+    std::thread dohClient(dohClientThread, s_dohClientPipe[0]);
+    dohClient.detach();
+  });
+}
+
+int getDoHClientStreamSocket(const std::shared_ptr<DownstreamState>& ds)
+{
+  int fd = getDoHClientSocket(ds, SOCK_STREAM);
+  if (!setNonBlocking(fd)) {
+    int err = errno;
+    close(fd);
+    throw std::runtime_error("Error setting the DoH client socket non-blocking: " + stringerror(err));
+  }
+  return fd;
+}
+
+int getDoHClientDatagramSocket(const std::shared_ptr<DownstreamState>& ds)
+{
+  return getDoHClientSocket(ds, SOCK_SEQPACKET);
+}
+
+#else /* HAVE_NGHTTP2 */
+
+bool isOutgoingDoHSupported()
+{
+  return false;
+}
+
+void setupDoHClientBackend(const std::shared_ptr<DownstreamState>& ds)
+{
+  throw std::runtime_error("Outgoing DNS over HTTPS support is not available");
+}
+
+void startDoHClientThread()
+{
+}
+
+int getDoHClientStreamSocket(const std::shared_ptr<DownstreamState>& ds)
+{
+  throw std::runtime_error("Outgoing DNS over HTTPS support is not available");
+}
+
+int getDoHClientDatagramSocket(const std::shared_ptr<DownstreamState>& ds)
+{
+  throw std::runtime_error("Outgoing DNS over HTTPS support is not available");
+}
+
+#endif /* HAVE_NGHTTP2 */
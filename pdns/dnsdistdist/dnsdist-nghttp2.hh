@@ -0,0 +1,54 @@
+/*
+ * This file is part of PowerDNS or dnsdist.
+ * Copyright -- PowerDNS.COM B.V. and its contributors
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of version 2 of the GNU General Public License as
+ * published by the Free Software Foundation.
+ *
+ * In addition, for the avoidance of any doubt, permission is granted to
+ * link this program with OpenSSL and to (re)distribute the binaries
+ * produced as the result of such linking.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+ */
+#pragma once
+
+#include <memory>
+
+#include "config.h"
+
+struct DownstreamState;
+
+/* Outgoing DNS over HTTPS, over HTTP/2.
+
+   A single worker thread maintains a small pool of long-lived HTTP/2 connections to each DoH
+   backend, multiplexing the queries over them. The rest of dnsdist talks to that thread over
+   local socket pairs, as if it were talking to a regular backend:
+   - the UDP sockets of a DoH backend are replaced by SOCK_SEQPACKET sockets, one query or
+     response per message, so that the UDP and DoH frontends, and the responder thread, don't
+     need to know about DoH at all ;
+   - the TCP connections to a DoH backend are replaced by SOCK_STREAM sockets, using the
+     regular DNS over TCP framing ;
+   - health check queries use a dedicated SOCK_SEQPACKET socket.
+*/
+
+bool isOutgoingDoHSupported();
+/* replaces the UDP sockets of this backend by sockets connected to the DoH worker thread,
+   throws if that fails */
+void setupDoHClientBackend(const std::shared_ptr<DownstreamState>& ds);
+/* starts the DoH worker thread, if it is not running yet */
+void startDoHClientThread();
+/* returns a socket connected to the DoH worker thread, over which DNS over TCP queries for that backend
+   can be sent. The caller owns the socket. Throws on error */
+int getDoHClientStreamSocket(const std::shared_ptr<DownstreamState>& ds);
+/* returns a socket connected to the DoH worker thread, over which queries for that backend can be sent,
+   one per message. The caller owns the socket. Throws on error */
+int getDoHClientDatagramSocket(const std::shared_ptr<DownstreamState>& ds);
@@ -0,0 +1 @@
+../dnsdist-rings-history.cc
\ No newline at end of file
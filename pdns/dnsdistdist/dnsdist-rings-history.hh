@@ -0,0 +1 @@
+../dnsdist-rings-history.hh
\ No newline at end of file
@@ -0,0 +1,133 @@
+/*
+ * This file is part of PowerDNS or dnsdist.
+ * Copyright -- PowerDNS.COM B.V. and its contributors
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of version 2 of the GNU General Public License as
+ * published by the Free Software Foundation.
+ *
+ * In addition, for the avoidance of any doubt, permission is granted to
+ * link this program with OpenSSL and to (re)distribute the binaries
+ * produced as the result of such linking.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+ */
+
+#include <algorithm>
+
+#include "dnsdist.hh"
+#include "dnsdist-rules.hh"
+
+void RuleChainIndex::update(const std::vector<DNSDistRuleAction>& rules)
+{
+  if (d_source == &rules) {
+    return;
+  }
+
+  d_source = &rules;
+  d_exact.clear();
+  d_suffixes.clear();
+  d_qtypes.clear();
+  d_generic.clear();
+  d_indexed.clear();
+  d_indexed.resize(rules.size(), false);
+
+  size_t indexedRules = 0;
+  for (size_t position = 0; position < rules.size(); position++) {
+    const DNSRule* rule = rules.at(position).d_rule.get();
+
+    if (const auto qnameRule = dynamic_cast<const QNameRule*>(rule)) {
+      d_exact[qnameRule->getQName()].push_back(position);
+    }
+    else if (const auto qnameSetRule = dynamic_cast<const QNameSetRule*>(rule)) {
+      for (const auto& name : qnameSetRule->getNames()) {
+        d_exact[name].push_back(position);
+      }
+    }
+    else if (const auto suffixRule = dynamic_cast<const SuffixMatchNodeRule*>(rule)) {
+      for (const auto& name : suffixRule->getSuffixMatchNode().d_tree.getNodes()) {
+        /* the root node is reported as an empty name */
+        auto& positions = d_suffixes[name.empty() ? g_rootdnsname : name];
+        /* the same rule might cover both a name and one of its parents */
+        if (positions.empty() || positions.back() != position) {
+          positions.push_back(position);
+        }
+      }
+    }
+    else if (const auto qtypeRule = dynamic_cast<const QTypeRule*>(rule)) {
+      d_qtypes[qtypeRule->getType()].push_back(position);
+    }
+    else {
+      d_generic.push_back(position);
+      continue;
+    }
+
+    d_indexed.at(position) = true;
+    indexedRules++;
+  }
+
+  d_enabled = indexedRules >= s_minIndexedRules;
+  d_candidates.reserve(rules.size());
+}
+
+const std::vector<RuleChainIndex::Candidate>& RuleChainIndex::getCandidates(const DNSQuestion& dq)
+{
+  d_matched.clear();
+
+  if (!d_exact.empty()) {
+    const auto it = d_exact.find(*dq.qname);
+    if (it != d_exact.end()) {
+      d_matched.insert(d_matched.end(), it->second.begin(), it->second.end());
+    }
+  }
+
+  if (!d_suffixes.empty()) {
+    DNSName current(*dq.qname);
+    do {
+      const auto it = d_suffixes.find(current);
+      if (it != d_suffixes.end()) {
+        d_matched.insert(d_matched.end(), it->second.begin(), it->second.end());
+      }
+    }
+    while (current.chopOff());
+  }
+
+  if (!d_qtypes.empty()) {
+    const auto it = d_qtypes.find(dq.qtype);
+    if (it != d_qtypes.end()) {
+      d_matched.insert(d_matched.end(), it->second.begin(), it->second.end());
+    }
+  }
+
+  std::sort(d_matched.begin(), d_matched.end());
+  d_matched.erase(std::unique(d_matched.begin(), d_matched.end()), d_matched.end());
+
+  /* merge the rules we know are matching with the ones we still need to evaluate, keeping the order of the chain */
+  d_candidates.clear();
+  auto matched = d_matched.cbegin();
+  auto generic = d_generic.cbegin();
+  while (matched != d_matched.cend() || generic != d_generic.cend()) {
+    if (generic == d_generic.cend() || (matched != d_matched.cend() && *matched < *generic)) {
+      d_candidates.push_back({*matched, true});
+      ++matched;
+    }
+    else {
+      d_candidates.push_back({*generic, false});
+      ++generic;
+    }
+  }
+
+  return d_candidates;
+}
+
+bool RuleChainIndex::isIndexed(size_t position) const
+{
+  return position < d_indexed.size() && d_indexed.at(position);
+}
@@ -581,6 +581,10 @@ public:
     else
       return "qname in "+d_smn.toString();
   }
+  const SuffixMatchNode& getSuffixMatchNode() const
+  {
+    return d_smn;
+  }
 private:
   SuffixMatchNode d_smn;
   bool d_quiet;
@@ -601,6 +605,10 @@ public:
   {
     return "qname=="+d_qname.toString();
   }
+  const DNSName& getQName() const
+  {
+    return d_qname;
+  }
 private:
   DNSName d_qname;
 };
@@ -618,6 +626,10 @@ public:
         ss << "qname in DNSNameSet(" << qname_idx.size() << " FQDNs)";
         return ss.str();
     }
+
+    const DNSNameSet& getNames() const {
+        return qname_idx;
+    }
 private:
     DNSNameSet qname_idx;
 };
@@ -637,6 +649,10 @@ public:
     QType qt(d_qtype);
     return "qtype=="+qt.getName();
   }
+  uint16_t getType() const
+  {
+    return d_qtype;
+  }
 private:
   uint16_t d_qtype;
 };
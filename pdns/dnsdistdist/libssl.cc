@@ -730,6 +730,73 @@ std::unique_ptr<SSL_CTX, void(*)(SSL_CTX*)> libssl_init_server_context(const TLS
   return ctx;
 }
 
+std::unique_ptr<SSL_CTX, void(*)(SSL_CTX*)> libssl_init_client_context(const TLSContextParameters& params)
+{
+  auto ctx = std::unique_ptr<SSL_CTX, void(*)(SSL_CTX*)>(SSL_CTX_new(SSLv23_client_method()), SSL_CTX_free);
+  if (!ctx) {
+    throw std::runtime_error("Error creating a TLS client context");
+  }
+
+  int sslOptions =
+    SSL_OP_NO_SSLv2 |
+    SSL_OP_NO_SSLv3 |
+    SSL_OP_NO_COMPRESSION |
+    SSL_OP_NO_SESSION_RESUMPTION_ON_RENEGOTIATION;
+
+  SSL_CTX_set_options(ctx.get(), sslOptions);
+
+  if (params.d_validateCertificates) {
+    if (params.d_caStore.empty()) {
+      if (SSL_CTX_set_default_verify_paths(ctx.get()) != 1) {
+        throw std::runtime_error("Error adding the system's default trusted CAs");
+      }
+    }
+    else {
+      if (SSL_CTX_load_verify_locations(ctx.get(), params.d_caStore.c_str(), nullptr) != 1) {
+        throw std::runtime_error("Error adding the trusted CAs file " + params.d_caStore);
+      }
+    }
+
+    SSL_CTX_set_verify(ctx.get(), SSL_VERIFY_PEER, nullptr);
+  }
+
+  /* the sessions are handed to us via the new session callback, and stored outside of OpenSSL */
+  SSL_CTX_set_session_cache_mode(ctx.get(), SSL_SESS_CACHE_CLIENT | SSL_SESS_CACHE_NO_INTERNAL_STORE);
+
+  if (!params.d_ciphers.empty() && SSL_CTX_set_cipher_list(ctx.get(), params.d_ciphers.c_str()) != 1) {
+    throw std::runtime_error("The TLS ciphers could not be set: " + params.d_ciphers);
+  }
+
+#ifdef HAVE_SSL_CTX_SET_CIPHERSUITES
+  if (!params.d_ciphers13.empty() && SSL_CTX_set_ciphersuites(ctx.get(), params.d_ciphers13.c_str()) != 1) {
+    throw std::runtime_error("The TLS 1.3 ciphers could not be set: " + params.d_ciphers13);
+  }
+#endif /* HAVE_SSL_CTX_SET_CIPHERSUITES */
+
+  if (!params.d_alpnProtocols.empty()) {
+#ifdef HAVE_SSL_CTX_SET_ALPN_PROTOS
+    /* wire format: each protocol name prefixed by its length */
+    std::vector<uint8_t> wire;
+    for (const auto& protocol : params.d_alpnProtocols) {
+      if (protocol.empty() || protocol.size() > std::numeric_limits<uint8_t>::max()) {
+        throw std::runtime_error("Invalid ALPN protocol name '" + protocol + "'");
+      }
+      wire.push_back(static_cast<uint8_t>(protocol.size()));
+      wire.insert(wire.end(), protocol.begin(), protocol.end());
+    }
+
+    /* this one returns 0 on success */
+    if (SSL_CTX_set_alpn_protos(ctx.get(), wire.data(), wire.size()) != 0) {
+      throw std::runtime_error("Error setting the ALPN protocols");
+    }
+#else
+    throw std::runtime_error("ALPN is not supported by this version of OpenSSL");
+#endif /* HAVE_SSL_CTX_SET_ALPN_PROTOS */
+  }
+
+  return ctx;
+}
+
 #ifdef HAVE_SSL_CTX_SET_KEYLOG_CALLBACK
 static void libssl_key_log_file_callback(const SSL* ssl, const char* line)
 {
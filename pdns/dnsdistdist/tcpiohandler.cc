@@ -5,6 +5,9 @@
 #include "lock.hh"
 #include "tcpiohandler.hh"
 
+#include <deque>
+#include <mutex>
+
 #ifdef HAVE_LIBSODIUM
 #include <sodium.h>
 #endif /* HAVE_LIBSODIUM */
@@ -15,6 +18,7 @@
 #include <openssl/err.h>
 #include <openssl/rand.h>
 #include <openssl/ssl.h>
+#include <openssl/x509v3.h>
 
 #include "libssl.hh"
 
@@ -45,34 +49,108 @@ public:
   std::unique_ptr<FILE, int(*)(FILE*)> d_keyLogFile{nullptr, fclose};
 };
 
+/* state shared by the outgoing connections using the same context, including the sessions
+   sent by the servers, which can be used to resume subsequent connections */
+class OpenSSLClientContext
+{
+public:
+  OpenSSLClientContext(const TLSContextParameters& params): d_maxStoredSessions(params.d_maxStoredSessions)
+  {
+    registerOpenSSLUser();
+
+    d_tlsCtx = libssl_init_client_context(params);
+  }
+
+  ~OpenSSLClientContext()
+  {
+    d_sessions.clear();
+    d_tlsCtx.reset();
+
+    unregisterOpenSSLUser();
+  }
+
+  /* takes ownership of the session */
+  void storeSession(SSL_SESSION* session)
+  {
+    std::unique_ptr<SSL_SESSION, void(*)(SSL_SESSION*)> ptr(session, SSL_SESSION_free);
+    if (d_maxStoredSessions == 0) {
+      return;
+    }
+
+    std::lock_guard<std::mutex> lock(d_sessionsLock);
+    if (d_sessions.size() >= d_maxStoredSessions) {
+      d_sessions.pop_front();
+    }
+    d_sessions.push_back(std::move(ptr));
+  }
+
+  /* a session is only used once, as recommended for TLS 1.3 tickets */
+  std::unique_ptr<SSL_SESSION, void(*)(SSL_SESSION*)> getSession()
+  {
+    std::lock_guard<std::mutex> lock(d_sessionsLock);
+    if (d_sessions.empty()) {
+      return std::unique_ptr<SSL_SESSION, void(*)(SSL_SESSION*)>(nullptr, SSL_SESSION_free);
+    }
+
+    auto session = std::move(d_sessions.back());
+    d_sessions.pop_back();
+    return session;
+  }
+
+  std::unique_ptr<SSL_CTX, void(*)(SSL_CTX*)> d_tlsCtx{nullptr, SSL_CTX_free};
+
+private:
+  std::deque<std::unique_ptr<SSL_SESSION, void(*)(SSL_SESSION*)>> d_sessions;
+  std::mutex d_sessionsLock;
+  const size_t d_maxStoredSessions;
+};
+
 class OpenSSLTLSConnection: public TLSConnection
 {
 public:
   OpenSSLTLSConnection(int socket, unsigned int timeout, std::shared_ptr<OpenSSLFrontendContext> feContext): d_feContext(feContext), d_conn(std::unique_ptr<SSL, void(*)(SSL*)>(SSL_new(d_feContext->d_tlsCtx.get()), SSL_free)), d_timeout(timeout)
   {
     d_socket = socket;
+    attachSocket();
+  }
 
-    if (!s_initTLSConnIndex.test_and_set()) {
-      /* not initialized yet */
-      s_tlsConnIndex = SSL_get_ex_new_index(0, nullptr, nullptr, nullptr, nullptr);
-      if (s_tlsConnIndex == -1) {
-        throw std::runtime_error("Error getting an index for TLS connection data");
+  OpenSSLTLSConnection(const std::string& hostname, int socket, unsigned int timeout, std::shared_ptr<OpenSSLClientContext> clientContext): d_clientContext(clientContext), d_conn(std::unique_ptr<SSL, void(*)(SSL*)>(SSL_new(d_clientContext->d_tlsCtx.get()), SSL_free)), d_timeout(timeout), d_isClient(true)
+  {
+    d_socket = socket;
+    attachSocket();
+
+    if (!hostname.empty()) {
+      bool isAddress = false;
+      try {
+        ComboAddress addr(hostname);
+        isAddress = true;
+      }
+      catch (const PDNSException& e) {
       }
-    }
 
-    if (!d_conn) {
-      vinfolog("Error creating TLS object");
-      if (g_verbose) {
-        ERR_print_errors_fp(stderr);
+      /* the certificate is only checked against these if the context requires the validation of certificates */
+      X509_VERIFY_PARAM* param = SSL_get0_param(d_conn.get());
+      if (isAddress) {
+        if (X509_VERIFY_PARAM_set1_ip_asc(param, hostname.c_str()) != 1) {
+          throw std::runtime_error("Error setting the address to validate the TLS certificate against: " + hostname);
+        }
       }
-      throw std::runtime_error("Error creating TLS object");
-    }
+      else {
+        X509_VERIFY_PARAM_set_hostflags(param, X509_CHECK_FLAG_NO_PARTIAL_WILDCARDS);
+        if (X509_VERIFY_PARAM_set1_host(param, hostname.c_str(), hostname.size()) != 1) {
+          throw std::runtime_error("Error setting the name to validate the TLS certificate against: " + hostname);
+        }
 
-    if (!SSL_set_fd(d_conn.get(), d_socket)) {
-      throw std::runtime_error("Error assigning socket");
+        if (SSL_set_tlsext_host_name(d_conn.get(), hostname.c_str()) != 1) {
+          throw std::runtime_error("Error setting the TLS Server Name Indication to " + hostname);
+        }
+      }
     }
 
-    SSL_set_ex_data(d_conn.get(), s_tlsConnIndex, this);
+    auto session = d_clientContext->getSession();
+    if (session && SSL_set_session(d_conn.get(), session.get()) != 1) {
+      throw std::runtime_error("Error setting a TLS session to resume");
+    }
   }
 
   IOState convertIORequestToIOState(int res) const
@@ -87,9 +165,14 @@ public:
     else if (error == SSL_ERROR_SYSCALL) {
       throw std::runtime_error("Error while processing TLS connection: " + std::string(strerror(errno)));
     }
-    else {
-      throw std::runtime_error("Error while processing TLS connection: " + std::to_string(error));
+    else if (error == SSL_ERROR_SSL && d_isClient) {
+      long verifyResult = SSL_get_verify_result(d_conn.get());
+      if (verifyResult != X509_V_OK) {
+        throw std::runtime_error("Error while validating the TLS certificate presented by the server: " + std::string(X509_verify_cert_error_string(verifyResult)));
+      }
     }
+
+    throw std::runtime_error("Error while processing TLS connection: " + std::to_string(error));
   }
 
   void handleIORequest(int res, unsigned int timeout)
@@ -117,22 +200,23 @@ public:
 
   IOState tryHandshake() override
   {
-    int res = SSL_accept(d_conn.get());
+    int res = d_isClient ? SSL_connect(d_conn.get()) : SSL_accept(d_conn.get());
     if (res == 1) {
+      handshakeDone();
       return IOState::Done;
     }
     else if (res < 0) {
       return convertIORequestToIOState(res);
     }
 
-    throw std::runtime_error("Error accepting TLS connection");
+    throw std::runtime_error(d_isClient ? "Error establishing TLS connection" : "Error accepting TLS connection");
   }
 
   void doHandshake() override
   {
     int res = 0;
     do {
-      res = SSL_accept(d_conn.get());
+      res = d_isClient ? SSL_connect(d_conn.get()) : SSL_accept(d_conn.get());
       if (res < 0) {
         handleIORequest(res, d_timeout);
       }
@@ -140,8 +224,10 @@ public:
     while (res < 0);
 
     if (res != 1) {
-      throw std::runtime_error("Error accepting TLS connection");
+      throw std::runtime_error(d_isClient ? "Error establishing TLS connection" : "Error accepting TLS connection");
     }
+
+    handshakeDone();
   }
 
   IOState tryWrite(std::vector<uint8_t>& buffer, size_t& pos, size_t toWrite) override
@@ -159,7 +245,7 @@ public:
     return IOState::Done;
   }
 
-  IOState tryRead(std::vector<uint8_t>& buffer, size_t& pos, size_t toRead) override
+  IOState tryRead(std::vector<uint8_t>& buffer, size_t& pos, size_t toRead, bool allowIncomplete) override
   {
     do {
       int res = SSL_read(d_conn.get(), reinterpret_cast<char *>(&buffer.at(pos)), static_cast<int>(toRead - pos));
@@ -168,6 +254,9 @@ public:
       }
       else {
         pos += static_cast<size_t>(res);
+        if (allowIncomplete) {
+          break;
+        }
       }
     }
     while (pos < toRead);
@@ -269,14 +358,71 @@ public:
     return false;
   }
 
+  /* called by OpenSSL when an outgoing connection receives a new session from the server */
+  static int newTicketFromServerCb(SSL* ssl, SSL_SESSION* session)
+  {
+    OpenSSLTLSConnection* conn = reinterpret_cast<OpenSSLTLSConnection*>(SSL_get_ex_data(ssl, s_tlsConnIndex));
+    if (conn == nullptr || !conn->d_clientContext) {
+      return 0;
+    }
+
+    conn->d_clientContext->storeSession(session);
+    /* we took ownership of the session */
+    return 1;
+  }
+
   static int s_tlsConnIndex;
 
 private:
+  void attachSocket()
+  {
+    if (!s_initTLSConnIndex.test_and_set()) {
+      /* not initialized yet */
+      s_tlsConnIndex = SSL_get_ex_new_index(0, nullptr, nullptr, nullptr, nullptr);
+      if (s_tlsConnIndex == -1) {
+        throw std::runtime_error("Error getting an index for TLS connection data");
+      }
+    }
+
+    if (!d_conn) {
+      vinfolog("Error creating TLS object");
+      if (g_verbose) {
+        ERR_print_errors_fp(stderr);
+      }
+      throw std::runtime_error("Error creating TLS object");
+    }
+
+    if (!SSL_set_fd(d_conn.get(), d_socket)) {
+      throw std::runtime_error("Error assigning socket");
+    }
+
+    SSL_set_ex_data(d_conn.get(), s_tlsConnIndex, this);
+  }
+
+  void handshakeDone()
+  {
+    if (!d_isClient || !SSL_session_reused(d_conn.get())) {
+      return;
+    }
+
+#ifdef TLS1_3_VERSION
+    if (SSL_version(d_conn.get()) == TLS1_3_VERSION) {
+      /* the server will send us new tickets */
+      return;
+    }
+#endif /* TLS1_3_VERSION */
+
+    /* before TLS 1.3 a session can be resumed several times, keep it */
+    d_clientContext->storeSession(SSL_get1_session(d_conn.get()));
+  }
+
   static std::atomic_flag s_initTLSConnIndex;
 
-  std::shared_ptr<OpenSSLFrontendContext> d_feContext;
+  std::shared_ptr<OpenSSLFrontendContext> d_feContext{nullptr};
+  std::shared_ptr<OpenSSLClientContext> d_clientContext{nullptr};
   std::unique_ptr<SSL, void(*)(SSL*)> d_conn;
   unsigned int d_timeout;
+  bool d_isClient{false};
 };
 
 std::atomic_flag OpenSSLTLSConnection::s_initTLSConnIndex = ATOMIC_FLAG_INIT;
@@ -393,6 +539,37 @@ private:
   std::shared_ptr<OpenSSLFrontendContext> d_feContext;
 };
 
+class OpenSSLTLSClientCtx: public TLSCtx
+{
+public:
+  OpenSSLTLSClientCtx(const TLSContextParameters& params): d_clientContext(std::make_shared<OpenSSLClientContext>(params))
+  {
+    SSL_CTX_sess_set_new_cb(d_clientContext->d_tlsCtx.get(), &OpenSSLTLSConnection::newTicketFromServerCb);
+  }
+
+  std::unique_ptr<TLSConnection> getConnection(int socket, unsigned int timeout, time_t now) override
+  {
+    throw std::runtime_error("This TLS context can only be used for outgoing connections");
+  }
+
+  std::unique_ptr<TLSConnection> getClientConnection(const std::string& host, int socket, unsigned int timeout) override
+  {
+    return std::unique_ptr<OpenSSLTLSConnection>(new OpenSSLTLSConnection(host, socket, timeout, d_clientContext));
+  }
+
+  void rotateTicketsKey(time_t now) override
+  {
+  }
+
+  size_t getTicketsKeysCount() override
+  {
+    return 0;
+  }
+
+private:
+  std::shared_ptr<OpenSSLClientContext> d_clientContext;
+};
+
 #endif /* HAVE_LIBSSL */
 
 #ifdef HAVE_GNUTLS
@@ -587,7 +764,7 @@ public:
     return IOState::Done;
   }
 
-  IOState tryRead(std::vector<uint8_t>& buffer, size_t& pos, size_t toRead) override
+  IOState tryRead(std::vector<uint8_t>& buffer, size_t& pos, size_t toRead, bool allowIncomplete) override
   {
     do {
       ssize_t res = gnutls_record_recv(d_conn.get(), reinterpret_cast<char *>(&buffer.at(pos)), toRead - pos);
@@ -596,6 +773,9 @@ public:
       }
       else if (res > 0) {
         pos += static_cast<size_t>(res);
+        if (allowIncomplete) {
+          break;
+        }
       }
       else if (res < 0) {
         if (gnutls_error_is_fatal(res)) {
@@ -908,3 +1088,19 @@ bool TLSFrontend::setupTLS()
 #endif /* HAVE_DNS_OVER_TLS */
   return true;
 }
+
+std::shared_ptr<TLSCtx> getTLSContext(const TLSContextParameters& params)
+{
+#ifdef HAVE_DNS_OVER_TLS
+  /* only the OpenSSL provider supports outgoing connections for now */
+  if (!params.d_provider.empty() && params.d_provider != "openssl") {
+    throw std::runtime_error("The '" + params.d_provider + "' TLS provider does not support outgoing connections");
+  }
+
+#ifdef HAVE_LIBSSL
+  return std::make_shared<OpenSSLTLSClientCtx>(params);
+#endif /* HAVE_LIBSSL */
+#endif /* HAVE_DNS_OVER_TLS */
+
+  throw std::runtime_error("TLS support for outgoing connections is not available");
+}
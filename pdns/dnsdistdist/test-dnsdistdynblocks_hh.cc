@@ -82,6 +82,193 @@ BOOST_AUTO_TEST_CASE(test_DynBlockRulesGroup_QueryRate) {
 
 }
 
+BOOST_AUTO_TEST_CASE(test_DynBlockRulesGroup_Incremental) {
+  dnsheader dh;
+  DNSName qname("rings.powerdns.com.");
+  ComboAddress requestor1("192.0.2.1");
+  ComboAddress requestor2("192.0.2.2");
+  uint16_t qtype = QType::AAAA;
+  uint16_t size = 42;
+  struct timespec now;
+  gettime(&now);
+  NetmaskTree<DynBlock> emptyNMG;
+
+  time_t numberOfSeconds = 10;
+  unsigned int blockDuration = 60;
+  const auto action = DNSAction::Action::Drop;
+  const std::string reason = "Exceeded query rate";
+
+  DynBlockRulesGroup dbrg;
+  dbrg.setQuiet(true);
+  dbrg.setIncremental(true);
+
+  /* block above 50 qps for numberOfSeconds seconds, no warning */
+  dbrg.setQueryRate(50, 0, numberOfSeconds, reason, blockDuration, action);
+  /* and above 20 ANY qps over twice that period */
+  dbrg.setQTypeRate(QType::ANY, 20, 0, numberOfSeconds * 2, reason, blockDuration, action);
+
+  g_rings.clear();
+  g_dynblockNMG.setState(emptyNMG);
+
+  /* insert 45 qps from a given client in the last 10s, this should not trigger the rule */
+  for (size_t idx = 0; idx < 45 * static_cast<size_t>(numberOfSeconds); idx++) {
+    g_rings.insertQuery(now, requestor1, qname, qtype, size, dh);
+  }
+  dbrg.apply(now);
+  BOOST_CHECK_EQUAL(g_dynblockNMG.getLocal()->size(), 0U);
+
+  /* 5 more qps, we are now just at the limit */
+  for (size_t idx = 0; idx < 5 * static_cast<size_t>(numberOfSeconds); idx++) {
+    g_rings.insertQuery(now, requestor1, qname, qtype, size, dh);
+  }
+  dbrg.apply(now);
+  BOOST_CHECK_EQUAL(g_dynblockNMG.getLocal()->size(), 0U);
+
+  /* and one more query should trigger the rule, even though only that last query is read from the ring */
+  g_rings.insertQuery(now, requestor1, qname, qtype, size, dh);
+  dbrg.apply(now);
+  BOOST_CHECK_EQUAL(g_dynblockNMG.getLocal()->size(), 1U);
+  BOOST_REQUIRE(g_dynblockNMG.getLocal()->lookup(requestor1) != nullptr);
+  BOOST_CHECK(g_dynblockNMG.getLocal()->lookup(requestor2) == nullptr);
+  BOOST_CHECK_EQUAL(g_dynblockNMG.getLocal()->lookup(requestor1)->second.until.tv_sec, now.tv_sec + blockDuration);
+
+  /* the client is still exceeding the rate one second later, without having sent any new query: the block should be refreshed */
+  struct timespec later = now;
+  later.tv_sec += 1;
+  dbrg.apply(later);
+  BOOST_REQUIRE(g_dynblockNMG.getLocal()->lookup(requestor1) != nullptr);
+  BOOST_CHECK_EQUAL(g_dynblockNMG.getLocal()->lookup(requestor1)->second.until.tv_sec, later.tv_sec + blockDuration);
+
+  /* once the queries have moved out of the window, the block should not be refreshed anymore */
+  g_dynblockNMG.setState(emptyNMG);
+  later.tv_sec = now.tv_sec + numberOfSeconds;
+  dbrg.apply(later);
+  BOOST_CHECK_EQUAL(g_dynblockNMG.getLocal()->size(), 0U);
+
+  /* 20 ANY qps over the last 20s is fine, even spread over two runs */
+  for (size_t idx = 0; idx < 20 * static_cast<size_t>(numberOfSeconds); idx++) {
+    g_rings.insertQuery(now, requestor2, qname, QType::ANY, size, dh);
+  }
+  dbrg.apply(later);
+  for (size_t idx = 0; idx < 20 * static_cast<size_t>(numberOfSeconds); idx++) {
+    g_rings.insertQuery(later, requestor2, qname, QType::ANY, size, dh);
+  }
+  dbrg.apply(later);
+  BOOST_CHECK_EQUAL(g_dynblockNMG.getLocal()->size(), 0U);
+
+  /* but not one more */
+  g_rings.insertQuery(later, requestor2, qname, QType::ANY, size, dh);
+  dbrg.apply(later);
+  BOOST_CHECK_EQUAL(g_dynblockNMG.getLocal()->size(), 1U);
+  BOOST_CHECK(g_dynblockNMG.getLocal()->lookup(requestor2) != nullptr);
+
+  /* clearing the rings discards the existing counters */
+  g_rings.clear();
+  g_dynblockNMG.setState(emptyNMG);
+  g_rings.insertQuery(later, requestor2, qname, QType::ANY, size, dh);
+  dbrg.apply(later);
+  BOOST_CHECK_EQUAL(g_dynblockNMG.getLocal()->size(), 0U);
+}
+
+BOOST_AUTO_TEST_CASE(test_DynBlockRulesGroup_IncrementalMatchesFull) {
+  dnsheader dh;
+  memset(&dh, 0, sizeof(dh));
+  DNSName qname("rings.powerdns.com.");
+  ComboAddress backend("192.0.2.42");
+  uint16_t qtype = QType::AAAA;
+  uint16_t size = 42;
+  unsigned int responseTime = 100 * 1000; /* 100ms */
+  struct timespec now;
+  gettime(&now);
+  /* the incremental mode uses one-second buckets, so entries are inserted on whole seconds, away from the window boundaries */
+  now.tv_nsec = 0;
+  NetmaskTree<DynBlock> emptyNMG;
+
+  const time_t numberOfSeconds = 10;
+  const unsigned int blockDuration = 60;
+  const auto action = DNSAction::Action::Drop;
+
+  auto ago = [&now](time_t seconds) {
+    struct timespec when = now;
+    when.tv_sec -= seconds;
+    return when;
+  };
+  auto insertQueries = [&](const ComboAddress& requestor, size_t count, time_t secondsAgo) {
+    for (size_t idx = 0; idx < count; idx++) {
+      g_rings.insertQuery(ago(secondsAgo), requestor, qname, qtype, size, dh);
+    }
+  };
+  auto insertResponses = [&](const ComboAddress& requestor, uint8_t rcode, size_t count, time_t secondsAgo) {
+    dh.rcode = rcode;
+    for (size_t idx = 0; idx < count; idx++) {
+      g_rings.insertResponse(ago(secondsAgo), requestor, qname, qtype, responseTime, size, dh, backend);
+    }
+    dh.rcode = RCode::NoError;
+  };
+
+  std::vector<ComboAddress> requestors;
+  for (size_t idx = 1; idx <= 6; idx++) {
+    requestors.push_back(ComboAddress("192.0.2." + std::to_string(idx)));
+  }
+
+  g_rings.clear();
+  /* 60 qps over the last 9 seconds, plus older queries: exceeds the query rate */
+  for (time_t second = 0; second < 9; second++) {
+    insertQueries(requestors.at(0), 60, second);
+  }
+  insertQueries(requestors.at(0), 500, 15);
+  /* 50 qps over the last 8 seconds and as many responses, the responses should not be counted as queries */
+  for (time_t second = 0; second < 8; second++) {
+    insertQueries(requestors.at(1), 50, second);
+    insertResponses(requestors.at(1), RCode::NoError, 50, second);
+  }
+  insertQueries(requestors.at(1), 2000, 15);
+  /* 30% of ServFail in the window: exceeds the ratio */
+  insertResponses(requestors.at(2), RCode::ServFail, 30, 2);
+  insertResponses(requestors.at(2), RCode::NoError, 70, 3);
+  /* 30 ServFail out of 70 responses in the window, the older NoError should not dilute the ratio */
+  insertResponses(requestors.at(3), RCode::ServFail, 30, 1);
+  insertResponses(requestors.at(3), RCode::NoError, 40, 5);
+  insertResponses(requestors.at(3), RCode::NoError, 1000, 25);
+  /* not enough responses in the window for the ratio to be considered */
+  insertResponses(requestors.at(4), RCode::ServFail, 10, 4);
+  insertResponses(requestors.at(4), RCode::NoError, 10, 4);
+  insertResponses(requestors.at(4), RCode::ServFail, 500, 25);
+  /* 6 Refused/s over the 20s window of the Refused rate rule */
+  for (time_t second = 0; second < 2 * numberOfSeconds; second++) {
+    if (second == numberOfSeconds) {
+      continue;
+    }
+    insertResponses(requestors.at(5), RCode::Refused, 6, second);
+  }
+  insertResponses(requestors.at(5), RCode::Refused, 6, 21);
+
+  auto getBlocks = [&](bool incremental) {
+    DynBlockRulesGroup dbrg;
+    dbrg.setQuiet(true);
+    dbrg.setIncremental(incremental);
+    dbrg.setQueryRate(50, 0, numberOfSeconds, "Exceeded query rate", blockDuration, action);
+    dbrg.setRCodeRate(RCode::Refused, 5, 0, numberOfSeconds * 2, "Exceeded Refused rate", blockDuration, action);
+    dbrg.setRCodeRatio(RCode::ServFail, 0.2, 0, numberOfSeconds, "Exceeded ServFail ratio", blockDuration, action, 50);
+
+    g_dynblockNMG.setState(emptyNMG);
+    dbrg.apply(now);
+
+    std::vector<std::string> blocks;
+    for (const auto& requestor : requestors) {
+      const auto& block = g_dynblockNMG.getLocal()->lookup(requestor);
+      blocks.push_back(block == nullptr ? "" : block->second.reason);
+    }
+    return blocks;
+  };
+
+  const std::vector<std::string> expected = { "Exceeded query rate", "", "Exceeded ServFail ratio", "Exceeded ServFail ratio", "", "Exceeded Refused rate" };
+  const auto full = getBlocks(false);
+  const auto incremental = getBlocks(true);
+  BOOST_CHECK_EQUAL_COLLECTIONS(full.cbegin(), full.cend(), expected.cbegin(), expected.cend());
+  BOOST_CHECK_EQUAL_COLLECTIONS(incremental.cbegin(), incremental.cend(), expected.cbegin(), expected.cend());
+}
+
 BOOST_AUTO_TEST_CASE(test_DynBlockRulesGroup_QTypeRate) {
   dnsheader dh;
   DNSName qname("rings.powerdns.com.");
@@ -6,6 +6,7 @@
 #include <boost/test/unit_test.hpp>
 
 #include "dnsdist-rings.hh"
+#include "dnsdist-rings-history.hh"
 #include "gettime.hh"
 
 BOOST_AUTO_TEST_SUITE(dnsdistrings_cc)
@@ -271,4 +272,221 @@ BOOST_AUTO_TEST_CASE(test_Rings_Threaded) {
 #endif
 }
 
+BOOST_AUTO_TEST_CASE(test_Rings_PerThreadShards) {
+  size_t numberOfEntries = 100000;
+  size_t numberOfWriterThreads = 4;
+  size_t numberOfShards = numberOfWriterThreads;
+  size_t lockAttempts = 5;
+
+  struct timespec now;
+  gettime(&now);
+  dnsheader dh;
+  memset(&dh, 0, sizeof(dh));
+  DNSName qname("rings.powerdns.com.");
+  ComboAddress requestor("192.0.2.1");
+  ComboAddress server("192.0.2.42");
+  unsigned int latency = 100;
+  uint16_t qtype = QType::AAAA;
+  uint16_t size = 42;
+
+  /* leave some room for the late writer below */
+  Rings rings(2 * numberOfEntries, numberOfShards, lockAttempts, true);
+  rings.setPerThreadShards(true);
+  BOOST_CHECK(rings.hasPerThreadShards());
+  Rings::Query query({now, requestor, qname, size, qtype, dh});
+  Rings::Response response({now, requestor, qname, qtype, latency, size, dh, server});
+
+  std::atomic<bool> done(false);
+  std::vector<std::thread> writerThreads;
+  std::thread readerThread(ringReaderThread, std::ref(rings), std::ref(done), numberOfEntries, qtype);
+
+  size_t insertionsPerThread = numberOfEntries / numberOfWriterThreads;
+  for (size_t idx = 0; idx < numberOfWriterThreads; idx++) {
+    writerThreads.push_back(std::thread(ringWriterThread, std::ref(rings), insertionsPerThread, query, response));
+  }
+
+  for (auto& t : writerThreads) {
+    t.join();
+  }
+
+  done = true;
+  readerThread.join();
+
+  /* the writers never block on a reader, and every entry went either to the ring of the
+     writer's own shard or to its pending list */
+  BOOST_CHECK_EQUAL(rings.d_blockingQueryInserts.load(), 0U);
+  BOOST_CHECK_EQUAL(rings.d_blockingResponseInserts.load(), 0U);
+  size_t totalQueries = 0;
+  size_t totalResponses = 0;
+  for (const auto& shard : rings.d_shards) {
+    BOOST_CHECK_EQUAL(shard->queryInserts + shard->pendingQueries.size(), insertionsPerThread);
+    BOOST_CHECK_EQUAL(shard->respInserts + shard->pendingResponses.size(), insertionsPerThread);
+    totalQueries += shard->queryRing.size();
+    totalResponses += shard->respRing.size();
+  }
+  BOOST_CHECK_EQUAL(rings.getNumberOfQueryEntries(), totalQueries);
+  BOOST_CHECK_EQUAL(rings.getNumberOfResponseEntries(), totalResponses);
+
+  /* a new writer does not get a shard of its own, and uses the regular method */
+  std::thread lateWriter(ringWriterThread, std::ref(rings), 1, query, response);
+  lateWriter.join();
+  BOOST_CHECK_EQUAL(rings.getNumberOfQueryEntries(), totalQueries + 1);
+  BOOST_CHECK_EQUAL(rings.getNumberOfResponseEntries(), totalResponses + 1);
+
+  /* the entries the writers kept aside reach the rings without waiting for their next insertion */
+  rings.flushPendingEntries();
+  for (const auto& shard : rings.d_shards) {
+    BOOST_CHECK(shard->pendingQueries.empty());
+    BOOST_CHECK(shard->pendingResponses.empty());
+  }
+  BOOST_CHECK_EQUAL(rings.getNumberOfQueryEntries(), numberOfEntries + 1);
+  BOOST_CHECK_EQUAL(rings.getNumberOfResponseEntries(), numberOfEntries + 1);
+}
+
+BOOST_AUTO_TEST_CASE(test_Rings_History) {
+  const size_t maxEntries = 100;
+  Rings rings(maxEntries, 1);
+
+  char path[] = "/tmp/dnsdist-rings-history-XXXXXX";
+  int fd = mkstemp(path);
+  BOOST_REQUIRE(fd >= 0);
+  close(fd);
+
+  /* no history yet */
+  BOOST_CHECK_EQUAL(rings.spillToHistory(), 0U);
+
+  BOOST_CHECK_THROW(RingsHistory(path, RingsHistory::s_minimumSegmentSize, RingsHistory::s_minimumSegmentSize - 1), std::runtime_error);
+  BOOST_CHECK_THROW(RingsHistory(path, RingsHistory::s_minimumSegmentSize - 1, RingsHistory::s_minimumSegmentSize), std::runtime_error);
+
+  const size_t numberOfSegments = 4;
+  auto history = std::make_shared<RingsHistory>(path, numberOfSegments * RingsHistory::s_minimumSegmentSize, RingsHistory::s_minimumSegmentSize);
+  BOOST_CHECK_EQUAL(history->getNumberOfSegments(), numberOfSegments);
+  rings.setHistory(history);
+
+  dnsheader dh;
+  memset(&dh, 0, sizeof(dh));
+  dh.id = htons(4242);
+  dh.rd = 1;
+  dh.rcode = RCode::NXDomain;
+  DNSName qname("history.rings.powerdns.com.");
+  ComboAddress requestor("192.0.2.1:4242");
+  ComboAddress requestorV6("[2001:db8::1]:4343");
+  ComboAddress server("[2001:db8::53]:53");
+  uint16_t qtype = QType::AAAA;
+  uint16_t size = 42;
+  unsigned int latency = 100;
+  struct timespec now;
+  gettime(&now);
+  struct timespec old = now;
+  old.tv_sec -= 3600;
+
+  for (size_t idx = 0; idx < maxEntries / 2; idx++) {
+    rings.insertQuery(now, requestor, qname, qtype, size, dh);
+    rings.insertResponse(now, requestorV6, qname, qtype, latency, size, dh, server);
+  }
+  rings.insertQuery(old, requestor, DNSName(), qtype, size, dh);
+
+  BOOST_CHECK_EQUAL(rings.spillToHistory(), maxEntries + 1);
+  BOOST_CHECK_EQUAL(history->getNumberOfEntries(), maxEntries + 1);
+  /* nothing new */
+  BOOST_CHECK_EQUAL(rings.spillToHistory(), 0U);
+
+  size_t queries = 0;
+  rings.visitQueries([&](const Rings::Query& query) {
+    queries++;
+    BOOST_CHECK_EQUAL(query.name, qname);
+    BOOST_CHECK_EQUAL(query.qtype, qtype);
+    BOOST_CHECK_EQUAL(query.size, size);
+    BOOST_CHECK_EQUAL(query.when.tv_sec, now.tv_sec);
+    BOOST_CHECK_EQUAL(query.when.tv_nsec / 1000000, now.tv_nsec / 1000000);
+    BOOST_CHECK_EQUAL(query.requestor.toStringWithPort(), requestor.toStringWithPort());
+    BOOST_CHECK_EQUAL(ntohs(query.dh.id), 4242U);
+    BOOST_CHECK_EQUAL(query.dh.rd, 1U);
+  }, 60);
+  BOOST_CHECK_EQUAL(queries, maxEntries / 2);
+
+  size_t responses = 0;
+  rings.visitResponses([&](const Rings::Response& response) {
+    responses++;
+    BOOST_CHECK_EQUAL(response.name, qname);
+    BOOST_CHECK_EQUAL(response.usec, latency);
+    BOOST_CHECK_EQUAL(response.size, size);
+    BOOST_CHECK_EQUAL(response.dh.rcode, RCode::NXDomain);
+    BOOST_CHECK_EQUAL(response.requestor.toStringWithPort(), requestorV6.toStringWithPort());
+    BOOST_CHECK_EQUAL(response.ds.toStringWithPort(), server.toStringWithPort());
+  }, 60);
+  BOOST_CHECK_EQUAL(responses, maxEntries / 2);
+
+  /* looking further back, we get the old entry with an empty name */
+  queries = 0;
+  size_t emptyNames = 0;
+  rings.visitQueries([&](const Rings::Query& query) {
+    queries++;
+    if (query.name.empty()) {
+      emptyNames++;
+      BOOST_CHECK_EQUAL(query.when.tv_sec, old.tv_sec);
+    }
+  }, 7200);
+  BOOST_CHECK_EQUAL(queries, maxEntries / 2 + 1);
+  BOOST_CHECK_EQUAL(emptyNames, 1U);
+
+  /* without a lookback, only the live rings are visited */
+  queries = 0;
+  rings.visitQueries([&](const Rings::Query&) {
+    queries++;
+  });
+  BOOST_CHECK_EQUAL(queries, rings.getNumberOfQueryEntries());
+
+  /* entries that are no longer in the rings when we copy them are lost */
+  for (size_t idx = 0; idx < maxEntries * 2; idx++) {
+    rings.insertQuery(now, requestor, qname, qtype, size, dh);
+  }
+  BOOST_CHECK_EQUAL(rings.spillToHistory(), maxEntries);
+  BOOST_CHECK_EQUAL(rings.d_historyMissedEntries.load(), maxEntries);
+
+  /* but entries removed by clear() are not */
+  rings.insertQuery(now, requestor, qname, qtype, size, dh);
+  rings.clear();
+  BOOST_CHECK_EQUAL(rings.spillToHistory(), 0U);
+  BOOST_CHECK_EQUAL(rings.d_historyMissedEntries.load(), maxEntries);
+
+  /* fill all the segments with different names, the oldest ones get reused */
+  size_t spilled = history->getNumberOfEntries();
+  for (size_t idx = 0; idx < 10000; idx++) {
+    rings.insertQuery(now, requestor, DNSName("name-" + std::to_string(idx)) + qname, qtype, size, dh);
+    if ((idx % (maxEntries / 2)) == 0) {
+      spilled += rings.spillToHistory();
+    }
+  }
+  spilled += rings.spillToHistory();
+  BOOST_CHECK_GT(history->getNumberOfDiscardedEntries(), 0U);
+  BOOST_CHECK_EQUAL(history->getNumberOfEntries() + history->getNumberOfDiscardedEntries(), spilled);
+
+  /* the newest entries are still there, with the right names */
+  std::set<DNSName> names;
+  rings.visitQueries([&](const Rings::Query& query) {
+    names.insert(query.name);
+  }, 60);
+  BOOST_CHECK_EQUAL(names.size(), history->getNumberOfEntries());
+  BOOST_CHECK(names.count(DNSName("name-9999") + qname) == 1);
+  BOOST_CHECK(names.count(DNSName("name-0") + qname) == 0);
+
+  /* the history is not locked while the visitor is called, so entries can be added meanwhile.
+     They reuse the segments being visited, whose remaining entries are then skipped */
+  const size_t entriesBefore = history->getNumberOfEntries();
+  size_t visited = 0;
+  size_t added = 0;
+  history->visitQueries(old, [&](const Rings::Query& query) {
+    visited++;
+    BOOST_CHECK(query.name.isPartOf(qname));
+    for (size_t idx = 0; idx < 10; idx++) {
+      history->addQuery({now, requestor, DNSName("late-" + std::to_string(added++)) + qname, size, qtype, dh});
+    }
+  });
+  BOOST_CHECK_GT(visited, 0U);
+  BOOST_CHECK_LT(visited, entriesBefore);
+
+  unlink(path);
+}
+
 BOOST_AUTO_TEST_SUITE_END()
@@ -104,5 +104,113 @@ BOOST_AUTO_TEST_CASE(test_MaxQPSIPRule) {
   BOOST_CHECK_EQUAL(scanned, 0U);
 }
 
+BOOST_AUTO_TEST_CASE(test_RuleChainIndex) {
+  std::vector<DNSDistRuleAction> rules;
+  auto addRule = [&rules](std::shared_ptr<DNSRule> rule) {
+    rules.push_back({rule, nullptr, boost::uuids::uuid(), rules.size()});
+  };
+
+  SuffixMatchNode smn;
+  smn.add(DNSName("powerdns.com."));
+  smn.add(DNSName("sub.powerdns.com."));
+  SuffixMatchNode root;
+  root.add(g_rootdnsname);
+  DNSNameSet names;
+  names.insert(DNSName("www.powerdns.com."));
+  names.insert(DNSName("dnsdist.org."));
+
+  addRule(std::make_shared<QTypeRule>(QType::AAAA));
+  addRule(std::make_shared<QClassRule>(QClass::CHAOS));
+  addRule(std::make_shared<QNameRule>(DNSName("WWW.PowerDNS.com.")));
+  addRule(std::make_shared<SuffixMatchNodeRule>(smn));
+  addRule(std::make_shared<QNameSetRule>(names));
+  addRule(std::make_shared<QTypeRule>(QType::A));
+  addRule(std::make_shared<QNameRule>(DNSName("dnsdist.org.")));
+  addRule(std::make_shared<AllRule>());
+  addRule(std::make_shared<SuffixMatchNodeRule>(root));
+
+  RuleChainIndex index;
+  index.update(rules);
+  BOOST_CHECK(index.isEnabled());
+  BOOST_CHECK(index.isIndexed(0));
+  BOOST_CHECK(!index.isIndexed(1));
+  BOOST_CHECK(!index.isIndexed(7));
+  BOOST_CHECK(index.isIndexed(8));
+
+  ComboAddress lc("127.0.0.1:53");
+  ComboAddress rem("192.0.2.1:42");
+  struct dnsheader dh;
+  memset(&dh, 0, sizeof(dh));
+  struct timespec queryRealTime;
+  gettime(&queryRealTime, true);
+
+  const std::vector<DNSName> qnames = { DNSName("www.powerdns.com."), DNSName("a.sub.POWERDNS.com."), DNSName("powerdns.com."), DNSName("dnsdist.org."), DNSName("www.dnsdist.org."), DNSName("powerdns.org."), g_rootdnsname };
+  const std::vector<uint16_t> qtypes = { QType::A, QType::AAAA, QType::MX };
+  const std::vector<uint16_t> qclasses = { QClass::IN, QClass::CHAOS };
+
+  for (const auto& qname : qnames) {
+    for (const auto qtype : qtypes) {
+      for (const auto qclass : qclasses) {
+        DNSQuestion dq(&qname, qtype, qclass, qname.wirelength(), &lc, &rem, &dh, 0, 0, false, &queryRealTime);
+
+        std::vector<size_t> expected;
+        for (size_t idx = 0; idx < rules.size(); idx++) {
+          if (rules.at(idx).d_rule->matches(&dq)) {
+            expected.push_back(idx);
+          }
+        }
+
+        std::vector<size_t> got;
+        size_t lastPosition = 0;
+        bool first = true;
+        for (const auto& candidate : index.getCandidates(dq)) {
+          /* the candidates have to be in the order of the chain */
+          BOOST_CHECK(first || candidate.d_position > lastPosition);
+          first = false;
+          lastPosition = candidate.d_position;
+          if (candidate.d_matches) {
+            BOOST_CHECK(rules.at(candidate.d_position).d_rule->matches(&dq));
+            got.push_back(candidate.d_position);
+          }
+          else if (rules.at(candidate.d_position).d_rule->matches(&dq)) {
+            got.push_back(candidate.d_position);
+          }
+        }
+
+        BOOST_CHECK(got == expected);
+      }
+    }
+  }
+
+  /* too few rules that can be indexed, we should keep evaluating the chain in order */
+  std::vector<DNSDistRuleAction> smallChain(rules.begin(), rules.begin() + 3);
+  index.update(smallChain);
+  BOOST_CHECK(!index.isEnabled());
+}
+
+BOOST_AUTO_TEST_CASE(test_TimingHistogram) {
+  TimingHistogram timings;
+  BOOST_CHECK_EQUAL(timings.getCount(), 0U);
+
+  timings.add(0);
+  timings.add(100);
+  timings.add(101);
+  timings.add(5000);
+  timings.add(1000000);
+  timings.add(1000001);
+  timings.add(3600000000000ULL);
+
+  BOOST_CHECK_EQUAL(timings.getCount(), 7U);
+  BOOST_CHECK_EQUAL(timings.getSum(), 0U + 100U + 101U + 5000U + 1000000U + 1000001U + 3600000000000ULL);
+  BOOST_CHECK_EQUAL(timings.getBucket(0), 2U);
+  BOOST_CHECK_EQUAL(timings.getBucket(1), 1U);
+  BOOST_CHECK_EQUAL(timings.getBucket(2), 1U);
+  BOOST_CHECK_EQUAL(timings.getBucket(3), 0U);
+  BOOST_CHECK_EQUAL(timings.getBucket(4), 1U);
+  BOOST_CHECK_EQUAL(timings.getBucket(5), 2U);
+
+  BOOST_CHECK_EQUAL(TimingHistogram::getBucketUpperBound(0), 100U);
+  BOOST_CHECK_EQUAL(TimingHistogram::getBucketUpperBound(4), 1000000U);
+}
 
 BOOST_AUTO_TEST_SUITE_END()
@@ -33,6 +33,22 @@ public:
   bool d_enableTickets{true};
 };
 
+/* parameters of a TLS context used for outgoing connections */
+class TLSContextParameters
+{
+public:
+  std::string d_provider;
+  std::string d_ciphers;
+  std::string d_ciphers13;
+  /* file containing the certificates of the trusted CAs, the system's default store is used if empty */
+  std::string d_caStore;
+  /* protocols to advertise via ALPN, "h2" for DNS over HTTPS for example */
+  std::vector<std::string> d_alpnProtocols;
+  /* number of sessions received from the server that are kept to resume later connections */
+  size_t d_maxStoredSessions{20};
+  bool d_validateCertificates{true};
+};
+
 struct TLSErrorCounters
 {
   std::atomic<uint64_t> d_dhKeyTooSmall{0}; /* the other side sent a DH value that is not large enough */
@@ -119,5 +135,7 @@ bool libssl_set_min_tls_version(std::unique_ptr<SSL_CTX, void(*)(SSL_CTX*)>& ctx
 std::unique_ptr<SSL_CTX, void(*)(SSL_CTX*)> libssl_init_server_context(const TLSConfig& config,
                                                                        std::map<int, std::string>& ocspResponses);
 
+std::unique_ptr<SSL_CTX, void(*)(SSL_CTX*)> libssl_init_client_context(const TLSContextParameters& params);
+
 std::unique_ptr<FILE, int(*)(FILE*)> libssl_set_key_log_file(std::unique_ptr<SSL_CTX, void(*)(SSL_CTX*)>& ctx, const std::string& logFile);
 #endif /* HAVE_LIBSSL */
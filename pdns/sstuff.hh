@@ -44,11 +44,12 @@ typedef int ProtocolType; //!< Supported protocol types
 //! Representation of a Socket and many of the Berkeley functions available
 class Socket : public boost::noncopyable
 {
-  Socket(int fd): d_socket(fd)
+public:
+  //! Take ownership of an existing socket
+  explicit Socket(int fd): d_socket(fd)
   {
   }
 
-public:
   //! Construct a socket of specified address family and socket type.
   Socket(int af, int st, ProtocolType pt=0)
   {
@@ -16,7 +16,8 @@ public:
   virtual size_t read(void* buffer, size_t bufferSize, unsigned int readTimeout, unsigned int totalTimeout=0) = 0;
   virtual size_t write(const void* buffer, size_t bufferSize, unsigned int writeTimeout) = 0;
   virtual IOState tryWrite(std::vector<uint8_t>& buffer, size_t& pos, size_t toWrite) = 0;
-  virtual IOState tryRead(std::vector<uint8_t>& buffer, size_t& pos, size_t toRead) = 0;
+  /* if allowIncomplete is set, returns Done as soon as some data has been read */
+  virtual IOState tryRead(std::vector<uint8_t>& buffer, size_t& pos, size_t toRead, bool allowIncomplete) = 0;
   virtual std::string getServerNameIndication() const = 0;
   virtual LibsslTLSVersion getTLSVersion() const = 0;
   virtual bool hasSessionBeenResumed() const = 0;
@@ -57,6 +58,12 @@ public:
   }
   virtual ~TLSCtx() {}
   virtual std::unique_ptr<TLSConnection> getConnection(int socket, unsigned int timeout, time_t now) = 0;
+  /* for outgoing connections, host being the name the certificate presented by the server
+     has to be valid for, and sent as SNI */
+  virtual std::unique_ptr<TLSConnection> getClientConnection(const std::string& host, int socket, unsigned int timeout)
+  {
+    throw std::runtime_error("This TLS backend does not support outgoing connections");
+  }
   virtual void rotateTicketsKey(time_t now) = 0;
   virtual void loadTicketsKeys(const std::string& file)
   {
@@ -183,6 +190,14 @@ public:
     }
   }
 
+  /* outgoing connection */
+  TCPIOHandler(const std::string& host, int socket, unsigned int timeout, std::shared_ptr<TLSCtx> ctx): d_socket(socket)
+  {
+    if (ctx) {
+      d_conn = ctx->getClientConnection(host, d_socket, timeout);
+    }
+  }
+
   ~TCPIOHandler()
   {
     if (d_conn) {
@@ -215,15 +230,16 @@ public:
      throws an std::runtime_error in case of IO error,
      return Done when toRead bytes have been read, needRead or needWrite if the IO operation
      would block.
+     If allowIncomplete is set, returns Done as soon as at least one byte has been read.
   */
-  IOState tryRead(std::vector<uint8_t>& buffer, size_t& pos, size_t toRead)
+  IOState tryRead(std::vector<uint8_t>& buffer, size_t& pos, size_t toRead, bool allowIncomplete=false)
   {
     if (buffer.size() < toRead || pos >= toRead) {
       throw std::out_of_range("Calling tryRead() with a too small buffer (" + std::to_string(buffer.size()) + ") for a read of " + std::to_string(toRead - pos) + " bytes starting at " + std::to_string(pos));
     }
 
     if (d_conn) {
-      return d_conn->tryRead(buffer, pos, toRead);
+      return d_conn->tryRead(buffer, pos, toRead, allowIncomplete);
     }
 
     do {
@@ -241,6 +257,9 @@ public:
       }
 
       pos += static_cast<size_t>(res);
+      if (allowIncomplete) {
+        break;
+      }
     }
     while (pos < toRead);
 
@@ -333,3 +352,6 @@ private:
   std::unique_ptr<TLSConnection> d_conn{nullptr};
   int d_socket{-1};
 };
+
+/* returns a TLS context suitable for outgoing connections */
+std::shared_ptr<TLSCtx> getTLSContext(const TLSContextParameters& params);
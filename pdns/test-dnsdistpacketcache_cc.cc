@@ -2,6 +2,7 @@
 #define BOOST_TEST_NO_MAIN
 
 #include <boost/test/unit_test.hpp>
+#include <sys/wait.h>
 
 #include "ednscookies.hh"
 #include "ednsoptions.hh"
@@ -298,7 +299,7 @@ BOOST_AUTO_TEST_CASE(test_PacketCacheNXDomainTTL) {
 
 static DNSDistPacketCache g_PC(500000);
 
-static void threadMangler(unsigned int offset)
+static void threadMangler(DNSDistPacketCache& cache, unsigned int offset)
 {
   struct timespec queryTime;
   gettime(&queryTime);  // does not have to be accurate ("realTime") in tests
@@ -328,9 +329,9 @@ static void threadMangler(unsigned int offset)
       boost::optional<Netmask> subnet;
       auto dh = reinterpret_cast<dnsheader*>(query.data());
       DNSQuestion dq(&a, QType::A, QClass::IN, 0, &remote, &remote, dh, query.size(), query.size(), false, &queryTime);
-      g_PC.get(dq, a.wirelength(), 0, responseBuf, &responseBufSize, &key, subnet, dnssecOK);
+      cache.get(dq, a.wirelength(), 0, responseBuf, &responseBufSize, &key, subnet, dnssecOK);
 
-      g_PC.insert(key, subnet, *(getFlagsFromDNSHeader(dh)), dnssecOK, a, QType::A, QClass::IN, (const char*) response.data(), responseLen, false, 0, boost::none);
+      cache.insert(key, subnet, *(getFlagsFromDNSHeader(dh)), dnssecOK, a, QType::A, QClass::IN, (const char*) response.data(), responseLen, false, 0, boost::none);
     }
   }
   catch(PDNSException& e) {
@@ -341,7 +342,7 @@ static void threadMangler(unsigned int offset)
 
 AtomicCounter g_missing;
 
-static void threadReader(unsigned int offset)
+static void threadReader(DNSDistPacketCache& cache, unsigned int offset, AtomicCounter& missing)
 {
   bool dnssecOK = false;
   struct timespec queryTime;
@@ -361,9 +362,9 @@ static void threadReader(unsigned int offset)
       uint32_t key = 0;
       boost::optional<Netmask> subnet;
       DNSQuestion dq(&a, QType::A, QClass::IN, 0, &remote, &remote, (struct dnsheader*) query.data(), query.size(), query.size(), false, &queryTime);
-      bool found = g_PC.get(dq, a.wirelength(), 0, responseBuf, &responseBufSize, &key, subnet, dnssecOK);
+      bool found = cache.get(dq, a.wirelength(), 0, responseBuf, &responseBufSize, &key, subnet, dnssecOK);
       if (!found) {
-	g_missing++;
+	missing++;
       }
     }
   }
@@ -377,7 +378,7 @@ BOOST_AUTO_TEST_CASE(test_PacketCacheThreaded) {
   try {
     std::vector<std::thread> threads;
     for (int i = 0; i < 4; ++i) {
-      threads.push_back(std::thread(threadMangler, i*1000000UL));
+      threads.push_back(std::thread(threadMangler, std::ref(g_PC), i*1000000UL));
     }
 
     for (auto& t : threads) {
@@ -390,7 +391,7 @@ BOOST_AUTO_TEST_CASE(test_PacketCacheThreaded) {
     BOOST_CHECK_SMALL(1.0*g_PC.getInsertCollisions(), 10000.0);
 
     for (int i = 0; i < 4; ++i) {
-      threads.push_back(std::thread(threadReader, i*1000000UL));
+      threads.push_back(std::thread(threadReader, std::ref(g_PC), i*1000000UL, std::ref(g_missing)));
     }
 
     for (auto& t : threads) {
@@ -406,6 +407,50 @@ BOOST_AUTO_TEST_CASE(test_PacketCacheThreaded) {
 
 }
 
+BOOST_AUTO_TEST_CASE(test_PacketCacheThreadedLockFree) {
+  DNSDistPacketCache PC(500000, 86400, 0, 60, 3600, 60, false, 4, true, false, true);
+  AtomicCounter missing;
+
+  try {
+    /* readers and writers running at the same time */
+    std::vector<std::thread> threads;
+    for (int i = 0; i < 4; ++i) {
+      threads.push_back(std::thread(threadMangler, std::ref(PC), i*1000000UL));
+      threads.push_back(std::thread(threadReader, std::ref(PC), i*1000000UL, std::ref(missing)));
+    }
+
+    for (auto& t : threads) {
+      t.join();
+    }
+
+    threads.clear();
+
+    BOOST_CHECK_EQUAL(PC.getSize() + PC.getDeferredInserts() + PC.getInsertCollisions(), 400000U);
+    BOOST_CHECK_SMALL(1.0*PC.getInsertCollisions(), 10000.0);
+    /* lookups are never deferred */
+    BOOST_CHECK_EQUAL(PC.getDeferredLookups(), 0U);
+
+    missing = 0;
+    for (int i = 0; i < 4; ++i) {
+      threads.push_back(std::thread(threadReader, std::ref(PC), i*1000000UL, std::ref(missing)));
+    }
+
+    for (auto& t : threads) {
+      t.join();
+    }
+
+    BOOST_CHECK((PC.getDeferredInserts() + PC.getInsertCollisions()) >= missing);
+    BOOST_CHECK_EQUAL(PC.getDeferredLookups(), 0U);
+
+    BOOST_CHECK_EQUAL(PC.expungeByName(DNSName("."), QType::ANY, true), 400000U - PC.getDeferredInserts() - PC.getInsertCollisions());
+    BOOST_CHECK_EQUAL(PC.getSize(), 0U);
+  }
+  catch(PDNSException& e) {
+    cerr<<"Had error: "<<e.reason<<endl;
+    throw;
+  }
+}
+
 BOOST_AUTO_TEST_CASE(test_PCCollision) {
   const size_t maxEntries = 150000;
   DNSDistPacketCache PC(maxEntries, 86400, 1, 60, 3600, 60, false, 1, true, true);
@@ -588,4 +633,449 @@ BOOST_AUTO_TEST_CASE(test_PCDNSSECCollision) {
 
 }
 
+BOOST_AUTO_TEST_CASE(test_PacketCacheSaveAndLoad) {
+  const size_t maxEntries = 150000;
+  DNSDistPacketCache PC(maxEntries, 86400, 1, 60, 3600, 60, false, 4, true, true);
+  BOOST_CHECK_EQUAL(PC.getSize(), 0U);
+
+  ComboAddress remote("192.0.2.1");
+  struct timespec queryTime;
+  gettime(&queryTime);
+  const size_t numberOfNames = 100;
+
+  auto lookupAndMaybeInsert = [&remote, &queryTime](DNSDistPacketCache& cache, size_t idx, bool insert) {
+    DNSName qname = DNSName(std::to_string(idx)) + DNSName("save.powerdns.com.");
+    vector<uint8_t> query;
+    DNSPacketWriter pwQ(query, qname, QType::A, QClass::IN, 0);
+    pwQ.getHeader()->rd = 1;
+    /* half of the queries carry an ECS option */
+    DNSPacketWriter::optvect_t ednsOptions;
+    if (idx % 2 == 0) {
+      EDNSSubnetOpts opt;
+      opt.source = Netmask(idx % 4 == 0 ? "192.0.2.0/24" : "2001:db8::/56");
+      ednsOptions.push_back(std::make_pair(EDNSOptionCode::ECS, makeEDNSSubnetOptsString(opt)));
+    }
+    pwQ.addOpt(512, 0, 0, ednsOptions);
+    pwQ.commit();
+
+    char responseBuf[4096];
+    uint16_t responseBufSize = sizeof(responseBuf);
+    uint32_t key = 0;
+    boost::optional<Netmask> subnet;
+    DNSQuestion dq(&qname, QType::A, QClass::IN, 0, &remote, &remote, pwQ.getHeader(), query.size(), query.size(), false, &queryTime);
+    bool found = cache.get(dq, qname.wirelength(), 0, responseBuf, &responseBufSize, &key, subnet, false);
+    if (!insert) {
+      return found;
+    }
+
+    vector<uint8_t> response;
+    DNSPacketWriter pwR(response, qname, QType::A, QClass::IN, 0);
+    pwR.getHeader()->rd = 1;
+    pwR.getHeader()->ra = 1;
+    pwR.getHeader()->qr = 1;
+    pwR.startRecord(qname, QType::A, 7200, QClass::IN, DNSResourceRecord::ANSWER);
+    pwR.xfr32BitInt(0x01020304);
+    pwR.commit();
+    cache.insert(key, subnet, *(getFlagsFromDNSHeader(pwQ.getHeader())), false, qname, QType::A, QClass::IN, reinterpret_cast<const char*>(response.data()), response.size(), false, RCode::NoError, boost::none);
+    return found;
+  };
+
+  for (size_t idx = 0; idx < numberOfNames; idx++) {
+    BOOST_CHECK_EQUAL(lookupAndMaybeInsert(PC, idx, true), false);
+  }
+  BOOST_CHECK_EQUAL(PC.getSize(), numberOfNames);
+
+  auto fp = std::unique_ptr<FILE, int(*)(FILE*)>(tmpfile(), fclose);
+  BOOST_REQUIRE(fp != nullptr);
+  int fd = fileno(fp.get());
+  BOOST_CHECK_EQUAL(PC.save(fd), numberOfNames);
+
+  /* the file does not depend on the engine used by the cache */
+  DNSDistPacketCache loaded(maxEntries, 86400, 1, 60, 3600, 60, false, 4, true, true, true);
+  BOOST_REQUIRE_EQUAL(lseek(fd, 0, SEEK_SET), 0);
+  BOOST_CHECK_EQUAL(loaded.load(fd), numberOfNames);
+  BOOST_CHECK_EQUAL(loaded.getSize(), numberOfNames);
+
+  for (size_t idx = 0; idx < numberOfNames; idx++) {
+    BOOST_CHECK_EQUAL(lookupAndMaybeInsert(loaded, idx, false), true);
+  }
+  BOOST_CHECK_EQUAL(loaded.getHits(), numberOfNames);
+  BOOST_CHECK_EQUAL(loaded.getMisses(), 0U);
+
+  /* the file has been saved without cookie hashing */
+  DNSDistPacketCache cookieHashing(maxEntries, 86400, 1, 60, 3600, 60, false, 4, true, true);
+  cookieHashing.setCookieHashing(true);
+  BOOST_REQUIRE_EQUAL(lseek(fd, 0, SEEK_SET), 0);
+  BOOST_CHECK_THROW(cookieHashing.load(fd), std::runtime_error);
+  BOOST_CHECK_EQUAL(cookieHashing.getSize(), 0U);
+
+  /* truncated file */
+  BOOST_REQUIRE_EQUAL(ftruncate(fd, 10), 0);
+  BOOST_REQUIRE_EQUAL(lseek(fd, 0, SEEK_SET), 0);
+  DNSDistPacketCache truncated(maxEntries, 86400, 1, 60, 3600, 60, false, 4, true, true);
+  BOOST_CHECK_THROW(truncated.load(fd), std::runtime_error);
+}
+
+BOOST_AUTO_TEST_CASE(test_PacketCachePrefetch) {
+  const size_t maxEntries = 150000;
+  DNSDistPacketCache PC(maxEntries, 86400, 1);
+  struct timespec queryTime;
+  gettime(&queryTime);  // does not have to be accurate ("realTime") in tests
+
+  ComboAddress remote;
+  bool dnssecOK = false;
+  DNSName a = DNSName("prefetch.powerdns.com.");
+
+  vector<uint8_t> query;
+  DNSPacketWriter pwQ(query, a, QType::A, QClass::IN, 0);
+  pwQ.getHeader()->rd = 1;
+
+  vector<uint8_t> response;
+  DNSPacketWriter pwR(response, a, QType::A, QClass::IN, 0);
+  pwR.getHeader()->rd = 1;
+  pwR.getHeader()->ra = 1;
+  pwR.getHeader()->qr = 1;
+  pwR.getHeader()->id = pwQ.getHeader()->id;
+  pwR.startRecord(a, QType::A, 3600, QClass::IN, DNSResourceRecord::ANSWER);
+  pwR.xfr32BitInt(0x01020304);
+  pwR.commit();
+
+  char responseBuf[4096];
+  uint16_t responseBufSize = sizeof(responseBuf);
+  uint32_t key = 0;
+  boost::optional<Netmask> subnet;
+  auto dh = reinterpret_cast<dnsheader*>(query.data());
+  DNSQuestion dq(&a, QType::A, QClass::IN, 0, &remote, &remote, dh, query.size(), query.size(), false, &queryTime);
+
+  auto lookup = [&](DNSDistPacketCache& cache, bool& prefetch) {
+    prefetch = false;
+    responseBufSize = sizeof(responseBuf);
+    return cache.get(dq, a.wirelength(), 0, responseBuf, &responseBufSize, &key, subnet, dnssecOK, 0, false, &prefetch);
+  };
+  auto insert = [&](DNSDistPacketCache& cache) {
+    cache.insert(key, subnet, *(getFlagsFromDNSHeader(dh)), dnssecOK, a, QType::A, QClass::IN, reinterpret_cast<const char*>(response.data()), response.size(), false, RCode::NoError, boost::none);
+  };
+
+  bool prefetch = false;
+  BOOST_CHECK_EQUAL(lookup(PC, prefetch), false);
+  insert(PC);
+
+  /* prefetching is disabled by default */
+  BOOST_CHECK(!PC.isPrefetchEnabled());
+  BOOST_CHECK_EQUAL(lookup(PC, prefetch), true);
+  BOOST_CHECK_EQUAL(prefetch, false);
+
+  /* every hit is now in the prefetch window, but we need 3 hits first */
+  PC.setPrefetch(100, 3);
+  BOOST_CHECK(PC.isPrefetchEnabled());
+  BOOST_CHECK_EQUAL(lookup(PC, prefetch), true);
+  BOOST_CHECK_EQUAL(prefetch, false);
+  BOOST_CHECK_EQUAL(lookup(PC, prefetch), true);
+  BOOST_CHECK_EQUAL(prefetch, false);
+  BOOST_CHECK_EQUAL(lookup(PC, prefetch), true);
+  BOOST_CHECK_EQUAL(prefetch, true);
+  BOOST_CHECK_EQUAL(PC.getPrefetches(), 1U);
+
+  /* only one prefetch per entry */
+  BOOST_CHECK_EQUAL(lookup(PC, prefetch), true);
+  BOOST_CHECK_EQUAL(prefetch, false);
+  BOOST_CHECK_EQUAL(PC.getPrefetches(), 1U);
+
+  /* a new entry starts over */
+  BOOST_CHECK_EQUAL(PC.expungeByName(a), 1U);
+  insert(PC);
+  for (size_t idx = 0; idx < 2; idx++) {
+    BOOST_CHECK_EQUAL(lookup(PC, prefetch), true);
+    BOOST_CHECK_EQUAL(prefetch, false);
+  }
+  BOOST_CHECK_EQUAL(lookup(PC, prefetch), true);
+  BOOST_CHECK_EQUAL(prefetch, true);
+  BOOST_CHECK_EQUAL(PC.getPrefetches(), 2U);
+
+  /* the entry has just been inserted, so it is not in the last 10% of its TTL */
+  DNSDistPacketCache notYet(maxEntries, 86400, 1);
+  notYet.setPrefetch(10, 0);
+  insert(notYet);
+  for (size_t idx = 0; idx < 10; idx++) {
+    BOOST_CHECK_EQUAL(lookup(notYet, prefetch), true);
+    BOOST_CHECK_EQUAL(prefetch, false);
+  }
+  BOOST_CHECK_EQUAL(notYet.getPrefetches(), 0U);
+}
+
+BOOST_AUTO_TEST_CASE(test_PacketCacheCompactEntries) {
+  const size_t maxEntries = 150000;
+  DNSDistPacketCache PC(maxEntries, 86400, 1, 60, 3600, 60, false, 4, true, true);
+  struct timespec queryTime;
+  gettime(&queryTime);  // does not have to be accurate ("realTime") in tests
+
+  ComboAddress remote;
+  bool dnssecOK = false;
+
+  /* returns whether the lookup was a hit, inserts the response if it was not */
+  auto lookupAndMaybeInsert = [&](const DNSName& qname, const boost::optional<Netmask>& ecs, bool headerOnly) {
+    vector<uint8_t> query;
+    DNSPacketWriter pwQ(query, qname, QType::A, QClass::IN, 0);
+    pwQ.getHeader()->rd = 1;
+    if (ecs) {
+      EDNSSubnetOpts opt;
+      opt.source = *ecs;
+      DNSPacketWriter::optvect_t ednsOptions;
+      ednsOptions.push_back(std::make_pair(EDNSOptionCode::ECS, makeEDNSSubnetOptsString(opt)));
+      pwQ.addOpt(512, 0, 0, ednsOptions);
+    }
+    pwQ.commit();
+
+    char responseBuf[4096];
+    uint16_t responseBufSize = sizeof(responseBuf);
+    uint32_t key = 0;
+    boost::optional<Netmask> subnet;
+    auto dh = reinterpret_cast<dnsheader*>(query.data());
+    DNSQuestion dq(&qname, QType::A, QClass::IN, 0, &remote, &remote, dh, query.size(), query.size(), false, &queryTime);
+    if (PC.get(dq, qname.wirelength(), 0, responseBuf, &responseBufSize, &key, subnet, dnssecOK)) {
+      return true;
+    }
+
+    vector<uint8_t> response;
+    DNSPacketWriter pwR(response, qname, QType::A, QClass::IN, 0);
+    pwR.getHeader()->rd = 1;
+    pwR.getHeader()->ra = 1;
+    pwR.getHeader()->qr = 1;
+    pwR.startRecord(qname, QType::A, 3600, QClass::IN, DNSResourceRecord::ANSWER);
+    pwR.xfr32BitInt(0x01020304);
+    pwR.commit();
+    if (headerOnly) {
+      /* no question section, so the qname has to be stored separately. Without
+         a TTL, only a ServFail can be cached */
+      response.resize(sizeof(dnsheader));
+      reinterpret_cast<dnsheader*>(response.data())->qdcount = 0;
+      reinterpret_cast<dnsheader*>(response.data())->ancount = 0;
+      reinterpret_cast<dnsheader*>(response.data())->rcode = RCode::ServFail;
+    }
+    PC.insert(key, subnet, *(getFlagsFromDNSHeader(dh)), dnssecOK, qname, QType::A, QClass::IN, reinterpret_cast<const char*>(response.data()), response.size(), false, headerOnly ? RCode::ServFail : RCode::NoError, boost::none);
+    return false;
+  };
+
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(DNSName("www.powerdns.com."), boost::none, false), false);
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(DNSName("www.powerdns.com."), boost::none, false), true);
+  /* the qname stored in the response is compared without regard to case */
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(DNSName("WWW.PowerDNS.com."), boost::none, false), true);
+
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(DNSName("header-only.powerdns.com."), boost::none, true), false);
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(DNSName("header-only.powerdns.com."), boost::none, true), true);
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(DNSName("HEADER-ONLY.powerdns.com."), boost::none, true), true);
+
+  /* the subnet is stored along with the response */
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(DNSName("v4.ecs.powerdns.com."), Netmask("192.0.2.0/24"), false), false);
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(DNSName("v4.ecs.powerdns.com."), Netmask("192.0.2.0/24"), false), true);
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(DNSName("v6.ecs.powerdns.com."), Netmask("2001:db8::/56"), true), false);
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(DNSName("v6.ecs.powerdns.com."), Netmask("2001:db8::/56"), true), true);
+  BOOST_CHECK_EQUAL(PC.getSize(), 4U);
+  BOOST_CHECK_EQUAL(PC.getLookupCollisions(), 0U);
+
+  /* suffix matches stop at label boundaries */
+  BOOST_CHECK_EQUAL(PC.expungeByName(DNSName("cs.powerdns.com."), QType::ANY, true), 0U);
+  BOOST_CHECK_EQUAL(PC.expungeByName(DNSName("ECS.powerdns.com."), QType::ANY, true), 2U);
+  BOOST_CHECK_EQUAL(PC.expungeByName(DNSName("header-only.powerdns.com."), QType::ANY, false), 1U);
+  BOOST_CHECK_EQUAL(PC.getSize(), 1U);
+
+  const auto usage = PC.getMemoryUsage();
+  BOOST_REQUIRE_EQUAL(usage.size(), 4U);
+  uint64_t entries = 0;
+  for (const auto& shard : usage) {
+    entries += shard.entries;
+    /* even empty shards have buckets */
+    BOOST_CHECK_GT(shard.bytes, 0U);
+  }
+  BOOST_CHECK_EQUAL(entries, 1U);
+}
+
+BOOST_AUTO_TEST_CASE(test_PacketCacheEviction) {
+  const size_t maxEntries = 100;
+  struct timespec queryTime;
+  gettime(&queryTime);  // does not have to be accurate ("realTime") in tests
+
+  ComboAddress remote;
+  bool dnssecOK = false;
+
+  auto lookupAndMaybeInsert = [&](DNSDistPacketCache& cache, size_t idx, bool doInsert) {
+    DNSName name("name" + std::to_string(idx) + ".eviction.powerdns.com.");
+    vector<uint8_t> query;
+    DNSPacketWriter pwQ(query, name, QType::A, QClass::IN, 0);
+    pwQ.getHeader()->rd = 1;
+
+    vector<uint8_t> response;
+    DNSPacketWriter pwR(response, name, QType::A, QClass::IN, 0);
+    pwR.getHeader()->rd = 1;
+    pwR.getHeader()->ra = 1;
+    pwR.getHeader()->qr = 1;
+    pwR.getHeader()->id = pwQ.getHeader()->id;
+    pwR.startRecord(name, QType::A, 3600, QClass::IN, DNSResourceRecord::ANSWER);
+    pwR.xfr32BitInt(0x01020304);
+    pwR.commit();
+
+    char responseBuf[4096];
+    uint16_t responseBufSize = sizeof(responseBuf);
+    uint32_t key = 0;
+    boost::optional<Netmask> subnet;
+    auto dh = reinterpret_cast<dnsheader*>(query.data());
+    DNSQuestion dq(&name, QType::A, QClass::IN, 0, &remote, &remote, dh, query.size(), query.size(), false, &queryTime);
+    bool found = cache.get(dq, name.wirelength(), 0, responseBuf, &responseBufSize, &key, subnet, dnssecOK);
+    if (!found && doInsert) {
+      cache.insert(key, subnet, *(getFlagsFromDNSHeader(dh)), dnssecOK, name, QType::A, QClass::IN, reinterpret_cast<const char*>(response.data()), response.size(), false, RCode::NoError, boost::none);
+    }
+    return found;
+  };
+
+  for (const bool lockFree : {false, true}) {
+    /* the default is to refuse new entries once the cache is full */
+    DNSDistPacketCache none(maxEntries, 86400, 1, 60, 3600, 60, false, 1, true, false, lockFree);
+    BOOST_CHECK(none.getEvictionPolicy() == DNSDistPacketCache::EvictionPolicy::None);
+    for (size_t idx = 0; idx < maxEntries * 2; idx++) {
+      lookupAndMaybeInsert(none, idx, true);
+    }
+    BOOST_CHECK_EQUAL(none.getSize(), maxEntries);
+    BOOST_CHECK_EQUAL(none.getEvictions(), 0U);
+    BOOST_CHECK_EQUAL(lookupAndMaybeInsert(none, 0, false), true);
+    BOOST_CHECK_EQUAL(lookupAndMaybeInsert(none, maxEntries, false), false);
+
+    /* LRU makes room for every new entry */
+    DNSDistPacketCache lru(maxEntries, 86400, 1, 60, 3600, 60, false, 1, true, false, lockFree);
+    lru.setEvictionPolicy(DNSDistPacketCache::EvictionPolicy::LRU);
+    for (size_t idx = 0; idx < maxEntries * 2; idx++) {
+      lookupAndMaybeInsert(lru, idx, true);
+    }
+    BOOST_CHECK_EQUAL(lru.getSize(), maxEntries);
+    BOOST_CHECK_EQUAL(lru.getEvictions(), maxEntries);
+    BOOST_CHECK_EQUAL(lru.getRejectedAdmissions(), 0U);
+    BOOST_CHECK_EQUAL(lookupAndMaybeInsert(lru, (maxEntries * 2) - 1, false), true);
+    /* the entries that are still there can be expunged, so the count is right */
+    BOOST_CHECK_EQUAL(lru.expungeByName(DNSName("eviction.powerdns.com."), QType::ANY, true), maxEntries);
+    BOOST_CHECK_EQUAL(lru.getSize(), 0U);
+
+    /* TinyLFU only admits a new entry if it has been requested more often than the victim */
+    DNSDistPacketCache tinylfu(maxEntries, 86400, 1, 60, 3600, 60, false, 1, true, false, lockFree);
+    tinylfu.setEvictionPolicy(DNSDistPacketCache::EvictionPolicy::TinyLFU);
+    for (size_t idx = 0; idx < maxEntries; idx++) {
+      lookupAndMaybeInsert(tinylfu, idx, true);
+    }
+    BOOST_CHECK_EQUAL(tinylfu.getSize(), maxEntries);
+
+    /* requested once, as often as any cached entry */
+    BOOST_CHECK_EQUAL(lookupAndMaybeInsert(tinylfu, maxEntries, true), false);
+    BOOST_CHECK_EQUAL(tinylfu.getRejectedAdmissions(), 1U);
+    BOOST_CHECK_EQUAL(tinylfu.getEvictions(), 0U);
+    BOOST_CHECK_EQUAL(lookupAndMaybeInsert(tinylfu, maxEntries, false), false);
+
+    /* requested a few more times, it now gets in */
+    for (size_t count = 0; count < 3; count++) {
+      lookupAndMaybeInsert(tinylfu, maxEntries, false);
+    }
+    BOOST_CHECK_EQUAL(lookupAndMaybeInsert(tinylfu, maxEntries, true), false);
+    BOOST_CHECK_EQUAL(tinylfu.getEvictions(), 1U);
+    BOOST_CHECK_EQUAL(tinylfu.getSize(), maxEntries);
+    BOOST_CHECK_EQUAL(lookupAndMaybeInsert(tinylfu, maxEntries, false), true);
+  }
+}
+
+BOOST_AUTO_TEST_CASE(test_PacketCacheSharedMemory) {
+  const size_t maxEntries = 100;
+  struct timespec queryTime;
+  gettime(&queryTime);  // does not have to be accurate ("realTime") in tests
+
+  ComboAddress remote;
+  bool dnssecOK = false;
+
+  auto lookupAndMaybeInsert = [&](DNSDistPacketCache& cache, size_t idx, bool doInsert) {
+    DNSName name("name" + std::to_string(idx) + ".shared.powerdns.com.");
+    vector<uint8_t> query;
+    DNSPacketWriter pwQ(query, name, QType::A, QClass::IN, 0);
+    pwQ.getHeader()->rd = 1;
+
+    vector<uint8_t> response;
+    DNSPacketWriter pwR(response, name, QType::A, QClass::IN, 0);
+    pwR.getHeader()->rd = 1;
+    pwR.getHeader()->ra = 1;
+    pwR.getHeader()->qr = 1;
+    pwR.getHeader()->id = pwQ.getHeader()->id;
+    pwR.startRecord(name, QType::A, 3600, QClass::IN, DNSResourceRecord::ANSWER);
+    pwR.xfr32BitInt(0x01020304);
+    pwR.commit();
+
+    char responseBuf[4096];
+    uint16_t responseBufSize = sizeof(responseBuf);
+    uint32_t key = 0;
+    boost::optional<Netmask> subnet;
+    auto dh = reinterpret_cast<dnsheader*>(query.data());
+    DNSQuestion dq(&name, QType::A, QClass::IN, 0, &remote, &remote, dh, query.size(), query.size(), false, &queryTime);
+    bool found = cache.get(dq, name.wirelength(), 0, responseBuf, &responseBufSize, &key, subnet, dnssecOK);
+    if (found) {
+      BOOST_CHECK_EQUAL(responseBufSize, response.size());
+      BOOST_CHECK_EQUAL(memcmp(responseBuf, response.data(), response.size()), 0);
+    }
+    else if (doInsert) {
+      cache.insert(key, subnet, *(getFlagsFromDNSHeader(dh)), dnssecOK, name, QType::A, QClass::IN, reinterpret_cast<const char*>(response.data()), response.size(), false, RCode::NoError, boost::none);
+    }
+    return found;
+  };
+
+  char path[] = "/tmp/dnsdist-shared-cache-XXXXXX";
+  int fd = mkstemp(path);
+  BOOST_REQUIRE(fd >= 0);
+  close(fd);
+
+  DNSDistPacketCache first(maxEntries, 86400, 1);
+  first.setSharedMemory(path, 512);
+  BOOST_CHECK(first.isSharedMemoryEnabled());
+  DNSDistPacketCache second(maxEntries, 86400, 1, 60, 3600, 60, false, 4);
+  second.setSharedMemory(path, 512);
+
+  /* inserted via one cache, found via the other, the statistics being kept per cache */
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(first, 0, true), false);
+  BOOST_CHECK_EQUAL(first.getSize(), 1U);
+  BOOST_CHECK_EQUAL(second.getSize(), 1U);
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(second, 0, false), true);
+  BOOST_CHECK_EQUAL(first.getHits(), 0U);
+  BOOST_CHECK_EQUAL(first.getMisses(), 1U);
+  BOOST_CHECK_EQUAL(second.getHits(), 1U);
+  BOOST_CHECK_EQUAL(second.getMisses(), 0U);
+
+  /* and by another process */
+  pid_t pid = fork();
+  BOOST_REQUIRE(pid >= 0);
+  if (pid == 0) {
+    DNSDistPacketCache child(maxEntries, 86400, 1);
+    child.setSharedMemory(path, 512);
+    bool ok = lookupAndMaybeInsert(child, 0, false) && !lookupAndMaybeInsert(child, 1, true) && child.getSize() == 2;
+    _exit(ok ? 0 : 1);
+  }
+  int status = 0;
+  BOOST_REQUIRE_EQUAL(waitpid(pid, &status, 0), pid);
+  BOOST_CHECK(WIFEXITED(status) && WEXITSTATUS(status) == 0);
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(first, 1, false), true);
+
+  /* the entries can be saved and removed from any of the caches */
+  auto fp = std::unique_ptr<FILE, int(*)(FILE*)>(tmpfile(), fclose);
+  BOOST_REQUIRE(fp != nullptr);
+  fd = fileno(fp.get());
+  BOOST_CHECK_EQUAL(second.save(fd), 2U);
+  BOOST_CHECK_EQUAL(second.expungeByName(DNSName("name0.shared.powerdns.com.")), 1U);
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(first, 0, false), false);
+  BOOST_CHECK_EQUAL(first.expunge(0), 1U);
+  BOOST_CHECK_EQUAL(second.getSize(), 0U);
+  BOOST_REQUIRE_EQUAL(lseek(fd, 0, SEEK_SET), 0);
+  BOOST_CHECK_EQUAL(first.load(fd), 2U);
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(second, 0, false), true);
+  BOOST_CHECK_EQUAL(lookupAndMaybeInsert(second, 1, false), true);
+
+  /* the file can't be used by caches with different settings */
+  DNSDistPacketCache larger(maxEntries * 2, 86400, 1);
+  BOOST_CHECK_THROW(larger.setSharedMemory(path, 512), std::runtime_error);
+  DNSDistPacketCache cookies(maxEntries, 86400, 1);
+  cookies.setCookieHashing(true);
+  BOOST_CHECK_THROW(cookies.setSharedMemory(path, 512), std::runtime_error);
+
+  unlink(path);
+}
+
 BOOST_AUTO_TEST_SUITE_END()
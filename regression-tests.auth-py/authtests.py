@@ -12,6 +12,7 @@ import time
 import unittest
 import dns
 import dns.message
+import readiness
 
 from pprint import pprint
 from eqdnsmessage import AssertEqualDNSMessageMixin
@@ -23,6 +24,8 @@ class AuthTest(AssertEqualDNSMessageMixin, unittest.TestCase):
 
     _confdir = 'auth'
     _authPort = 5300
+    # maximum time to wait for the auth to answer queries
+    _authStartupDelay = 2.0
 
     _config_params = []
 
@@ -189,7 +192,7 @@ options {
                                                      stdout=fdLog, stderr=fdLog,
                                                      env=cls._auth_env)
 
-        time.sleep(2)
+        readiness.waitForDNS(ipaddress, cls._authPort, cls._authStartupDelay, cls._auths[ipaddress])
 
         if cls._auths[ipaddress].poll() is not None:
             try:
@@ -0,0 +1 @@
+../regression-tests.common/clientsubnetoption.py
\ No newline at end of file
@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 OpenDNS, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the OpenDNS nor the names of its contributors may be
+#      used to endorse or promote products derived from this software without
+#      specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL OPENDNS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+""" Class to implement draft-ietf-dnsop-edns-client-subnet (previously known as
+draft-vandergaast-edns-client-subnet.
+
+The contained class supports both IPv4 and IPv6 addresses.
+
+The encode_subnets() and decode_subnets() functions handle many options at
+once, for tools generating large numbers of ECS-tagged queries. They cache
+the wire encoding of the subnets they have already seen, and encoding IPv4
+addresses given as integers uses NumPy when it is available. The results
+are the same with or without NumPy.
+
+Requirements:
+  dnspython (http://www.dnspython.org/)
+Optional:
+  numpy (https://numpy.org/)
+"""
+from __future__ import print_function
+from __future__ import division
+
+import math
+import numbers
+import socket
+import struct
+import dns
+import dns.edns
+import dns.flags
+import dns.message
+import dns.query
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = "bhartvigsen@opendns.com (Brian Hartvigsen)"
+__version__ = "2.0.0"
+
+ASSIGNED_OPTION_CODE = 0x0008
+DRAFT_OPTION_CODE = 0x50FA
+
+FAMILY_IPV4 = 1
+FAMILY_IPV6 = 2
+SUPPORTED_FAMILIES = (FAMILY_IPV4, FAMILY_IPV6)
+
+# maximum number of wire encodings kept by the cache, see encode_payload()
+WIRE_CACHE_SIZE = 65536
+_wire_cache = {}
+
+
+def _prefix_bytes(family, ip, mask):
+    """Returns the first ceil(mask / 8) bytes of ip, an integer, with the
+    bits past mask set to zero."""
+    if family == FAMILY_IPV4:
+        bits = 32
+        packed = struct.pack("!L", ip)
+    else:
+        bits = 128
+        packed = struct.pack("!QQ", ip >> 64, ip & (2 ** 64 - 1))
+
+    nbytes = (mask + 7) // 8
+    if nbytes == 0:
+        return b''
+    prefix = bytearray(packed[:nbytes])
+    if mask % 8 != 0:
+        prefix[-1] &= (0xFF << (8 - mask % 8)) & 0xFF
+    return bytes(prefix)
+
+
+def _cache_key(family, ip, mask, scope):
+    if family == FAMILY_IPV4:
+        significant = ip >> (32 - mask)
+    else:
+        significant = ip >> (128 - mask)
+    return (family, significant, mask, scope)
+
+
+def _cached_payload(key, data):
+    """Returns the cached payload for key if any, otherwise caches data,
+    which is either the payload or a function building it."""
+    cached = _wire_cache.get(key)
+    if cached is not None:
+        return cached
+    if callable(data):
+        data = data()
+    if len(_wire_cache) >= WIRE_CACHE_SIZE:
+        _wire_cache.clear()
+    _wire_cache[key] = data
+    return data
+
+
+def encode_payload(family, ip, mask, scope=0):
+    """Returns the ECS option payload for the given family, ip (an integer),
+    source prefix length and scope prefix length.
+
+    Encodings are cached, keyed on the significant bits only, so that
+    addresses from the same subnet share the same entry.
+    """
+    return _cached_payload(_cache_key(family, ip, mask, scope),
+                           lambda: struct.pack("!HBB", family, mask, scope) + _prefix_bytes(family, ip, mask))
+
+
+class ClientSubnetOption(dns.edns.Option):
+    """Implementation of draft-vandergaast-edns-client-subnet-01.
+
+    Attributes:
+        family: An integer indicating which address family is being sent
+        ip: IP address in integer notation
+        mask: An integer representing the number of relevant bits being sent
+        scope: An integer representing the number of significant bits used by
+            the authoritative server.
+    """
+
+    def __init__(self, ip, bits=24, scope=0, option=ASSIGNED_OPTION_CODE):
+        super(ClientSubnetOption, self).__init__(option)
+
+        n = None
+        f = None
+
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                n = socket.inet_pton(family, ip)
+                if family == socket.AF_INET6:
+                    f = FAMILY_IPV6
+                    hi, lo = struct.unpack('!QQ', n)
+                    ip = hi << 64 | lo
+                elif family == socket.AF_INET:
+                    f = FAMILY_IPV4
+                    ip = struct.unpack('!L', n)[0]
+            except Exception:
+                pass
+
+        if n is None:
+            raise Exception("%s is an invalid ip" % ip)
+
+        self.family = f
+        self.ip = ip
+        self.mask = bits
+        self.scope = scope
+        self.option = option
+
+        if self.family == FAMILY_IPV4 and self.mask > 32:
+            raise Exception("32 bits is the max for IPv4 (%d)" % bits)
+        if self.family == FAMILY_IPV6 and self.mask > 128:
+            raise Exception("128 bits is the max for IPv6 (%d)" % bits)
+
+    def calculate_ip(self):
+        """Calculates the relevant ip address based on the network mask.
+
+        Calculates the relevant bits of the IP address based on network mask.
+        Sizes up to the nearest octet for use with wire format.
+
+        Returns:
+            An integer of only the significant bits sized up to the nearest
+            octect.
+        """
+
+        if self.family == FAMILY_IPV4:
+            bits = 32
+        elif self.family == FAMILY_IPV6:
+            bits = 128
+
+        ip = self.ip >> bits - self.mask
+
+        if (self.mask % 8 != 0):
+            ip = ip << 8 - (self.mask % 8)
+
+        return ip
+
+    def is_draft(self):
+        """" Determines whether this instance is using the draft option code """
+        return self.option == DRAFT_OPTION_CODE
+
+    def to_wire(self, file=None):
+        """Create EDNS packet as defined in draft-vandergaast-edns-client-subnet-01."""
+
+        data = encode_payload(self.family, self.ip, self.mask, self.scope)
+        if file:
+            file.write(data)
+        else:
+            return data
+
+    def from_wire(cls, otype, wire, current, olen):
+        """Read EDNS packet as defined in draft-vandergaast-edns-client-subnet-01.
+
+        Returns:
+            An instance of ClientSubnetOption based on the ENDS packet
+        """
+
+        data = wire[current:current + olen]
+        (family, mask, scope) = struct.unpack("!HBB", data[:4])
+
+        c_mask = mask
+        if mask % 8 != 0:
+            c_mask += 8 - (mask % 8)
+
+        ip = struct.unpack_from("!%ds" % (c_mask // 8), data, 4)[0]
+
+        if (family == FAMILY_IPV4):
+            ip = ip + b'\0' * ((32 - c_mask) // 8)
+            ip = socket.inet_ntop(socket.AF_INET, ip)
+        elif (family == FAMILY_IPV6):
+            ip = ip + b'\0' * ((128 - c_mask) // 8)
+            ip = socket.inet_ntop(socket.AF_INET6, ip)
+        else:
+            raise Exception("Returned a family other then IPv4 or IPv6")
+
+        return cls(ip, mask, scope, otype)
+
+    from_wire = classmethod(from_wire)
+
+    # needed in 2.0.0..
+    @classmethod
+    def from_wire_parser(cls, otype, parser):
+        family, src, scope = parser.get_struct('!HBB')
+        addrlen = int(math.ceil(src / 8.0))
+        prefix = parser.get_bytes(addrlen)
+        if family == 1:
+            pad = 4 - addrlen
+            addr = dns.ipv4.inet_ntoa(prefix + b'\x00' * pad)
+        elif family == 2:
+            pad = 16 - addrlen
+            addr = dns.ipv6.inet_ntoa(prefix + b'\x00' * pad)
+        else:
+            raise ValueError('unsupported family')
+
+        return cls(addr, src, scope, otype)
+
+    def __repr__(self):
+        ip = _to_text(self.family, self.ip)
+
+        return "%s(%s, %s, %s)" % (
+            self.__class__.__name__,
+            ip,
+            self.mask,
+            self.scope
+        )
+
+    def to_text(self):
+        return self.__repr__()
+
+    def __eq__(self, other):
+        """Rich comparison method for equality.
+
+        Two ClientSubnetOptions are equal if their relevant ip bits, mask, and
+        family are identical. We ignore scope since generally we want to
+        compare questions to responses and that bit is only relevant when
+        determining caching behavior.
+
+        Returns:
+            boolean
+        """
+
+        if not isinstance(other, ClientSubnetOption):
+            return False
+        if self.calculate_ip() != other.calculate_ip():
+            return False
+        if self.mask != other.mask:
+            return False
+        if self.family != other.family:
+            return False
+        return True
+
+    def __ne__(self, other):
+        """Rich comparison method for inequality.
+
+        See notes for __eq__()
+
+        Returns:
+            boolean
+        """
+        return not self.__eq__(other)
+
+
+def _to_int(family, address):
+    if family == FAMILY_IPV4:
+        return struct.unpack('!L', socket.inet_pton(socket.AF_INET, address))[0]
+    hi, lo = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, address))
+    return hi << 64 | lo
+
+
+def _to_text(family, ip):
+    if family == FAMILY_IPV4:
+        return socket.inet_ntop(socket.AF_INET, struct.pack('!L', ip))
+    return socket.inet_ntop(socket.AF_INET6, struct.pack('!QQ', ip >> 64, ip & (2 ** 64 - 1)))
+
+
+def _broadcast(value, count, name):
+    if isinstance(value, numbers.Integral):
+        return [value] * count
+    value = list(value)
+    if len(value) != count:
+        raise ValueError("%d %s for %d addresses" % (len(value), name, count))
+    return value
+
+
+def encode_subnets(addresses, bits=24, scope=0):
+    """Returns the list of ECS option payloads for the given addresses.
+
+    addresses is either a sequence of IP addresses as strings, IPv4 and IPv6
+    ones can be mixed, or an array of IPv4 addresses as 32-bit integers
+    (array.array, numpy array or list). bits and scope are either integers
+    applied to every address, or sequences of the same length.
+
+    IPv4 addresses given as integers are encoded with NumPy when it is
+    available. All the encodings go through the cache of encode_payload().
+    """
+    count = len(addresses)
+    if count == 0:
+        return []
+    bits = _broadcast(bits, count, 'prefix lengths')
+    scope = _broadcast(scope, count, 'scopes')
+
+    if not isinstance(addresses[0], str):
+        if numpy is not None:
+            return _encode_ipv4_numpy(addresses, bits, scope)
+        return [encode_payload(FAMILY_IPV4, int(address), mask, sc) for address, mask, sc in zip(addresses, bits, scope)]
+
+    result = []
+    for address, mask, sc in zip(addresses, bits, scope):
+        family = FAMILY_IPV6 if ':' in address else FAMILY_IPV4
+        if (family == FAMILY_IPV4 and mask > 32) or mask > 128:
+            raise ValueError("Invalid prefix length %d for %s" % (mask, address))
+        result.append(encode_payload(family, _to_int(family, address), mask, sc))
+    return result
+
+
+def _encode_ipv4_numpy(addresses, bits, scope):
+    addresses = numpy.asarray(addresses, dtype=numpy.uint32)
+    bits = numpy.asarray(bits, dtype=numpy.uint8)
+    scope = numpy.asarray(scope, dtype=numpy.uint8)
+    if bits.max() > 32:
+        raise ValueError("32 bits is the max for IPv4 (%d)" % bits.max())
+
+    # zero the bits past the prefix length, with a 64-bit shift since
+    # shifting a 32-bit value by 32 is undefined
+    masks = ((numpy.uint64(0xFFFFFFFF) << (32 - bits.astype(numpy.uint64))) & numpy.uint64(0xFFFFFFFF)).astype(numpy.uint32)
+    prefixes = (addresses & masks).astype('>u4').view(numpy.uint8).reshape(-1, 4)
+    headers = numpy.empty((len(addresses), 4), dtype=numpy.uint8)
+    headers[:, 0:2] = numpy.frombuffer(struct.pack('!H', FAMILY_IPV4), dtype=numpy.uint8)
+    headers[:, 2] = bits
+    headers[:, 3] = scope
+    rows = numpy.concatenate((headers, prefixes), axis=1)
+    lengths = 4 + (bits.astype(numpy.int32) + 7) // 8
+    return [_cached_payload(_cache_key(FAMILY_IPV4, int(address), int(mask), int(sc)), row[:length].tobytes())
+            for address, mask, sc, row, length in zip(addresses, bits, scope, rows, lengths)]
+
+
+def decode_subnets(payloads):
+    """Decodes a sequence of ECS option payloads.
+
+    Returns a (families, addresses, masks, scopes) tuple of lists, the
+    addresses being strings.
+    """
+    families, addresses, masks, scopes = [], [], [], []
+    for payload in payloads:
+        option = ClientSubnetOption.from_wire(ASSIGNED_OPTION_CODE, payload, 0, len(payload))
+        families.append(option.family)
+        addresses.append(_to_text(option.family, option.ip))
+        masks.append(option.mask)
+        scopes.append(option.scope)
+    return (families, addresses, masks, scopes)
+
+
+dns.edns._type_to_class[DRAFT_OPTION_CODE] = ClientSubnetOption
+dns.edns._type_to_class[ASSIGNED_OPTION_CODE] = ClientSubnetOption
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    def CheckForClientSubnetOption(addr, args, option_code=ASSIGNED_OPTION_CODE):
+        print("Testing for edns-clientsubnet using option code", hex(option_code), file=sys.stderr)
+        cso = ClientSubnetOption(args.subnet, args.mask, option=option_code)
+        message = dns.message.make_query(args.rr, args.type)
+        # Tested authoritative servers seem to use the last code in cases
+        # where they support both. We make the official code last to allow
+        # us to check for support of both draft and official
+        message.use_edns(options=[cso])
+
+        try:
+            r = dns.query.udp(message, addr, timeout=args.timeout)
+            if r.flags & dns.flags.TC:
+                r = dns.query.tcp(message, addr, timeout=args.timeout)
+        except dns.exception.Timeout:
+            print("Timeout: No answer received from %s\n" % args.nameserver, file=sys.stderr)
+            sys.exit(3)
+
+        error = False
+        found = False
+        for options in r.options:
+            # Have not run into anyone who passes back both codes yet
+            # but just in case, we want to check all possible options
+            if isinstance(options, ClientSubnetOption):
+                found = True
+                print("Found ClientSubnetOption...", end=None, file=sys.stderr)
+                if not cso.family == options.family:
+                    error = True
+                    print("\nFailed: returned family (%d) is different from the passed family (%d)" % (options.family, cso.family), file=sys.stderr)
+                if not cso.calculate_ip() == options.calculate_ip():
+                    error = True
+                    print("\nFailed: returned ip (%s) is different from the passed ip (%s)." % (options.calculate_ip(), cso.calculate_ip()), file=sys.stderr)
+                if not options.mask == cso.mask:
+                    error = True
+                    print("\nFailed: returned mask bits (%d) is different from the passed mask bits (%d)" % (options.mask, cso.mask), file=sys.stderr)
+                if not options.scope != 0:
+                    print("\nWarning: scope indicates edns-clientsubnet data is not used", file=sys.stderr)
+                if options.is_draft():
+                    print("\nWarning: detected support for edns-clientsubnet draft code", file=sys.stderr)
+
+        if found and not error:
+            print("Success", file=sys.stderr)
+        elif found:
+            print("Failed: See error messages above", file=sys.stderr)
+        else:
+            print("Failed: No ClientSubnetOption returned", file=sys.stderr)
+
+    parser = argparse.ArgumentParser(description='draft-vandergaast-edns-client-subnet-01 tester')
+    parser.add_argument('nameserver', help='The nameserver to test')
+    parser.add_argument('rr', help='DNS record that should return an EDNS enabled response')
+    parser.add_argument('-s', '--subnet', help='Specifies an IP to pass as the client subnet.', default='192.0.2.0')
+    parser.add_argument('-m', '--mask', type=int, help='CIDR mask to use for subnet')
+    parser.add_argument('--timeout', type=int, help='Set the timeout for query to TIMEOUT seconds, default=10', default=10)
+    parser.add_argument('-t', '--type', help='DNS query type, default=A', default='A')
+    args = parser.parse_args()
+
+    if not args.mask:
+        if ':' in args.subnet:
+            args.mask = 48
+        else:
+            args.mask = 24
+
+    try:
+        addr = socket.gethostbyname(args.nameserver)
+    except socket.gaierror:
+        print("Unable to resolve %s\n" % args.nameserver, file=sys.stderr)
+        sys.exit(3)
+
+    CheckForClientSubnetOption(addr, args, DRAFT_OPTION_CODE)
+    print("", file=sys.stderr)
+    CheckForClientSubnetOption(addr, args, ASSIGNED_OPTION_CODE)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import os
+import socket
+import struct
+import time
+
+# Helpers used by the test harnesses to wait until a daemon they just
+# started is ready to serve, instead of sleeping for a fixed delay.
+
+def waitUntil(check, timeout, process=None, interval=0.05):
+    """
+    Calls check() every `interval` seconds until it returns True,
+    returning True. Returns False if `timeout` seconds elapsed or if
+    `process` (a subprocess.Popen object) exited in the meantime.
+    """
+    deadline = time.time() + timeout
+    while True:
+        if process is not None and process.poll() is not None:
+            return False
+        try:
+            if check():
+                return True
+        except (socket.error, OSError):
+            pass
+        if time.time() >= deadline:
+            return False
+        time.sleep(interval)
+
+def isTCPPortOpen(address, port, timeout=0.5):
+    """
+    Returns True if a TCP connection to address:port can be established.
+    """
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect((address, port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+def answersDNSQuery(address, port, timeout=0.2):
+    """
+    Returns True if a '. IN SOA' query sent over UDP to address:port
+    gets a response, whatever its rcode.
+    """
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    qid = struct.unpack('!H', os.urandom(2))[0]
+    # header with no flags set and a single question, then the root name, SOA, IN
+    query = struct.pack('!HHHHHH', qid, 0, 1, 0, 0, 0) + b'\x00' + struct.pack('!HH', 6, 1)
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    try:
+        sock.sendto(query, (address, port))
+        data = sock.recv(4096)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return len(data) >= 12 and struct.unpack('!H', data[0:2])[0] == qid
+
+def waitForTCPPorts(address, ports, timeout, process=None):
+    """
+    Waits until every port in `ports` accepts TCP connections on `address`.
+    """
+    return waitUntil(lambda: all([isTCPPortOpen(address, port) for port in ports]), timeout, process)
+
+def waitForDNS(address, port, timeout, process=None):
+    """
+    Waits until address:port answers DNS queries over UDP.
+    """
+    return waitUntil(lambda: answersDNSQuery(address, port), timeout, process)
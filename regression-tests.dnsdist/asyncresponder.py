@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import asyncio
+import socket
+import struct
+import dns
+import dns.message
+
+# asyncio-based responders, serving any number of concurrent TCP connections
+# and pipelined queries. They share the queue-based API of the threaded
+# DNSDistTest.UDPResponder and DNSDistTest.TCPResponder, with the addition of
+# an optional delay applied before sending each response: either a number of
+# seconds, or a function called with the request and returning that number.
+# Each responder runs its own event loop, and is meant to be the target of a
+# thread, like the threaded ones.
+
+def _getDelay(delay, request):
+    if delay is None:
+        return 0
+    if callable(delay):
+        return delay(request) or 0
+    return delay
+
+def _getResponseWire(testcls, request, fromQueue, toQueue, callback, maxSize=None):
+    # called in order of arrival, so that responses are picked from the queue
+    # in the same order than with the threaded responders
+    if callback:
+        return callback(request)
+    response = testcls._getResponse(request, fromQueue, toQueue)
+    if not response:
+        return None
+    if maxSize:
+        return response.to_wire(max_size=maxSize)
+    return response.to_wire()
+
+class _UDPResponderProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, testcls, fromQueue, toQueue, delay, callback):
+        self._testcls = testcls
+        self._fromQueue = fromQueue
+        self._toQueue = toQueue
+        self._delay = delay
+        self._callback = callback
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        request = dns.message.from_wire(data)
+        wire = _getResponseWire(self._testcls, request, self._fromQueue, self._toQueue, self._callback)
+        if not wire:
+            return
+        delay = _getDelay(self._delay, request)
+        if delay:
+            asyncio.get_event_loop().call_later(delay, self._transport.sendto, wire, addr)
+        else:
+            self._transport.sendto(wire, addr)
+
+def AsyncUDPResponder(testcls, port, fromQueue, toQueue, delay=None, callback=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    listen = loop.create_datagram_endpoint(lambda: _UDPResponderProtocol(testcls, fromQueue, toQueue, delay, callback),
+                                           local_addr=("127.0.0.1", port),
+                                           reuse_port=True)
+    loop.run_until_complete(listen)
+    loop.run_forever()
+
+async def _sendTCPResponse(writer, wire, delay):
+    if delay:
+        await asyncio.sleep(delay)
+    if writer.is_closing():
+        return
+    # a single write, so that responses to pipelined queries are never interleaved
+    writer.write(struct.pack("!H", len(wire)) + wire)
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+
+async def _handleTCPConnection(testcls, fromQueue, toQueue, delay, callback, reader, writer):
+    pending = []
+    try:
+        while True:
+            try:
+                data = await reader.readexactly(2)
+                (datalen,) = struct.unpack("!H", data)
+                data = await reader.readexactly(datalen)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+
+            request = dns.message.from_wire(data)
+            wire = _getResponseWire(testcls, request, fromQueue, toQueue, callback, maxSize=65535)
+            if not wire:
+                break
+
+            pending.append(asyncio.ensure_future(_sendTCPResponse(writer, wire, _getDelay(delay, request))))
+            pending = [task for task in pending if not task.done()]
+
+        if pending:
+            await asyncio.wait(pending)
+    finally:
+        writer.close()
+
+def AsyncTCPResponder(testcls, port, fromQueue, toQueue, delay=None, callback=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def handler(reader, writer):
+        await _handleTCPConnection(testcls, fromQueue, toQueue, delay, callback, reader, writer)
+
+    listen = asyncio.start_server(handler, "127.0.0.1", port, reuse_port=True, backlog=100)
+    server = loop.run_until_complete(listen)
+    for sock in server.sockets:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    loop.run_forever()
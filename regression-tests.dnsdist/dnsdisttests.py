@@ -1,6 +1,7 @@
 #!/usr/bin/env python2
 
 import copy
+import errno
 import os
 import socket
 import ssl
@@ -11,6 +12,7 @@ import threading
 import time
 import unittest
 import clientsubnetoption
+import readiness
 import dns
 import dns.message
 import libnacl
@@ -30,6 +32,63 @@ except NameError:
   pass
 
 
+class PortAllocator(object):
+    """
+    Hands out ports that are not used by another test class, possibly
+    running in a different worker process. A port is reserved by
+    exclusively creating a file named after it in a directory shared
+    by all the workers, then checked to be bindable over UDP and TCP.
+    """
+
+    def __init__(self, directory, first=10000, last=30000):
+        self._directory = directory
+        self._first = first
+        self._last = last
+
+    @staticmethod
+    def isAvailable(port):
+        for socktype in [socket.SOCK_DGRAM, socket.SOCK_STREAM]:
+            sock = socket.socket(socket.AF_INET, socktype)
+            try:
+                sock.bind(("127.0.0.1", port))
+            except socket.error:
+                return False
+            finally:
+                sock.close()
+        return True
+
+    def allocate(self):
+        try:
+            os.makedirs(self._directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        span = self._last - self._first + 1
+        # start at a different place in each process to limit contention
+        start = (os.getpid() * 97) % span
+        for idx in range(span):
+            port = self._first + (start + idx) % span
+            try:
+                fd = os.open(os.path.join(self._directory, str(port)), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    continue
+                raise
+
+            if self.isAvailable(port):
+                return port
+            # used by something else, leave it reserved
+
+        raise RuntimeError('No port available in the [%d, %d] range' % (self._first, self._last))
+
+    def release(self, port):
+        try:
+            os.unlink(os.path.join(self._directory, str(port)))
+        except OSError:
+            pass
+
 class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
     """
     Set up a dnsdist instance and responder threads.
@@ -45,7 +104,9 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
     _toResponderQueue = Queue()
     _fromResponderQueue = Queue()
     _queueTimeout = 1
+    # maximum time to wait for dnsdist to accept connections
     _dnsdistStartupDelay = 2.0
+    _dnsdistServedPorts = ['_consolePort', '_webServerPort', '_dohServerPort', '_tlsServerPort', '_dnsDistPortDNSCrypt']
     _dnsdist = None
     _responsesCounter = {}
     _config_template = """
@@ -59,11 +120,66 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
     _answerUnexpected = True
     _checkConfigExpectedOutput = None
     _verboseMode = False
+    # when set, the listening address is not passed on the command line, which
+    # would override the addLocal() and setLocal() directives of the configuration
+    _skipListeningOnCL = False
+    # use the asyncio responders (see asyncresponder.py), serving concurrent
+    # TCP connections and pipelined queries, waiting _responderDelay seconds
+    # (or _responderDelay(request) if it is a function) before each response
+    _asyncResponders = False
+    _responderDelay = None
+    # when set, every '_*Port' class attribute not listed in _staticPorts is
+    # replaced by a port reserved for this class, so that test classes can
+    # be run in parallel by different processes
+    _parallelTests = 'DNSDIST_PARALLEL_TESTS' in os.environ
+    _portAllocator = PortAllocator(os.path.join('configs', 'ports'))
+    _staticPorts = ['_snmpPort']
+    _allocatedPorts = []
+
+    @classmethod
+    def allocatePorts(cls):
+        cls._configDir = os.path.join('configs', cls.__name__)
+        if not os.path.isdir(cls._configDir):
+            os.makedirs(cls._configDir)
+
+        if not cls._parallelTests:
+            return
+
+        # attributes sharing the same port keep sharing it
+        mapping = {}
+        for name in dir(cls):
+            if not name.startswith('_') or 'Port' not in name:
+                continue
+            if name in cls._staticPorts:
+                continue
+            value = getattr(cls, name)
+            if not isinstance(value, int) or isinstance(value, bool) or value <= 0 or value > 65535:
+                continue
+            if value not in mapping:
+                mapping[value] = cls._portAllocator.allocate()
+            setattr(cls, name, mapping[value])
+        cls._allocatedPorts = list(mapping.values())
+
+    @classmethod
+    def releasePorts(cls):
+        for port in cls._allocatedPorts:
+            cls._portAllocator.release(port)
+        cls._allocatedPorts = []
+
+    @classmethod
+    def expectedCheckConfigOutput(cls, confFile):
+        if cls._checkConfigExpectedOutput is not None:
+            return cls._checkConfigExpectedOutput
+        return ('Configuration \'%s\' OK!\n' % (confFile)).encode()
 
     @classmethod
     def startResponders(cls):
         print("Launching responders..")
 
+        if cls._asyncResponders:
+            cls.startAsyncResponders(cls._testServerPort)
+            return
+
         cls._UDPResponder = threading.Thread(name='UDP Responder', target=cls.UDPResponder, args=[cls._testServerPort, cls._toResponderQueue, cls._fromResponderQueue])
         cls._UDPResponder.setDaemon(True)
         cls._UDPResponder.start()
@@ -71,18 +187,34 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
         cls._TCPResponder.setDaemon(True)
         cls._TCPResponder.start()
 
+    @classmethod
+    def startAsyncResponders(cls, port, delay=None, callback=None):
+        # Python 3 only, hence the late import
+        import asyncresponder
+
+        if delay is None:
+            delay = cls._responderDelay
+
+        cls._UDPResponder = threading.Thread(name='UDP Responder', target=asyncresponder.AsyncUDPResponder, args=[cls, port, cls._toResponderQueue, cls._fromResponderQueue, delay, callback])
+        cls._UDPResponder.setDaemon(True)
+        cls._UDPResponder.start()
+        cls._TCPResponder = threading.Thread(name='TCP Responder', target=asyncresponder.AsyncTCPResponder, args=[cls, port, cls._toResponderQueue, cls._fromResponderQueue, delay, callback])
+        cls._TCPResponder.setDaemon(True)
+        cls._TCPResponder.start()
+
     @classmethod
     def startDNSDist(cls):
         print("Launching dnsdist..")
-        confFile = os.path.join('configs', 'dnsdist_%s.conf' % (cls.__name__))
+        confFile = os.path.join(cls._configDir, 'dnsdist.conf')
         params = tuple([getattr(cls, param) for param in cls._config_params])
         print(params)
         with open(confFile, 'w') as conf:
             conf.write("-- Autogenerated by dnsdisttests.py\n")
             conf.write(cls._config_template % params)
 
-        dnsdistcmd = [os.environ['DNSDISTBIN'], '--supervised', '-C', confFile,
-                      '-l', '%s:%d' % (cls._dnsDistListeningAddr, cls._dnsDistPort) ]
+        dnsdistcmd = [os.environ['DNSDISTBIN'], '--supervised', '-C', confFile ]
+        if not cls._skipListeningOnCL:
+            dnsdistcmd.extend(['-l', '%s:%d' % (cls._dnsDistListeningAddr, cls._dnsDistPort) ])
         if cls._verboseMode:
             dnsdistcmd.append('-v')
 
@@ -96,28 +228,33 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
             output = subprocess.check_output(testcmd, stderr=subprocess.STDOUT, close_fds=True)
         except subprocess.CalledProcessError as exc:
             raise AssertionError('dnsdist --check-config failed (%d): %s' % (exc.returncode, exc.output))
-        if cls._checkConfigExpectedOutput is not None:
-          expectedOutput = cls._checkConfigExpectedOutput
-        else:
-          expectedOutput = ('Configuration \'%s\' OK!\n' % (confFile)).encode()
+        expectedOutput = cls.expectedCheckConfigOutput(confFile)
         if not cls._verboseMode and output != expectedOutput:
             raise AssertionError('dnsdist --check-config failed: %s' % output)
 
-        logFile = os.path.join('configs', 'dnsdist_%s.log' % (cls.__name__))
+        logFile = os.path.join(cls._configDir, 'dnsdist.log')
         with open(logFile, 'w') as fdLog:
           cls._dnsdist = subprocess.Popen(dnsdistcmd, close_fds=True, stdout=fdLog, stderr=fdLog)
 
-        if 'DNSDIST_FAST_TESTS' in os.environ:
-            delay = 0.5
-        else:
-            delay = cls._dnsdistStartupDelay
-
-        time.sleep(delay)
+        cls.waitForDNSDist()
 
         if cls._dnsdist.poll() is not None:
             cls._dnsdist.kill()
             sys.exit(cls._dnsdist.returncode)
 
+    @classmethod
+    def waitForDNSDist(cls):
+        # wait, for at most _dnsdistStartupDelay seconds, until the main
+        # listener and every console, web server, DoT, DoH and DNSCrypt
+        # port present in the configuration accept connections
+        address = cls._dnsDistListeningAddr
+        if address in ['0.0.0.0', '::']:
+            address = '127.0.0.1'
+        ports = [getattr(cls, param) for param in cls._config_params if param in cls._dnsdistServedPorts]
+        if not readiness.waitForTCPPorts(address, [cls._dnsDistPort], cls._dnsdistStartupDelay, cls._dnsdist):
+            return
+        readiness.waitForTCPPorts('127.0.0.1', ports, cls._dnsdistStartupDelay, cls._dnsdist)
+
     @classmethod
     def setUpSockets(cls):
         print("Setting up UDP socket..")
@@ -128,6 +265,7 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
     @classmethod
     def setUpClass(cls):
 
+        cls.allocatePorts()
         cls.startResponders()
         cls.startDNSDist()
         cls.setUpSockets()
@@ -147,6 +285,7 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
                 if cls._dnsdist.poll() is None:
                     cls._dnsdist.kill()
                 cls._dnsdist.wait()
+        cls.releasePorts()
 
     @classmethod
     def _ResponderIncrementCounter(cls):
@@ -226,11 +365,12 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
         sock.close()
 
     @classmethod
-    def TCPResponder(cls, port, fromQueue, toQueue, trailingDataResponse=False, multipleResponses=False, callback=None):
+    def TCPResponder(cls, port, fromQueue, toQueue, trailingDataResponse=False, multipleResponses=False, callback=None, tlsContext=None):
         # trailingDataResponse=True means "ignore trailing data".
         # Other values are either False (meaning "raise an exception")
         # or are interpreted as a response RCODE for queries with trailing data.
         # callback is invoked for every -even healthcheck ones- query and should return a raw response
+        # tlsContext, if set, is used to accept DNS over TLS connections instead of plain TCP ones
         ignoreTrailing = trailingDataResponse is True
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -246,6 +386,14 @@ class DNSDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
         while True:
             (conn, _) = sock.accept()
             conn.settimeout(5.0)
+            if tlsContext:
+                try:
+                    conn = tlsContext.wrap_socket(conn, server_side=True)
+                except (ssl.SSLError, socket.error) as e:
+                    print("Error during the TLS handshake in the TCP responder: %s" % str(e))
+                    conn.close()
+                    continue
+
             data = conn.recv(2)
             if not data:
                 conn.close()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+import copy
+import random
+import socket
+import struct
+import threading
+import time
+import dns
+import dns.exception
+import dns.message
+import dns.rcode
+
+# Open-loop load generator for the dnsdist under test, built on the socket
+# helpers of DNSDistTest. Queries are scheduled at a fixed rate and sent by
+# a pool of worker threads, each one using its own socket, TLS connection or
+# HTTP/2 handle. The latency of a query is measured from the time it was
+# scheduled to be sent, not from the time it was actually sent, so that a
+# stalled worker does not hide the queries it delayed.
+
+try:
+  range = xrange
+except NameError:
+  pass
+
+class LoadReport(object):
+
+    def __init__(self, protocol, qps, duration, latencies, drops, errors, rcodes, late):
+        self.protocol = protocol
+        self.qps = qps
+        self.duration = duration
+        self.latencies = sorted(latencies)
+        self.drops = drops
+        self.errors = errors
+        self.rcodes = rcodes
+        self.late = late
+
+    @property
+    def sent(self):
+        return len(self.latencies) + self.drops + self.errors
+
+    @property
+    def received(self):
+        return len(self.latencies)
+
+    @property
+    def dropRate(self):
+        """
+        Ratio of the queries that got no response, either because of a
+        timeout or because of a network error.
+        """
+        if self.sent == 0:
+            return 0.0
+        return float(self.drops + self.errors) / self.sent
+
+    def percentile(self, pct):
+        """
+        Returns the latency, in seconds, below which `pct` percent of the
+        responses were received (nearest-rank method), or None if no
+        response was received.
+        """
+        if not self.latencies:
+            return None
+        rank = int(round(pct / 100.0 * len(self.latencies) + 0.5)) - 1
+        rank = max(0, min(rank, len(self.latencies) - 1))
+        return self.latencies[rank]
+
+    def __str__(self):
+        lines = ['%s: %d queries at %d qps over %.1fs, %d responses, %d drops, %d errors (%.2f%% dropped), %d sent late' % (self.protocol, self.sent, self.qps, self.duration, self.received, self.drops, self.errors, 100.0 * self.dropRate, self.late)]
+        if self.latencies:
+            lines.append('latency (ms): p50 %.2f, p90 %.2f, p99 %.2f, max %.2f' % tuple([1000.0 * self.percentile(pct) for pct in (50, 90, 99, 100)]))
+        if self.rcodes:
+            lines.append('rcodes: ' + ', '.join(['%s %d' % (dns.rcode.to_text(rcode), count) for rcode, count in sorted(self.rcodes.items())]))
+        return '\n'.join(lines)
+
+class _UDPClient(object):
+
+    def __init__(self, driver):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.settimeout(driver.timeout)
+        self._sock.connect(("127.0.0.1", driver.port))
+
+    def query(self, query):
+        wire = query.to_wire()
+        self._sock.send(wire)
+        while True:
+            data = self._sock.recv(4096)
+            message = dns.message.from_wire(data)
+            # skip late responses to queries that already timed out
+            if message.id == query.id:
+                return message
+
+    def close(self):
+        self._sock.close()
+
+class _TCPClient(object):
+
+    def __init__(self, driver):
+        self._driver = driver
+        self._conn = None
+
+    def _connect(self):
+        return self._driver.testcls.openTCPConnection(self._driver.timeout)
+
+    def query(self, query):
+        if self._conn is None:
+            self._conn = self._connect()
+        try:
+            self._driver.testcls.sendTCPQueryOverConnection(self._conn, query)
+            message = self._driver.testcls.recvTCPResponseOverConnection(self._conn)
+        except:
+            self.close()
+            raise
+        if message is None:
+            # the connection has been closed, we will need a new one
+            self.close()
+            raise socket.error('Connection closed by dnsdist')
+        if not self._driver.reuseConnections:
+            self.close()
+        return message
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+class _DoTClient(_TCPClient):
+
+    def _connect(self):
+        return self._driver.testcls.openTLSConnection(self._driver.port, self._driver.serverName, self._driver.caFile, self._driver.timeout)
+
+class _DoHClient(object):
+
+    def __init__(self, driver):
+        # not needed by the other protocols, hence the late import
+        import pycurl
+
+        self._pycurl = pycurl
+        self._driver = driver
+        self._conn = None
+
+    def _connect(self):
+        pycurl = self._pycurl
+        conn = pycurl.Curl()
+        conn.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2)
+        conn.setopt(pycurl.HTTPHEADER, ["Content-type: application/dns-message",
+                                         "Accept: application/dns-message"])
+        conn.setopt(pycurl.URL, 'https://%s:%d%s' % (self._driver.serverName, self._driver.port, self._driver.dohPath))
+        conn.setopt(pycurl.RESOLVE, ["%s:%d:127.0.0.1" % (self._driver.serverName, self._driver.port)])
+        conn.setopt(pycurl.SSL_VERIFYPEER, 1)
+        conn.setopt(pycurl.SSL_VERIFYHOST, 2)
+        if self._driver.caFile:
+            conn.setopt(pycurl.CAINFO, self._driver.caFile)
+        conn.setopt(pycurl.TIMEOUT_MS, int(self._driver.timeout * 1000))
+        conn.setopt(pycurl.POST, True)
+        return conn
+
+    def query(self, query):
+        if self._conn is None:
+            self._conn = self._connect()
+        self._conn.setopt(self._pycurl.POSTFIELDS, query.to_wire())
+        try:
+            data = self._conn.perform_rb()
+        except self._pycurl.error as e:
+            self.close()
+            if e.args[0] == self._pycurl.E_OPERATION_TIMEDOUT:
+                raise socket.timeout(str(e))
+            raise socket.error(str(e))
+        rcode = self._conn.getinfo(self._pycurl.RESPONSE_CODE)
+        if not self._driver.reuseConnections:
+            self.close()
+        if rcode != 200:
+            raise socket.error('HTTP status code %d' % (rcode))
+        return dns.message.from_wire(data)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+class LoadDriver(object):
+    """
+    Sends `qps` queries per second over `protocol` ('udp', 'tcp', 'dot' or
+    'doh') to the dnsdist started by `testcls`, a DNSDistTest subclass, for
+    `duration` seconds, then returns a LoadReport.
+
+    `queries` is either a list of dns.message.Message objects, sent in a
+    round-robin fashion, or a function returning the query to send given
+    its index. Every query is sent with a new random ID, so that a late
+    response to a previous query is not mistaken for the response to the
+    current one. A query that did not get a response after `timeout` seconds
+    counts as dropped. The responses are not matched against the responder
+    queues, so the backend should either answer without them or the answers
+    should come from the cache.
+
+    `port` defaults to the _dnsDistPort, _tlsServerPort or _dohServerPort of
+    `testcls` depending on the protocol, `serverName` and `caFile` to its
+    _serverName and _caCert.
+    """
+
+    _clients = {
+        'udp': _UDPClient,
+        'tcp': _TCPClient,
+        'dot': _DoTClient,
+        'doh': _DoHClient,
+    }
+    _ports = {
+        'udp': '_dnsDistPort',
+        'tcp': '_dnsDistPort',
+        'dot': '_tlsServerPort',
+        'doh': '_dohServerPort',
+    }
+
+    def __init__(self, testcls, protocol='udp', qps=100, duration=1.0, queries=None, concurrency=10, timeout=2.0, port=None, serverName=None, caFile=None, dohPath='/', reuseConnections=True):
+        if protocol not in self._clients:
+            raise ValueError("Unsupported protocol '%s', expected one of %s" % (protocol, ', '.join(sorted(self._clients.keys()))))
+        if qps <= 0:
+            raise ValueError("The number of queries per second should be positive")
+
+        self.testcls = testcls
+        self.protocol = protocol
+        self.qps = qps
+        self.duration = duration
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.port = port if port is not None else getattr(testcls, self._ports[protocol])
+        self.serverName = serverName if serverName is not None else getattr(testcls, '_serverName', None)
+        self.caFile = caFile if caFile is not None else getattr(testcls, '_caCert', None)
+        self.dohPath = dohPath
+        self.reuseConnections = reuseConnections
+
+        if queries is None:
+            queries = [dns.message.make_query('load.tests.powerdns.com.', 'A', 'IN')]
+        if callable(queries):
+            self._getQuery = queries
+        else:
+            self._getQuery = lambda idx: queries[idx % len(queries)]
+
+        self._lock = threading.Lock()
+
+    def _nextSlot(self):
+        with self._lock:
+            if self._next >= self._total:
+                return None
+            idx = self._next
+            self._next += 1
+            return idx
+
+    def _worker(self):
+        client = self._clients[self.protocol](self)
+        latencies = []
+        drops = 0
+        errors = 0
+        late = 0
+        rcodes = {}
+        try:
+            while True:
+                idx = self._nextSlot()
+                if idx is None:
+                    break
+
+                scheduled = self._start + float(idx) / self.qps
+                now = time.time()
+                if now < scheduled:
+                    time.sleep(scheduled - now)
+                elif now - scheduled > 0.01:
+                    late += 1
+
+                query = copy.copy(self._getQuery(idx))
+                query.id = random.randint(0, 65535)
+                try:
+                    message = client.query(query)
+                    latencies.append(time.time() - scheduled)
+                    rcode = message.rcode()
+                    rcodes[rcode] = rcodes.get(rcode, 0) + 1
+                except socket.timeout:
+                    drops += 1
+                except (socket.error, EOFError, struct.error, dns.exception.DNSException):
+                    errors += 1
+        finally:
+            client.close()
+
+        with self._lock:
+            self._latencies.extend(latencies)
+            self._drops += drops
+            self._errors += errors
+            self._late += late
+            for rcode, count in rcodes.items():
+                self._rcodes[rcode] = self._rcodes.get(rcode, 0) + count
+
+    def run(self):
+        self._total = int(self.qps * self.duration)
+        self._next = 0
+        self._latencies = []
+        self._drops = 0
+        self._errors = 0
+        self._late = 0
+        self._rcodes = {}
+        # leave the workers some time to set up their clients
+        self._start = time.time() + 0.1
+
+        workers = []
+        for idx in range(self.concurrency):
+            worker = threading.Thread(name='Load worker %d' % (idx), target=self._worker)
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+        return LoadReport(self.protocol, self.qps, self.duration, self._latencies, self._drops, self._errors, self._rcodes, self._late)
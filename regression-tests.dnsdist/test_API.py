@@ -2,6 +2,7 @@
 import os.path
 
 import base64
+import dns
 import json
 import requests
 from dnsdisttests import DNSDistTest
@@ -97,7 +98,7 @@ class TestAPIBasics(DNSDistTest):
 
         for rule_group in rule_groups:
             for rule in content[rule_group]:
-                for key in ['id', 'creationOrder', 'matches', 'rule', 'action', 'uuid']:
+                for key in ['id', 'creationOrder', 'matches', 'rule', 'action', 'uuid', 'rule-timings', 'action-timings']:
                     self.assertIn(key, rule)
                 for key in ['id', 'creationOrder', 'matches']:
                     self.assertTrue(rule[key] >= 0)
@@ -122,10 +123,10 @@ class TestAPIBasics(DNSDistTest):
                 self.assertTrue(frontend[key] >= 0)
 
         for pool in content['pools']:
-            for key in ['id', 'name', 'cacheSize', 'cacheEntries', 'cacheHits', 'cacheMisses', 'cacheDeferredInserts', 'cacheDeferredLookups', 'cacheLookupCollisions', 'cacheInsertCollisions', 'cacheTTLTooShorts']:
+            for key in ['id', 'name', 'cacheSize', 'cacheEntries', 'cacheHits', 'cacheMisses', 'cacheDeferredInserts', 'cacheDeferredLookups', 'cacheLookupCollisions', 'cacheInsertCollisions', 'cacheTTLTooShorts', 'cachePrefetches', 'cacheEvictions', 'cacheRejectedAdmissions']:
                 self.assertIn(key, pool)
 
-            for key in ['id', 'cacheSize', 'cacheEntries', 'cacheHits', 'cacheMisses', 'cacheDeferredInserts', 'cacheDeferredLookups', 'cacheLookupCollisions', 'cacheInsertCollisions', 'cacheTTLTooShorts']:
+            for key in ['id', 'cacheSize', 'cacheEntries', 'cacheHits', 'cacheMisses', 'cacheDeferredInserts', 'cacheDeferredLookups', 'cacheLookupCollisions', 'cacheInsertCollisions', 'cacheTTLTooShorts', 'cachePrefetches', 'cacheEvictions', 'cacheRejectedAdmissions']:
                 self.assertTrue(pool[key] >= 0)
 
     def testServersIDontExist(self):
@@ -322,6 +323,56 @@ class TestAPIServerDown(DNSDistTest):
 
         self.assertEquals(content['servers'][0]['latency'], None)
 
+class TestAPIRuleTimings(DNSDistTest):
+
+    _webTimeout = 2.0
+    _webServerPort = 8083
+    _webServerBasicAuthPassword = 'secret'
+    _webServerAPIKey = 'apisecret'
+    _config_params = ['_testServerPort', '_webServerPort', '_webServerBasicAuthPassword', '_webServerAPIKey']
+    _config_template = """
+    setACL({"127.0.0.1/32", "::1/128"})
+    newServer{address="127.0.0.1:%s"}
+    webserver("127.0.0.1:%s", "%s", "%s")
+    setRuleTimingSampleRate(1)
+    addAction(AllRule(), NoneAction())
+    addAction("timings.api.tests.powerdns.com.", SpoofAction("192.0.2.1"))
+    """
+
+    def testRuleTimings(self):
+        """
+        API: Sampled rule timings
+        """
+        name = 'timings.api.tests.powerdns.com.'
+        query = dns.message.make_query(name, 'A', 'IN')
+        (_, receivedResponse) = self.sendUDPQuery(query, response=None, useQueue=False)
+        self.assertTrue(receivedResponse)
+
+        headers = {'x-api-key': self._webServerAPIKey}
+        url = 'http://127.0.0.1:' + str(self._webServerPort) + '/api/v1/servers/localhost'
+        r = requests.get(url, headers=headers, timeout=self._webTimeout)
+        self.assertTrue(r)
+        self.assertEquals(r.status_code, 200)
+        content = r.json()
+
+        self.assertEquals(len(content['rules']), 2)
+        for rule in content['rules']:
+            self.assertEquals(rule['matches'], 1)
+            for key in ['rule-timings', 'action-timings']:
+                timings = rule[key]
+                self.assertEquals(timings['count'], 1)
+                self.assertEquals(len(timings['buckets']), 6)
+                self.assertEquals(sum(timings['buckets']), 1)
+
+        url = 'http://127.0.0.1:' + str(self._webServerPort) + '/metrics'
+        r = requests.get(url, auth=('whatever', self._webServerBasicAuthPassword), timeout=self._webTimeout)
+        self.assertTrue(r)
+        self.assertEquals(r.status_code, 200)
+        for rule in content['rules']:
+            label = 'chain="rules",id="%d",uuid="%s"' % (rule['id'], rule['uuid'])
+            self.assertIn('dnsdist_rule_selector_duration_count{%s} 1' % (label), r.text)
+            self.assertIn('dnsdist_rule_action_duration_bucket{%s,le="+Inf"} 1' % (label), r.text)
+
 class TestAPIWritable(DNSDistTest):
 
     _webTimeout = 2.0
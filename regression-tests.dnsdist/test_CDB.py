@@ -59,6 +59,7 @@ class TestCDBSimple(CDBTest):
     def setUpClass(cls):
 
         cls.setUpCDB()
+        cls.allocatePorts()
         cls.startResponders()
         cls.startDNSDist()
         cls.setUpSockets()
@@ -144,6 +145,7 @@ class TestCDBReload(CDBTest):
     def setUpClass(cls):
 
         cls.setUpCDB()
+        cls.allocatePorts()
         cls.startResponders()
         cls.startDNSDist()
         cls.setUpSockets()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import base64
+import os
 import time
 import dns
 import clientsubnetoption
@@ -1133,6 +1134,362 @@ class TestCachingStaleExpunged(DNSDistTest):
 
         self.assertEquals(total, misses)
 
+class TestCachingSaveAndLoad(DNSDistTest):
+
+    _consoleKey = DNSDistTest.generateConsoleKey()
+    _consoleKeyB64 = base64.b64encode(_consoleKey).decode('ascii')
+    _config_params = ['_consoleKeyB64', '_consolePort', '_testServerPort']
+    _config_template = """
+    pc = newPacketCache(100, {maxTTL=86400, minTTL=1})
+    getPool(""):setCache(pc)
+    setKey("%s")
+    controlSocket("127.0.0.1:%d")
+    newServer{address="127.0.0.1:%d"}
+    """
+
+    def testCacheSaveAndLoad(self):
+        """
+        Cache: Save the cache to a file, empty it, load it back and get a cache HIT
+        """
+        ttl = 3600
+        name = 'save-and-load.cache.tests.powerdns.com.'
+        cacheFile = os.path.join(self._configDir, 'packetcache.bin')
+        query = dns.message.make_query(name, 'A', 'IN')
+        response = dns.message.make_response(query)
+        rrset = dns.rrset.from_text(name,
+                                    ttl,
+                                    dns.rdataclass.IN,
+                                    dns.rdatatype.A,
+                                    '127.0.0.1')
+        response.answer.append(rrset)
+
+        # Miss
+        (receivedQuery, receivedResponse) = self.sendUDPQuery(query, response)
+        self.assertTrue(receivedQuery)
+        self.assertTrue(receivedResponse)
+        receivedQuery.id = query.id
+        self.assertEquals(query, receivedQuery)
+        self.assertEquals(response, receivedResponse)
+
+        self.assertEquals(self.sendConsoleCommand("getPool(\"\"):getCache():saveToFile(\"%s\")" % (cacheFile)), "Saved 1 entries\n")
+        self.sendConsoleCommand("getPool(\"\"):getCache():expunge(0)")
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"entries\"]").strip("\n")), 0)
+
+        self.assertEquals(self.sendConsoleCommand("getPool(\"\"):getCache():loadFromFile(\"%s\")" % (cacheFile)), "Loaded 1 entries\n")
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"entries\"]").strip("\n")), 1)
+
+        # the entry should now be served from the cache, with a decreased TTL
+        (_, receivedResponse) = self.sendUDPQuery(query, response=None, useQueue=False)
+        self.assertTrue(receivedResponse)
+        self.assertEquals(receivedResponse.answer, response.answer)
+        self.assertLessEqual(receivedResponse.answer[0].ttl, ttl)
+
+        total = 0
+        for key in self._responsesCounter:
+            total += self._responsesCounter[key]
+        self.assertEquals(total, 1)
+
+    def testCacheLoadInvalidFile(self):
+        """
+        Cache: Loading an invalid file reports an error and leaves the cache untouched
+        """
+        cacheFile = os.path.join(self._configDir, 'invalid-packetcache.bin')
+        with open(cacheFile, 'wb') as fp:
+            fp.write(b'not a packet cache')
+
+        entries = int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"entries\"]").strip("\n"))
+        output = self.sendConsoleCommand("getPool(\"\"):getCache():loadFromFile(\"%s\")" % (cacheFile))
+        self.assertTrue(output.startswith("Error loading the packet cache"))
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"entries\"]").strip("\n")), entries)
+
+class TestCachingLockFreeLookups(DNSDistTest):
+
+    _consoleKey = DNSDistTest.generateConsoleKey()
+    _consoleKeyB64 = base64.b64encode(_consoleKey).decode('ascii')
+    _config_params = ['_consoleKeyB64', '_consolePort', '_testServerPort']
+    _config_template = """
+    pc = newPacketCache(100, {maxTTL=86400, minTTL=1, numberOfShards=4, lockFreeLookups=true})
+    getPool(""):setCache(pc)
+    setKey("%s")
+    controlSocket("127.0.0.1:%d")
+    newServer{address="127.0.0.1:%d"}
+    """
+
+    def testCachedLockFree(self):
+        """
+        Cache: Served from a cache with lock-free lookups, then expunged
+        """
+        numberOfQueries = 10
+        name = 'lockfree.cache.tests.powerdns.com.'
+        query = dns.message.make_query(name, 'AAAA', 'IN')
+        response = dns.message.make_response(query)
+        rrset = dns.rrset.from_text(name,
+                                    3600,
+                                    dns.rdataclass.IN,
+                                    dns.rdatatype.AAAA,
+                                    '::1')
+        response.answer.append(rrset)
+
+        # first query to fill the cache
+        (receivedQuery, receivedResponse) = self.sendUDPQuery(query, response)
+        self.assertTrue(receivedQuery)
+        self.assertTrue(receivedResponse)
+        receivedQuery.id = query.id
+        self.assertEquals(query, receivedQuery)
+        self.assertEquals(receivedResponse, response)
+
+        for _ in range(numberOfQueries):
+            (_, receivedResponse) = self.sendUDPQuery(query, response=None, useQueue=False)
+            self.assertEquals(receivedResponse, response)
+
+        total = 0
+        for key in self._responsesCounter:
+            total += self._responsesCounter[key]
+            TestCachingLockFreeLookups._responsesCounter[key] = 0
+
+        self.assertEquals(total, 1)
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"hits\"]").strip("\n")), numberOfQueries)
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"deferredLookups\"]").strip("\n")), 0)
+
+        # remove the entry, the next query should go to the backend
+        self.sendConsoleCommand("getPool(\"\"):getCache():expungeByName(newDNSName(\"%s\"))" % (name))
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"entries\"]").strip("\n")), 0)
+
+        (receivedQuery, receivedResponse) = self.sendUDPQuery(query, response)
+        self.assertTrue(receivedQuery)
+        self.assertTrue(receivedResponse)
+        receivedQuery.id = query.id
+        self.assertEquals(query, receivedQuery)
+        self.assertEquals(receivedResponse, response)
+
+class TestCachingPrefetch(DNSDistTest):
+
+    _consoleKey = DNSDistTest.generateConsoleKey()
+    _consoleKeyB64 = base64.b64encode(_consoleKey).decode('ascii')
+    _config_params = ['_consoleKeyB64', '_consolePort', '_testServerPort']
+    _config_template = """
+    pc = newPacketCache(100, {maxTTL=86400, minTTL=1, prefetchTTLPercentage=50, prefetchMinHits=3})
+    getPool(""):setCache(pc)
+    setKey("%s")
+    controlSocket("127.0.0.1:%d")
+    newServer{address="127.0.0.1:%d"}
+    """
+
+    def testCachePrefetch(self):
+        """
+        Cache: Popular entries are refreshed before they expire
+        """
+        ttl = 4
+        name = 'prefetch.cache.tests.powerdns.com.'
+        query = dns.message.make_query(name, 'A', 'IN')
+        response = dns.message.make_response(query)
+        rrset = dns.rrset.from_text(name,
+                                    ttl,
+                                    dns.rdataclass.IN,
+                                    dns.rdatatype.A,
+                                    '192.0.2.1')
+        response.answer.append(rrset)
+        refreshed = dns.message.make_response(query)
+        rrset = dns.rrset.from_text(name,
+                                    ttl,
+                                    dns.rdataclass.IN,
+                                    dns.rdatatype.A,
+                                    '192.0.2.2')
+        refreshed.answer.append(rrset)
+
+        # first query to fill the cache
+        (receivedQuery, receivedResponse) = self.sendUDPQuery(query, response)
+        self.assertTrue(receivedQuery)
+        self.assertTrue(receivedResponse)
+        receivedQuery.id = query.id
+        self.assertEquals(query, receivedQuery)
+        self.assertEquals(receivedResponse, response)
+
+        # enough hits, but too early in the TTL
+        for _ in range(3):
+            (_, receivedResponse) = self.sendUDPQuery(query, response=None, useQueue=False)
+            self.assertEquals(receivedResponse, response)
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"prefetches\"]").strip("\n")), 0)
+
+        # in the last half of the TTL, the hit is still answered from the
+        # cache but the query is sent to the backend
+        time.sleep(ttl / 2 + 1)
+        self._toResponderQueue.put(refreshed, True, 2.0)
+        (_, receivedResponse) = self.sendUDPQuery(query, response=None, useQueue=False)
+        self.assertTrue(receivedResponse)
+        self.assertEquals(receivedResponse.answer[0][0].address, '192.0.2.1')
+        receivedQuery = self._fromResponderQueue.get(True, 2.0)
+        self.assertTrue(receivedQuery)
+        receivedQuery.id = query.id
+        self.assertEquals(query, receivedQuery)
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"prefetches\"]").strip("\n")), 1)
+
+        # the refreshed entry is served from now on, even past the initial TTL
+        time.sleep(ttl / 2)
+        (_, receivedResponse) = self.sendUDPQuery(query, response=None, useQueue=False)
+        self.assertTrue(receivedResponse)
+        self.assertEquals(receivedResponse.answer[0][0].address, '192.0.2.2')
+
+        total = 0
+        for key in self._responsesCounter:
+            total += self._responsesCounter[key]
+            TestCachingPrefetch._responsesCounter[key] = 0
+
+        self.assertEquals(total, 2)
+
+class TestCachingMemoryUsage(DNSDistTest):
+
+    _consoleKey = DNSDistTest.generateConsoleKey()
+    _consoleKeyB64 = base64.b64encode(_consoleKey).decode('ascii')
+    _config_params = ['_consoleKeyB64', '_consolePort', '_testServerPort']
+    _config_template = """
+    pc = newPacketCache(100, {maxTTL=86400, minTTL=1, numberOfShards=2})
+    getPool(""):setCache(pc)
+    setKey("%s")
+    controlSocket("127.0.0.1:%d")
+    newServer{address="127.0.0.1:%d"}
+    """
+
+    def testCacheMemoryUsage(self):
+        """
+        Cache: The memory usage of each shard is reported
+        """
+        numberOfEntries = 10
+        for idx in range(numberOfEntries):
+            name = str(idx) + '.memory.cache.tests.powerdns.com.'
+            query = dns.message.make_query(name, 'AAAA', 'IN')
+            response = dns.message.make_response(query)
+            rrset = dns.rrset.from_text(name,
+                                        3600,
+                                        dns.rdataclass.IN,
+                                        dns.rdatatype.AAAA,
+                                        '::1')
+            response.answer.append(rrset)
+            (receivedQuery, receivedResponse) = self.sendUDPQuery(query, response)
+            self.assertTrue(receivedQuery)
+            self.assertEquals(receivedResponse, response)
+
+        lines = self.sendConsoleCommand("getPool(\"\"):getCache():printMemoryUsage()").strip("\n").split("\n")
+        # header, one line per shard, then the total
+        self.assertEquals(len(lines), 4)
+        entries = 0
+        for line in lines[1:3]:
+            entries += int(line.split()[1])
+        total = lines[3].split()
+        self.assertEquals(total[0], 'Total')
+        self.assertEquals(int(total[1]), numberOfEntries)
+        self.assertEquals(entries, numberOfEntries)
+        # at least the responses themselves
+        self.assertGreater(int(total[2]), numberOfEntries * len(response.to_wire()))
+
+class TestCachingEvictionLRU(DNSDistTest):
+
+    _consoleKey = DNSDistTest.generateConsoleKey()
+    _consoleKeyB64 = base64.b64encode(_consoleKey).decode('ascii')
+    _config_params = ['_consoleKeyB64', '_consolePort', '_testServerPort']
+    _config_template = """
+    pc = newPacketCache(10, {maxTTL=86400, minTTL=1, numberOfShards=1, evictionPolicy="lru"})
+    getPool(""):setCache(pc)
+    setKey("%s")
+    controlSocket("127.0.0.1:%d")
+    newServer{address="127.0.0.1:%d"}
+    """
+
+    def testCacheEvictionLRU(self):
+        """
+        Cache: A full cache evicts entries to make room for new ones
+        """
+        numberOfEntries = 20
+        for idx in range(numberOfEntries):
+            name = str(idx) + '.eviction.cache.tests.powerdns.com.'
+            query = dns.message.make_query(name, 'AAAA', 'IN')
+            response = dns.message.make_response(query)
+            rrset = dns.rrset.from_text(name,
+                                        3600,
+                                        dns.rdataclass.IN,
+                                        dns.rdatatype.AAAA,
+                                        '::1')
+            response.answer.append(rrset)
+            (receivedQuery, receivedResponse) = self.sendUDPQuery(query, response)
+            self.assertTrue(receivedQuery)
+            self.assertEquals(receivedResponse, response)
+
+        # the last one should have been inserted, and is now served from the cache
+        (_, receivedResponse) = self.sendUDPQuery(query, response=None, useQueue=False)
+        self.assertEquals(receivedResponse, response)
+
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"entries\"]").strip("\n")), 10)
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"evictions\"]").strip("\n")), numberOfEntries - 10)
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"rejectedAdmissions\"]").strip("\n")), 0)
+
+class TestCachingSharedMemory(DNSDistTest):
+
+    _consoleKey = DNSDistTest.generateConsoleKey()
+    _consoleKeyB64 = base64.b64encode(_consoleKey).decode('ascii')
+    _sharedMemoryFile = '/tmp/test-dnsdist-shared-cache'
+    _config_params = ['_sharedMemoryFile', '_sharedMemoryFile', '_consoleKeyB64', '_consolePort', '_testServerPort']
+    _config_template = """
+    -- two caches using the same file, as two dnsdist processes would
+    pc = newPacketCache(100, {maxTTL=86400, minTTL=1, sharedMemoryFile="%s"})
+    other = newPacketCache(100, {maxTTL=86400, minTTL=1, sharedMemoryFile="%s"})
+    getPool(""):setCache(pc)
+    getPool("other"):setCache(other)
+    setKey("%s")
+    controlSocket("127.0.0.1:%d")
+    newServer{address="127.0.0.1:%d"}
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        if os.path.exists(cls._sharedMemoryFile):
+            os.unlink(cls._sharedMemoryFile)
+        super(TestCachingSharedMemory, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestCachingSharedMemory, cls).tearDownClass()
+        if os.path.exists(cls._sharedMemoryFile):
+            os.unlink(cls._sharedMemoryFile)
+
+    def testCacheSharedMemory(self):
+        """
+        Cache: Entries stored in shared memory are seen by every cache using the same file
+        """
+        name = 'shared.cache.tests.powerdns.com.'
+        query = dns.message.make_query(name, 'AAAA', 'IN')
+        response = dns.message.make_response(query)
+        rrset = dns.rrset.from_text(name,
+                                    3600,
+                                    dns.rdataclass.IN,
+                                    dns.rdatatype.AAAA,
+                                    '::1')
+        response.answer.append(rrset)
+
+        # Miss
+        (receivedQuery, receivedResponse) = self.sendUDPQuery(query, response)
+        self.assertTrue(receivedQuery)
+        receivedQuery.id = query.id
+        self.assertEquals(query, receivedQuery)
+        self.assertEquals(receivedResponse, response)
+
+        # Hit
+        (_, receivedResponse) = self.sendUDPQuery(query, response=None, useQueue=False)
+        self.assertEquals(receivedResponse, response)
+
+        # the entry is seen by the other cache, which has its own statistics
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"other\"):getCache():getStats()[\"entries\"]").strip("\n")), 1)
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"other\"):getCache():getStats()[\"hits\"]").strip("\n")), 0)
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"hits\"]").strip("\n")), 1)
+
+        # and can be removed from there
+        self.assertEquals(self.sendConsoleCommand("getPool(\"other\"):getCache():expungeByName(newDNSName(\"%s\"))" % (name)), "Expunged 1 records\n")
+        self.assertEquals(int(self.sendConsoleCommand("getPool(\"\"):getCache():getStats()[\"entries\"]").strip("\n")), 0)
+
+        # Miss again
+        (receivedQuery, receivedResponse) = self.sendUDPQuery(query, response)
+        self.assertTrue(receivedQuery)
+        self.assertEquals(receivedResponse, response)
+
 class TestCachingStaleExpungePrevented(DNSDistTest):
 
     _consoleKey = DNSDistTest.generateConsoleKey()
@@ -132,6 +132,8 @@ class DNSDistDOHTest(DNSDistTest):
         if 'SKIP_DOH_TESTS' in os.environ:
             raise unittest.SkipTest('DNS over HTTPS tests are disabled')
 
+        cls.allocatePorts()
+        cls._dohBaseURL = cls._dohBaseURLTemplate % (cls._serverName, cls._dohServerPort)
         cls.startResponders()
         cls.startDNSDist()
         cls.setUpSockets()
@@ -147,7 +149,7 @@ class TestDOH(DNSDistDOHTest):
     _dohServerPort = 8443
     _customResponseHeader1 = 'access-control-allow-origin: *'
     _customResponseHeader2 = 'user-agent: derp'
-    _dohBaseURL = ("https://%s:%d/" % (_serverName, _dohServerPort))
+    _dohBaseURLTemplate = "https://%s:%d/"
     _config_template = """
     newServer{address="127.0.0.1:%s"}
 
@@ -628,7 +630,7 @@ class TestDOHAddingECS(DNSDistDOHTest):
     _serverName = 'tls.tests.dnsdist.org'
     _caCert = 'ca.pem'
     _dohServerPort = 8443
-    _dohBaseURL = ("https://%s:%d/" % (_serverName, _dohServerPort))
+    _dohBaseURLTemplate = "https://%s:%d/"
     _config_template = """
     newServer{address="127.0.0.1:%s", useClientSubnet=true}
     addDOHLocal("127.0.0.1:%s", "%s", "%s", { "/" })
@@ -720,15 +722,18 @@ class TestDOHOverHTTP(DNSDistDOHTest):
 
     _dohServerPort = 8480
     _serverName = 'tls.tests.dnsdist.org'
-    _dohBaseURL = ("http://%s:%d/dns-query" % (_serverName, _dohServerPort))
+    _dohBaseURLTemplate = "http://%s:%d/dns-query"
     _config_template = """
     newServer{address="127.0.0.1:%s"}
     addDOHLocal("127.0.0.1:%s")
     """
     _config_params = ['_testServerPort', '_dohServerPort']
-    _checkConfigExpectedOutput = b"""No certificate provided for DoH endpoint 127.0.0.1:8480, running in DNS over HTTP mode instead of DNS over HTTPS
-Configuration 'configs/dnsdist_TestDOHOverHTTP.conf' OK!
-"""
+
+    @classmethod
+    def expectedCheckConfigOutput(cls, confFile):
+        return ("""No certificate provided for DoH endpoint 127.0.0.1:%d, running in DNS over HTTP mode instead of DNS over HTTPS
+Configuration '%s' OK!
+""" % (cls._dohServerPort, confFile)).encode()
 
     def testDOHSimple(self):
         """
@@ -788,7 +793,7 @@ class TestDOHWithCache(DNSDistDOHTest):
     _serverName = 'tls.tests.dnsdist.org'
     _caCert = 'ca.pem'
     _dohServerPort = 8443
-    _dohBaseURL = ("https://%s:%d/dns-query" % (_serverName, _dohServerPort))
+    _dohBaseURLTemplate = "https://%s:%d/dns-query"
     _config_template = """
     newServer{address="127.0.0.1:%s"}
 
@@ -855,7 +860,7 @@ class TestDOHWithoutCacheControl(DNSDistDOHTest):
     _serverName = 'tls.tests.dnsdist.org'
     _caCert = 'ca.pem'
     _dohServerPort = 8443
-    _dohBaseURL = ("https://%s:%d/" % (_serverName, _dohServerPort))
+    _dohBaseURLTemplate = "https://%s:%d/"
     _config_template = """
     newServer{address="127.0.0.1:%s"}
 
@@ -898,7 +903,7 @@ class TestDOHFFI(DNSDistDOHTest):
     _dohServerPort = 8443
     _customResponseHeader1 = 'access-control-allow-origin: *'
     _customResponseHeader2 = 'user-agent: derp'
-    _dohBaseURL = ("https://%s:%d/" % (_serverName, _dohServerPort))
+    _dohBaseURLTemplate = "https://%s:%d/"
     _config_template = """
     newServer{address="127.0.0.1:%s"}
 
@@ -957,7 +962,7 @@ class TestDOHForwardedFor(DNSDistDOHTest):
     _serverName = 'tls.tests.dnsdist.org'
     _caCert = 'ca.pem'
     _dohServerPort = 8443
-    _dohBaseURL = ("https://%s:%d/" % (_serverName, _dohServerPort))
+    _dohBaseURLTemplate = "https://%s:%d/"
     _config_template = """
     newServer{address="127.0.0.1:%s"}
 
@@ -1020,7 +1025,7 @@ class TestDOHForwardedForNoTrusted(DNSDistDOHTest):
     _serverName = 'tls.tests.dnsdist.org'
     _caCert = 'ca.pem'
     _dohServerPort = 8443
-    _dohBaseURL = ("https://%s:%d/" % (_serverName, _dohServerPort))
+    _dohBaseURLTemplate = "https://%s:%d/"
     _config_template = """
     newServer{address="127.0.0.1:%s"}
 
@@ -72,6 +72,7 @@ class TestLMDB(DNSDistTest):
     def setUpClass(cls):
 
         cls.setUpLMDB()
+        cls.allocatePorts()
         cls.startResponders()
         cls.startDNSDist()
         cls.setUpSockets()
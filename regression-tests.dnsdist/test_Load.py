@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+import os
+import unittest
+import dns
+from dnsdisttests import DNSDistTest
+from loaddriver import LoadDriver
+
+class DNSDistLoadTest(DNSDistTest):
+    """
+    Runs a fixed rate of queries against dnsdist and checks the drop rate
+    and latency. The rate and duration can be raised via the
+    DNSDIST_LOAD_QPS and DNSDIST_LOAD_DURATION environment variables, to
+    turn these functional checks into performance regression ones.
+    """
+
+    _loadQPS = int(os.environ.get('DNSDIST_LOAD_QPS', '200'))
+    _loadDuration = float(os.environ.get('DNSDIST_LOAD_DURATION', '2'))
+    _maxDropRate = 0.0
+    _maxP99Latency = 0.5
+
+    def primeCache(self, query):
+        response = dns.message.make_response(query)
+        rrset = dns.rrset.from_text(query.question[0].name,
+                                    3600,
+                                    dns.rdataclass.IN,
+                                    dns.rdatatype.A,
+                                    '192.0.2.1')
+        response.answer.append(rrset)
+
+        (receivedQuery, receivedResponse) = self.sendUDPQuery(query, response)
+        self.assertTrue(receivedQuery)
+        self.assertTrue(receivedResponse)
+        self.assertEquals(response, receivedResponse)
+
+    def runLoad(self, protocol, queries):
+        report = LoadDriver(self, protocol=protocol, qps=self._loadQPS, duration=self._loadDuration, queries=queries).run()
+        print(report)
+        self.assertEquals(report.sent, int(self._loadQPS * self._loadDuration))
+        self.assertLessEqual(report.dropRate, self._maxDropRate)
+        self.assertEquals(report.rcodes, {dns.rcode.NOERROR: report.received})
+        self.assertLess(report.percentile(99), self._maxP99Latency)
+        return report
+
+    def checkCachedLoad(self, protocol):
+        name = protocol + '.load.tests.powerdns.com.'
+        query = dns.message.make_query(name, 'A', 'IN')
+        self.primeCache(query)
+
+        for key in self._responsesCounter:
+            self._responsesCounter[key] = 0
+
+        self.runLoad(protocol, [query])
+
+        # every response should have been served from the cache
+        total = 0
+        for key in self._responsesCounter:
+            total += self._responsesCounter[key]
+        self.assertEquals(total, 0)
+
+class TestLoadCaching(DNSDistLoadTest):
+
+    _serverKey = 'server.key'
+    _serverCert = 'server.chain'
+    _serverName = 'tls.tests.dnsdist.org'
+    _caCert = 'ca.pem'
+    _tlsServerPort = 8453
+    _config_template = """
+    pc = newPacketCache(100, {maxTTL=86400, minTTL=1})
+    getPool(""):setCache(pc)
+    newServer{address="127.0.0.1:%s"}
+    addTLSLocal("127.0.0.1:%s", "%s", "%s")
+    """
+    _config_params = ['_testServerPort', '_tlsServerPort', '_serverCert', '_serverKey']
+
+    def testUDPLoad(self):
+        """
+        Load: UDP queries served from the cache
+        """
+        self.checkCachedLoad('udp')
+
+    def testTCPLoad(self):
+        """
+        Load: TCP queries served from the cache
+        """
+        self.checkCachedLoad('tcp')
+
+    def testDoTLoad(self):
+        """
+        Load: DoT queries served from the cache
+        """
+        self.checkCachedLoad('dot')
+
+@unittest.skipIf('SKIP_DOH_TESTS' in os.environ, 'DNS over HTTPS tests are disabled')
+class TestLoadCachingDOH(DNSDistLoadTest):
+
+    _serverKey = 'server.key'
+    _serverCert = 'server.chain'
+    _serverName = 'tls.tests.dnsdist.org'
+    _caCert = 'ca.pem'
+    _dohServerPort = 8443
+    _config_template = """
+    pc = newPacketCache(100, {maxTTL=86400, minTTL=1})
+    getPool(""):setCache(pc)
+    newServer{address="127.0.0.1:%s"}
+    addDOHLocal("127.0.0.1:%s", "%s", "%s")
+    """
+    _config_params = ['_testServerPort', '_dohServerPort', '_serverCert', '_serverKey']
+
+    @classmethod
+    def setUpClass(cls):
+        # for some reason, @unittest.skipIf() is not applied to derived classes with some versions of Python
+        if 'SKIP_DOH_TESTS' in os.environ:
+            raise unittest.SkipTest('DNS over HTTPS tests are disabled')
+        super(TestLoadCachingDOH, cls).setUpClass()
+
+    def testDoHLoad(self):
+        """
+        Load: DoH queries served from the cache
+        """
+        self.checkCachedLoad('doh')
@@ -45,6 +45,7 @@ class TestOCSPStaplingDOH(DNSDistOCSPStaplingTest):
         if 'SKIP_DOH_TESTS' in os.environ:
             raise unittest.SkipTest('DNS over HTTPS tests are disabled')
 
+        cls.allocatePorts()
         cls.startResponders()
         cls.startDNSDist()
         cls.setUpSockets()
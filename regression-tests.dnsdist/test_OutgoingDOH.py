@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+import os
+import requests
+import subprocess
+import time
+import dns
+import readiness
+from dnsdisttests import DNSDistTest
+
+class OutgoingDOHTest(object):
+    """
+    The DoH backend is a second dnsdist, with a DoH frontend, forwarding
+    the queries to the regular responders over Do53.
+    """
+
+    _serverKey = 'server.key'
+    _serverCert = 'server.chain'
+    _caCert = 'ca.pem'
+    _dohBackendPort = 10443
+    _dohBackendDNSPort = 10553
+    _dohBackend = None
+    _webTimeout = 2.0
+    _webServerPort = 8083
+    _webServerBasicAuthPassword = 'secret'
+    _webServerAPIKey = 'apisecret'
+    _backendConfigTemplate = """
+    setLocal("127.0.0.1:%d")
+    addDOHLocal("127.0.0.1:%d", "%s", "%s", { "/dns-query" })
+    newServer{address="127.0.0.1:%d"}
+    """
+
+    @classmethod
+    def getServerStat(cls, name):
+        headers = {'x-api-key': cls._webServerAPIKey}
+        url = 'http://127.0.0.1:' + str(cls._webServerPort) + '/api/v1/servers/localhost'
+        r = requests.get(url, headers=headers, timeout=cls._webTimeout)
+        r.raise_for_status()
+        return r.json()['servers'][0][name]
+
+    @classmethod
+    def startResponders(cls):
+        super(OutgoingDOHTest, cls).startResponders()
+        cls.startDOHBackend()
+
+    @classmethod
+    def startDOHBackend(cls):
+        print("Launching the DoH backend..")
+        confFile = os.path.join(cls._configDir, 'dnsdist-doh-backend.conf')
+        with open(confFile, 'w') as conf:
+            conf.write("-- Autogenerated by test_OutgoingDOH.py\n")
+            conf.write(cls._backendConfigTemplate % (cls._dohBackendDNSPort, cls._dohBackendPort, cls._serverCert, cls._serverKey, cls._testServerPort))
+
+        dohBackendCmd = [os.environ['DNSDISTBIN'], '--supervised', '-C', confFile, '--acl', '127.0.0.1/32']
+        logFile = os.path.join(cls._configDir, 'dnsdist-doh-backend.log')
+        with open(logFile, 'w') as fdLog:
+            cls._dohBackend = subprocess.Popen(dohBackendCmd, close_fds=True, stdout=fdLog, stderr=fdLog)
+
+        if not readiness.waitForTCPPorts('127.0.0.1', [cls._dohBackendPort], cls._dnsdistStartupDelay, cls._dohBackend):
+            raise AssertionError('The DoH backend did not start, see %s' % (logFile))
+
+    @classmethod
+    def tearDownClass(cls):
+        super(OutgoingDOHTest, cls).tearDownClass()
+        if cls._dohBackend:
+            cls._dohBackend.terminate()
+            if cls._dohBackend.poll() is None:
+                time.sleep(0.1)
+                if cls._dohBackend.poll() is None:
+                    cls._dohBackend.kill()
+                cls._dohBackend.wait()
+
+    def checkQuery(self, name, method):
+        query = dns.message.make_query(name, 'A', 'IN')
+        response = dns.message.make_response(query)
+        rrset = dns.rrset.from_text(name,
+                                    60,
+                                    dns.rdataclass.IN,
+                                    dns.rdatatype.A,
+                                    '192.0.2.1')
+        response.answer.append(rrset)
+
+        for _ in range(3):
+            sender = getattr(self, method)
+            (receivedQuery, receivedResponse) = sender(query, response)
+            self.assertTrue(receivedQuery)
+            self.assertTrue(receivedResponse)
+            receivedQuery.id = query.id
+            self.assertEquals(query, receivedQuery)
+            self.assertEquals(response, receivedResponse)
+
+class TestOutgoingDOH(OutgoingDOHTest, DNSDistTest):
+    """
+    These tests check that dnsdist can forward UDP and TCP queries to,
+    and check the health of, a backend over DNS over HTTPS, validating
+    its certificate.
+    """
+
+    _config_template = """
+    newServer{address="127.0.0.1:%s", tls="openssl", subjectName="powerdns.com", caStore="%s", dohPath="/dns-query"}
+    webserver("127.0.0.1:%s", "%s", "%s")
+    """
+    _config_params = ['_dohBackendPort', '_caCert', '_webServerPort', '_webServerBasicAuthPassword', '_webServerAPIKey']
+
+    def testUDPQuery(self):
+        """
+        Outgoing DoH: UDP query forwarded over DoH
+        """
+        queriesBefore = self.getServerStat('queries')
+        self.checkQuery('udp.outgoing-doh.tests.powerdns.com.', 'sendUDPQuery')
+        self.assertEquals(self.getServerStat('queries'), queriesBefore + 3)
+
+    def testTCPQuery(self):
+        """
+        Outgoing DoH: TCP query forwarded over DoH
+        """
+        queriesBefore = self.getServerStat('queries')
+        self.checkQuery('tcp.outgoing-doh.tests.powerdns.com.', 'sendTCPQuery')
+        self.assertEquals(self.getServerStat('queries'), queriesBefore + 3)
+
+    def testHealthAndMetrics(self):
+        """
+        Outgoing DoH: health-check state and DoH metrics of the backend
+        """
+        self.checkQuery('metrics.outgoing-doh.tests.powerdns.com.', 'sendUDPQuery')
+
+        self.assertEquals(self.getServerStat('state'), 'up')
+        # the connections are long-lived, and limited to 'dohMaxConnections'
+        self.assertGreaterEqual(self.getServerStat('dohCurrentConnections'), 1)
+        self.assertLessEqual(self.getServerStat('dohCurrentConnections'), 2)
+        self.assertGreater(self.getServerStat('dohLatency'), 0)
+        for name in ['dohConnectErrors', 'dohHTTPErrors', 'dohProtocolErrors', 'dohTimeouts']:
+            self.assertEquals(self.getServerStat(name), 0)
+
+class TestOutgoingDOHInvalidName(OutgoingDOHTest, DNSDistTest):
+    """
+    These tests check that dnsdist refuses to use a DoH backend presenting
+    a certificate that is not valid for the expected name.
+    """
+
+    _config_template = """
+    newServer{address="127.0.0.1:%s", tls="openssl", subjectName="not-powerdns.com", caStore="%s", dohPath="/dns-query"}
+    setServFailWhenNoServer(true)
+    webserver("127.0.0.1:%s", "%s", "%s")
+    """
+    _config_params = ['_dohBackendPort', '_caCert', '_webServerPort', '_webServerBasicAuthPassword', '_webServerAPIKey']
+
+    def testTCPQuery(self):
+        """
+        Outgoing DoH: the backend certificate does not match the expected name
+        """
+        name = 'invalid-name.outgoing-doh.tests.powerdns.com.'
+        query = dns.message.make_query(name, 'A', 'IN')
+        expectedResponse = dns.message.make_response(query)
+        expectedResponse.set_rcode(dns.rcode.SERVFAIL)
+
+        (_, receivedResponse) = self.sendTCPQuery(query, response=None, useQueue=False)
+        self.assertEquals(receivedResponse, expectedResponse)
+
+        self.assertEquals(self.getServerStat('state'), 'down')
+        self.assertGreater(self.getServerStat('dohConnectErrors'), 0)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+import requests
+import ssl
+import threading
+import dns
+from dnsdisttests import DNSDistTest
+from test_DOH import DNSDistDOHTest
+
+class OutgoingTLSTest(object):
+
+    _serverKey = 'server.key'
+    _serverCert = 'server.chain'
+    _caCert = 'ca.pem'
+    _tlsBackendPort = 10853
+    _webTimeout = 2.0
+    _webServerPort = 8083
+    _webServerBasicAuthPassword = 'secret'
+    _webServerAPIKey = 'apisecret'
+
+    @classmethod
+    def getServerStat(cls, name):
+        headers = {'x-api-key': cls._webServerAPIKey}
+        url = 'http://127.0.0.1:' + str(cls._webServerPort) + '/api/v1/servers/localhost'
+        r = requests.get(url, headers=headers, timeout=cls._webTimeout)
+        r.raise_for_status()
+        return r.json()['servers'][0][name]
+
+    @classmethod
+    def startResponders(cls):
+        print("Launching responders..")
+
+        tlsContext = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        tlsContext.load_cert_chain(cls._serverCert, cls._serverKey)
+
+        cls._TLSResponder = threading.Thread(name='TLS Responder', target=cls.TCPResponder, args=[cls._tlsBackendPort, cls._toResponderQueue, cls._fromResponderQueue, False, False, None, tlsContext])
+        cls._TLSResponder.setDaemon(True)
+        cls._TLSResponder.start()
+
+class TestOutgoingTLS(OutgoingTLSTest, DNSDistTest):
+    """
+    These tests check that dnsdist can forward queries to, and check the
+    health of, a backend over DNS over TLS, validating its certificate.
+    """
+
+    _config_template = """
+    newServer{address="127.0.0.1:%s", tls="openssl", subjectName="powerdns.com", caStore="%s"}
+    webserver("127.0.0.1:%s", "%s", "%s")
+    """
+    _config_params = ['_tlsBackendPort', '_caCert', '_webServerPort', '_webServerBasicAuthPassword', '_webServerAPIKey']
+
+    def testTCPQuery(self):
+        """
+        Outgoing TLS: TCP query forwarded over TLS
+        """
+        name = 'tcp.outgoing-tls.tests.powerdns.com.'
+        query = dns.message.make_query(name, 'A', 'IN')
+        response = dns.message.make_response(query)
+        rrset = dns.rrset.from_text(name,
+                                    60,
+                                    dns.rdataclass.IN,
+                                    dns.rdatatype.A,
+                                    '192.0.2.1')
+        response.answer.append(rrset)
+
+        resumptionsBefore = self.getServerStat('tlsResumptions')
+        # the responder closes the connection after every query, so all
+        # queries but the first one should resume the TLS session
+        for _ in range(3):
+            (receivedQuery, receivedResponse) = self.sendTCPQuery(query, response)
+            self.assertTrue(receivedQuery)
+            self.assertTrue(receivedResponse)
+            receivedQuery.id = query.id
+            self.assertEquals(query, receivedQuery)
+            self.assertEquals(response, receivedResponse)
+
+        self.assertGreater(self.getServerStat('tlsResumptions'), resumptionsBefore)
+
+    def testUDPQueryTruncated(self):
+        """
+        Outgoing TLS: UDP query routed to a TLS backend gets a truncated answer
+        """
+        name = 'udp.outgoing-tls.tests.powerdns.com.'
+        query = dns.message.make_query(name, 'A', 'IN')
+        # dnsdist sets RA = RD for TC responses
+        query.flags &= ~dns.flags.RD
+        expectedResponse = dns.message.make_response(query)
+        expectedResponse.flags |= dns.flags.TC
+
+        (_, receivedResponse) = self.sendUDPQuery(query, response=None, useQueue=False)
+        self.assertEquals(receivedResponse, expectedResponse)
+
+class TestOutgoingTLSFromDOH(OutgoingTLSTest, DNSDistDOHTest):
+    """
+    These tests check that queries received over DoH and routed to a TLS
+    backend get a ServFail answer, since a DoH client can't retry over TCP.
+    """
+
+    _serverName = 'tls.tests.dnsdist.org'
+    _dohServerPort = 8443
+    _dohBaseURLTemplate = "https://%s:%d/"
+    _config_template = """
+    newServer{address="127.0.0.1:%s", tls="openssl", subjectName="powerdns.com", caStore="%s"}
+    addDOHLocal("127.0.0.1:%s", "%s", "%s", { "/" })
+    """
+    _config_params = ['_tlsBackendPort', '_caCert', '_dohServerPort', '_serverCert', '_serverKey']
+
+    def testDOHQueryServFail(self):
+        """
+        Outgoing TLS: DoH query routed to a TLS backend gets a ServFail answer
+        """
+        name = 'doh.outgoing-tls.tests.powerdns.com.'
+        query = dns.message.make_query(name, 'A', 'IN')
+        query.id = 0
+        expectedResponse = dns.message.make_response(query)
+        expectedResponse.set_rcode(dns.rcode.SERVFAIL)
+
+        (_, receivedResponse) = self.sendDOHQuery(self._dohServerPort, self._serverName, self._dohBaseURL, caFile=self._caCert, query=query, response=None, useQueue=False)
+        self.assertEquals(receivedResponse, expectedResponse)
+
+class TestOutgoingTLSInvalidName(OutgoingTLSTest, DNSDistTest):
+    """
+    These tests check that dnsdist refuses to use a backend presenting
+    a certificate that is not valid for the expected name.
+    """
+
+    _config_template = """
+    newServer{address="127.0.0.1:%s", tls="openssl", subjectName="not-powerdns.com", caStore="%s"}
+    setServFailWhenNoServer(true)
+    """
+    _config_params = ['_tlsBackendPort', '_caCert']
+
+    def testTCPQuery(self):
+        """
+        Outgoing TLS: the backend certificate does not match the expected name
+        """
+        name = 'invalid-name.outgoing-tls.tests.powerdns.com.'
+        query = dns.message.make_query(name, 'A', 'IN')
+        expectedResponse = dns.message.make_response(query)
+        expectedResponse.set_rcode(dns.rcode.SERVFAIL)
+
+        (_, receivedResponse) = self.sendTCPQuery(query, response=None, useQueue=False)
+        self.assertEquals(receivedResponse, expectedResponse)
@@ -125,19 +125,28 @@ def ProxyProtocolTCPResponder(port, fromQueue, toQueue):
 
 toProxyQueue = Queue()
 fromProxyQueue = Queue()
-proxyResponderPort = 5470
-
-udpResponder = threading.Thread(name='UDP Proxy Protocol Responder', target=ProxyProtocolUDPResponder, args=[proxyResponderPort, toProxyQueue, fromProxyQueue])
-udpResponder.setDaemon(True)
-udpResponder.start()
-tcpResponder = threading.Thread(name='TCP Proxy Protocol Responder', target=ProxyProtocolTCPResponder, args=[proxyResponderPort, toProxyQueue, fromProxyQueue])
-tcpResponder.setDaemon(True)
-tcpResponder.start()
+# ports we already have responders listening on, since they are shared by all
+# the test classes using the same port and never stopped
+proxyResponderPorts = set()
 
 class ProxyProtocolTest(DNSDistTest):
-    _proxyResponderPort = proxyResponderPort
+    _proxyResponderPort = 5470
     _config_params = ['_proxyResponderPort']
 
+    @classmethod
+    def startResponders(cls):
+        if cls._proxyResponderPort in proxyResponderPorts:
+            return
+        proxyResponderPorts.add(cls._proxyResponderPort)
+        print("Launching responders..")
+
+        cls._UDPResponder = threading.Thread(name='UDP Proxy Protocol Responder', target=ProxyProtocolUDPResponder, args=[cls._proxyResponderPort, toProxyQueue, fromProxyQueue])
+        cls._UDPResponder.setDaemon(True)
+        cls._UDPResponder.start()
+        cls._TCPResponder = threading.Thread(name='TCP Proxy Protocol Responder', target=ProxyProtocolTCPResponder, args=[cls._proxyResponderPort, toProxyQueue, fromProxyQueue])
+        cls._TCPResponder.setDaemon(True)
+        cls._TCPResponder.start()
+
     def checkMessageProxyProtocol(self, receivedProxyPayload, source, destination, isTCP, values=[]):
       proxy = ProxyProtocol()
       self.assertTrue(proxy.parseHeader(receivedProxyPayload))
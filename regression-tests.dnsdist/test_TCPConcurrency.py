@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+import threading
+import time
+import dns
+from dnsdisttests import DNSDistTest
+
+class TestTCPConcurrency(DNSDistTest):
+    """
+    These tests use the asyncio responders to check that dnsdist
+    handles TCP queries from several clients concurrently, instead
+    of waiting for the answer to a slow query before processing the
+    next one.
+    """
+
+    _asyncResponders = True
+    _backendDelay = 1.0
+    _concurrentClients = 10
+    _config_template = """
+    newServer{address="127.0.0.1:%s"}
+    setMaxTCPClientThreads(%d)
+    """
+    _config_params = ['_testServerPort', '_concurrentClients']
+
+    @classmethod
+    def slowBackendResponse(cls, request):
+        response = dns.message.make_response(request)
+        rrset = dns.rrset.from_text(request.question[0].name,
+                                    60,
+                                    dns.rdataclass.IN,
+                                    dns.rdatatype.A,
+                                    '192.0.2.1')
+        response.answer.append(rrset)
+        return response.to_wire()
+
+    @classmethod
+    def startResponders(cls):
+        print("Launching responders..")
+        cls.startAsyncResponders(cls._testServerPort, delay=cls.backendDelay, callback=cls.slowBackendResponse)
+
+    @classmethod
+    def backendDelay(cls, request):
+        if str(request.question[0].name).startswith('slow'):
+            return cls._backendDelay
+        return 0
+
+    def testConcurrentSlowQueries(self):
+        """
+        TCP Concurrency: slow queries from several clients
+        """
+        responses = {}
+
+        def sendQuery(idx):
+            name = 'slow-%d.tcp-concurrency.tests.powerdns.com.' % (idx)
+            query = dns.message.make_query(name, 'A', 'IN')
+            conn = self.openTCPConnection(timeout=self._backendDelay * self._concurrentClients)
+            try:
+                self.sendTCPQueryOverConnection(conn, query)
+                responses[idx] = self.recvTCPResponseOverConnection(conn)
+            finally:
+                conn.close()
+
+        start = time.time()
+        threads = []
+        for idx in range(self._concurrentClients):
+            thread = threading.Thread(target=sendQuery, args=[idx])
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        self.assertEquals(len(responses), self._concurrentClients)
+        for idx, response in responses.items():
+            self.assertTrue(response)
+            self.assertEquals(str(response.question[0].name), 'slow-%d.tcp-concurrency.tests.powerdns.com.' % (idx))
+            self.assertEquals(len(response.answer), 1)
+
+        # processed one after the other, the queries would take
+        # _concurrentClients * _backendDelay seconds
+        self.assertLess(elapsed, self._backendDelay * self._concurrentClients / 2)
+
+    def testFastQueryNotDelayedBySlowOne(self):
+        """
+        TCP Concurrency: a fast query is not delayed by a slow one from another client
+        """
+        slowQuery = dns.message.make_query('slow.tcp-concurrency.tests.powerdns.com.', 'A', 'IN')
+        fastQuery = dns.message.make_query('fast.tcp-concurrency.tests.powerdns.com.', 'A', 'IN')
+
+        slowConn = self.openTCPConnection(timeout=self._backendDelay * 2)
+        fastConn = self.openTCPConnection(timeout=self._backendDelay * 2)
+        try:
+            self.sendTCPQueryOverConnection(slowConn, slowQuery)
+            start = time.time()
+            self.sendTCPQueryOverConnection(fastConn, fastQuery)
+            fastResponse = self.recvTCPResponseOverConnection(fastConn)
+            fastElapsed = time.time() - start
+            slowResponse = self.recvTCPResponseOverConnection(slowConn)
+        finally:
+            slowConn.close()
+            fastConn.close()
+
+        self.assertTrue(fastResponse)
+        self.assertTrue(slowResponse)
+        self.assertLess(fastElapsed, self._backendDelay)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+import time
+import dns
+from dnsdisttests import DNSDistTest
+
+class OutOfOrderTest(object):
+
+    _asyncResponders = True
+    _backendDelay = 1.0
+
+    @classmethod
+    def backendResponse(cls, request):
+        response = dns.message.make_response(request)
+        rrset = dns.rrset.from_text(request.question[0].name,
+                                    60,
+                                    dns.rdataclass.IN,
+                                    dns.rdatatype.A,
+                                    '192.0.2.1')
+        response.answer.append(rrset)
+        return response.to_wire()
+
+    @classmethod
+    def startResponders(cls):
+        print("Launching responders..")
+        cls.startAsyncResponders(cls._testServerPort, delay=cls.backendDelay, callback=cls.backendResponse)
+
+    @classmethod
+    def backendDelay(cls, request):
+        if str(request.question[0].name).startswith('slow'):
+            return cls._backendDelay
+        return 0
+
+    def sendPipelinedQueries(self, names):
+        conn = self.openTCPConnection(timeout=self._backendDelay * 3)
+        responses = []
+        try:
+            queries = {}
+            for name in names:
+                query = dns.message.make_query(name, 'A', 'IN')
+                queries[name] = query
+                self.sendTCPQueryOverConnection(conn, query)
+
+            for _ in names:
+                response = self.recvTCPResponseOverConnection(conn)
+                self.assertTrue(response)
+                name = str(response.question[0].name)
+                self.assertEquals(response.id, queries[name].id)
+                self.assertEquals(len(response.answer), 1)
+                responses.append(name)
+        finally:
+            conn.close()
+
+        return responses
+
+class TestTCPOutOfOrder(OutOfOrderTest, DNSDistTest):
+    """
+    These tests check that the queries pipelined by a client over a single
+    TCP connection are processed concurrently, and answered as soon as the
+    response is available, when maxInFlight is set.
+    """
+
+    _config_template = """
+    newServer{address="127.0.0.1:%s", maxInFlight=10}
+    addLocal("127.0.0.1:%s", {maxInFlight=10})
+    """
+    _config_params = ['_testServerPort', '_dnsDistPort']
+    _skipListeningOnCL = True
+
+    def testFastQueryAnsweredBeforeSlowOne(self):
+        """
+        TCP Out-of-order: a fast query is answered before a slow one sent before it
+        """
+        slowName = 'slow.tcp-ooo.tests.powerdns.com.'
+        fastName = 'fast.tcp-ooo.tests.powerdns.com.'
+
+        start = time.time()
+        responses = self.sendPipelinedQueries([slowName, fastName])
+        elapsed = time.time() - start
+
+        self.assertEquals(responses, [fastName, slowName])
+        self.assertLess(elapsed, self._backendDelay * 2)
+
+    def testSlowQueriesProcessedConcurrently(self):
+        """
+        TCP Out-of-order: pipelined slow queries are processed concurrently
+        """
+        names = ['slow-%d.tcp-ooo.tests.powerdns.com.' % (idx) for idx in range(5)]
+
+        start = time.time()
+        responses = self.sendPipelinedQueries(names)
+        elapsed = time.time() - start
+
+        self.assertEquals(sorted(responses), sorted(names))
+        # processed one after the other, the queries would take
+        # len(names) * _backendDelay seconds
+        self.assertLess(elapsed, self._backendDelay * 2)
+
+class TestTCPInOrder(OutOfOrderTest, DNSDistTest):
+    """
+    These tests check that the queries pipelined by a client over a single
+    TCP connection are still answered in order when maxInFlight is not set.
+    """
+
+    _config_template = """
+    newServer{address="127.0.0.1:%s"}
+    """
+
+    def testResponsesInOrder(self):
+        """
+        TCP Out-of-order: responses are sent in order by default
+        """
+        slowName = 'slow.tcp-in-order.tests.powerdns.com.'
+        fastName = 'fast.tcp-in-order.tests.powerdns.com.'
+
+        responses = self.sendPipelinedQueries([slowName, fastName])
+
+        self.assertEquals(responses, [slowName, fastName])
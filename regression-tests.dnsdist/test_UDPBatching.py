@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+import base64
+import dns
+from dnsdisttests import DNSDistTest
+
+class TestUDPBatching(DNSDistTest):
+    """
+    These tests check that queries and responses are still correctly
+    handled when they are sent in batch via sendmmsg().
+    """
+
+    _consoleKey = DNSDistTest.generateConsoleKey()
+    _consoleKeyB64 = base64.b64encode(_consoleKey).decode('ascii')
+    _config_params = ['_consoleKeyB64', '_consolePort', '_testServerPort']
+    _config_template = """
+    setKey("%s")
+    controlSocket("127.0.0.1:%s")
+    setUDPMultipleMessagesVectorSize(10)
+    newServer{address="127.0.0.1:%s"}
+    addAction(makeRule("self-answered.udp-batching.tests.powerdns.com."), SpoofAction("192.0.2.2"))
+    """
+
+    def getStats(self):
+        stats = self.sendConsoleCommand("dumpStats()").split()
+        stats_dict = {}
+
+        # Map to a dict with every other element being the value to the previous one
+        for i, x in enumerate(stats):
+            if not i % 2:
+                stats_dict[x] = stats[i+1]
+
+        return stats_dict
+
+    def testForwardedQueries(self):
+        """
+        UDP Batching: queries forwarded to the backend
+        """
+        name = 'forwarded.udp-batching.tests.powerdns.com.'
+        query = dns.message.make_query(name, 'A', 'IN')
+        response = dns.message.make_response(query)
+        rrset = dns.rrset.from_text(name,
+                                    60,
+                                    dns.rdataclass.IN,
+                                    dns.rdatatype.A,
+                                    '192.0.2.1')
+        response.answer.append(rrset)
+
+        for _ in range(10):
+            (receivedQuery, receivedResponse) = self.sendUDPQuery(query, response)
+            self.assertTrue(receivedQuery)
+            self.assertTrue(receivedResponse)
+            receivedQuery.id = query.id
+            self.assertEquals(query, receivedQuery)
+            self.assertEquals(response, receivedResponse)
+
+        stats = self.getStats()
+        # at least one batch for the queries, and one for the responses
+        self.assertGreaterEqual(int(stats['udp-out-batches']), 2)
+        self.assertGreaterEqual(int(stats['udp-out-batched-datagrams']), 20)
+
+    def testSelfAnsweredQueries(self):
+        """
+        UDP Batching: self-answered queries
+        """
+        name = 'self-answered.udp-batching.tests.powerdns.com.'
+        query = dns.message.make_query(name, 'A', 'IN')
+        # dnsdist set RA = RD for spoofed responses
+        query.flags &= ~dns.flags.RD
+        expectedResponse = dns.message.make_response(query)
+        rrset = dns.rrset.from_text(name,
+                                    60,
+                                    dns.rdataclass.IN,
+                                    dns.rdatatype.A,
+                                    '192.0.2.2')
+        expectedResponse.answer.append(rrset)
+
+        for _ in range(10):
+            (_, receivedResponse) = self.sendUDPQuery(query, response=None, useQueue=False)
+            self.assertTrue(receivedResponse)
+            self.assertEquals(expectedResponse, receivedResponse)
@@ -11,11 +11,13 @@ import time
 import unittest
 import dns
 import dns.message
+import readiness
 
 from eqdnsmessage import AssertEqualDNSMessageMixin
 
 class IXFRDistTest(AssertEqualDNSMessageMixin, unittest.TestCase):
 
+    # maximum time to wait for ixfrdist to accept connections
     _ixfrDistStartupDelay = 2.0
     _ixfrDistPort = 5342
 
@@ -57,12 +59,7 @@ failed-soa-retry: 3
             cls._ixfrdist = subprocess.Popen(ixfrdistcmd, close_fds=True,
                                              stdout=fdLog, stderr=fdLog)
 
-        if 'IXFRDIST_FAST_TESTS' in os.environ:
-            delay = 0.5
-        else:
-            delay = cls._ixfrDistStartupDelay
-
-        time.sleep(delay)
+        readiness.waitForTCPPorts('127.0.0.1', [cls._ixfrDistPort], cls._ixfrDistStartupDelay, cls._ixfrdist)
 
         if cls._ixfrdist.poll() is not None:
             cls._ixfrdist.kill()
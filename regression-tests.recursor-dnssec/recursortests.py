@@ -12,6 +12,7 @@ import time
 import unittest
 import dns
 import dns.message
+import readiness
 
 from eqdnsmessage import AssertEqualDNSMessageMixin
 
@@ -37,7 +38,9 @@ class RecursorTest(AssertEqualDNSMessageMixin, unittest.TestCase):
 
     _confdir = 'recursor'
 
+    # maximum time to wait for the recursor and each auth to be ready
     _recursorStartupDelay = 2.0
+    _authStartupDelay = 2.0
     _recursorPort = 5300
 
     _recursor = None
@@ -510,13 +513,23 @@ distributor-threads={threads}""".format(confdir=confdir,
     @classmethod
     def startAllAuth(cls, confdir):
         if cls._auth_zones:
+            # launch all of them first so they boot in parallel
             for auth_suffix, _ in cls._auth_zones.items():
                 authconfdir = os.path.join(confdir, 'auth-%s' % auth_suffix)
                 ipaddress = cls._PREFIX + '.' + auth_suffix
-                cls.startAuth(authconfdir, ipaddress)
+                cls.launchAuth(authconfdir, ipaddress)
+            for auth_suffix, _ in cls._auth_zones.items():
+                authconfdir = os.path.join(confdir, 'auth-%s' % auth_suffix)
+                ipaddress = cls._PREFIX + '.' + auth_suffix
+                cls.waitForAuth(authconfdir, ipaddress)
 
     @classmethod
     def startAuth(cls, confdir, ipaddress):
+        cls.launchAuth(confdir, ipaddress)
+        cls.waitForAuth(confdir, ipaddress)
+
+    @classmethod
+    def launchAuth(cls, confdir, ipaddress):
         print("Launching pdns_server..")
         authcmd = list(cls._auth_cmd)
         authcmd.append('--config-dir=%s' % confdir)
@@ -533,8 +546,11 @@ distributor-threads={threads}""".format(confdir=confdir,
                                                      stdout=fdLog, stderr=fdLog,
                                                      env=cls._auth_env)
 
-        time.sleep(2)
+    @classmethod
+    def waitForAuth(cls, confdir, ipaddress):
+        readiness.waitForDNS(ipaddress, 53, cls._authStartupDelay, cls._auths[ipaddress])
 
+        logFile = os.path.join(confdir, 'pdns.log')
         if cls._auths[ipaddress].poll() is not None:
             try:
                 cls._auths[ipaddress].kill()
@@ -596,12 +612,7 @@ distributor-threads={threads}""".format(confdir=confdir,
             cls._recursor = subprocess.Popen(recursorcmd, close_fds=True,
                                              stdout=fdLog, stderr=fdLog)
 
-        if 'PDNSRECURSOR_FAST_TESTS' in os.environ:
-            delay = 0.5
-        else:
-            delay = cls._recursorStartupDelay
-
-        time.sleep(delay)
+        readiness.waitForTCPPorts('127.0.0.1', [port], cls._recursorStartupDelay, cls._recursor)
 
         if cls._recursor.poll() is not None:
             try: